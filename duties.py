@@ -140,6 +140,15 @@ def test(ctx: Context, *cli_args: str) -> None:
     )
 
 
+@duty(capture=False)
+def benchmark(ctx: Context, *cli_args: str) -> None:
+    """Benchmark backup and restore throughput and compare it with the saved baseline."""
+    ctx.run(
+        [sys.executable, "scripts/benchmark.py", *cli_args],
+        title=pyprefix("Running benchmarks"),
+    )
+
+
 @duty()
 def dev_clean(ctx: Context) -> None:
     """Clean the development environment."""
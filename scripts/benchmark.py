@@ -0,0 +1,446 @@
+"""Benchmark backup and restore throughput on synthetic datasets and compare it with a baseline.
+
+Every dataset is generated from a seed, so every run and every machine archives the same files. Each backup and restore runs in a fresh process, so the peak resident memory of one measurement never includes another's. Run it with `duty benchmark`, and pass `--save` to record the results as the baseline later runs are compared with.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import random
+import resource
+import shutil
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from rich.table import Table
+
+from homelab_service_backup.modules import do_backup_filesystem, do_restore_filesystem
+from homelab_service_backup.utils import Config, RunStats, collect_stats, console, use_config
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+DATASET_VERSION = 1
+BASELINE_VERSION = 1
+DEFAULT_BASELINE = Path(".benchmarks/baseline.json")
+DEFAULT_DATA_DIR = Path(".cache/benchmarks")
+DATASETS = ("small", "huge", "media", "deep")
+CODECS = ("gzip:1", "gzip:6", "zstd:3", "zstd:10", "none")
+MIB = 1024 * 1024
+
+# Whether a higher value of a checked metric is better
+CHECKS = {"mb_per_second": True, "cpu_seconds": False, "peak_rss_mib": False}
+
+WORDS = [
+    "backup",
+    "restore",
+    "archive",
+    "service",
+    "container",
+    "volume",
+    "database",
+    "snapshot",
+    "schedule",
+    "retention",
+    "daily",
+    "weekly",
+    "monthly",
+    "config",
+    "error",
+    "warning",
+    "info",
+    "debug",
+    "request",
+    "response",
+    "user",
+    "session",
+    "token",
+    "GET",
+    "POST",
+    "/api/v1/items",
+    "200",
+    "404",
+    "500",
+    "2024-01-01T00:00:00Z",
+    "INFO",
+    "nginx",
+    "postgres",
+    "redis",
+]
+
+
+def _text(rng: random.Random, size: int) -> bytes:
+    """Generate compressible text that resembles logs and configuration files.
+
+    Returns:
+        bytes: `size` bytes of words and numbers.
+    """
+    parts: list[str] = []
+    length = 0
+    while length < size:
+        line = " ".join(rng.choices(WORDS, k=rng.randint(4, 14))) + f" {rng.randint(0, 99999)}\n"
+        parts.append(line)
+        length += len(line)
+    return "".join(parts).encode()[:size]
+
+
+def _write_small(root: Path, rng: random.Random, scale: float) -> None:
+    """Write many small text files spread over a flat tree of directories."""
+    for index in range(max(1, int(20_000 * scale))):
+        directory = root / f"dir-{index // 100:04d}"
+        directory.mkdir(exist_ok=True)
+        (directory / f"file-{index:06d}.txt").write_bytes(_text(rng, rng.randint(64, 8192)))
+
+
+def _write_huge(root: Path, rng: random.Random, scale: float) -> None:
+    """Write a few large files of mostly compressible data, built from blocks of text and noise."""
+    blocks = [_text(rng, MIB - 4096) for _ in range(8)]
+    for index in range(2):
+        with (root / f"huge-{index}.bin").open("wb") as f:
+            for _ in range(max(1, int(128 * scale))):
+                f.write(rng.choice(blocks))
+                f.write(rng.randbytes(4096))
+
+
+def _write_media(root: Path, rng: random.Random, scale: float) -> None:
+    """Write incompressible files, like already compressed photos and videos."""
+    for index in range(max(1, int(50 * scale))):
+        (root / f"media-{index:04d}.jpg").write_bytes(rng.randbytes(2 * MIB))
+
+
+def _write_deep(root: Path, rng: random.Random, scale: float) -> None:
+    """Write a deeply nested tree with a few small files at every level."""
+    for tree in range(max(1, int(20 * scale))):
+        directory = root / f"tree-{tree:03d}"
+        for level in range(100):
+            directory /= f"d{level:02d}"
+            directory.mkdir(parents=True)
+            for index in range(5):
+                (directory / f"f{index}.txt").write_bytes(_text(rng, rng.randint(16, 2048)))
+
+
+WRITERS: dict[str, Callable[[Path, random.Random, float], None]] = {
+    "small": _write_small,
+    "huge": _write_huge,
+    "media": _write_media,
+    "deep": _write_deep,
+}
+
+
+def generate_dataset(data_dir: Path, name: str, scale: float, seed: int) -> Path:
+    """Generate a dataset, or reuse it if it was generated before with the same settings.
+
+    Args:
+        data_dir (Path): The directory datasets are kept in.
+        name (str): The dataset, one of `DATASETS`.
+        scale (float): The factor to multiply the number and size of the files by.
+        seed (int): The seed of the generated content.
+
+    Returns:
+        Path: The dataset's directory.
+    """
+    root = data_dir / f"{name}-v{DATASET_VERSION}-scale{scale:g}-seed{seed}"
+    marker = root.with_name(f"{root.name}.complete")
+    if marker.exists():
+        return root
+
+    shutil.rmtree(root, ignore_errors=True)
+    root.mkdir(parents=True)
+    console.print(f"Generate dataset: {root}")
+    WRITERS[name](root, random.Random(f"{name}-{seed}"), scale)
+    marker.touch()
+    return root
+
+
+def _peak_rss_mib() -> float:
+    """Return the peak resident memory of this process.
+
+    Returns:
+        float: The peak in MiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / MIB if sys.platform == "darwin" else peak / 1024
+
+
+def _measure(action: str, settings: dict[str, Any]) -> dict[str, float]:
+    """Run one backup or restore in this process and measure it.
+
+    Returns:
+        dict[str, float]: The run's duration, throughput, CPU time and the process's peak resident memory.
+    """
+    from loguru import logger  # noqa: PLC0415
+
+    logger.remove()
+    config = Config.model_validate({**settings, "action": action})
+    task = do_backup_filesystem if action == "backup" else do_restore_filesystem
+    stats = RunStats()
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    with use_config(config), collect_stats(stats):
+        task(config)
+    seconds = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    return {
+        "seconds": seconds,
+        "files_per_second": stats.files / seconds,
+        "mb_per_second": stats.read_bytes / seconds / 1e6,
+        "cpu_seconds": after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime,
+        "peak_rss_mib": _peak_rss_mib(),
+    }
+
+
+def _in_process(action: str, settings: dict[str, Any]) -> dict[str, float]:
+    """Measure a backup or restore in a fresh process.
+
+    Returns:
+        dict[str, float]: The measurements.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        return pool.submit(_measure, action, settings).result()
+
+
+def run_case(dataset: Path, codec: str, work_dir: Path, repeat: int) -> dict[str, dict[str, float]]:
+    """Back up a dataset and restore it several times, keeping the median of every measurement.
+
+    Args:
+        dataset (Path): The dataset to back up.
+        codec (str): The codec and level, such as `gzip:6`, or `none`.
+        work_dir (Path): A directory for the backups and restored files, emptied before every run.
+        repeat (int): How many times to back up and restore.
+
+    Returns:
+        dict[str, dict[str, float]]: The median measurements of the backups and of the restores.
+    """
+    name, _, level = codec.partition(":")
+    runs: dict[str, list[dict[str, float]]] = {"backup": [], "restore": []}
+    for _ in range(repeat):
+        shutil.rmtree(work_dir, ignore_errors=True)
+        (work_dir / "storage").mkdir(parents=True)
+        (work_dir / "restored").mkdir()
+        settings = {
+            "job_name": "benchmark",
+            "backup_storage_dir": work_dir / "storage",
+            "job_data_dir": dataset,
+            "compression": name,
+            "compression_level": int(level) if level else None,
+            "log_to_file": False,
+        }
+        runs["backup"].append(_in_process("backup", settings))
+        settings["job_data_dir"] = work_dir / "restored"
+        runs["restore"].append(_in_process("restore", settings))
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        action: {
+            metric: statistics.median(run[metric] for run in measured) for metric in measured[0]
+        }
+        for action, measured in runs.items()
+    }
+
+
+def compare(
+    baseline: dict[str, dict[str, float]], results: dict[str, dict[str, float]], threshold: float
+) -> list[str]:
+    """Find the measurements that got worse than the baseline by more than the threshold.
+
+    Args:
+        baseline (dict[str, dict[str, float]]): The baseline measurements by case.
+        results (dict[str, dict[str, float]]): The new measurements by case.
+        threshold (float): The fraction a measurement may get worse by.
+
+    Returns:
+        list[str]: A description of every regression.
+    """
+    regressions = []
+    for case, measured in results.items():
+        if case not in baseline:
+            continue
+        for metric, higher_is_better in CHECKS.items():
+            before, after = baseline[case][metric], measured[metric]
+            change = (after - before) / before if before else 0.0
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append(f"{case}: {metric} {before:.2f} -> {after:.2f} ({change:+.0%})")
+    return regressions
+
+
+def _print_results(
+    results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]]
+) -> None:
+    """Print the measurements of every case, with the change in throughput against the baseline."""
+    table = Table("Case", "Files/s", "MB/s", "vs baseline", "CPU s", "Peak RSS MiB")
+    for case, measured in results.items():
+        change = ""
+        if case in baseline and baseline[case]["mb_per_second"]:
+            change = f"{measured['mb_per_second'] / baseline[case]['mb_per_second'] - 1:+.1%}"
+        table.add_row(
+            case,
+            f"{measured['files_per_second']:,.0f}",
+            f"{measured['mb_per_second']:,.1f}",
+            change,
+            f"{measured['cpu_seconds']:.2f}",
+            f"{measured['peak_rss_mib']:.0f}",
+        )
+    console.print(table)
+
+
+def _split(value: str) -> list[str]:
+    """Split a comma-separated command line option.
+
+    Returns:
+        list[str]: The items.
+    """
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def _parse_args(argv: list[str]) -> argparse.Namespace:
+    """Parse the command line.
+
+    Returns:
+        argparse.Namespace: The options.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--datasets",
+        type=_split,
+        default=list(DATASETS),
+        help="comma-separated datasets to run, of: %(default)s",
+    )
+    parser.add_argument(
+        "--codecs",
+        type=_split,
+        default=list(CODECS),
+        help="comma-separated codecs and levels to run, default: %(default)s",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="multiply the number and size of files by this, default: %(default)s",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the generated datasets, default: %(default)s"
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="runs of every case to take the median of, default: %(default)s",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="fail when throughput drops, or CPU time or peak memory grows, by more than this fraction, default: %(default)s",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=DEFAULT_BASELINE,
+        help="baseline file, default: %(default)s",
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        default=DEFAULT_DATA_DIR,
+        help="directory to keep the datasets in, default: %(default)s",
+    )
+    parser.add_argument(
+        "--save",
+        action="store_true",
+        help="save the results as the new baseline instead of comparing",
+    )
+    return parser.parse_args(argv)  # fmt: skip
+
+
+def _save_baseline(
+    args: argparse.Namespace,
+    baseline: dict[str, dict[str, float]],
+    results: dict[str, dict[str, float]],
+) -> None:
+    """Save the results as the new baseline, keeping the baseline of cases that did not run."""
+    args.baseline.parent.mkdir(parents=True, exist_ok=True)
+    args.baseline.write_text(
+        json.dumps(
+            {
+                "version": BASELINE_VERSION,
+                "scale": args.scale,
+                "seed": args.seed,
+                "machine": {
+                    "platform": platform.platform(),
+                    "python": platform.python_version(),
+                    "processor": platform.processor(),
+                },
+                "results": {**baseline, **results},
+            },
+            indent=2,
+        ),
+        encoding="utf-8",
+    )
+    console.print(f"Saved baseline: {args.baseline}")
+
+
+def main(argv: list[str]) -> int:
+    """Run the benchmarks, and compare them with the baseline or save them as the new one.
+
+    Args:
+        argv (list[str]): The command line arguments.
+
+    Returns:
+        int: The exit status, 1 if any measurement regressed.
+    """
+    args = _parse_args(argv)
+    if unknown := set(args.datasets) - set(DATASETS):
+        console.print(f"[red]Unknown datasets: {', '.join(sorted(unknown))}[/red]")
+        return 2
+
+    saved: dict[str, Any] = {}
+    if args.baseline.exists():
+        saved = json.loads(args.baseline.read_text(encoding="utf-8"))
+        if not args.save and (saved["scale"], saved["seed"]) != (args.scale, args.seed):
+            console.print(
+                f"[red]The baseline was recorded with --scale {saved['scale']:g} --seed {saved['seed']}, run with the same options or --save a new baseline[/red]"
+            )
+            return 2
+    baseline: dict[str, dict[str, float]] = saved.get("results", {})
+
+    results: dict[str, dict[str, float]] = {}
+    for name in args.datasets:
+        dataset = generate_dataset(args.data_dir, name, args.scale, args.seed)
+        for codec in args.codecs:
+            console.print(f"Benchmark: {name} with {codec}")
+            measured = run_case(dataset, codec, args.data_dir / "work", args.repeat)
+            results.update(
+                {f"{name}/{codec}/{action}": value for action, value in measured.items()}
+            )
+
+    _print_results(results, baseline)
+
+    if args.save:
+        _save_baseline(args, baseline, results)
+        return 0
+
+    if not baseline:
+        console.print(f"No baseline at {args.baseline}, save one with --save")
+        return 0
+
+    if regressions := compare(baseline, results, args.threshold):
+        console.print(f"[red]Regressed by more than {args.threshold:.0%}:[/red]")
+        for regression in regressions:
+            console.print(f"  {regression}")
+        return 1
+
+    console.print(f"No regression of more than {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,13 +1,12 @@
 """service-backup CLI."""
 
 import datetime
-import time
+from pathlib import Path
+from typing import Annotated
 
-import inflect
 import typer
 from confz import validate_all_configs
 from loguru import logger
-from nclutils import print_debug
 from pydantic import ValidationError
 
 from homelab_service_backup.modules import (
@@ -15,9 +14,23 @@ from homelab_service_backup.modules import (
     do_backup_postgres,
     do_restore_filesystem,
     do_restore_postgres,
+    do_verify,
+    run_jobs,
     setup_schedule,
 )
-from homelab_service_backup.utils import Config, console, instantiate_logger
+from homelab_service_backup.utils import (
+    Config,
+    JobsFileError,
+    PressureMonitor,
+    console,
+    get_catalog,
+    instantiate_logger,
+    io_limits,
+    load_jobs_file,
+    lower_priority,
+    pluralize,
+    watch_pressure,
+)
 
 app = typer.Typer(
     add_completion=False,
@@ -26,12 +39,13 @@ app = typer.Typer(
     context_settings={"help_option_names": ["-h", "--help"]},
 )
 typer.rich_utils.STYLE_HELPTEXT = ""
-p = inflect.engine()
 
 
 def log_config_trace(config: Config) -> None:
     """Log configuration at TRACE level if enabled."""
-    if config.log_level in {"TRACE", "DEBUG"}:
+    if config.log_level in {"TRACE", "DEBUG"} and config.output != "stdout":
+        from nclutils import print_debug  # noqa: PLC0415
+
         print_debug(
             custom=[
                 {"Config": config.model_dump()},
@@ -41,9 +55,125 @@ def log_config_trace(config: Config) -> None:
         )
 
 
+def validate_output(config: Config) -> None:
+    """Check that the streaming output settings can be used together.
+
+    Raises:
+        typer.Exit: If the output settings are incomplete or conflict with the backup mode.
+    """
+    if config.output == "command" and not config.output_command:
+        logger.error("HSB_OUTPUT_COMMAND is required when HSB_OUTPUT is 'command'")
+        raise typer.Exit(code=1)
+
+    if config.output != "file" and config.backup_mode == "repository" and not config.use_postgres:
+        logger.error("Repository backups can not be streamed, set HSB_OUTPUT to 'file'")
+        raise typer.Exit(code=1)
+
+    if (
+        config.output != "file"
+        and config.use_postgres
+        and config.postgres_format == "directory"
+        and not config.postgres_pack
+    ):
+        logger.error(
+            "Unpacked directory dumps can not be streamed, set HSB_POSTGRES_PACK to 'true'"
+        )
+        raise typer.Exit(code=1)
+
+
+def run_action(config: Config, paths: list[str] | None = None) -> None:
+    """Run the configured backup, restore or verification once.
+
+    The process exits after the run, so its priority is lowered on the main thread.
+
+    Args:
+        config (Config): The application configuration.
+        paths (list[str] | None, optional): Restore only these paths from a filesystem backup. Defaults to None.
+
+    Raises:
+        typer.Exit: If the machine stayed under pressure until the pressure deadline, or a verified backup is damaged.
+    """
+    monitor = PressureMonitor.from_config(config)
+    if monitor is not None and not monitor.defer():
+        raise typer.Exit(code=1)
+
+    lower_priority(config)
+
+    with io_limits(config), watch_pressure(monitor):
+        if config.action == "backup":
+            if config.use_postgres:
+                logger.info("Backing up PostgreSQL database")
+                do_backup_postgres(config)
+            else:
+                logger.info("Backing up filesystem")
+                do_backup_filesystem(config)
+
+        if config.action == "restore":
+            if config.use_postgres:
+                logger.info("Restoring PostgreSQL database")
+                do_restore_postgres(config)
+            else:
+                logger.info("Restoring filesystem")
+                do_restore_filesystem(config, paths=paths)
+
+        if config.action == "verify":
+            logger.info("Verifying backups")
+            if not do_verify(config):
+                raise typer.Exit(code=1)
+
+
+def run_jobs_file(jobs_file: Path) -> None:
+    """Run every job in a multi-job configuration file.
+
+    Args:
+        jobs_file (Path): The TOML file defining the jobs.
+
+    Raises:
+        typer.Exit: If the file is invalid or a job that runs once fails.
+    """
+    try:
+        jobs = load_jobs_file(jobs_file)
+    except JobsFileError as e:
+        logger.error(str(e))
+        raise typer.Exit(code=1) from e
+
+    instantiate_logger(jobs.logging_config)
+    for config in jobs.jobs:
+        validate_output(config)
+
+    logger.info(f"Loaded {len(jobs.jobs)} {pluralize('job', len(jobs.jobs))} from {jobs_file}")
+    if not run_jobs(jobs):
+        raise typer.Exit(code=1)
+
+
 @app.command()
-def main() -> None:
+def main(
+    path: Annotated[
+        list[str] | None,
+        typer.Option(
+            "--path",
+            help="Restore only this file or directory, relative to the job data directory. Can be repeated.",
+            show_default=False,
+        ),
+    ] = None,
+    jobs_file: Annotated[
+        Path | None,
+        typer.Option(
+            "--jobs",
+            envvar="HSB_JOBS_FILE",
+            help="Run every job defined in this TOML file instead of the single job configured by HSB_ environment variables.",
+            show_default=False,
+        ),
+    ] = None,
+) -> None:
     """Add application documentation here."""
+    if jobs_file:
+        if path:
+            logger.error("--path can not be used with --jobs")
+            raise typer.Exit(code=1)
+        run_jobs_file(jobs_file)
+        return
+
     instantiate_logger()
 
     # Load and validate configuration
@@ -58,27 +188,22 @@ def main() -> None:
     config = Config()
 
     log_config_trace(config)
+    validate_output(config)
+
+    if path and (config.action != "restore" or config.use_postgres or config.schedule):
+        logger.error("--path can only be used to restore a filesystem backup")
+        raise typer.Exit(code=1)
+
+    if config.action == "rebuild-catalog":
+        count = get_catalog(config).rebuild()
+        logger.info(f"Rebuilt catalog with {count} backups in {config.backup_storage_dir}")
+        return
 
     if config.schedule:
-        setup_schedule()
-        while True:  # Run the scheduler in a loop
-            time.sleep(1)
-
-    if not config.schedule and config.action == "backup":
-        if config.use_postgres:
-            logger.info("Backing up PostgreSQL database")
-            do_backup_postgres()
-        else:
-            logger.info("Backing up filesystem")
-            do_backup_filesystem()
-
-    if not config.schedule and config.action == "restore":
-        if config.use_postgres:
-            logger.info("Restoring PostgreSQL database")
-            do_restore_postgres()
-        else:
-            logger.info("Restoring filesystem")
-            do_restore_filesystem()
+        setup_schedule(config)  # Blocks until the process is stopped
+        return
+
+    run_action(config, paths=path)
 
 
 if __name__ == "__main__":
@@ -6,8 +6,13 @@ import typer
 
 APP_DIR = Path(typer.get_app_dir("service-backup"))
 VERSION = "0.0.0"
-FILESYSTEM_BACKUP_EXT = "tgz"
-POSTGRES_BACKUP_EXT = "sql.gz"
-ALWAYS_ECLUDE_FILENAMES = (".DS_Store", "@eaDir", ".Trashes", "__pycache__")
+FILESYSTEM_BACKUP_EXTENSIONS = {"gzip": "tgz", "zstd": "tar.zst", "none": "tar"}
+POSTGRES_BACKUP_EXTENSIONS = {"gzip": "sql.gz", "zstd": "sql.zst", "none": "sql"}
+REPOSITORY_SNAPSHOT_EXT = "snapshot.json.gz"
+POSTGRES_DIRECTORY_EXTENSIONS = {"tar": "dump.tar", "directory": "dump"}
+FILESYSTEM_BACKUP_EXT = FILESYSTEM_BACKUP_EXTENSIONS["gzip"]
+POSTGRES_BACKUP_EXT = POSTGRES_BACKUP_EXTENSIONS["gzip"]
+ALWAYS_ECLUDE_FILENAMES = frozenset((".DS_Store", "@eaDir", ".Trashes", "__pycache__"))
+FULL_BACKUP_TYPES = ("yearly", "monthly", "weekly")
 PROJECT_ROOT_PATH = Path(__file__).parents[2].absolute()
 DEV_DIR = PROJECT_ROOT_PATH / ".development"
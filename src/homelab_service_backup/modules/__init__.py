@@ -2,12 +2,15 @@
 
 from .backup import do_backup_filesystem, do_backup_postgres
 from .restore import do_restore_filesystem, do_restore_postgres
-from .scheduler import setup_schedule
+from .scheduler import run_jobs, setup_schedule
+from .verify import do_verify
 
 __all__ = [
     "do_backup_filesystem",
     "do_backup_postgres",
     "do_restore_filesystem",
     "do_restore_postgres",
+    "do_verify",
+    "run_jobs",
     "setup_schedule",
 ]
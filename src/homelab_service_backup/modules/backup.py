@@ -1,95 +1,490 @@
 """Backup service data."""
 
-import os
+import shutil
+import stat
 import tarfile
+from collections.abc import Iterator
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
+from typing import BinaryIO, cast
 
-import inflect
 import typer
 from loguru import logger
-from sh import ErrorReturnCode, pg_dump
 
-from homelab_service_backup.constants import ALWAYS_ECLUDE_FILENAMES
+from homelab_service_backup.constants import FULL_BACKUP_TYPES
 from homelab_service_backup.utils import (
+    BackupFilter,
+    ChunkStore,
+    CompressedWriter,
     Config,
+    DigestWriter,
+    FileDigest,
+    FileState,
+    IndexEntry,
+    IndexWriter,
+    LeaseTimeoutError,
+    Manifest,
+    Snapshot,
+    StorageLease,
+    TarWriter,
+    WalkEntry,
+    add_to_tar,
     clean_directory,
     clean_old_backups,
-    filter_file_for_backup,
+    count_run,
+    count_span,
+    create_snapshot,
+    find_most_recent_backup,
     get_backup_file_extension,
+    get_catalog,
+    get_chunk_store_path,
     get_current_time,
     get_job_name,
+    get_postgres_connection_args,
+    get_postgres_env,
+    is_snapshot,
+    is_streaming,
+    new_file_hash,
+    open_backup_output,
+    open_compressed_writer,
+    pluralize,
+    profiled,
+    read_manifest,
+    span,
+    timed_iter,
+    traced,
     type_of_backup,
+    wait_for_command,
+    walk_directory,
 )
+from homelab_service_backup.utils.archive_index import INDEX_BLOCK_SIZE
+from homelab_service_backup.utils.compression import GZIP_BLOCK_SIZE, resolve_worker_count
 
-p = inflect.engine()
 
+@contextmanager
+def _storage_lease(config: Config) -> Iterator[None]:
+    """Hold one of the backup storage directory's leases while a backup is written to it.
 
-def do_backup_postgres() -> Path | None:
-    """Create a compressed backup of a PostgreSQL database using pg_dump.
-
-    Dump the configured PostgreSQL database to a timestamped file in the backup directory. Clean up old backups based on retention policy. Optionally delete the source data directory after successful backup.
+    Leases limit the backups writing to a storage directory shared by several nodes. They are off unless `storage_lease_slots` is set, and streamed backups never take one since they do not write to the storage directory.
 
-    Returns:
-        Path | None: Path to the created backup file, or None if backup fails.
+    Args:
+        config (Config): The validated configuration for this run.
 
     Raises:
-        typer.Exit: If pg_dump fails to create the backup
+        typer.Exit: If no lease became free within `storage_lease_timeout` seconds
     """
-    logger.debug("Begin backup PostgreSQL database")
+    if not config.storage_lease_slots or is_streaming(config):
+        yield
+        return
+
+    lease = StorageLease(
+        config.backup_storage_dir,
+        config.storage_lease_slots,
+        ttl=config.storage_lease_ttl,
+        job=get_job_name(config),
+    )
+    try:
+        with span("lease"):
+            lease.acquire(timeout=config.storage_lease_timeout or None)
+    except LeaseTimeoutError as e:
+        logger.error(str(e))
+        raise typer.Exit(code=1) from e
+
+    try:
+        yield
+    finally:
+        lease.release()
 
-    backup_dir = Config().backup_storage_dir
-    backup_type = type_of_backup()
-    job_name = get_job_name()
-    timestamp = get_current_time().format("YYYYMMDDTHHmmss")
-    backup_filename = f"{job_name}-{timestamp}-{backup_type}.{get_backup_file_extension()}"
-    backup_file = backup_dir / backup_filename
-    logger.trace(f"{backup_file=!s}")
 
-    # Set password in PGPASSWORD environment variable
-    os.environ["PGPASSWORD"] = Config().postgres_password
+def _dump_postgres_plain(config: Config, backup_file: Path) -> None:
+    """Dump the database as plain SQL, compressed with the configured codec.
+
+    Args:
+        config (Config): The validated configuration for this run.
+        backup_file (Path): The backup file to create.
+
+    Raises:
+        typer.Exit: If pg_dump fails or the output stream fails
+    """
+    from sh import ErrorReturnCode, pg_dump  # noqa: PLC0415
 
+    # pg_dump writes plain SQL to stdout so compression can run on every core instead of pg_dump's single-threaded -Z
     try:
-        pg_dump(
-            "-h",
-            Config().postgres_host,
-            "-p",
-            Config().postgres_port,
-            "-U",
-            Config().postgres_user,
-            "-d",
-            Config().postgres_db,
-            "--clean",
-            "--if-exists",
-            "-Z",
-            "9",
-            _out=backup_file,
-        )
+        with (
+            span("pg_dump"),
+            open_backup_output(config, backup_file) as fh,
+            open_compressed_writer(
+                fh,
+                codec=config.compression,
+                level=config.compression_level,
+                workers=config.compression_workers,
+            ) as compressed,
+        ):
+            wait_for_command(
+                pg_dump(
+                    *get_postgres_connection_args(config),
+                    "--clean",
+                    "--if-exists",
+                    _out=cast("BinaryIO", compressed),
+                    _out_bufsize=GZIP_BLOCK_SIZE,
+                    _env=get_postgres_env(config),
+                    _bg=True,
+                    _bg_exc=False,
+                )
+            )
     except ErrorReturnCode as e:
-        if backup_file.exists():
+        if not is_streaming(config) and backup_file.exists():
             logger.debug("Removing incomplete backup file")
             backup_file.unlink()
         msg = e.stderr.decode("utf-8").strip()
         logger.error(msg)
         raise typer.Exit(code=1) from e
+    except OSError as e:
+        logger.error(f"Failed to stream backup: {e}")
+        raise typer.Exit(code=1) from e
+
+
+def _pg_dump_compression_args(config: Config) -> list[str]:
+    """Translate the compression settings into pg_dump's `-Z` option for directory-format dumps.
+
+    Args:
+        config (Config): The validated configuration for this run.
+
+    Returns:
+        list[str]: The arguments to pass to pg_dump. Empty to use pg_dump's default compression.
+    """
+    level = config.compression_level
+    match config.compression:
+        case "none":
+            return ["-Z", "0"]
+        case "zstd":
+            # Requires PostgreSQL 16 or newer
+            return ["-Z", "zstd" if level is None else f"zstd:{level}"]
+        case _:
+            return [] if level is None else ["-Z", str(level)]
+
+
+def _dump_postgres_directory(config: Config, backup_file: Path) -> None:
+    """Dump the database in directory format with parallel pg_dump jobs.
+
+    pg_dump writes one compressed file per table into a staging directory next to the backup. The directory is then packed into an uncompressed tar archive, which can be streamed, or renamed into place when `postgres_pack` is off.
+
+    Args:
+        config (Config): The validated configuration for this run.
+        backup_file (Path): The backup archive or directory to create.
+
+    Raises:
+        typer.Exit: If pg_dump fails or the output stream fails
+    """
+    from sh import ErrorReturnCode, pg_dump  # noqa: PLC0415
+
+    jobs = resolve_worker_count(config.postgres_jobs)
+    staging = backup_file.with_name(f".{backup_file.name}.tmp")
+    shutil.rmtree(staging, ignore_errors=True)
+
+    logger.debug(f"Dump with {jobs} parallel {pluralize('job', jobs)}")
+    try:
+        with span("pg_dump"):
+            wait_for_command(
+                pg_dump(
+                    *get_postgres_connection_args(config),
+                    "--format=directory",
+                    f"--jobs={jobs}",
+                    *_pg_dump_compression_args(config),
+                    f"--file={staging}",
+                    _env=get_postgres_env(config),
+                    _bg=True,
+                    _bg_exc=False,
+                )
+            )
+
+        if not config.postgres_pack:
+            staging.rename(backup_file)
+            get_catalog(config).add(backup_file)
+            return
+
+        with (
+            span("pack"),
+            open_backup_output(config, backup_file) as fh,
+            tarfile.open(fileobj=fh, mode="w|") as tar,
+        ):
+            for file in sorted(staging.iterdir()):
+                tar.add(file, arcname=file.name)
+                size = file.stat().st_size
+                count_run(files=1, read_bytes=size, written_bytes=size)
+    except ErrorReturnCode as e:
+        msg = e.stderr.decode("utf-8").strip()
+        logger.error(msg)
+        raise typer.Exit(code=1) from e
+    except (tarfile.TarError, OSError) as e:
+        if not is_streaming(config):
+            backup_file.unlink(missing_ok=True)
+        logger.error(f"Failed to create backup: {e}")
+        raise typer.Exit(code=1) from e
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
 
-    logger.success(f"Backup created: {backup_file.name}")
+@profiled("backup")
+@traced("backup")
+def do_backup_postgres(config: Config) -> Path | None:
+    """Create a compressed backup of a PostgreSQL database using pg_dump.
+
+    Dump the configured PostgreSQL database to a timestamped file in the backup directory, or stream it to stdout or the output command. With `postgres_format` set to `directory`, pg_dump writes a directory-format dump using several parallel jobs. Clean up old backups based on retention policy unless streaming. Optionally delete the source data directory after successful backup.
 
-    deleted_backups = clean_old_backups()
+    Args:
+        config (Config): The validated configuration for this run.
+
+    Returns:
+        Path | None: Path to the created backup file, or None if backup fails.
+    """
+    logger.debug("Begin backup PostgreSQL database")
+
+    backup_dir = config.backup_storage_dir
+    backup_type = type_of_backup(config)
+    job_name = get_job_name(config)
+    timestamp = get_current_time(config).format("YYYYMMDDTHHmmss")
+    backup_filename = f"{job_name}-{timestamp}-{backup_type}.{get_backup_file_extension(config)}"
+    backup_file = backup_dir / backup_filename
+    logger.trace(f"{backup_file=!s}")
+
+    with _storage_lease(config):
+        if config.postgres_format == "directory":
+            _dump_postgres_directory(config, backup_file)
+        else:
+            _dump_postgres_plain(config, backup_file)
+
+    if is_streaming(config):
+        logger.success(f"Backup streamed: {backup_file.name}")
+    else:
+        logger.success(f"Backup created: {backup_file.name}")
+        _clean_old_backups(config)
+
+    if config.delete_source and config.job_data_dir != Path("/nonexistent"):
+        with span("delete_source"):
+            clean_directory(config.job_data_dir)
+
+    return backup_file
+
+
+def _clean_old_backups(config: Config) -> None:
+    """Apply the retention policy to the backup storage directory and log what was deleted."""
+    with span("retention"):
+        deleted_backups = clean_old_backups(config)
+    count_run(deleted_backups=len(deleted_backups))
     if deleted_backups:
         logger.info(
-            f"Delete {len(deleted_backups)} old {p.plural_noun('backup', len(deleted_backups))}"
+            f"Delete {len(deleted_backups)} old {pluralize('backup', len(deleted_backups))}"
         )
 
-    if Config().delete_source and Config().job_data_dir != Path("/nonexistent"):
-        clean_directory(Config().job_data_dir)
 
-    return backup_file
+def _iter_backup_files(config: Config, source_dir: Path) -> Iterator[WalkEntry]:
+    """Yield every file and directory under the source directory that belongs in the backup.
+
+    Directories named in ALWAYS_EXCLUDE_FILENAMES, excluded directories and directories the include rules can not match anything below are pruned by the walker without being descended. Everything below an included directory passes the include rules, matching how they treat directories, but the exclude rules are checked for every entry at any depth.
 
+    Args:
+        config (Config): The validated configuration for this run.
+        source_dir (Path): The directory being backed up.
 
-def do_backup_filesystem() -> Path | None:
+    Yields:
+        WalkEntry: The entry with its path relative to `source_dir` and its stat result.
+    """
+    backup_filter = BackupFilter.from_config(config)
+    included_dirs: set[Path] = set()
+
+    def descend(directory: Path) -> bool:
+        if backup_filter.excluded(directory, is_dir=True):
+            return False
+        return directory in included_dirs or backup_filter.could_match_under(directory)
+
+    filtered = 0
+    for entry in walk_directory(source_dir, descend=descend):
+        f = entry.relative
+        is_dir = stat.S_ISDIR(entry.stat.st_mode)
+
+        # Respect include/exclude rules. Only the include side is inherited from an included parent
+        if backup_filter.excluded(f, is_dir=is_dir) or (
+            f.parent not in included_dirs and not backup_filter.included(f, is_dir=is_dir)
+        ):
+            logger.trace(f"Skipping file due to include/exclude rules: {f}")
+            filtered += 1
+            continue
+
+        if is_dir:
+            included_dirs.add(f)
+
+        yield entry
+
+    count_span(filtered=filtered)
+
+
+def _get_parent_manifest(config: Config, backup_type: str) -> Manifest | None:
+    """Find the manifest an incremental backup should be compared against.
+
+    Return None when the run must be a full backup: incremental mode is off, the backup is streamed, the backup type is one that always starts a new chain, or the most recent backup has no manifest to compare against.
+
+    Args:
+        config (Config): The validated configuration for this run.
+        backup_type (str): The type of backup being created, as returned by `type_of_backup`.
+
+    Returns:
+        Manifest | None: The manifest of the most recent backup, or None for a full backup.
+    """
+    if (
+        config.backup_mode != "incremental"
+        or is_streaming(config)
+        or backup_type in FULL_BACKUP_TYPES
+    ):
+        return None
+
+    most_recent = find_most_recent_backup(config)
+    if not most_recent:
+        return None
+
+    return read_manifest(most_recent)
+
+
+def _add_indexed(
+    tar: TarWriter,
+    compressed: CompressedWriter,
+    entry: WalkEntry,
+    index: IndexWriter | None,
+    digests: DigestWriter | None,
+) -> None:
+    """Add an entry to an archive, record in the index where it is stored and record a regular file's digest.
+
+    A new compressed block is started first once the current one holds `INDEX_BLOCK_SIZE` bytes, so every member starts inside a block a restore can seek to. The digest is computed from the data as it is archived.
+    """
+    if compressed.block_size >= INDEX_BLOCK_SIZE:
+        compressed.start_block()
+    offset = tar.offset - compressed.block_start
+    digest = new_file_hash() if digests is not None else None
+    if not (added := add_to_tar(tar, entry, digest)):
+        return
+
+    tarinfo, checksum = added
+    if index is not None:
+        index.add(
+            tarinfo.name,
+            IndexEntry.from_tarinfo(tarinfo, compressed.block_offset, offset, checksum),
+        )
+    if digests is not None and digest is not None and tarinfo.isreg():
+        digests.add(
+            FileDigest(tarinfo.name, tarinfo.size, entry.stat.st_mtime_ns, digest.hexdigest())
+        )
+
+
+def _write_archive(config: Config, source_dir: Path, backup_file: Path, backup_type: str) -> bool:
+    """Write the source directory to a compressed tar archive.
+
+    In incremental mode, daily and hourly backups only archive files that changed since the previous backup and record deletions in the manifest written next to the archive. The manifest, and the parent manifest it is compared with, are held in memory, so unlike full backups incremental backups use memory in proportion to the number of files. The compressed stream is split into independently decompressible blocks at member boundaries, and an index of where each member is stored is written next to the archive so single paths can be restored without reading all of it. A digest manifest, signed with `signing_key` when one is set, records the BLAKE2b digest of every file so the archive can be verified later. When streaming, the archive is always a full backup written to the output stream and no index or digests are kept.
+
+    Args:
+        config (Config): The validated configuration for this run.
+        source_dir (Path): The directory to back up.
+        backup_file (Path): The archive to create.
+        backup_type (str): The retention type of the backup.
+
+    Returns:
+        bool: True if the archive was written, False if it failed.
+    """
+    parent = _get_parent_manifest(config, backup_type)
+    manifest = Manifest(
+        backup=backup_file.name,
+        kind="incremental" if parent else "full",
+        parent=parent.backup if parent else None,
+    )
+    # The manifest is only kept for the next incremental backup, so full-mode jobs skip recording every file.
+    # In incremental mode it and the parent manifest are held in memory, which grows with the number of files
+    track_files = config.backup_mode == "incremental"
+
+    try:
+        with (
+            span("archive"),
+            nullcontext() if is_streaming(config) else IndexWriter(backup_file) as index,
+            nullcontext()
+            if is_streaming(config)
+            else DigestWriter(backup_file, config.signing_key) as digests,
+            open_backup_output(config, backup_file) as fh,
+            open_compressed_writer(
+                fh,
+                codec=config.compression,
+                level=config.compression_level,
+                workers=config.compression_workers,
+            ) as compressed,
+            TarWriter(cast("BinaryIO", compressed)) as tar,
+        ):
+            for entry in timed_iter(_iter_backup_files(config, source_dir), "walk_seconds"):
+                f = str(entry.relative)
+                state = FileState.from_stat(entry.stat)
+                if track_files:
+                    manifest.files[f] = state
+                if parent and not parent.has_changed(f, state):
+                    continue
+
+                logger.debug(f"-> '{f}'")
+                _add_indexed(tar, compressed, entry, index, digests)
+    except (tarfile.TarError, OSError) as e:
+        logger.error(f"Failed to create backup: {e}")
+        if not is_streaming(config):
+            backup_file.unlink(missing_ok=True)
+        return False
+
+    if is_streaming(config):
+        logger.success(f"Backup streamed: {backup_file.name}")
+        return True
+
+    if track_files:
+        if parent:
+            manifest.deleted = sorted(set(parent.files).difference(manifest.files))
+        manifest.write(backup_file)
+
+    logger.success(f"Backup created: {backup_file.name} ({manifest.kind})")
+    return True
+
+
+def _write_snapshot(config: Config, source_dir: Path, backup_file: Path) -> None:
+    """Chunk the source directory into the job's chunk store and write a snapshot index.
+
+    Only chunks the store does not already hold are written, so every snapshot is a complete backup while storing just the data that changed.
+
+    Args:
+        config (Config): The validated configuration for this run.
+        source_dir (Path): The directory to back up.
+        backup_file (Path): The snapshot index to create.
+    """
+    level = config.compression_level if config.compression == "zstd" else None
+    store = ChunkStore(
+        get_chunk_store_path(config.backup_storage_dir, get_job_name(config)),
+        level=level if level is not None else 3,
+    )
+
+    previous_file = find_most_recent_backup(config)
+    previous = (
+        Snapshot.read(previous_file) if previous_file and is_snapshot(previous_file) else None
+    )
+
+    with span("snapshot"):
+        files = timed_iter(_iter_backup_files(config, source_dir), "walk_seconds")
+        snapshot = create_snapshot(backup_file.name, files, store, previous)
+        snapshot.write(backup_file)
+    get_catalog(config).add(backup_file)
+
+    logger.success(
+        f"Backup created: {backup_file.name} ({store.new_chunks} new {pluralize('chunk', store.new_chunks)}, {store.new_bytes} bytes)"
+    )
+
+
+@profiled("backup")
+@traced("backup")
+def do_backup_filesystem(config: Config) -> Path | None:
     """Create a compressed tar archive backup of the service data directory.
 
-    Recursively scan the configured job data directory and create a gzipped tar archive containing all files that pass the include/exclude filters. Files in ALWAYS_EXCLUDE_FILENAMES are always skipped.
+    Recursively scan the configured job data directory and create a tar archive, compressed with the configured codec, containing all files that pass the include/exclude filters. Files in ALWAYS_EXCLUDE_FILENAMES are always skipped. In incremental mode, daily and hourly backups only archive files that changed since the previous backup. In repository mode, files are stored as deduplicated chunks and the backup file is a snapshot index.
+
+    Args:
+        config (Config): The validated configuration for this run.
 
     Returns:
         Path | None: Path to the created backup file, or None if backup creation failed.
@@ -97,48 +492,32 @@ def do_backup_filesystem() -> Path | None:
     Raises:
         typer.Exit: If no job data directory is configured
     """
-    if Config().job_data_dir == Path("/nonexistent"):
+    if config.job_data_dir == Path("/nonexistent"):
         logger.error("No job data directory specified")
         raise typer.Exit(code=1)
 
-    logger.debug(f"Begin backup source directory: {Config().job_data_dir}")
+    logger.debug(f"Begin backup source directory: {config.job_data_dir}")
 
-    source_dir = Config().job_data_dir
-    backup_dir = Config().backup_storage_dir
-    backup_type = type_of_backup()
-    job_name = get_job_name()
-    timestamp = get_current_time().format("YYYYMMDDTHHmmss")
-    backup_filename = f"{job_name}-{timestamp}-{backup_type}.{get_backup_file_extension()}"
+    source_dir = config.job_data_dir
+    backup_dir = config.backup_storage_dir
+    backup_type = type_of_backup(config)
+    job_name = get_job_name(config)
+    timestamp = get_current_time(config).format("YYYYMMDDTHHmmss")
+    backup_filename = f"{job_name}-{timestamp}-{backup_type}.{get_backup_file_extension(config)}"
     backup_file = backup_dir / backup_filename
     logger.trace(f"{backup_file=!s}")
 
-    # NOTE: compresslevel 6 is the tar program default
-    try:
-        with tarfile.open(backup_file, "w:gz", compresslevel=9) as tar:
-            for file in source_dir.rglob("*"):
-                f = file.relative_to(source_dir)
-
-                # Skip files that should always be excluded
-                if f.name in ALWAYS_ECLUDE_FILENAMES:
-                    continue
+    with _storage_lease(config):
+        if config.backup_mode == "repository":
+            _write_snapshot(config, source_dir, backup_file)
+        elif not _write_archive(config, source_dir, backup_file, backup_type):
+            return None
 
-                # Respect include/exclude rules
-                if filter_file_for_backup(f):
-                    logger.debug(f"-> '{f}'")
-                    tar.add(file, arcname=f)
-    except tarfile.TarError as e:
-        logger.error(f"Failed to create backup: {e}")
-        return None
-
-    logger.success(f"Backup created: {backup_file.name}")
-
-    deleted_backups = clean_old_backups()
-    if deleted_backups:
-        logger.info(
-            f"Delete {len(deleted_backups)} old {p.plural_noun('backup', len(deleted_backups))}"
-        )
+    if not is_streaming(config):
+        _clean_old_backups(config)
 
-    if Config().delete_source:
-        clean_directory(Config().job_data_dir)
+    if config.delete_source:
+        with span("delete_source"):
+            clean_directory(config.job_data_dir)
 
     return backup_file
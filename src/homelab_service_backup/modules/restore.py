@@ -1,74 +1,506 @@
 """Restore service data."""
 
-import gzip
 import os
+import shutil
+import stat
 import tarfile
-import time
 from pathlib import Path
+from typing import BinaryIO
 
 import typer
+import zstandard
 from loguru import logger
-from sh import ErrorReturnCode, psql
 
 from homelab_service_backup.utils import (
+    ChunkStore,
     Config,
+    IndexEntry,
+    ParallelExtractor,
+    Snapshot,
+    StreamFeeder,
     chown_all_files,
     clean_directory,
+    file_checksum,
     find_most_recent_backup,
+    format_bytes,
+    get_backup_codec,
+    get_chown_ids,
+    get_chunk_store_path,
     get_job_name,
+    get_postgres_connection_args,
+    get_postgres_env,
+    is_directory_dump,
+    is_snapshot,
+    limit_reads,
+    open_compressed_reader,
+    pluralize,
+    profiled,
+    read_index,
+    read_manifest,
+    resolve_backup_chain,
+    restore_snapshot,
+    span,
+    traced,
+    wait_for_command,
+    walk_directory,
 )
+from homelab_service_backup.utils.compression import resolve_worker_count
 
 
-def do_restore_postgres() -> bool:
+def _restore_postgres_directory(config: Config, backup: Path) -> bool:
+    """Restore a directory-format dump with parallel pg_restore jobs.
+
+    Packed dumps are first extracted to a staging directory next to the backup, since pg_restore can only run parallel jobs against a directory.
+
+    Args:
+        config (Config): The validated configuration for this run.
+        backup (Path): The dump directory or the tar archive holding it.
+
+    Returns:
+        bool: True if restore succeeds, False if the archive can not be extracted.
+
+    Raises:
+        typer.Exit: If pg_restore fails to restore the backup
+    """
+    from sh import ErrorReturnCode, pg_restore  # noqa: PLC0415
+
+    jobs = resolve_worker_count(config.postgres_jobs)
+    staging = backup.with_name(f".{backup.name}.restore")
+
+    try:
+        if backup.is_dir():
+            dump_dir = backup
+        else:
+            shutil.rmtree(staging, ignore_errors=True)
+            with span("unpack"), tarfile.open(backup, mode="r|") as archive:
+                archive.extractall(path=staging, filter="data")
+            dump_dir = staging
+
+        logger.debug(f"Restore with {jobs} parallel {pluralize('job', jobs)}")
+        with span("pg_restore"):
+            wait_for_command(
+                pg_restore(
+                    *get_postgres_connection_args(config),
+                    "--clean",
+                    "--if-exists",
+                    f"--jobs={jobs}",
+                    dump_dir,
+                    _env=get_postgres_env(config),
+                    _bg=True,
+                    _bg_exc=False,
+                )
+            )
+    except ErrorReturnCode as e:
+        msg = e.stderr.decode("utf-8").strip()
+        logger.error(msg)
+        raise typer.Exit(code=1) from e
+    except tarfile.TarError as e:
+        logger.error(f"Failed to read backup {backup.name}: {e}")
+        return False
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    logger.success(f"Data restored from {backup.name}")
+    return True
+
+
+@profiled("restore")
+@traced("restore")
+def do_restore_postgres(config: Config) -> bool:
     """Restore a PostgreSQL database from the most recent backup file.
 
-    Find and decompress the most recent backup file, then restore it to the configured PostgreSQL database using psql. The backup must be a gzipped SQL dump created by pg_dump.
+    Find the most recent backup file and stream it into psql, or restore it with parallel pg_restore jobs if it is a directory-format dump. The dump is decompressed in chunks on a separate thread and handed to psql through a bounded queue, so memory use does not depend on the size of the dump. The backup must be a SQL dump created by pg_dump, compressed with any supported codec.
+
+    Args:
+        config (Config): The validated configuration for this run.
 
     Returns:
-        bool: True if restore succeeds, False if no backups found.
+        bool: True if restore succeeds, False if no backups found or the backup can not be read.
 
     Raises:
         typer.Exit: If psql fails to restore the backup
     """
-    most_recent_backup = find_most_recent_backup()
+    from sh import ErrorReturnCode, psql  # noqa: PLC0415
+
+    most_recent_backup = find_most_recent_backup(config)
     if not most_recent_backup:
-        logger.error(f"No backups found to restore for {get_job_name()}")
+        logger.error(f"No backups found to restore for {get_job_name(config)}")
         return False
     logger.debug(f"Restore from: {most_recent_backup.name}")
 
-    # Set password in PGPASSWORD environment variable
-    os.environ["PGPASSWORD"] = Config().postgres_password
-
-    with gzip.open(most_recent_backup, "rb") as f:
-        file_content = f.read()
+    if is_directory_dump(most_recent_backup):
+        return _restore_postgres_directory(config, most_recent_backup)
 
     try:
-        psql(
-            "-h",
-            Config().postgres_host,
-            "-p",
-            Config().postgres_port,
-            "-U",
-            Config().postgres_user,
-            "-d",
-            Config().postgres_db,
-            # "-f",
-            # most_recent_backup,
-            _in=file_content,
-        )
+        with (
+            span("psql"),
+            most_recent_backup.open("rb") as fh,
+            open_compressed_reader(limit_reads(fh), get_backup_codec(most_recent_backup)) as f,
+            StreamFeeder(f, label="Restore") as feeder,
+        ):
+            # Apply the dump in one transaction that stops at the first error, so a failed restore rolls back
+            wait_for_command(
+                feeder.attach(
+                    psql(
+                        "--single-transaction",
+                        "--variable=ON_ERROR_STOP=1",
+                        *get_postgres_connection_args(config),
+                        _in=feeder.queue,
+                        _env=get_postgres_env(config),
+                        _bg=True,
+                        _bg_exc=False,
+                    )
+                )
+            )
     except ErrorReturnCode as e:
         msg = e.stderr.decode("utf-8").strip()
         logger.error(msg)
         raise typer.Exit(code=1) from e
+    except (OSError, EOFError, zstandard.ZstdError) as e:
+        logger.error(f"Failed to read backup {most_recent_backup.name}: {e}")
+        return False
 
-    logger.success(f"Data restored from {most_recent_backup.name}")
+    logger.success(
+        f"Data restored from {most_recent_backup.name} ({format_bytes(feeder.bytes_read)} at {format_bytes(feeder.rate)}/s)"
+    )
     return True
 
 
-def do_restore_filesystem() -> bool:
+def _remove_deleted_paths(destination: Path, deleted: list[str]) -> None:
+    """Remove paths that an incremental backup recorded as deleted since its parent.
+
+    Args:
+        destination (Path): The directory being restored into.
+        deleted (list[str]): Paths relative to `destination` to remove.
+    """
+    for name in deleted:
+        target = destination / name
+        if target.is_dir() and not target.is_symlink():
+            shutil.rmtree(target)
+        else:
+            target.unlink(missing_ok=True)
+
+
+def _extract_archive(backup_file: Path, extractor: ParallelExtractor) -> None:
+    """Extract a single backup archive into the destination directory.
+
+    Args:
+        backup_file (Path): The archive to extract.
+        extractor (ParallelExtractor): The extractor writing into the destination directory.
+    """
+    with (
+        backup_file.open("rb") as fh,
+        open_compressed_reader(limit_reads(fh), get_backup_codec(backup_file)) as reader,
+    ):
+        extractor.extract(reader)
+
+
+def _restore_snapshot(config: Config, snapshot_file: Path) -> bool:
+    """Rebuild the job data directory from a repository snapshot.
+
+    Args:
+        config (Config): The validated configuration for this run.
+        snapshot_file (Path): The snapshot index to restore.
+
+    Returns:
+        bool: True if restore succeeds, False if a chunk is missing.
+    """
+    store = ChunkStore(get_chunk_store_path(config.backup_storage_dir, get_job_name(config)))
+    destination = config.job_data_dir
+
+    with span("clean"):
+        clean_directory(destination)
+
+    try:
+        with span("snapshot"):
+            restore_snapshot(Snapshot.read(snapshot_file), store, destination)
+    except FileNotFoundError as e:
+        logger.error(f"Failed to restore backup, missing chunk: {e.filename}")
+        return False
+
+    with span("chown"):
+        chown_all_files(config, destination)
+    logger.success(f"Data restored from {snapshot_file.name}")
+
+    return True
+
+
+def _relative_restore_path(path: str, destination: Path) -> str:
+    """Turn a path given on the command line into the name it is stored under in the archives.
+
+    Args:
+        path (str): A path relative to the job data directory, or an absolute path inside it.
+        destination (Path): The job data directory.
+
+    Returns:
+        str: The path relative to the job data directory, without leading or trailing slashes.
+    """
+    candidate = Path(path)
+    if candidate.is_absolute() and candidate.is_relative_to(destination):
+        candidate = candidate.relative_to(destination)
+
+    return str(candidate).strip("/").removeprefix("./")
+
+
+def _skip(reader: BinaryIO, size: int) -> None:
+    """Read and discard bytes from a decompressed stream.
+
+    Raises:
+        EOFError: If the stream ends first.
+    """
+    while size > 0:
+        chunk = reader.read(min(size, 1024 * 1024))
+        if not chunk:
+            msg = "Archive ended before the indexed member"
+            raise EOFError(msg)
+        size -= len(chunk)
+
+
+def _extract_block(
+    config: Config,
+    backup_file: Path,
+    block: int,
+    entries: dict[str, IndexEntry],
+    destination: Path,
+) -> int:
+    """Extract members from one independently decompressible block of an archive.
+
+    Seek to the block, skip to the first wanted member and read members until every wanted one is extracted. Members that follow in later blocks are read through, since the blocks are contiguous.
+
+    Args:
+        config (Config): The validated configuration for this run.
+        backup_file (Path): The archive to read.
+        block (int): The compressed offset of the block.
+        entries (dict[str, IndexEntry]): The members to extract, all stored in this block.
+        destination (Path): The directory to restore into.
+
+    Returns:
+        int: The number of compressed bytes read.
+
+    Raises:
+        tarfile.ReadError: If a member does not match its index entry.
+    """
+    owner = get_chown_ids(config)
+    wanted = dict(entries)
+    first = min(entry.offset for entry in wanted.values())
+
+    with backup_file.open("rb") as fh:
+        fh.seek(block)
+        with open_compressed_reader(limit_reads(fh), get_backup_codec(backup_file)) as reader:
+            _skip(reader, first)
+            with tarfile.open(fileobj=reader, mode="r|") as archive:
+                for member in archive:
+                    entry = wanted.pop(member.name, None)
+                    if entry is None:
+                        continue
+
+                    archive.extract(member, destination, filter="data")
+                    target = destination / member.name
+                    if entry.checksum is not None and file_checksum(target) != entry.checksum:
+                        msg = f"Checksum mismatch for {member.name}"
+                        raise tarfile.ReadError(msg)
+                    if owner:
+                        os.lchown(target, *owner)
+                    if not wanted:
+                        break
+
+        if wanted:
+            msg = f"Members missing from {backup_file.name}: {', '.join(sorted(wanted))}"
+            raise tarfile.ReadError(msg)
+
+        return fh.tell() - block
+
+
+def _indexed_members(
+    chain: list[Path], paths: list[str] | None = None
+) -> dict[str, tuple[Path, IndexEntry]] | None:
+    """Find the archive holding the newest copy of every member of a backup chain.
+
+    Paths the newest manifest records as deleted are left out, so the result describes the backed up directory as it was when the newest archive was written.
+
+    Args:
+        chain (list[Path]): The archives of the backup, oldest first.
+        paths (list[str] | None, optional): Only include members that are, or are below, these paths. Defaults to None, which includes every member.
+
+    Returns:
+        dict[str, tuple[Path, IndexEntry]] | None: The archive and index entry of each member, or None if an archive has no index.
+    """
+    members: dict[str, tuple[Path, IndexEntry]] = {}
+    for backup_file in chain:
+        index = read_index(backup_file, paths)
+        if index is None:
+            logger.debug(f"{backup_file.name} has no index")
+            return None
+
+        members.update({name: (backup_file, entry) for name, entry in index.members.items()})
+
+    manifest = read_manifest(chain[-1])
+    if manifest:
+        members = {name: value for name, value in members.items() if name in manifest.files}
+
+    return members
+
+
+def _extract_members(
+    config: Config, members: dict[str, tuple[Path, IndexEntry]], destination: Path
+) -> int:
+    """Extract members by reading only the archive blocks that hold them.
+
+    Args:
+        config (Config): The validated configuration for this run.
+        members (dict[str, tuple[Path, IndexEntry]]): The members to extract, with the archive and index entry of each.
+        destination (Path): The directory to restore into.
+
+    Returns:
+        int: The number of compressed bytes read.
+    """
+    blocks: dict[tuple[Path, int], dict[str, IndexEntry]] = {}
+    for name, (backup_file, entry) in members.items():
+        blocks.setdefault((backup_file, entry.block), {})[name] = entry
+
+    compressed = 0
+    for (backup_file, block), entries in sorted(blocks.items()):
+        logger.debug(
+            f"Read {len(entries)} {pluralize('member', len(entries))} from {backup_file.name} at {block}"
+        )
+        compressed += _extract_block(config, backup_file, block, entries, destination)
+
+    return compressed
+
+
+def _restore_paths(config: Config, chain: list[Path], paths: list[str], destination: Path) -> bool:
+    """Restore selected paths from a backup chain without touching the rest of the destination.
+
+    Look up each path in the archive indexes, newest archive first, and read only the blocks that hold them. Paths the newest manifest records as deleted are not restored.
+
+    Args:
+        config (Config): The validated configuration for this run.
+        chain (list[Path]): The archives of the backup, oldest first.
+        paths (list[str]): The files or directories to restore, relative to the job data directory.
+        destination (Path): The job data directory.
+
+    Returns:
+        bool: True if every selected member was restored.
+    """
+    paths = [_relative_restore_path(path, destination) for path in paths]
+    selected = _indexed_members(chain, paths)
+    if selected is None:
+        logger.error("The backup has no index, restore the whole backup instead")
+        return False
+
+    if not selected:
+        logger.error(f"Nothing in {chain[-1].name} matches {', '.join(paths)}")
+        return False
+
+    with span("extract"):
+        compressed = _extract_members(config, selected, destination)
+    archive_size = sum(backup_file.stat().st_size for backup_file in chain)
+    logger.success(
+        f"Restored {len(selected)} {pluralize('path', len(selected))} from {chain[-1].name}, read {format_bytes(compressed)} of {format_bytes(archive_size)}"
+    )
+    return True
+
+
+def _restore_delta(config: Config, chain: list[Path], destination: Path) -> bool:
+    """Bring an existing directory in line with a backup, rewriting only what differs.
+
+    Walk the destination once and compare every entry with the newest copy of it in the archive indexes. Entries the backup does not contain are deleted, entries that differ are removed and restored from the blocks that hold them, and everything that already matches is left alone.
+
+    Args:
+        config (Config): The validated configuration for this run.
+        chain (list[Path]): The archives of the backup, oldest first.
+        destination (Path): The job data directory.
+
+    Returns:
+        bool: True if the destination was updated, False if the backup has no index to compare against.
+    """
+    members = _indexed_members(chain)
+    if members is None:
+        return False
+
+    compare_checksum = config.restore_checksum
+    changed = dict(members)
+    removed: set[Path] = set()
+    deleted = 0
+
+    with span("compare"):
+        for entry in walk_directory(
+            destination, exclude_names=(), descend=lambda x: x not in removed
+        ):
+            name = str(entry.relative)
+            member = members.get(name)
+            if member and member[1].is_current(
+                destination, name, entry.stat, compare_checksum=compare_checksum
+            ):
+                del changed[name]
+                continue
+
+            if stat.S_ISDIR(entry.stat.st_mode):
+                shutil.rmtree(entry.path)
+                removed.add(entry.relative)
+            else:
+                entry.path.unlink()
+
+            if member is None:
+                logger.trace(f"Delete {name}")
+                deleted += 1
+
+    # A kept hard link would still point at the old data once its target is rewritten
+    for name, (backup_file, link) in members.items():
+        if (
+            link.kind.encode() == tarfile.LNKTYPE
+            and name not in changed
+            and link.linkname in changed
+        ):
+            (destination / name).unlink()
+            changed[name] = (backup_file, link)
+
+    with span("extract"):
+        compressed = _extract_members(config, changed, destination) if changed else 0
+    archive_size = sum(backup_file.stat().st_size for backup_file in chain)
+    logger.info(
+        f"Restored {len(changed)} changed {pluralize('path', len(changed))}, deleted {deleted} and kept {len(members) - len(changed)}. Read {format_bytes(compressed)} of {format_bytes(archive_size)}"
+    )
+    return True
+
+
+def _restore_chain(config: Config, chain: list[Path], destination: Path) -> None:
+    """Replay every archive of a backup chain into the destination directory.
+
+    Args:
+        config (Config): The validated configuration for this run.
+        chain (list[Path]): The archives of the backup, oldest first.
+        destination (Path): The directory to restore into.
+    """
+    workers = resolve_worker_count(config.restore_workers)
+
+    with (
+        span("extract"),
+        ParallelExtractor(destination, workers=workers, owner=get_chown_ids(config)) as extractor,
+    ):
+        for backup_file in chain:
+            manifest = read_manifest(backup_file)
+            if manifest and manifest.deleted:
+                _remove_deleted_paths(destination, manifest.deleted)
+
+            logger.debug(f"Extract: {backup_file.name}")
+            _extract_archive(backup_file, extractor)
+
+    logger.info(
+        f"Restored {extractor.files} {pluralize('file', extractor.files)} ({format_bytes(extractor.bytes_written)}) with {workers} {pluralize('writer', workers)}"
+    )
+
+
+@profiled("restore")
+@traced("restore")
+def do_restore_filesystem(config: Config, paths: list[str] | None = None) -> bool:
     """Extract and restore service data from the most recent backup archive.
 
-    Find the most recent backup archive, clean the destination directory, and extract the archive contents. After extraction, update file ownership permissions.
+    Find the most recent backup archive, clean the destination directory, and extract the archive contents. With `restore_mode` set to `delta`, the destination is not cleaned. Only entries that differ from the backup are rewritten or deleted, falling back to a full restore when the backup has no index. When `paths` are given, only those files and directories are restored, using the archive indexes to read just the blocks that hold them, and the rest of the destination is left alone. Incremental backups are restored by replaying every archive in the chain, starting from the full backup it builds on. Archives are read once as a stream while a pool of threads writes the files, and ownership is applied as each file is written. Repository snapshots are rebuilt from the job's chunk store.
+
+    Args:
+        config (Config): The validated configuration for this run.
+        paths (list[str] | None, optional): Files or directories to restore, relative to the job data directory. Defaults to None, which restores everything.
 
     Returns:
         bool: True if restore succeeds, False if no backups found or extraction fails.
@@ -76,32 +508,39 @@ def do_restore_filesystem() -> bool:
     Raises:
         typer.Exit: If no job data directory is configured
     """
-    if Config().job_data_dir == Path("/nonexistent"):
+    if config.job_data_dir == Path("/nonexistent"):
         logger.error("No job data directory specified")
         raise typer.Exit(code=1)
 
-    # Confirm destination is empty
-    clean_directory(Config().job_data_dir)
-
-    most_recent_backup = find_most_recent_backup()
+    most_recent_backup = find_most_recent_backup(config)
 
     if not most_recent_backup:
-        logger.error(f"No backups found to restore for {get_job_name()}")
+        logger.error(f"No backups found to restore for {get_job_name(config)}")
         return False
     logger.debug(f"Restore from: {most_recent_backup.name}")
 
-    destination = f"{Config().job_data_dir}"
+    destination = config.job_data_dir
 
     try:
-        with tarfile.open(most_recent_backup) as archive:
-            archive.extractall(path=destination, filter="data")
-    except tarfile.TarError as e:
+        chain = resolve_backup_chain(most_recent_backup)
+        if paths:
+            return _restore_paths(config, chain, paths, destination)
+
+        if is_snapshot(most_recent_backup):
+            return _restore_snapshot(config, most_recent_backup)
+
+        if config.restore_mode == "delta" and _restore_delta(config, chain, destination):
+            logger.success(f"Data restored from {most_recent_backup.name}")
+            return True
+
+        # Confirm destination is empty
+        with span("clean"):
+            clean_directory(destination)
+        _restore_chain(config, chain, destination)
+    except (tarfile.TarError, OSError, EOFError, zstandard.ZstdError) as e:
         logger.error(f"Failed to restore backup: {e}")
         return False
 
-    time.sleep(5)
-    chown_all_files(destination)
-
     logger.success(f"Data restored from {most_recent_backup.name}")
 
     return True
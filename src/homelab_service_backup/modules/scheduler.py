@@ -1,85 +1,410 @@
 """Scheduler module for the backup service."""
 
-import inflect
-from apscheduler.schedulers.background import BackgroundScheduler
+import contextvars
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+import typer
 from loguru import logger
 
-from homelab_service_backup.utils import Config
+from homelab_service_backup.utils import (
+    Config,
+    JobsFile,
+    MetricsRegistry,
+    PressureMonitor,
+    RunCancelledError,
+    RunHistory,
+    RunRecord,
+    RunStats,
+    cancellable,
+    collect_stats,
+    get_job_name,
+    has_priority,
+    io_limits,
+    lower_priority,
+    pluralize,
+    serve_metrics,
+    use_config,
+    watch_pressure,
+)
 
 from .backup import do_backup_filesystem, do_backup_postgres
 from .restore import do_restore_filesystem, do_restore_postgres
+from .verify import do_verify
 
-p = inflect.engine()
-
-
-def setup_schedule() -> None:
-    """Setup the scheduler for the backup or restore task."""
-    scheduler = BackgroundScheduler()
-    config = Config()
-
-    if config.action == "backup" and not config.use_postgres:
-        scheduler.add_job(
-            do_backup_filesystem,
-            "cron",
-            minute=config.schedule_minute,
-            hour=config.schedule_hour,
-            day_of_week=config.schedule_day_of_week,
-            week=config.schedule_week,
-            day=config.schedule_day,
-            jitter=600,
-            timezone=config.tz,
-        )
-        logger.success("Scheduled filesystem backup task")
-
-    if config.action == "backup" and config.use_postgres:
-        scheduler.add_job(
-            do_backup_postgres,
-            "cron",
-            minute=config.schedule_minute,
-            hour=config.schedule_hour,
-            day_of_week=config.schedule_day_of_week,
-            week=config.schedule_week,
-            day=config.schedule_day,
-            jitter=600,
-            timezone=config.tz,
-        )
-        logger.success("Scheduled postgres backup task")
-
-    if config.action == "restore" and not config.use_postgres:
-        scheduler.add_job(
-            do_restore_filesystem,
-            "cron",
-            minute=config.schedule_minute,
-            hour=config.schedule_hour,
-            day_of_week=config.schedule_day_of_week,
-            week=config.schedule_week,
-            day=config.schedule_day,
-            jitter=600,
-            timezone=config.tz,
-        )
-        logger.success("Scheduled filesystem restore task")
-
-    if config.action == "restore" and config.use_postgres:
-        scheduler.add_job(
-            do_restore_postgres,
-            "cron",
-            minute=config.schedule_minute,
-            hour=config.schedule_hour,
-            day_of_week=config.schedule_day_of_week,
-            week=config.schedule_week,
-            day=config.schedule_day,
-            jitter=600,
-            timezone=config.tz,
+if TYPE_CHECKING:
+    from apscheduler.schedulers.blocking import BlockingScheduler
+
+    from homelab_service_backup.utils.history import RunOutcome
+
+
+def get_task(config: Config) -> Callable[[Config], Any]:
+    """Pick the backup, restore or verify function a job runs.
+
+    Args:
+        config (Config): The job's configuration.
+
+    Returns:
+        Callable[[Config], Any]: The function to call with the configuration.
+    """
+    match (config.action, config.use_postgres):
+        case ("verify", _):
+            return do_verify
+        case ("backup", True):
+            return do_backup_postgres
+        case ("backup", False):
+            return do_backup_filesystem
+        case ("restore", True):
+            return do_restore_postgres
+        case _:
+            return do_restore_filesystem
+
+
+def _run_lowered(config: Config) -> object:
+    """Lower the priority of the current thread, then run the job's task on it.
+
+    Returns:
+        object: What the task returned.
+    """
+    lower_priority(config)
+    return get_task(config)(config)
+
+
+def run_task(config: Config) -> object:
+    """Run a job's task under its bandwidth limits and priority.
+
+    Lowered priorities can not be raised again without privileges, so a job with a lower priority runs on a thread of its own that ends with the run, instead of lowering a pool thread that runs other jobs later.
+
+    Args:
+        config (Config): The job's configuration.
+
+    Returns:
+        object: What the task returned.
+    """
+    with io_limits(config):
+        if not has_priority(config):
+            return get_task(config)(config)
+
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="hsb-lowered") as pool:
+            return pool.submit(contextvars.copy_context().run, _run_lowered, config).result()
+
+
+@dataclass
+class _JobState:
+    """The run of one job that is in progress, used to apply the overlap policy."""
+
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    cancel: threading.Event = field(default_factory=threading.Event)
+
+
+class JobRunner:
+    """Run jobs, each with its own configuration, and record how long every run took.
+
+    Every run holds a slot of its storage target, so no more than the target's limit of jobs read from or write to it at once. The global limit is enforced by the size of the thread pool the runs are submitted to. A run that starts while the previous run of the same job is still in progress is skipped, queued behind it, or cancels it, as set by the job's `schedule_overlap`. A job with a pressure threshold waits for the machine to calm down before it takes a slot, and pauses while it runs. With a metrics registry, what every run did is recorded in it as well.
+    """
+
+    def __init__(self, jobs: JobsFile, metrics: MetricsRegistry | None = None) -> None:
+        self.jobs = jobs
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._storage_slots: dict[Path, threading.BoundedSemaphore] = {}
+        self._states: dict[tuple[str, bool], _JobState] = {}
+
+    def _slots(self, config: Config) -> threading.BoundedSemaphore:
+        """Return the semaphore limiting the jobs that use a job's storage target."""
+        target, limit = self.jobs.storage_target(config)
+        with self._lock:
+            if target not in self._storage_slots:
+                self._storage_slots[target] = threading.BoundedSemaphore(limit)
+            return self._storage_slots[target]
+
+    def _state(self, config: Config) -> _JobState:
+        """Return the state shared by every run of a job."""
+        with self._lock:
+            return self._states.setdefault((config.job_name, config.use_postgres), _JobState())
+
+    @staticmethod
+    def _claim(config: Config, state: _JobState) -> bool:
+        """Take over a job from its previous run, following the job's overlap policy.
+
+        Returns:
+            bool: True once the run may start, False if it is skipped.
+        """
+        if state.lock.acquire(blocking=False):
+            return True
+
+        match config.schedule_overlap:
+            case "skip":
+                logger.warning("Skip run, the previous run is still in progress")
+                return False
+            case "queue":
+                logger.info("Wait for the previous run to finish")
+            case "kill":
+                logger.warning("Cancel the previous run, it is still in progress")
+                state.cancel.set()
+
+        state.lock.acquire()
+        return True
+
+    @staticmethod
+    def _defer(monitor: PressureMonitor | None, cancel: threading.Event) -> "RunOutcome | None":
+        """Wait for the pressure on the machine to drop before a run starts.
+
+        Returns:
+            RunOutcome | None: None once the run may start, or how the run ended if it never started.
+        """
+        if monitor is None:
+            return None
+
+        try:
+            with cancellable(cancel):
+                calm = monitor.defer()
+        except RunCancelledError:
+            logger.warning("Deferred run cancelled")
+            return "cancelled"
+
+        return None if calm else "deferred"
+
+    @staticmethod
+    def _execute(
+        config: Config, cancel: threading.Event, monitor: PressureMonitor | None, stats: RunStats
+    ) -> "RunOutcome":
+        """Run a job's task, counting what it does into `stats`.
+
+        A failing job is logged and does not stop the other jobs.
+
+        Returns:
+            RunOutcome: How the run ended.
+        """
+        try:
+            with cancellable(cancel), watch_pressure(monitor), collect_stats(stats):
+                result = run_task(config)
+        except RunCancelledError:
+            logger.warning(f"Job {config.job_name} cancelled")
+            return "cancelled"
+        except typer.Exit:
+            return "failed"
+        except Exception:  # noqa: BLE001
+            logger.exception(f"Job {config.job_name} failed")
+            return "failed"
+
+        # Backups return the backup file and restores return True, both None or False on failure
+        return "success" if result else "failed"
+
+    @staticmethod
+    def _record(config: Config, started: float, duration: float, outcome: "RunOutcome") -> None:
+        """Append a run to the run history of the job's storage directory."""
+        record = RunRecord(
+            job=config.job_name,
+            action=config.action,
+            started=started,
+            duration=round(duration, 3),
+            outcome=outcome,
         )
-        logger.success("Scheduled postgres restore task")
+        try:
+            RunHistory(config.backup_storage_dir).add(record)
+        except OSError as e:
+            logger.warning(f"Failed to record run: {e}")
+
+    def _observe(
+        self,
+        config: Config,
+        outcome: "RunOutcome",
+        stats: RunStats | None = None,
+        duration: float = 0.0,
+    ) -> None:
+        """Record a run in the metrics registry, if metrics are enabled."""
+        if self.metrics is not None:
+            self.metrics.record_run(get_job_name(config), config.action, outcome, stats, duration)
 
+    def run(self, config: Config) -> bool:
+        """Run one job, waiting for a free slot of its storage target first.
+
+        Args:
+            config (Config): The job's configuration.
+
+        Returns:
+            bool: True if the job succeeded.
+        """
+        prefix = f"{config.job_name}: " if len(self.jobs.jobs) > 1 else ""
+        state = self._state(config)
+
+        with (
+            use_config(config),
+            logger.contextualize(job=config.job_name, job_prefix=prefix),
+        ):
+            if not self._claim(config, state):
+                self._record(config, time.time(), 0, "skipped")
+                self._observe(config, "skipped")
+                return False
+
+            try:
+                started = time.time()
+                start = time.perf_counter()
+                stats = None
+                monitor = PressureMonitor.from_config(config)
+                if (outcome := self._defer(monitor, state.cancel)) is None:
+                    with self._slots(config):
+                        started = time.time()
+                        start = time.perf_counter()
+                        stats = RunStats()
+                        outcome = self._execute(config, state.cancel, monitor, stats)
+                duration = time.perf_counter() - start
+
+                # Recorded before the next run of the job can start, so the history is in run order
+                logger.info(f"Run finished in {duration:.1f}s: {outcome}")
+                self._record(config, started, duration, outcome)
+                self._observe(config, outcome, stats, duration)
+            finally:
+                # Replaced while the lock is held, so a cancellation always reaches the run in progress
+                state.cancel = threading.Event()
+                state.lock.release()
+
+        return outcome == "success"
+
+
+def _add_cron_job(scheduler: "BlockingScheduler", runner: JobRunner, config: Config) -> None:
+    """Schedule a job with its cron, jitter and misfire settings, identified by the name its metrics are labelled with."""
+    scheduler.add_job(
+        runner.run,
+        "cron",
+        args=[config],
+        id=get_job_name(config),
+        name=config.job_name,
+        minute=config.schedule_minute,
+        hour=config.schedule_hour,
+        day_of_week=config.schedule_day_of_week,
+        week=config.schedule_week,
+        day=config.schedule_day,
+        jitter=config.schedule_jitter or None,
+        timezone=config.tz,
+        misfire_grace_time=config.schedule_misfire_grace or None,
+        coalesce=True,
+        # The runner applies the overlap policy, so a second run must be able to start while the first is in progress
+        max_instances=2,
+    )
     logger.info(
-        f"Schedule: minute: {config.schedule_minute}, hour: {config.schedule_hour}, day_of_week: {config.schedule_day_of_week}, week: {config.schedule_week}, day: {config.schedule_day}"
+        f"Schedule {config.job_name}: minute: {config.schedule_minute}, hour: {config.schedule_hour}, day_of_week: {config.schedule_day_of_week}, week: {config.schedule_week}, day: {config.schedule_day}, jitter: {config.schedule_jitter}s, overlap: {config.schedule_overlap}"
     )
 
-    # Start the scheduler
-    scheduler.start()
+
+def _next_runs(scheduler: "BlockingScheduler") -> dict[str, float]:
+    """Look up when every scheduled job runs next.
+
+    Returns:
+        dict[str, float]: The next run time of each job, in seconds since the epoch, by job ID. Empty until the scheduler is started.
+    """
+    return {
+        job.id: job.next_run_time.timestamp()
+        for job in scheduler.get_jobs()
+        if getattr(job, "next_run_time", None) is not None
+    }
+
+
+def _create_scheduler(runner: JobRunner, configs: list[Config]) -> "BlockingScheduler":
+    """Create a scheduler that runs jobs on their schedules, no more than `max_concurrent_jobs` at once.
+
+    With metrics enabled, the next run time of every job is added to them, and the metrics textfile is written as soon as the scheduler starts so it lists the first runs before any job ran.
+
+    Returns:
+        BlockingScheduler: The scheduler, not started yet.
+    """
+    from apscheduler.events import EVENT_SCHEDULER_START  # noqa: PLC0415
+    from apscheduler.executors.pool import (  # noqa: PLC0415
+        ThreadPoolExecutor as SchedulerThreadPool,
+    )
+    from apscheduler.schedulers.blocking import BlockingScheduler  # noqa: PLC0415
+
+    scheduler = BlockingScheduler(
+        executors={"default": SchedulerThreadPool(runner.jobs.max_concurrent_jobs)}
+    )
+    for config in configs:
+        _add_cron_job(scheduler, runner, config)
+
+    if (metrics := runner.metrics) is not None:
+        metrics.next_runs = lambda: _next_runs(scheduler)
+        scheduler.add_listener(lambda _: metrics.write_textfile(), EVENT_SCHEDULER_START)
 
     logger.debug("----- Scheduler Jobs -----")
     logger.debug(scheduler.print_jobs())
     logger.debug("----- end Scheduler Jobs -----")
+    return scheduler
+
+
+def _start_metrics(jobs: JobsFile) -> MetricsRegistry | None:
+    """Set up the metrics of the jobs, serving them over HTTP if `metrics_port` is set.
+
+    Args:
+        jobs (JobsFile): The jobs and their metrics settings.
+
+    Returns:
+        MetricsRegistry | None: The registry runs are recorded in, or None if metrics are disabled.
+
+    Raises:
+        typer.Exit: If the metrics port can not be listened on.
+    """
+    if not jobs.metrics_port and jobs.metrics_file is None:
+        return None
+
+    registry = MetricsRegistry(jobs.metrics_file)
+    if jobs.metrics_port:
+        try:
+            serve_metrics(registry, jobs.metrics_port)
+        except OSError as e:
+            logger.error(f"Can not serve metrics on port {jobs.metrics_port}: {e}")
+            raise typer.Exit(code=1) from e
+
+    return registry
+
+
+def setup_schedule(config: Config) -> None:
+    """Run the backup or restore task on its schedule, blocking until the process is stopped.
+
+    Args:
+        config (Config): The validated configuration, passed to every scheduled run.
+    """
+    jobs = JobsFile(
+        jobs=[config],
+        metrics_port=config.metrics_port,
+        metrics_file=Path(config.metrics_file) if config.metrics_file else None,
+    )
+    scheduler = _create_scheduler(JobRunner(jobs, _start_metrics(jobs)), [config])
+    logger.success(
+        f"Scheduled {'postgres' if config.use_postgres else 'filesystem'} {config.action} task"
+    )
+    scheduler.start()
+
+
+def run_jobs(jobs: JobsFile) -> bool:
+    """Run every job in a multi-job configuration file.
+
+    Jobs without a schedule run once, right away, and jobs with a schedule are then run on it by a single scheduler, blocking until the process is stopped. At most `max_concurrent_jobs` run at the same time.
+
+    Args:
+        jobs (JobsFile): The jobs and their limits.
+
+    Returns:
+        bool: True if every job that ran once succeeded. Only returns when no job is scheduled.
+    """
+    runner = JobRunner(jobs, _start_metrics(jobs))
+    once = [config for config in jobs.jobs if not config.schedule]
+    scheduled = [config for config in jobs.jobs if config.schedule]
+
+    succeeded = True
+    if once:
+        with ThreadPoolExecutor(
+            max_workers=jobs.max_concurrent_jobs, thread_name_prefix="hsb-job"
+        ) as pool:
+            succeeded = all(list(pool.map(runner.run, once)))
+
+    if scheduled:
+        scheduler = _create_scheduler(runner, scheduled)
+        logger.success(f"Scheduled {len(scheduled)} {pluralize('job', len(scheduled))}")
+        scheduler.start()
+
+    return succeeded
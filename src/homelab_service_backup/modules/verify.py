@@ -0,0 +1,294 @@
+"""Verify backups against the digests recorded when they were written."""
+
+import contextvars
+import hashlib
+import stat
+import tarfile
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, cast
+
+import typer
+import zstandard
+from loguru import logger
+
+from homelab_service_backup.utils import (
+    Config,
+    DigestReader,
+    FileDigest,
+    check_cancelled,
+    file_digest,
+    get_backup_codec,
+    get_catalog,
+    get_digests_path,
+    get_job_name,
+    is_snapshot,
+    limit_reads,
+    list_backup_files,
+    open_compressed_reader,
+    pause_under_pressure,
+    pluralize,
+    read_manifest,
+    resolve_backup_chain,
+    stream_digest,
+)
+from homelab_service_backup.utils.compression import resolve_worker_count
+
+VERIFY_CHUNK_SIZE = 1024 * 1024  # Bytes read at a time from what is left after the last member
+
+
+class _HashingReader:
+    """Hash the compressed bytes of an archive while they are decompressed, so the archive is read once."""
+
+    def __init__(self, fileobj: BinaryIO) -> None:
+        self.fileobj = fileobj
+        self._hash = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        """Read from the archive and hash what was read.
+
+        Args:
+            size (int, optional): The number of bytes to read. Defaults to -1, which reads everything.
+
+        Returns:
+            bytes: The bytes read.
+        """
+        data = self.fileobj.read(size)
+        self._hash.update(data)
+        return data
+
+    def finish(self) -> str:
+        """Hash the rest of the archive, which decompressors leave unread after the end of the tar stream.
+
+        Returns:
+            str: The SHA-256 of the whole archive.
+        """
+        while self.read(VERIFY_CHUNK_SIZE):
+            pass
+
+        return self._hash.hexdigest()
+
+
+def _iter_members(archive: tarfile.TarFile) -> Iterator[tarfile.TarInfo]:
+    """Iterate the members of a stream-mode archive without `tarfile` keeping a list of them.
+
+    Yields:
+        tarfile.TarInfo: The next member, whose data can be read until the next one is requested.
+    """
+    while (member := archive.next()) is not None:
+        yield member
+        archive.members.clear()  # type: ignore[attr-defined]
+
+
+def _verify_members(stream: BinaryIO, digests: DigestReader, problems: list[str]) -> int:
+    """Digest every regular file in a decompressed archive and compare it with the manifest.
+
+    The manifest lists files in archive order, so both are read side by side and neither is held in memory.
+
+    Args:
+        stream (BinaryIO): The decompressed tar stream.
+        digests (DigestReader): The archive's digest manifest.
+        problems (list[str]): Mismatches found are appended to this list.
+
+    Returns:
+        int: The number of files checked.
+    """
+    expected_files = iter(digests)
+    files = 0
+    with tarfile.open(fileobj=stream, mode="r|") as archive:
+        for member in _iter_members(archive):
+            check_cancelled()
+            pause_under_pressure()
+            if not member.isreg():
+                continue
+
+            expected = next(expected_files, None)
+            if expected is None or expected.name != member.name:
+                problems.append(f"{member.name} is not where the digest manifest expects it")
+                return files
+
+            files += 1
+            data = cast("BinaryIO", archive.extractfile(member))
+            if stream_digest(data) != expected.digest:
+                problems.append(f"Digest mismatch: {member.name}")
+
+    # Reading the rest of the manifest also checks its signature
+    if missing := sum(1 for _ in expected_files):
+        problems.append(f"{missing} {pluralize('file', missing)} missing from the archive")
+
+    return files
+
+
+def _verify_archive(config: Config, backup_file: Path, checksum: str | None) -> bool:
+    """Check that an archive is intact, reading it once.
+
+    The SHA-256 of the whole archive is compared with the one in its digest manifest, or the catalog for archives written without one. With a digest manifest, the archive is also decompressed and every file's BLAKE2b digest compared.
+
+    Args:
+        config (Config): The validated configuration for this run.
+        backup_file (Path): The archive to verify.
+        checksum (str | None): The archive's SHA-256 recorded in the catalog.
+
+    Returns:
+        bool: True if the archive matches, False if anything differs or it can not be read.
+    """
+    has_digests = get_digests_path(backup_file).exists()
+    if not has_digests and checksum is None:
+        logger.warning(f"Skip {backup_file.name}, it was written without digests or a checksum")
+        return True
+
+    problems: list[str] = []
+    files = 0
+    try:
+        with backup_file.open("rb") as fh:
+            archive = _HashingReader(limit_reads(fh))
+            if has_digests:
+                reader = open_compressed_reader(
+                    cast("BinaryIO", archive), get_backup_codec(backup_file)
+                )
+                with DigestReader(backup_file, config.signing_key) as digests:
+                    files = _verify_members(reader, digests, problems)
+                checksum = digests.archive
+            actual = archive.finish()
+    except (tarfile.TarError, OSError, EOFError, ValueError, zstandard.ZstdError) as e:
+        problems.append(f"Can not read archive: {e}")
+    else:
+        if checksum is not None and actual != checksum:
+            problems.append("Archive checksum does not match")
+
+    for problem in problems:
+        logger.error(f"{backup_file.name}: {problem}")
+    if problems:
+        return False
+
+    logger.info(f"Verified {backup_file.name} ({files} {pluralize('file', files)})")
+    return True
+
+
+def _source_differs(root: Path, entry: FileDigest) -> bool:
+    """Check whether a file in the job data directory differs from its backed up copy, reading it only if its stat changed.
+
+    Returns:
+        bool: True if the file is missing, no longer a regular file, or its contents changed.
+    """
+    path = root / entry.name
+    try:
+        st = path.lstat()
+    except FileNotFoundError:
+        return True
+
+    if not stat.S_ISREG(st.st_mode):
+        return True
+
+    if (st.st_size, st.st_mtime_ns) == (entry.size, entry.mtime_ns):
+        return False
+
+    return st.st_size != entry.size or file_digest(path) != entry.digest
+
+
+def _compare_source(config: Config, chain: list[Path]) -> int:
+    """Compare the files of the newest backup with the job data directory.
+
+    Files whose size and modification time are unchanged are trusted without being read. Incremental chains are read newest archive first, so each file is compared with its newest copy, and files the newest manifest no longer lists are left out. Files added since the backup are not reported.
+
+    Args:
+        config (Config): The validated configuration for this run.
+        chain (list[Path]): The archives of the newest backup, oldest first.
+
+    Returns:
+        int: The number of files that differ.
+    """
+    manifest = read_manifest(chain[-1]) if len(chain) > 1 else None
+    current = set(manifest.files) if manifest else None
+    seen: set[str] = set()
+    differ = 0
+
+    for backup_file in reversed(chain):
+        if not get_digests_path(backup_file).exists():
+            logger.warning(f"Can not compare {backup_file.name}, it was written without digests")
+            continue
+
+        with DigestReader(backup_file, config.signing_key) as digests:
+            for entry in digests:
+                if current is not None:
+                    if entry.name in seen or entry.name not in current:
+                        continue
+                    seen.add(entry.name)
+
+                check_cancelled()
+                if _source_differs(config.job_data_dir, entry):
+                    logger.info(f"Changed since the backup: {entry.name}")
+                    differ += 1
+
+    return differ
+
+
+def do_verify(config: Config) -> bool:
+    """Verify every backup of the job in the backup storage directory.
+
+    Archives are verified in parallel, `verify_workers` at a time, each read once as a stream, so memory stays bounded however large they are. With `verify_source`, the newest backup is also compared with the job data directory. Files that changed there are reported, but only damaged backups fail the run. Repository snapshots and unpacked PostgreSQL directory dumps are skipped, so a job that only has those passes with nothing verified.
+
+    Args:
+        config (Config): The validated configuration for this run.
+
+    Returns:
+        bool: True if every archive and dump is intact or there are none to verify, False if any is damaged or the job has no backups.
+
+    Raises:
+        typer.Exit: If `verify_source` is set without a job data directory.
+    """
+    if config.verify_source and config.job_data_dir == Path("/nonexistent"):
+        logger.error("No job data directory specified to compare backups with")
+        raise typer.Exit(code=1)
+
+    catalog = {entry.name: entry for entry in get_catalog(config).for_job(get_job_name(config))}
+    backups = []
+    all_backups = list_backup_files(config)
+    for backup_file in all_backups:
+        if backup_file.is_file() and not is_snapshot(backup_file):
+            backups.append(backup_file)
+        else:
+            logger.debug(f"Skip {backup_file.name}, only archives and dumps can be verified")
+
+    if not all_backups:
+        logger.error(f"No backups found to verify for {get_job_name(config)}")
+        return False
+
+    if not backups:
+        logger.info(
+            f"Nothing to verify for {get_job_name(config)}, it only has snapshots and dumps"
+        )
+        return True
+
+    workers = min(resolve_worker_count(config.verify_workers), len(backups))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hsb-verify") as pool:
+        futures = [
+            pool.submit(
+                contextvars.copy_context().run,
+                _verify_archive,
+                config,
+                backup_file,
+                catalog[backup_file.name].checksum,
+            )
+            for backup_file in backups
+        ]
+        failed = sum(not future.result() for future in futures)
+
+    if failed:
+        logger.error(f"{failed} of {len(backups)} {pluralize('backup', len(backups))} failed")
+        return False
+
+    logger.success(f"Verified {len(backups)} {pluralize('backup', len(backups))}")
+
+    newest = all_backups[-1]
+    if config.verify_source and not config.use_postgres and not is_snapshot(newest):
+        differ = _compare_source(config, resolve_backup_chain(newest))
+        if differ:
+            logger.warning(
+                f"{differ} {pluralize('file', differ)} in {config.job_data_dir} changed since {newest.name}"
+            )
+        else:
+            logger.info(f"{config.job_data_dir} matches {newest.name}")
+
+    return True
@@ -2,31 +2,204 @@
 
 from .console import console  # isort:skip
 from .logging import InterceptHandler, instantiate_logger  # isort:skip
-from .config import Config
+from .archive_index import ArchiveIndex, IndexEntry, IndexWriter, file_checksum, read_index
+from .cancellation import (
+    RunCancelledError,
+    cancellable,
+    check_cancelled,
+    is_cancelled,
+    wait_for_command,
+)
+from .catalog import Catalog, CatalogEntry, get_catalog
+from .compression import (
+    CompressedWriter,
+    ParallelGzipWriter,
+    open_compressed_reader,
+    open_compressed_writer,
+)
+from .config import Config, get_config, use_config
+from .digests import (
+    DigestManifestError,
+    DigestReader,
+    DigestWriter,
+    FileDigest,
+    file_digest,
+    get_digests_path,
+    new_file_hash,
+    stream_digest,
+)
+from .extract import ParallelExtractor
+from .filters import BackupFilter
 from .helpers import (
     chown_all_files,
     clean_directory,
     clean_old_backups,
     filter_file_for_backup,
     find_most_recent_backup,
+    get_backup_codec,
     get_backup_file_extension,
+    get_chown_ids,
     get_current_time,
     get_job_name,
+    get_postgres_connection_args,
+    get_postgres_env,
+    is_directory_dump,
+    list_backup_files,
+    pluralize,
+    prune_chunk_store,
     type_of_backup,
 )
+from .history import RunHistory, RunRecord
+from .jobs import JobsFile, JobsFileError, load_jobs_file
+from .lease import LeaseTimeoutError, StorageLease
+from .manifest import FileState, Manifest, read_manifest, resolve_backup_chain
+from .metrics import (
+    MetricsRegistry,
+    RunStats,
+    collect_stats,
+    count_run,
+    serve_metrics,
+)
+from .output import OutputCommandError, is_streaming, open_backup_output
+from .pressure import PressureMonitor, pause_under_pressure, read_pressure, watch_pressure
+from .profiling import MemoryProfiler, RunProfiler, StackSampler, get_profile_dir, profiled
+from .repository import (
+    ChunkStore,
+    Snapshot,
+    create_snapshot,
+    get_chunk_store_path,
+    is_snapshot,
+    restore_snapshot,
+)
+from .streaming import StreamFeeder, format_bytes
+from .tar_writer import TarWriter
+from .throttle import (
+    TokenBucket,
+    get_io_priority,
+    has_priority,
+    io_limits,
+    limit_reads,
+    limit_writes,
+    lower_priority,
+    throttle_read,
+    throttle_write,
+)
+from .tracing import (
+    RunTrace,
+    Span,
+    count_span,
+    get_report_path,
+    span,
+    timed_iter,
+    traced,
+)
+from .walker import WalkEntry, add_to_tar, walk_directory
 
 __all__ = [
+    "ArchiveIndex",
+    "BackupFilter",
+    "Catalog",
+    "CatalogEntry",
+    "ChunkStore",
+    "CompressedWriter",
     "Config",
+    "DigestManifestError",
+    "DigestReader",
+    "DigestWriter",
+    "FileDigest",
+    "FileState",
+    "IndexEntry",
+    "IndexWriter",
     "InterceptHandler",
+    "JobsFile",
+    "JobsFileError",
+    "LeaseTimeoutError",
+    "Manifest",
+    "MemoryProfiler",
+    "MetricsRegistry",
+    "OutputCommandError",
+    "ParallelExtractor",
+    "ParallelGzipWriter",
+    "PressureMonitor",
+    "RunCancelledError",
+    "RunHistory",
+    "RunProfiler",
+    "RunRecord",
+    "RunStats",
+    "RunTrace",
+    "Snapshot",
+    "Span",
+    "StackSampler",
+    "StorageLease",
+    "StreamFeeder",
+    "TarWriter",
+    "TokenBucket",
+    "WalkEntry",
+    "add_to_tar",
+    "cancellable",
+    "check_cancelled",
     "chown_all_files",
     "clean_directory",
     "clean_old_backups",
+    "collect_stats",
     "console",
+    "count_run",
+    "count_span",
+    "create_snapshot",
+    "file_checksum",
+    "file_digest",
     "filter_file_for_backup",
     "find_most_recent_backup",
+    "format_bytes",
+    "get_backup_codec",
     "get_backup_file_extension",
+    "get_catalog",
+    "get_chown_ids",
+    "get_chunk_store_path",
+    "get_config",
     "get_current_time",
+    "get_digests_path",
+    "get_io_priority",
     "get_job_name",
+    "get_postgres_connection_args",
+    "get_postgres_env",
+    "get_profile_dir",
+    "get_report_path",
+    "has_priority",
     "instantiate_logger",
+    "io_limits",
+    "is_cancelled",
+    "is_directory_dump",
+    "is_snapshot",
+    "is_streaming",
+    "limit_reads",
+    "limit_writes",
+    "list_backup_files",
+    "load_jobs_file",
+    "lower_priority",
+    "new_file_hash",
+    "open_backup_output",
+    "open_compressed_reader",
+    "open_compressed_writer",
+    "pause_under_pressure",
+    "pluralize",
+    "profiled",
+    "prune_chunk_store",
+    "read_index",
+    "read_manifest",
+    "read_pressure",
+    "resolve_backup_chain",
+    "restore_snapshot",
+    "serve_metrics",
+    "span",
+    "stream_digest",
+    "throttle_read",
+    "throttle_write",
+    "timed_iter",
+    "traced",
     "type_of_backup",
+    "use_config",
+    "wait_for_command",
+    "walk_directory",
+    "watch_pressure",
 ]
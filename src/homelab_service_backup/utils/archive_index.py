@@ -0,0 +1,286 @@
+"""Member indexes that let single paths be restored without reading a whole archive."""
+
+import gzip
+import json
+import os
+import stat
+import tarfile
+import zlib
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import TracebackType
+from typing import NamedTuple, Self
+
+INDEX_SUFFIX = ".index.jsonl.gz"
+INDEX_VERSION = 2
+LEGACY_INDEX_SUFFIX = ".index.json.gz"  # Version 1, a single JSON object that is read whole
+INDEX_BLOCK_SIZE = 4 * 1024 * 1024  # Uncompressed bytes between the points a restore can seek to
+
+
+class IndexEntry(NamedTuple):
+    """Where a member is stored in a compressed archive, and enough of its metadata to tell whether a file on disk matches it."""
+
+    block: int  # Compressed offset of the independently decompressible block holding the member
+    offset: int  # Uncompressed offset of the member's tar header within that block
+    size: int
+    checksum: int | None  # CRC-32 of the member's data, None for entries without data
+    mtime: int
+    kind: str  # The tar type flag, such as "0" for a regular file or "5" for a directory
+    linkname: str
+
+    @classmethod
+    def from_tarinfo(
+        cls, tarinfo: tarfile.TarInfo, block: int, offset: int, checksum: int | None
+    ) -> "IndexEntry":
+        """Build an index entry for a member that was just added to an archive.
+
+        Args:
+            tarinfo (tarfile.TarInfo): The member.
+            block (int): The compressed offset of the block the member was written to.
+            offset (int): The uncompressed offset of the member within the block.
+            checksum (int | None): The CRC-32 of the member's data.
+
+        Returns:
+            IndexEntry: The index entry.
+        """
+        return cls(
+            block=block,
+            offset=offset,
+            size=tarinfo.size,
+            checksum=checksum,
+            mtime=int(tarinfo.mtime),
+            kind=tarinfo.type.decode(),
+            linkname=tarinfo.linkname,
+        )
+
+    def is_current(
+        self, root: Path, name: str, st: os.stat_result, *, compare_checksum: bool = False
+    ) -> bool:
+        """Check whether what is on disk already matches this member, so restoring it can be skipped.
+
+        Regular files match on type, size and whole-second modification time, and optionally on their CRC-32. Directories match if they exist, symlinks if they point to the same target and hard links if they share an inode with their target. Other file types never match.
+
+        Args:
+            root (Path): The directory being restored into.
+            name (str): The member's path relative to `root`.
+            st (os.stat_result): The result of `lstat()` on the member's path.
+            compare_checksum (bool, optional): Also read regular files and compare their CRC-32. Defaults to False.
+
+        Returns:
+            bool: True if the path does not need to be restored.
+        """
+        path = root / name
+        match self.kind.encode():
+            case tarfile.DIRTYPE:
+                return stat.S_ISDIR(st.st_mode)
+            case tarfile.SYMTYPE:
+                return stat.S_ISLNK(st.st_mode) and str(path.readlink()) == self.linkname
+            case tarfile.LNKTYPE:
+                target = root / self.linkname
+                return target.exists() and target.lstat().st_ino == st.st_ino
+            case tarfile.REGTYPE | tarfile.AREGTYPE:
+                return (
+                    stat.S_ISREG(st.st_mode)
+                    and st.st_size == self.size
+                    and int(st.st_mtime) == self.mtime
+                    and (not compare_checksum or file_checksum(path) == self.checksum)
+                )
+            case _:
+                return False
+
+
+@dataclass
+class ArchiveIndex:
+    """Map every member of a backup archive to the compressed block it can be read from.
+
+    Archives are written as a series of gzip members or zstd frames that each start on a tar member boundary, so a reader can seek to a block, decompress from there and skip at most `INDEX_BLOCK_SIZE` bytes to reach the member it wants.
+    """
+
+    backup: str
+    members: dict[str, IndexEntry] = field(default_factory=dict)
+
+    def select(self, paths: list[str]) -> dict[str, IndexEntry]:
+        """Find the members that are, or are below, any of the given paths.
+
+        Args:
+            paths (list[str]): Paths relative to the backed up directory.
+
+        Returns:
+            dict[str, IndexEntry]: The matching members.
+        """
+        prefixes = tuple(f"{path}/" for path in paths)
+        return {
+            name: entry
+            for name, entry in self.members.items()
+            if name in paths or name.startswith(prefixes)
+        }
+
+    def write(self, backup_file: Path) -> Path:
+        """Write the index next to its backup archive.
+
+        Args:
+            backup_file (Path): The backup archive the index describes.
+
+        Returns:
+            Path: The path of the written index.
+        """
+        with IndexWriter(backup_file, backup=self.backup) as writer:
+            for name, entry in self.members.items():
+                writer.add(name, entry)
+
+        return writer.path
+
+
+class IndexWriter:
+    """Write an archive index member by member while the archive is written, so the index is never held in memory.
+
+    The index is a gzipped JSON lines file: a header, then one `[name, block, offset, size, checksum, mtime, kind, linkname]` line per member in archive order. Readers can pick out the members they want by the start of each line, without loading the rest.
+
+    Lines are appended to a temporary file that replaces the index once the block exits without an exception. An index whose archive failed is removed.
+    """
+
+    def __init__(self, backup_file: Path, backup: str | None = None) -> None:
+        self.path = get_index_path(backup_file)
+        self._temporary = self.path.with_name(f".{self.path.name}.tmp")
+        self._file = gzip.open(self._temporary, "wb")  # noqa: SIM115
+        self._write_line({"version": INDEX_VERSION, "backup": backup or backup_file.name})
+
+    def _write_line(self, value: object) -> None:
+        """Append a JSON line to the index."""
+        self._file.write(f"{json.dumps(value, separators=(',', ':'))}\n".encode())
+
+    def add(self, name: str, entry: IndexEntry) -> None:
+        """Append a member to the index.
+
+        Args:
+            name (str): The member's name in the archive.
+            entry (IndexEntry): Where the member is stored.
+        """
+        self._write_line([name, *entry])
+
+    def __enter__(self) -> Self:
+        """Enter the runtime context.
+
+        Returns:
+            Self: The writer instance.
+        """
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        """Complete the index, or remove it if an exception is propagating."""
+        if exc_type is not None:
+            self._file.close()
+            self._temporary.unlink(missing_ok=True)
+            return
+
+        self._file.close()
+        self._temporary.replace(self.path)
+
+
+def file_checksum(path: Path) -> int:
+    """Compute the CRC-32 of a file on disk.
+
+    Returns:
+        int: The checksum.
+    """
+    checksum = 0
+    with path.open("rb") as f:
+        while chunk := f.read(1024 * 1024):
+            checksum = zlib.crc32(chunk, checksum)
+
+    return checksum
+
+
+def get_index_path(backup_file: Path) -> Path:
+    """Return the path of the index that belongs to a backup archive.
+
+    Args:
+        backup_file (Path): The backup archive.
+
+    Returns:
+        Path: The index path.
+    """
+    return backup_file.with_name(f"{backup_file.name}{INDEX_SUFFIX}")
+
+
+def get_legacy_index_path(backup_file: Path) -> Path:
+    """Return the path a version 1 index of a backup archive was written to.
+
+    Args:
+        backup_file (Path): The backup archive.
+
+    Returns:
+        Path: The legacy index path.
+    """
+    return backup_file.with_name(f"{backup_file.name}{LEGACY_INDEX_SUFFIX}")
+
+
+def _line_prefixes(paths: list[str]) -> tuple[bytes, ...]:
+    """Encode the starts of the index lines of members that are, or are below, any of the given paths.
+
+    Returns:
+        tuple[bytes, ...]: The prefixes, for `bytes.startswith`.
+    """
+    prefixes: list[bytes] = []
+    for path in paths:
+        quoted = json.dumps(path)[
+            :-1
+        ]  # The opening quote and the escaped path, as the writer encodes it
+        prefixes.extend((f'[{quoted}",'.encode(), f"[{quoted}/".encode()))
+    return tuple(prefixes)
+
+
+def read_index(backup_file: Path, paths: list[str] | None = None) -> ArchiveIndex | None:
+    """Load the members of the index that belongs to a backup archive.
+
+    The index is read as a stream. With `paths`, lines are matched on their raw bytes and only the selected members are decoded and kept, so looking up a few paths in an archive of millions of files holds just those in memory. Indexes written before version 2 are a single JSON object and are loaded whole.
+
+    Args:
+        backup_file (Path): The backup archive.
+        paths (list[str] | None, optional): Only load members that are, or are below, these paths. Defaults to None, which loads every member.
+
+    Returns:
+        ArchiveIndex | None: The index with the selected members, or None if the backup was written without one.
+    """
+    path = get_index_path(backup_file)
+    if not path.exists():
+        return _read_legacy_index(backup_file, paths)
+
+    prefixes = _line_prefixes(paths) if paths is not None else None
+    with gzip.open(path, "rb") as f:
+        header = json.loads(f.readline())
+        index = ArchiveIndex(backup=header["backup"])
+        for line in f:
+            if prefixes is not None and not line.startswith(prefixes):
+                continue
+            name, *entry = json.loads(line)
+            index.members[name] = IndexEntry(*entry)
+
+    return index
+
+
+def _read_legacy_index(backup_file: Path, paths: list[str] | None) -> ArchiveIndex | None:
+    """Load a version 1 index, written as a single JSON object.
+
+    Returns:
+        ArchiveIndex | None: The index with the selected members, or None if there is no such index.
+    """
+    path = get_legacy_index_path(backup_file)
+    if not path.exists():
+        return None
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        data = json.load(f)
+
+    index = ArchiveIndex(
+        backup=data["backup"],
+        members={name: IndexEntry(*entry) for name, entry in data["members"].items()},
+    )
+    if paths is not None:
+        index.members = index.select(paths)
+    return index
@@ -0,0 +1,81 @@
+"""Cancel a running job from another thread."""
+
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager, suppress
+from contextvars import ContextVar
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from sh import RunningCommand
+
+COMMAND_POLL_INTERVAL = 0.5  # Seconds between checks for cancellation while a command runs
+
+_cancel_event: ContextVar[threading.Event | None] = ContextVar("cancel_event", default=None)
+
+
+class RunCancelledError(Exception):
+    """Raised inside a job run that was cancelled, so it stops at the next safe point."""
+
+
+@contextmanager
+def cancellable(event: threading.Event) -> Iterator[None]:
+    """Let the run in this block be cancelled by setting an event.
+
+    Threads can not be stopped from the outside, so the run checks the event between files, archive members and while waiting for external commands, and raises `RunCancelledError` once it is set.
+
+    Args:
+        event (threading.Event): Set from another thread to cancel the run.
+    """
+    token = _cancel_event.set(event)
+    try:
+        yield
+    finally:
+        _cancel_event.reset(token)
+
+
+def is_cancelled() -> bool:
+    """Check whether the run in the current thread was cancelled.
+
+    Returns:
+        bool: True if the run was cancelled.
+    """
+    event = _cancel_event.get()
+    return event is not None and event.is_set()
+
+
+def check_cancelled() -> None:
+    """Stop the run in the current thread if it was cancelled.
+
+    Raises:
+        RunCancelledError: If the run was cancelled.
+    """
+    if is_cancelled():
+        raise RunCancelledError
+
+
+def wait_for_command(command: "RunningCommand") -> None:
+    """Wait for a command started with `_bg=True`, terminating it if the run is cancelled.
+
+    Args:
+        command (RunningCommand): The command, started with `_bg_exc=False` so a failure is raised here and not printed by sh's background thread.
+
+    Raises:
+        RunCancelledError: If the run was cancelled while the command ran.
+    """
+    from sh import ErrorReturnCode, TimeoutException  # noqa: PLC0415
+
+    event = _cancel_event.get()
+    if event is None:
+        command.wait()
+        return
+
+    while not event.is_set():
+        with suppress(TimeoutException):
+            command.wait(timeout=COMMAND_POLL_INTERVAL)
+            return
+
+    command.terminate()
+    with suppress(ErrorReturnCode):
+        command.wait()
+    raise RunCancelledError
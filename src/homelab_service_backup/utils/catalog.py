@@ -0,0 +1,306 @@
+"""An append-only catalog of the backups in the backup storage directory."""
+
+import fcntl
+import json
+import os
+import re
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import NamedTuple
+
+from loguru import logger
+
+from homelab_service_backup.constants import (
+    FILESYSTEM_BACKUP_EXTENSIONS,
+    POSTGRES_BACKUP_EXTENSIONS,
+    POSTGRES_DIRECTORY_EXTENSIONS,
+    REPOSITORY_SNAPSHOT_EXT,
+)
+
+from .config import Config
+
+CATALOG_FILENAME = "hsb-catalog.jsonl"
+CATALOG_VERSION = 1
+CATALOG_COMPACT_THRESHOLD = 1000  # Superseded records tolerated before the catalog is rewritten
+
+BACKUP_NAME_PATTERN = re.compile(
+    r"^(?P<job>.+)-(?P<timestamp>\d{8}T\d{6})-(?P<type>hourly|daily|weekly|monthly|yearly)\.(?P<extension>[a-z.]+)$"
+)
+BACKUP_EXTENSIONS = frozenset(
+    {
+        *FILESYSTEM_BACKUP_EXTENSIONS.values(),
+        *POSTGRES_BACKUP_EXTENSIONS.values(),
+        *POSTGRES_DIRECTORY_EXTENSIONS.values(),
+        REPOSITORY_SNAPSHOT_EXT,
+    }
+)
+
+
+class CatalogEntry(NamedTuple):
+    """A backup recorded in the catalog."""
+
+    name: str
+    job: str
+    timestamp: str
+    type: str
+    created: float  # Seconds since the epoch when the backup was written, used to order backups
+    size: int
+    codec: str | None
+    checksum: str | None  # SHA-256 of the backup file, when it was recorded as it was written
+
+
+def parse_backup_name(name: str) -> dict[str, str] | None:
+    """Split a backup file name into its job, timestamp, type and extension.
+
+    Args:
+        name (str): The file name, such as `job-20240101T000000-daily.tgz`.
+
+    Returns:
+        dict[str, str] | None: The parts of the name, or None if it is not a backup.
+
+    Examples:
+        >>> parse_backup_name("nginx-20240101T000000-daily.tgz")["job"]
+        'nginx'
+        >>> parse_backup_name("notes.txt") is None
+        True
+    """
+    match = BACKUP_NAME_PATTERN.match(name)
+    if not match or match["extension"] not in BACKUP_EXTENSIONS:
+        return None
+
+    return match.groupdict()
+
+
+def _detect_codec(extension: str) -> str | None:
+    """Find the compression codec that belongs to a backup extension.
+
+    Returns:
+        str | None: The codec, or None for backups that are not compressed as a single stream.
+    """
+    for extensions in (FILESYSTEM_BACKUP_EXTENSIONS, POSTGRES_BACKUP_EXTENSIONS):
+        for codec, candidate in extensions.items():
+            if extension == candidate:
+                return codec
+
+    return None
+
+
+def _disk_usage(path: Path) -> int:
+    """Sum the size of a backup, which is a directory for unpacked PostgreSQL dumps.
+
+    Returns:
+        int: The size in bytes.
+    """
+    if not path.is_dir():
+        return path.stat().st_size
+
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+
+class Catalog:
+    """Record every backup in the backup storage directory in a single JSON lines file.
+
+    Listing backups, finding the newest one and applying retention read this one file instead of globbing and statting every archive, which is slow on network storage holding thousands of backups. Records are only ever appended: adding a backup appends an `add` record and deleting one appends a `remove` record. The file is rewritten without superseded records once they pile up, and rebuilt from the directory if it is missing.
+
+    Several jobs can share a storage directory, so every write holds an exclusive lock on a lock file next to the catalog. Compacting and rebuilding replay the catalog while holding the lock, so records appended by another job in the meantime are never dropped. Loaded entries are cached until the catalog file changes.
+    """
+
+    _cache: dict[Path, tuple[tuple[int, int, int], dict[str, CatalogEntry], int]] = {}  # noqa: RUF012
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self.path = directory / CATALOG_FILENAME
+        self.lock_path = directory / f".{CATALOG_FILENAME}.lock"
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        """Hold the catalog's write lock."""
+        with self.lock_path.open("a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _append(self, records: list[dict]) -> None:
+        """Append records to the catalog, creating it from the directory first if it is missing. Call with the lock held."""
+        if not self.path.exists():
+            self._rebuild()
+
+        with self.path.open("a", encoding="utf-8") as f:
+            f.writelines(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+
+    def _load(self) -> tuple[dict[str, CatalogEntry], int]:
+        """Replay the catalog's records.
+
+        Returns:
+            tuple[dict[str, CatalogEntry], int]: The current entries by name and the number of records read.
+        """
+        st = self.path.stat()
+        signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+        cached = self._cache.get(self.path)
+        if cached and cached[0] == signature:
+            return cached[1], cached[2]
+
+        entries: dict[str, CatalogEntry] = {}
+        records = 0
+        with self.path.open(encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                records += 1
+                if record["op"] == "add":
+                    entries[record["name"]] = CatalogEntry(
+                        **{field: record.get(field) for field in CatalogEntry._fields}
+                    )
+                elif record["op"] == "remove":
+                    entries.pop(record["name"], None)
+
+        self._cache[self.path] = (signature, entries, records)
+        return entries, records
+
+    def entries(self) -> dict[str, CatalogEntry]:
+        """Load every backup in the catalog, building the catalog from the directory if it does not exist yet.
+
+        Returns:
+            dict[str, CatalogEntry]: The backups by file name.
+        """
+        if not self.path.exists():
+            self.rebuild()
+
+        return self._load()[0]
+
+    def for_job(self, job: str) -> list[CatalogEntry]:
+        """List the backups of one job, oldest first.
+
+        Args:
+            job (str): The job name the backups were written under.
+
+        Returns:
+            list[CatalogEntry]: The job's backups.
+        """
+        return sorted(
+            (entry for entry in self.entries().values() if entry.job == job),
+            key=lambda x: x.created,
+        )
+
+    def add(self, backup_file: Path, size: int | None = None, checksum: str | None = None) -> None:
+        """Record a backup that was just written.
+
+        Args:
+            backup_file (Path): The backup file or directory.
+            size (int | None, optional): The size of the backup. Defaults to reading it from disk.
+            checksum (str | None, optional): The SHA-256 of the backup file. Defaults to None.
+        """
+        parts = parse_backup_name(backup_file.name)
+        if parts is None:
+            logger.warning(f"Not recording {backup_file.name} in the catalog, it is not a backup")
+            return
+
+        record = {
+            "op": "add",
+            "name": backup_file.name,
+            "job": parts["job"],
+            "timestamp": parts["timestamp"],
+            "type": parts["type"],
+            "created": time.time(),
+            "size": _disk_usage(backup_file) if size is None else size,
+            "codec": _detect_codec(parts["extension"]),
+            "checksum": checksum,
+        }
+        with self._lock():
+            self._append([record])
+
+    def remove(self, names: list[str]) -> None:
+        """Record that backups were deleted, and compact the catalog once enough records are superseded.
+
+        Args:
+            names (list[str]): The file names of the deleted backups.
+        """
+        if not names:
+            return
+
+        with self._lock():
+            self._append([{"op": "remove", "name": name} for name in names])
+
+            entries, records = self._load()
+            if records - len(entries) > CATALOG_COMPACT_THRESHOLD:
+                self._write(list(entries.values()))
+
+    def _write(self, entries: list[CatalogEntry]) -> None:
+        """Replace the catalog with one `add` record per entry. Call with the lock held, with entries replayed or scanned under it."""
+        temporary = self.path.with_name(f".{CATALOG_FILENAME}.tmp")
+        with temporary.open("w", encoding="utf-8") as f:
+            f.write(
+                json.dumps({"op": "version", "version": CATALOG_VERSION}, separators=(",", ":"))
+                + "\n"
+            )
+            for entry in sorted(entries, key=lambda x: x.created):
+                f.write(json.dumps({"op": "add", **entry._asdict()}, separators=(",", ":")))
+                f.write("\n")
+            f.flush()
+            os.fsync(f.fileno())
+        temporary.replace(self.path)
+
+    def rebuild(self) -> int:
+        """Rebuild the catalog from the backups in the directory.
+
+        Backups found on disk are ordered by their modification time. Checksums recorded when a backup was written are kept, since they can not be recomputed cheaply.
+
+        Returns:
+            int: The number of backups in the rebuilt catalog.
+        """
+        with self._lock():
+            return self._rebuild()
+
+    def _rebuild(self) -> int:
+        """Rebuild the catalog from the backups in the directory. Call with the lock held.
+
+        Returns:
+            int: The number of backups in the rebuilt catalog.
+        """
+        previous: dict[str, CatalogEntry] = {}
+        if self.path.exists():
+            try:
+                previous = self._load()[0]
+            except (json.JSONDecodeError, KeyError, TypeError) as e:
+                logger.warning(f"Ignore unreadable catalog {self.path}: {e}")
+
+        entries = []
+        for path in self.directory.iterdir():
+            parts = parse_backup_name(path.name)
+            if parts is None:
+                continue
+
+            known = previous.get(path.name)
+            entries.append(
+                CatalogEntry(
+                    name=path.name,
+                    job=parts["job"],
+                    timestamp=parts["timestamp"],
+                    type=parts["type"],
+                    created=known.created if known else path.stat().st_mtime,
+                    size=_disk_usage(path),
+                    codec=_detect_codec(parts["extension"]),
+                    checksum=known.checksum if known else None,
+                )
+            )
+
+        self._write(entries)
+        logger.debug(f"Rebuilt catalog with {len(entries)} backups in {self.directory}")
+        return len(entries)
+
+
+def get_catalog(config: Config) -> Catalog:
+    """Open the catalog of the configured backup storage directory.
+
+    Args:
+        config (Config): The job's configuration.
+
+    Returns:
+        Catalog: The catalog.
+    """
+    return Catalog(config.backup_storage_dir)
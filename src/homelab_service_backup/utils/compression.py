@@ -0,0 +1,480 @@
+"""Compression codecs for backup archives."""
+
+import gzip
+import io
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import TracebackType
+from typing import BinaryIO, Literal, Self, cast
+
+import zstandard
+
+from .metrics import count_run
+from .tracing import count_span
+
+GZIP_BLOCK_SIZE = 128 * 1024  # Matches the pigz default block size
+DEFLATE_DICT_SIZE = 32 * 1024  # Maximum distance a deflate back-reference can reach
+
+CodecName = Literal["gzip", "zstd", "none"]
+DEFAULT_COMPRESSION_LEVELS: dict[CodecName, int] = {"gzip": 9, "zstd": 10, "none": 0}
+
+
+def resolve_worker_count(workers: int) -> int:
+    """Translate a configured worker count into the number of threads to run.
+
+    Treat zero or negative values as "use every available CPU" so a single setting works across nodes with different core counts.
+
+    Args:
+        workers (int): The configured number of workers.
+
+    Returns:
+        int: The number of worker threads to start, never less than one.
+    """
+    if workers > 0:
+        return workers
+
+    return os.cpu_count() or 1
+
+
+def _deflate_block(data: bytes, zdict: bytes, level: int, *, last: bool) -> bytes:
+    """Compress a single block into a raw deflate fragment that can be concatenated with its neighbours.
+
+    Prime the compressor with the tail of the previous block so back-references across block boundaries keep the compression ratio close to a single-stream compressor. Non-final blocks end with a sync flush so they finish on a byte boundary without setting the final-block bit.
+
+    Args:
+        data (bytes): The uncompressed block.
+        zdict (bytes): Up to 32 KiB of uncompressed data that precedes this block in the stream.
+        level (int): The deflate compression level.
+        last (bool): Whether this is the final block of the stream.
+
+    Returns:
+        bytes: The raw deflate fragment for this block.
+    """
+    if zdict:
+        compressor = zlib.compressobj(
+            level,
+            zlib.DEFLATED,
+            -zlib.MAX_WBITS,
+            zlib.DEF_MEM_LEVEL,
+            zlib.Z_DEFAULT_STRATEGY,
+            zdict,
+        )
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+
+
+class ParallelGzipWriter:
+    """Write a standard single-member gzip stream while compressing blocks on a pool of threads.
+
+    Split incoming data into fixed-size blocks, deflate them concurrently and write the results in order, the same approach pigz uses. The output is an ordinary gzip file that `gzip`, `tar` and Python's `gzip` module can read. zlib releases the GIL while compressing so threads scale across cores.
+
+    The underlying file object is not closed by `close()`, mirroring how `tarfile` treats a caller-supplied `fileobj`.
+
+    Examples:
+        >>> import gzip, io
+        >>> buffer = io.BytesIO()
+        >>> with ParallelGzipWriter(buffer, workers=2, block_size=4) as writer:
+        ...     _ = writer.write(b"hello world")
+        >>> gzip.decompress(buffer.getvalue())
+        b'hello world'
+    """
+
+    def __init__(
+        self,
+        fileobj: BinaryIO,
+        level: int = 9,
+        workers: int = 0,
+        block_size: int = GZIP_BLOCK_SIZE,
+    ) -> None:
+        self.fileobj = fileobj
+        self.level = level
+        self.workers = resolve_worker_count(workers)
+        self.block_size = block_size
+        self.closed = False
+
+        self._buffer = bytearray()
+        self._zdict = b""
+        self._crc = 0
+        self._size = 0
+        self._needs_header = False
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hsb-gzip")
+        # Bound the number of blocks in flight so memory stays proportional to the worker count
+        self._max_pending = self.workers * 2
+        self._pending: deque[Future[bytes]] = deque()
+
+        self._write_header()
+
+    def __enter__(self) -> Self:
+        """Enter the runtime context.
+
+        Returns:
+            Self: The writer instance.
+        """
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        """Finish the gzip stream when leaving the runtime context."""
+        if exc_type is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self.closed = True
+            return
+
+        self.close()
+
+    def _write_header(self) -> None:
+        """Write the fixed ten byte gzip member header."""
+        if self.level >= zlib.Z_BEST_COMPRESSION:
+            extra_flags = 2
+        elif self.level == zlib.Z_BEST_SPEED:
+            extra_flags = 4
+        else:
+            extra_flags = 0
+
+        self.fileobj.write(
+            b"\x1f\x8b\x08\x00"
+            + struct.pack("<I", int(time.time()) & 0xFFFFFFFF)
+            + bytes([extra_flags, 255])
+        )
+
+    def _submit(self, block: bytes, *, last: bool) -> None:
+        """Queue a block for compression and write out any blocks that are ready."""
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+
+        self._pending.append(
+            self._executor.submit(_deflate_block, block, self._zdict, self.level, last=last)
+        )
+        self._zdict = block[-DEFLATE_DICT_SIZE:] if block else self._zdict
+
+        while len(self._pending) >= self._max_pending:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def writable(self) -> bool:  # noqa: PLR6301
+        """Report that the stream accepts writes.
+
+        Returns:
+            bool: Always True.
+        """
+        return True
+
+    def write(self, data: bytes) -> int:
+        """Buffer data and dispatch every complete block to the worker pool.
+
+        Args:
+            data (bytes): The uncompressed bytes to add to the stream.
+
+        Returns:
+            int: The number of bytes accepted.
+
+        Raises:
+            ValueError: If the writer has already been closed.
+        """
+        if self.closed:
+            msg = "write to closed ParallelGzipWriter"
+            raise ValueError(msg)
+
+        if self._needs_header and data:
+            self._write_header()
+            self._needs_header = False
+
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[: self.block_size])
+            del self._buffer[: self.block_size]
+            self._submit(block, last=False)
+
+        return len(data)
+
+    def flush(self) -> None:
+        """Accept flush requests without ending the current block.
+
+        Callers such as `sh` flush after every chunk they write. Emitting a partial block on each flush would shrink blocks and hurt the compression ratio, so buffered data stays buffered until a block fills or the stream is closed.
+        """
+
+    def end_member(self) -> None:
+        """Finish the current gzip member so the data written next starts a new, independent one.
+
+        Readers treat concatenated members as a single stream, but each member can also be decompressed on its own by seeking to where it starts. The header of the next member is written with the next data, so ending a member right before `close()` does not add an empty one.
+        """
+        if self._needs_header:
+            return
+
+        self._submit(bytes(self._buffer), last=True)
+        self._buffer.clear()
+        while self._pending:
+            self.fileobj.write(self._pending.popleft().result())
+
+        self.fileobj.write(struct.pack("<II", self._crc & 0xFFFFFFFF, self._size & 0xFFFFFFFF))
+        self._crc = 0
+        self._size = 0
+        self._zdict = b""
+        self._needs_header = True
+
+    def close(self) -> None:
+        """Compress the remaining data, wait for all workers and write the gzip trailer."""
+        if self.closed:
+            return
+
+        self.end_member()
+        self._executor.shutdown(wait=True)
+        self.fileobj.flush()
+        self.closed = True
+
+
+class _ByteCounter:
+    """Count the bytes written through to a file object and the time spent writing them."""
+
+    def __init__(self, fileobj: BinaryIO) -> None:
+        self.fileobj = fileobj
+        self.count = 0
+        self.seconds = 0.0
+
+    def write(self, data: bytes) -> int:
+        """Write data to the file object and count it.
+
+        Args:
+            data (bytes): The bytes to write.
+
+        Returns:
+            int: The number of bytes written.
+        """
+        started = time.perf_counter()
+        self.fileobj.write(data)
+        self.seconds += time.perf_counter() - started
+        self.count += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        """Flush the file object."""
+        self.fileobj.flush()
+
+
+class CompressedWriter:
+    """Present every codec behind the same write-only stream interface.
+
+    Wrap the codec specific stream so callers can hand one object to `tarfile` or `sh` regardless of the configured codec. `flush()` never ends a compression block because `sh` flushes after every chunk it writes, and `close()` finishes the compressed stream without closing the underlying file.
+
+    `start_block()` ends the current gzip member or zstd frame, so a reader can later seek to `block_offset` and decompress from there without reading anything before it. `tell()` reports the uncompressed position, like `gzip.GzipFile`.
+    """
+
+    def __init__(self, fileobj: BinaryIO, codec: CodecName, level: int, workers: int) -> None:
+        self.codec = codec
+        self.closed = False
+        self.block_offset = 0
+        self.block_start = 0
+
+        self._counter = _ByteCounter(fileobj)
+        self._position = 0
+        self._seconds = 0.0  # Spent compressing and writing, for the run's trace
+        sink = cast("BinaryIO", self._counter)
+        self._stream: ParallelGzipWriter | zstandard.ZstdCompressionWriter | None
+        match codec:
+            case "gzip":
+                self._stream = ParallelGzipWriter(sink, level=level, workers=workers)
+            case "zstd":
+                compressor = zstandard.ZstdCompressor(
+                    level=level, threads=resolve_worker_count(workers)
+                )
+                self._stream = compressor.stream_writer(sink, closefd=False)
+            case "none":
+                self._stream = None
+        self._fileobj = fileobj
+
+    def __enter__(self) -> Self:
+        """Enter the runtime context.
+
+        Returns:
+            Self: The writer instance.
+        """
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        """Finish the compressed stream when leaving the runtime context."""
+        if exc_type is not None and isinstance(self._stream, ParallelGzipWriter):
+            self._stream.__exit__(exc_type, exc_value, traceback)
+            self.closed = True
+            return
+
+        self.close()
+
+    def writable(self) -> bool:  # noqa: PLR6301
+        """Report that the stream accepts writes.
+
+        Returns:
+            bool: Always True.
+        """
+        return True
+
+    def write(self, data: bytes) -> int:
+        """Compress data into the underlying file.
+
+        Args:
+            data (bytes): The uncompressed bytes to add to the stream.
+
+        Returns:
+            int: The number of bytes accepted.
+        """
+        started = time.perf_counter()
+        if self._stream is None:
+            self._counter.write(data)
+        else:
+            self._stream.write(data)
+        self._seconds += time.perf_counter() - started
+
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        """Report how many uncompressed bytes were written.
+
+        Returns:
+            int: The uncompressed position in the stream.
+        """
+        return self._position
+
+    @property
+    def block_size(self) -> int:
+        """Uncompressed bytes written since the current block started."""
+        return self._position - self.block_start
+
+    def start_block(self) -> None:
+        """End the current compression block so the data written next can be decompressed on its own.
+
+        Afterwards `block_offset` is the compressed offset the new block starts at and `block_start` its uncompressed position. Does nothing if the current block is still empty.
+        """
+        if not self.block_size:
+            return
+
+        if isinstance(self._stream, ParallelGzipWriter):
+            self._stream.end_member()
+        elif self._stream is not None:
+            self._stream.flush(zstandard.FLUSH_FRAME)
+
+        self.block_offset = self._counter.count
+        self.block_start = self._position
+
+    def flush(self) -> None:
+        """Accept flush requests without ending the current compression block."""
+
+    def close(self) -> None:
+        """Finish the compressed stream and flush the underlying file.
+
+        Both sizes are counted towards the run's metrics, and the time spent compressing and writing towards the current span of its trace.
+        """
+        if self.closed:
+            return
+
+        started = time.perf_counter()
+        if self._stream is not None:
+            self._stream.close()
+        self._fileobj.flush()
+        self._seconds += time.perf_counter() - started
+        self.closed = True
+        count_run(read_bytes=self._position, written_bytes=self._counter.count)
+        count_span(
+            compress_seconds=self._seconds - self._counter.seconds,
+            write_seconds=self._counter.seconds,
+        )
+
+
+def open_compressed_writer(
+    fileobj: BinaryIO, codec: CodecName, level: int | None = None, workers: int = 0
+) -> CompressedWriter:
+    """Open a stream that compresses everything written to it with the chosen codec.
+
+    Use this instead of instantiating a compressor directly so the backup code stays independent of which codec a job is configured to use.
+
+    Args:
+        fileobj (BinaryIO): The file object that receives the compressed bytes. It is not closed by the writer.
+        codec (CodecName): The codec to compress with.
+        level (int | None, optional): The compression level. Defaults to the codec's default level.
+        workers (int, optional): Number of compression threads. `0` uses every CPU. Defaults to 0.
+
+    Returns:
+        CompressedWriter: The writer to send uncompressed data to.
+    """
+    if level is None:
+        level = DEFAULT_COMPRESSION_LEVELS[codec]
+
+    return CompressedWriter(fileobj, codec=codec, level=level, workers=workers)
+
+
+class _UnclosedReader(io.RawIOBase):
+    """Read from a file object without closing it when the reader is closed, like the decompressing readers."""
+
+    def __init__(self, fileobj: BinaryIO) -> None:
+        self._fileobj = fileobj
+
+    def readable(self) -> bool:  # noqa: PLR6301
+        """Report that the stream can be read.
+
+        Returns:
+            bool: Always True.
+        """
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        """Read bytes from the file object.
+
+        Args:
+            size (int, optional): The most bytes to read. Defaults to -1, which reads to the end.
+
+        Returns:
+            bytes: The bytes read, empty at the end of the file.
+        """
+        return self._fileobj.read(size)
+
+    def readinto(self, buffer: memoryview) -> int:  # type: ignore[override]
+        """Read bytes from the file object into a buffer.
+
+        Args:
+            buffer (memoryview): The buffer to fill.
+
+        Returns:
+            int: The number of bytes read.
+        """
+        data = self._fileobj.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def open_compressed_reader(fileobj: BinaryIO, codec: CodecName) -> BinaryIO:
+    """Open a stream that yields the decompressed contents of a backup.
+
+    Args:
+        fileobj (BinaryIO): The file object holding the compressed bytes. It is not closed by the reader.
+        codec (CodecName): The codec the data was compressed with.
+
+    Returns:
+        BinaryIO: A readable stream of decompressed bytes.
+    """
+    match codec:
+        case "gzip":
+            return cast("BinaryIO", gzip.GzipFile(fileobj=fileobj, mode="rb"))
+        case "zstd":
+            return cast(
+                "BinaryIO",
+                zstandard.ZstdDecompressor().stream_reader(
+                    fileobj, read_across_frames=True, closefd=False
+                ),
+            )
+        case _:
+            return cast("BinaryIO", _UnclosedReader(fileobj))
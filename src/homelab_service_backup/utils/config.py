@@ -1,5 +1,8 @@
 """Instantiate Config class and set default values."""
 
+from collections.abc import Iterator, Sequence
+from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
 from typing import ClassVar, Literal
 
@@ -11,34 +14,69 @@ class Config(BaseConfig):  # type: ignore [misc]
     """service-backup Configuration."""
 
     # Default values
-    action: Literal["backup", "restore"]
+    action: Literal["backup", "restore", "rebuild-catalog", "verify"]
+    backup_mode: Literal["full", "incremental", "repository"] = "full"
     backup_storage_dir: Path
     chown_group: str | None = None
     chown_user: str | None = None
+    compression: Literal["gzip", "zstd", "none"] = "gzip"
+    compression_level: int | None = None
+    compression_workers: int = 0
     delete_source: bool = False
     exclude_files: tuple[str, ...] = ()
     exclude_regex: str = ""
     host_name: str = "unknown"
     include_files: tuple[str, ...] = ()
     include_regex: str = ""
+    io_read_limit: int = 0
+    io_write_limit: int = 0
+    ionice: Literal["normal", "low", "idle"] = "normal"
     job_data_dir: Path = Path("/nonexistent")
     job_name: str
     log_file: str = "homelab_service_backup.log"
     log_level: str = "INFO"  # TRACE, DEBUG, INFO, WARNING, ERROR, CRITICAL
     log_to_file: bool = True
+    metrics_file: str = ""
+    metrics_port: int = 0
+    nice: int = 0
+    output: Literal["file", "stdout", "command"] = "file"
+    output_command: str = ""
+    pressure_deadline: int = 3600
+    pressure_resources: tuple[Literal["cpu", "io", "memory"], ...] = ("cpu", "io", "memory")
+    pressure_threshold: float = 0
+    profile: tuple[Literal["cpu", "sample", "memory"], ...] = ()
+    profile_dir: str = ""
+    restore_checksum: bool = False
+    restore_mode: Literal["clean", "delta"] = "clean"
+    restore_workers: int = 0
     retention_daily: int = 6
     retention_hourly: int = 2
     retention_monthly: int = 2
     retention_weekly: int = 3
     retention_yearly: int = 2
+    run_report: bool = False
+    sched_idle: bool = False
     schedule_day_of_week: str | None = None
     schedule_day: str | None = None
     schedule_hour: str | None = None
+    schedule_jitter: int = 600
     schedule_minute: str | None = None
+    schedule_misfire_grace: int = 3600
+    schedule_overlap: Literal["skip", "queue", "kill"] = "skip"
     schedule_week: str | None = None
     schedule: bool = False
+    signing_key: str = ""
+    storage_lease_slots: int = 0
+    storage_lease_timeout: int = 0
+    storage_lease_ttl: int = 300
+    trace_file: str = ""
     tz: str = "Etc/UTC"
+    verify_source: bool = False
+    verify_workers: int = 0
+    postgres_format: Literal["plain", "directory"] = "plain"
     postgres_host: str = "localhost"
+    postgres_jobs: int = 0
+    postgres_pack: bool = True
     postgres_port: int = 5432
     postgres_user: str = ""
     postgres_password: str = ""
@@ -49,33 +87,68 @@ class Config(BaseConfig):  # type: ignore [misc]
         file=".env",  # Default file to read from
         allow=[
             "HSB_ACTION",
+            "HSB_BACKUP_MODE",
             "HSB_BACKUP_STORAGE_DIR",
+            "HSB_COMPRESSION",
+            "HSB_COMPRESSION_LEVEL",
+            "HSB_COMPRESSION_WORKERS",
             "HSB_DELETE_SOURCE",
             "HSB_EXCLUDE_FILES",
             "HSB_EXCLUDE_REGEX",
             "HSB_HOST_NAME",
             "HSB_INCLUDE_FILES",
             "HSB_INCLUDE_REGEX",
+            "HSB_IO_READ_LIMIT",
+            "HSB_IO_WRITE_LIMIT",
+            "HSB_IONICE",
             "HSB_JOB_DATA_DIR",
             "HSB_JOB_NAME",
             "HSB_LOG_FILE",
             "HSB_LOG_LEVEL",
             "HSB_LOG_TO_FILE",
+            "HSB_METRICS_FILE",
+            "HSB_METRICS_PORT",
+            "HSB_NICE",
+            "HSB_OUTPUT",
+            "HSB_OUTPUT_COMMAND",
+            "HSB_PRESSURE_DEADLINE",
+            "HSB_PRESSURE_RESOURCES",
+            "HSB_PRESSURE_THRESHOLD",
+            "HSB_PROFILE",
+            "HSB_PROFILE_DIR",
+            "HSB_RESTORE_CHECKSUM",
+            "HSB_RESTORE_MODE",
+            "HSB_RESTORE_WORKERS",
             "HSB_RETENTION_DAILY",
             "HSB_RETENTION_HOURLY",
             "HSB_RETENTION_MONTHLY",
             "HSB_RETENTION_WEEKLY",
             "HSB_RETENTION_YEARLY",
+            "HSB_RUN_REPORT",
+            "HSB_SCHED_IDLE",
             "HSB_SCHEDULE_DAY_OF_WEEK",
             "HSB_SCHEDULE_DAY",
             "HSB_SCHEDULE_HOUR",
+            "HSB_SCHEDULE_JITTER",
             "HSB_SCHEDULE_MINUTE",
+            "HSB_SCHEDULE_MISFIRE_GRACE",
+            "HSB_SCHEDULE_OVERLAP",
             "HSB_SCHEDULE_WEEK",
             "HSB_SCHEDULE",
+            "HSB_SIGNING_KEY",
+            "HSB_STORAGE_LEASE_SLOTS",
+            "HSB_STORAGE_LEASE_TIMEOUT",
+            "HSB_STORAGE_LEASE_TTL",
+            "HSB_TRACE_FILE",
             "HSB_TZ",
+            "HSB_VERIFY_SOURCE",
+            "HSB_VERIFY_WORKERS",
             "HSB_CHOWN_UID",
             "HSB_CHOWN_GID",
+            "HSB_POSTGRES_FORMAT",
             "HSB_POSTGRES_HOST",
+            "HSB_POSTGRES_JOBS",
+            "HSB_POSTGRES_PACK",
             "HSB_POSTGRES_PORT",
             "HSB_POSTGRES_USER",
             "HSB_POSTGRES_PASSWORD",
@@ -84,33 +157,68 @@ class Config(BaseConfig):  # type: ignore [misc]
         ],
         remap={
             "HSB_ACTION": "action",
+            "HSB_BACKUP_MODE": "backup_mode",
             "HSB_BACKUP_STORAGE_DIR": "backup_storage_dir",
+            "HSB_COMPRESSION": "compression",
+            "HSB_COMPRESSION_LEVEL": "compression_level",
+            "HSB_COMPRESSION_WORKERS": "compression_workers",
             "HSB_DELETE_SOURCE": "delete_source",
             "HSB_EXCLUDE_FILES": "exclude_files",
             "HSB_EXCLUDE_REGEX": "exclude_regex",
             "HSB_HOST_NAME": "host_name",
             "HSB_INCLUDE_FILES": "include_files",
             "HSB_INCLUDE_REGEX": "include_regex",
+            "HSB_IO_READ_LIMIT": "io_read_limit",
+            "HSB_IO_WRITE_LIMIT": "io_write_limit",
+            "HSB_IONICE": "ionice",
             "HSB_JOB_DATA_DIR": "job_data_dir",
             "HSB_JOB_NAME": "job_name",
             "HSB_LOG_FILE": "log_file",
             "HSB_LOG_LEVEL": "log_level",
             "HSB_LOG_TO_FILE": "log_to_file",
+            "HSB_METRICS_FILE": "metrics_file",
+            "HSB_METRICS_PORT": "metrics_port",
+            "HSB_NICE": "nice",
+            "HSB_OUTPUT": "output",
+            "HSB_OUTPUT_COMMAND": "output_command",
+            "HSB_PRESSURE_DEADLINE": "pressure_deadline",
+            "HSB_PRESSURE_RESOURCES": "pressure_resources",
+            "HSB_PRESSURE_THRESHOLD": "pressure_threshold",
+            "HSB_PROFILE": "profile",
+            "HSB_PROFILE_DIR": "profile_dir",
+            "HSB_RESTORE_CHECKSUM": "restore_checksum",
+            "HSB_RESTORE_MODE": "restore_mode",
+            "HSB_RESTORE_WORKERS": "restore_workers",
             "HSB_RETENTION_DAILY": "retention_daily",
             "HSB_RETENTION_HOURLY": "retention_hourly",
             "HSB_RETENTION_MONTHLY": "retention_monthly",
             "HSB_RETENTION_WEEKLY": "retention_weekly",
             "HSB_RETENTION_YEARLY": "retention_yearly",
+            "HSB_RUN_REPORT": "run_report",
+            "HSB_SCHED_IDLE": "sched_idle",
             "HSB_SCHEDULE_DAY_OF_WEEK": "schedule_day_of_week",
             "HSB_SCHEDULE_DAY": "schedule_day",
             "HSB_SCHEDULE_HOUR": "schedule_hour",
+            "HSB_SCHEDULE_JITTER": "schedule_jitter",
             "HSB_SCHEDULE_MINUTE": "schedule_minute",
+            "HSB_SCHEDULE_MISFIRE_GRACE": "schedule_misfire_grace",
+            "HSB_SCHEDULE_OVERLAP": "schedule_overlap",
             "HSB_SCHEDULE_WEEK": "schedule_week",
             "HSB_SCHEDULE": "schedule",
+            "HSB_SIGNING_KEY": "signing_key",
+            "HSB_STORAGE_LEASE_SLOTS": "storage_lease_slots",
+            "HSB_STORAGE_LEASE_TIMEOUT": "storage_lease_timeout",
+            "HSB_STORAGE_LEASE_TTL": "storage_lease_ttl",
             "HSB_CHOWN_UID": "chown_user",
             "HSB_CHOWN_GID": "chown_group",
+            "HSB_TRACE_FILE": "trace_file",
             "HSB_TZ": "tz",
+            "HSB_VERIFY_SOURCE": "verify_source",
+            "HSB_VERIFY_WORKERS": "verify_workers",
+            "HSB_POSTGRES_FORMAT": "postgres_format",
             "HSB_POSTGRES_HOST": "postgres_host",
+            "HSB_POSTGRES_JOBS": "postgres_jobs",
+            "HSB_POSTGRES_PACK": "postgres_pack",
             "HSB_POSTGRES_PORT": "postgres_port",
             "HSB_POSTGRES_USER": "postgres_user",
             "HSB_POSTGRES_PASSWORD": "postgres_password",
@@ -119,22 +227,52 @@ class Config(BaseConfig):  # type: ignore [misc]
         },
     )
 
-    @validator("include_files", "exclude_files", pre=True, each_item=False)
-    def split_string(cls, v: str) -> tuple[str, ...]:
+    @validator(
+        "include_files", "exclude_files", "pressure_resources", "profile", pre=True, each_item=False
+    )
+    def split_string(cls, v: str | Sequence[str]) -> tuple[str, ...]:
         """Split a comma-separated string into a tuple of individual strings.
 
-        Convert a comma-delimited string into a tuple of substrings by splitting on commas. Used for parsing configuration values that accept multiple items.
+        Convert a comma-delimited string into a tuple of substrings by splitting on commas. Used for parsing configuration values that accept multiple items. Lists, as given in a multi-job TOML file, are kept as they are.
 
         Args:
-            v (str): The comma-separated string to split.
+            v (str | Sequence[str]): The comma-separated string to split, or a list of strings.
 
         Returns:
             tuple[str, ...]: A tuple containing the individual strings after splitting.
         """
         if not v:
             return ()
+        if not isinstance(v, str):
+            return tuple(v)
         return tuple(v.split(","))
 
+    @validator("io_read_limit", "io_write_limit", pre=True)
+    def parse_rate(cls, v: str | int) -> int:
+        """Convert a bandwidth such as `20M` into bytes per second.
+
+        Accept a plain number of bytes, or a number followed by `K`, `M` or `G` for kibibytes, mebibytes or gibibytes.
+
+        Args:
+            v (str | int): The bandwidth to convert.
+
+        Returns:
+            int: The bandwidth in bytes per second, 0 for no limit.
+
+        Raises:
+            ValueError: If the value is not a number with an optional unit.
+        """
+        if isinstance(v, int):
+            return v
+
+        text = str(v).strip().upper().removesuffix("B")
+        multiplier = 1024 ** ("KMG".index(text[-1]) + 1) if text and text[-1] in "KMG" else 1
+        try:
+            return int(float(text.rstrip("KMG") or 0) * multiplier)
+        except ValueError as e:
+            msg = f"Invalid bandwidth: {v}"
+            raise ValueError(msg) from e
+
     @validator("backup_storage_dir", "job_data_dir", pre=True)
     def validate_path(cls, string: str) -> Path:
         """Convert a string to a Path object and verify it exists on the filesystem.
@@ -155,3 +293,33 @@ class Config(BaseConfig):  # type: ignore [misc]
             msg = f"Path does not exist: {path}"
             raise ValueError(msg)
         return path
+
+
+_active_config: ContextVar[Config | None] = ContextVar("active_config", default=None)
+
+
+def get_config() -> Config:
+    """Return the configuration of the job running in the current thread.
+
+    In multi-job mode every job runs with its own configuration, set with `use_config`. Otherwise this is the configuration read from the environment.
+
+    Returns:
+        Config: The configuration.
+    """
+    return _active_config.get() or Config()
+
+
+@contextmanager
+def use_config(config: Config) -> Iterator[None]:
+    """Make `get_config` return a job's configuration until the block exits.
+
+    The configuration is held in a context variable, so jobs running on different threads each see their own.
+
+    Args:
+        config (Config): The job's configuration.
+    """
+    token = _active_config.set(config)
+    try:
+        yield
+    finally:
+        _active_config.reset(token)
@@ -0,0 +1,234 @@
+"""Signed manifests of the BLAKE2b digest of every file in a backup archive."""
+
+import gzip
+import hashlib
+import hmac
+import json
+from collections.abc import Iterator
+from pathlib import Path
+from types import TracebackType
+from typing import BinaryIO, NamedTuple, Self
+
+from .catalog import Catalog
+
+DIGESTS_SUFFIX = ".digests.jsonl.gz"
+DIGESTS_VERSION = 1
+DIGEST_SIZE = 32  # Bytes of each BLAKE2b digest
+DIGEST_CHUNK_SIZE = 1024 * 1024  # Bytes read at a time while digesting
+
+
+class DigestManifestError(ValueError):
+    """Raised when a digest manifest is truncated, its signature does not match or it is not signed with the configured key."""
+
+
+class FileDigest(NamedTuple):
+    """A regular file in an archive, with the stat data that tells whether the file on disk may have changed since."""
+
+    name: str
+    size: int
+    mtime_ns: int
+    digest: str  # Hex BLAKE2b digest of the file's data
+
+
+def new_file_hash() -> "hashlib.blake2b":
+    """Start the hash files are digested with.
+
+    Returns:
+        hashlib.blake2b: An empty BLAKE2b hash.
+    """
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def stream_digest(fileobj: BinaryIO) -> str:
+    """Digest everything that is left in a stream.
+
+    Returns:
+        str: The hex BLAKE2b digest.
+    """
+    digest = new_file_hash()
+    while chunk := fileobj.read(DIGEST_CHUNK_SIZE):
+        digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def file_digest(path: Path) -> str:
+    """Digest a file on disk.
+
+    Returns:
+        str: The hex BLAKE2b digest.
+    """
+    with path.open("rb") as f:
+        return stream_digest(f)
+
+
+def _signer(key: str) -> "hmac.HMAC | hashlib._Hash":
+    """Start the hash a manifest's lines are signed with, an HMAC if a key is configured.
+
+    Returns:
+        hmac.HMAC | hashlib._Hash: HMAC-SHA256 with the key, or a plain SHA-256 that only detects accidental damage.
+    """
+    if key:
+        return hmac.new(key.encode(), digestmod=hashlib.sha256)
+
+    return hashlib.sha256()
+
+
+class DigestWriter:
+    """Write a digest manifest file by file while the archive is written, so it is never held in memory.
+
+    The manifest is a gzipped JSON lines file: a header, one `[name, size, mtime_ns, digest]` line per regular file in archive order, a summary with the number of files and the SHA-256 of the archive, and a signature over every line before it. The archive's SHA-256 is the one `open_backup_output` records in the catalog, so enter the writer before the archive's output is opened and it is complete and cataloged by the time the manifest is finished.
+
+    Lines are appended to a temporary file that replaces the manifest once the block exits without an exception. A manifest whose archive failed is removed.
+    """
+
+    def __init__(self, backup_file: Path, key: str = "") -> None:
+        self.backup_file = backup_file
+        self.path = get_digests_path(backup_file)
+        self.files = 0
+        self._signed = bool(key)
+        self._signature = _signer(key)
+        self._temporary = self.path.with_name(f".{self.path.name}.tmp")
+        self._file = gzip.open(self._temporary, "wb")  # noqa: SIM115
+        self._write_line(
+            {"version": DIGESTS_VERSION, "backup": backup_file.name, "algorithm": "blake2b-256"}
+        )
+
+    def _write_line(self, value: object, *, signed: bool = True) -> None:
+        """Append a JSON line to the manifest, adding it to the signature unless it is the signature itself."""
+        line = f"{json.dumps(value, separators=(',', ':'))}\n".encode()
+        if signed:
+            self._signature.update(line)
+        self._file.write(line)
+
+    def add(self, entry: FileDigest) -> None:
+        """Append a file to the manifest.
+
+        Args:
+            entry (FileDigest): The file, in the order it was added to the archive.
+        """
+        self._write_line(entry)
+        self.files += 1
+
+    def __enter__(self) -> Self:
+        """Enter the runtime context.
+
+        Returns:
+            Self: The writer instance.
+        """
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        """Sign and complete the manifest, or remove it if an exception is propagating."""
+        if exc_type is not None:
+            self._file.close()
+            self._temporary.unlink(missing_ok=True)
+            return
+
+        cataloged = Catalog(self.backup_file.parent).entries().get(self.backup_file.name)
+        self._write_line({"files": self.files, "archive": cataloged and cataloged.checksum})
+        self._write_line(
+            {"signature": self._signature.hexdigest(), "signed": self._signed}, signed=False
+        )
+        self._file.close()
+        self._temporary.replace(self.path)
+
+
+class DigestReader:
+    """Read a digest manifest file by file, checking its signature once the last file was read.
+
+    Iterating yields the files in archive order. `archive` is set to the archive's SHA-256 once they are all read, and the signature is checked right after, raising `DigestManifestError` if the manifest was truncated or altered, is signed while no key is configured, or is unsigned while a key is.
+    """
+
+    def __init__(self, backup_file: Path, key: str = "") -> None:
+        self.path = get_digests_path(backup_file)
+        self.archive: str | None = None
+        self._key = key
+        self._signature = _signer(key)
+        self._file = gzip.open(self.path, "rb")  # noqa: SIM115
+        self.header = json.loads(self._read_line())
+
+    def _read_line(self) -> bytes:
+        """Read the next line and add it to the signature.
+
+        Returns:
+            bytes: The line.
+
+        Raises:
+            DigestManifestError: If the manifest ends before its signature.
+        """
+        line = self._file.readline()
+        if not line.endswith(b"\n"):
+            msg = f"Digest manifest is truncated: {self.path.name}"
+            raise DigestManifestError(msg)
+
+        self._signature.update(line)
+        return line
+
+    def __iter__(self) -> Iterator[FileDigest]:
+        """Yield every file in the manifest, then check the signature.
+
+        Yields:
+            FileDigest: The next file in archive order.
+        """
+        while isinstance(value := json.loads(self._read_line()), list):
+            yield FileDigest(*value)
+
+        self.archive = value["archive"]
+        self._check_signature(json.loads(self._file.readline() or b"{}"))
+
+    def _check_signature(self, trailer: dict) -> None:
+        """Compare the manifest's signature with the one computed while reading it.
+
+        Raises:
+            DigestManifestError: If the signature is missing, does not match, or was made with or without a key when the configuration says otherwise.
+        """
+        if "signature" not in trailer:
+            msg = f"Digest manifest is truncated: {self.path.name}"
+            raise DigestManifestError(msg)
+
+        if trailer["signed"] != bool(self._key):
+            msg = (
+                f"Digest manifest is signed, set HSB_SIGNING_KEY to verify it: {self.path.name}"
+                if trailer["signed"]
+                else f"Digest manifest is not signed: {self.path.name}"
+            )
+            raise DigestManifestError(msg)
+
+        if not hmac.compare_digest(trailer["signature"], self._signature.hexdigest()):
+            msg = f"Digest manifest signature does not match: {self.path.name}"
+            raise DigestManifestError(msg)
+
+    def __enter__(self) -> Self:
+        """Enter the runtime context.
+
+        Returns:
+            Self: The reader instance.
+        """
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        """Close the manifest when leaving the runtime context."""
+        self._file.close()
+
+
+def get_digests_path(backup_file: Path) -> Path:
+    """Return the path of the digest manifest that belongs to a backup archive.
+
+    Args:
+        backup_file (Path): The backup archive.
+
+    Returns:
+        Path: The digest manifest path.
+    """
+    return backup_file.with_name(f"{backup_file.name}{DIGESTS_SUFFIX}")
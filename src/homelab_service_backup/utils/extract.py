@@ -0,0 +1,247 @@
+"""Extract tar streams with a pool of writer threads."""
+
+import os
+import shutil
+import tarfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from types import TracebackType
+from typing import BinaryIO, Self
+
+from loguru import logger
+
+from .cancellation import check_cancelled
+from .compression import resolve_worker_count
+from .metrics import count_run
+from .pressure import pause_under_pressure
+from .throttle import throttle_write
+
+EXTRACT_MAX_PENDING_BYTES = 64 * 1024 * 1024  # File data read ahead of the writer threads
+EXTRACT_INLINE_SIZE = 8 * 1024 * 1024  # Larger files are streamed to disk by the reader thread
+EXTRACT_PRUNE_INTERVAL = 4096  # Queued writes between dropping the futures of finished ones
+
+
+class ParallelExtractor:
+    """Extract one or more tar streams into a directory, writing files on a pool of threads.
+
+    The archive is read once, in stream mode, on the calling thread. Directories and symlinks are created as they are read, so every later member's parent exists. The contents of small files are read into memory and written by the worker threads, with at most `max_pending_bytes` waiting at a time. Large files are streamed to disk directly. Hard links are created once the files they point to are written. Directory modes and timestamps are applied when the extractor is closed, deepest first, so writing their contents does not change them.
+
+    Every member passes through `tarfile.data_filter`, the same checks `extractall(filter="data")` applies. Device files and FIFOs, which the filter refuses, are logged and skipped instead of failing the restore. When `owner` is set, ownership is applied to each entry as it is written, so no second walk over the restored tree is needed.
+
+    Extract several archives with the same instance to replay an incremental chain. Each call to `extract` finishes writing before it returns.
+    """
+
+    def __init__(
+        self,
+        destination: Path,
+        workers: int = 0,
+        owner: tuple[int, int] | None = None,
+        max_pending_bytes: int = EXTRACT_MAX_PENDING_BYTES,
+    ) -> None:
+        self.destination = destination
+        self.owner = owner
+        self.max_pending_bytes = max_pending_bytes
+        self.files = 0
+        self.bytes_written = 0
+
+        self._dest = destination.resolve()
+        self._executor = ThreadPoolExecutor(
+            max_workers=resolve_worker_count(workers), thread_name_prefix="hsb-extract"
+        )
+        self._pending: dict[Path, Future[None]] = {}
+        self._pending_bytes = 0
+        self._condition = threading.Condition()
+        self._directories: dict[Path, tarfile.TarInfo] = {}
+        self._known_dirs: set[Path] = {self._dest}
+        self._error: BaseException | None = None
+
+    def __enter__(self) -> Self:
+        """Enter the runtime context.
+
+        Returns:
+            Self: The extractor instance.
+        """
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        """Wait for the writer threads and apply directory metadata when leaving the runtime context."""
+        if exc_type is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            return
+
+        self.close()
+
+    def _chown(self, path: Path) -> None:
+        """Apply the configured owner to a path without following symlinks."""
+        if self.owner:
+            os.lchown(path, *self.owner)
+
+    def _ensure_parent(self, path: Path) -> None:
+        """Create the parent directories of a path that the archive did not list."""
+        if path.parent not in self._known_dirs:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._known_dirs.add(path.parent)
+
+    def _wait_for(self, path: Path) -> None:
+        """Wait for an earlier write to the same path, so duplicate members keep archive order."""
+        future = self._pending.get(path)
+        if future is not None:
+            future.result()
+
+    def _release(self, size: int) -> None:
+        """Return buffered bytes to the budget once a worker has written them."""
+        with self._condition:
+            self._pending_bytes -= size
+            self._condition.notify_all()
+
+    def _reserve(self, size: int) -> None:
+        """Block until the buffered bytes fit in the budget, always admitting one file at a time."""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._pending_bytes == 0
+                or self._pending_bytes + size <= self.max_pending_bytes
+                or self._error is not None
+            )
+            self._pending_bytes += size
+
+        if self._error is not None:
+            raise self._error
+
+    def _write_file(self, path: Path, data: bytes, member: tarfile.TarInfo) -> None:
+        """Write a regular file and apply its metadata. Runs on a worker thread."""
+        try:
+            path.unlink(missing_ok=True)
+            path.write_bytes(data)
+            self._apply_metadata(path, member)
+        except BaseException as e:
+            with self._condition:
+                self._error = self._error or e
+            raise
+        finally:
+            self._release(len(data))
+
+    def _apply_metadata(self, path: Path, member: tarfile.TarInfo) -> None:
+        """Apply ownership, mode and modification time to an extracted entry."""
+        self._chown(path)
+        if member.mode is not None and not member.issym():
+            path.chmod(member.mode)
+        if member.mtime is not None and not member.issym():
+            os.utime(path, (member.mtime, member.mtime))
+
+    def _make_directory(self, path: Path, member: tarfile.TarInfo) -> None:
+        """Create a directory now and remember its metadata for `close`."""
+        if path.is_symlink() or (path.exists() and not path.is_dir()):
+            path.unlink()
+        path.mkdir(parents=True, exist_ok=True)
+        self._known_dirs.add(path)
+        self._chown(path)
+        self._directories[path] = member
+
+    def _make_symlink(self, path: Path, member: tarfile.TarInfo) -> None:
+        """Replace whatever is at a path with a symlink."""
+        self._wait_for(path)
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path)
+        else:
+            path.unlink(missing_ok=True)
+        path.symlink_to(member.linkname)
+        self._chown(path)
+
+    def _stream_file(self, archive: tarfile.TarFile, path: Path, member: tarfile.TarInfo) -> None:
+        """Copy a large file from the archive to disk without holding it in memory."""
+        self._wait_for(path)
+        source = archive.extractfile(member)
+        if source is None:
+            return
+
+        path.unlink(missing_ok=True)
+        with source, path.open("wb") as f:
+            shutil.copyfileobj(source, f, 1024 * 1024)
+        self._apply_metadata(path, member)
+
+    def _prune(self) -> None:
+        """Forget finished writes so archives with millions of files do not keep a future for each."""
+        for path, future in list(self._pending.items()):
+            if future.done():
+                future.result()
+                del self._pending[path]
+
+    def _drain(self) -> None:
+        """Wait for every queued write and raise the first error any worker hit."""
+        pending = list(self._pending.values())
+        self._pending.clear()
+        for future in pending:
+            future.result()
+
+    def extract(self, fileobj: BinaryIO) -> None:
+        """Extract every member of an uncompressed tar stream.
+
+        A cancelled run stops with `RunCancelledError` before the next member, and a run under pressure pauses there.
+
+        Args:
+            fileobj (BinaryIO): The tar stream. It is read sequentially and never seeked.
+        """
+        links: list[tuple[Path, tarfile.TarInfo]] = []
+
+        with tarfile.open(fileobj=fileobj, mode="r|") as archive:
+            for original in archive:
+                check_cancelled()
+                pause_under_pressure()
+                if original.isdev():
+                    logger.warning(f"Skip device file or FIFO: {original.name}")
+                    continue
+
+                member = tarfile.data_filter(original, str(self._dest))
+                path = self._dest / member.name
+
+                if member.isdir():
+                    self._make_directory(path, member)
+                    continue
+
+                self._ensure_parent(path)
+                if member.issym():
+                    self._make_symlink(path, member)
+                elif member.islnk():
+                    links.append((path, member))
+                elif member.isreg():
+                    self.files += 1
+                    self.bytes_written += member.size
+                    count_run(files=1, read_bytes=member.size, written_bytes=member.size)
+                    throttle_write(member.size)
+                    if member.size > EXTRACT_INLINE_SIZE:
+                        self._stream_file(archive, path, member)
+                        continue
+
+                    source = archive.extractfile(member)
+                    data = source.read() if source else b""
+                    self._wait_for(path)
+                    self._reserve(len(data))
+                    self._pending[path] = self._executor.submit(
+                        self._write_file, path, data, member
+                    )
+                    if self.files % EXTRACT_PRUNE_INTERVAL == 0:
+                        self._prune()
+
+        self._drain()
+
+        for path, member in links:
+            path.unlink(missing_ok=True)
+            path.hardlink_to(self._dest / member.linkname)
+            self._apply_metadata(path, member)
+
+    def close(self) -> None:
+        """Finish writing and apply directory modes and timestamps, deepest first."""
+        self._drain()
+        self._executor.shutdown(wait=True)
+
+        self._chown(self._dest)
+        for path in sorted(self._directories, key=lambda x: len(x.parts), reverse=True):
+            if path.is_dir() and not path.is_symlink():
+                self._apply_metadata(path, self._directories[path])
+        self._directories.clear()
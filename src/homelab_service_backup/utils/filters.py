@@ -0,0 +1,275 @@
+"""Compiled include and exclude rules for filesystem backups."""
+
+import re
+from collections.abc import Iterable
+from functools import lru_cache
+from pathlib import PurePath
+
+from .config import Config
+
+_GLOB_CHARS = frozenset("*?[")
+
+
+def _glob_to_regex(pattern: str) -> tuple[str, bool]:
+    """Translate a gitignore-style glob into a regular expression for relative paths.
+
+    A pattern without a slash matches a name at any depth, a pattern containing a slash is anchored at the root of the backup, `**` matches across directories and `*`, `?` and `[...]` never match a `/`.
+
+    Args:
+        pattern (str): The glob pattern. A trailing slash restricts it to directories.
+
+    Returns:
+        tuple[str, bool]: The regular expression body, and whether the pattern only matches directories.
+    """
+    dir_only = pattern.endswith("/")
+    pattern = pattern.strip("/")
+    anchored = "/" in pattern
+
+    parts = [] if anchored else ["(?:.*/)?"]
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+            continue
+
+        if char == "*":
+            parts.append("[^/]*")
+        elif char == "?":
+            parts.append("[^/]")
+        elif char == "[" and (end := pattern.find("]", i + 2)) != -1:
+            members = pattern[i + 1 : end].replace("\\", "\\\\")
+            if members.startswith("!"):
+                members = "^" + members[1:]
+            parts.append(f"[{members}]")
+            i = end
+        else:
+            parts.append(re.escape(char))
+        i += 1
+
+    return "".join(parts), dir_only
+
+
+def _literal_prefix(pattern: str) -> str:
+    """Return the directories of an anchored glob that come before its first wildcard.
+
+    Returns:
+        str: The leading literal directories, without a trailing slash.
+    """
+    literal = pattern.strip("/")
+    for i, char in enumerate(literal):
+        if char in _GLOB_CHARS:
+            literal = literal[:i]
+            break
+
+    return literal.rpartition("/")[0] if "/" in literal else ""
+
+
+class _Rules:
+    """One side of a filter: exact paths, globs and an optional regex, compiled for fast lookups."""
+
+    def __init__(self, entries: Iterable[str], regex: str) -> None:
+        self.paths: set[str] = set()
+        self.prefixes: set[str] = set()
+        self.globs: list[str] = []
+        anywhere: list[str] = []
+        dirs: list[str] = []
+
+        for raw in entries:
+            entry = raw.strip().removeprefix("./")
+            if not entry.strip("/"):
+                continue
+
+            # A plain path names one file or directory relative to the source directory. A trailing slash or a wildcard makes the entry a glob, as in `.gitignore`
+            if _GLOB_CHARS.isdisjoint(entry) and not entry.endswith("/"):
+                path = entry.strip("/")
+                self.paths.add(path)
+                # Every parent of a listed path, used to decide whether a directory can hold a listed path
+                parent = PurePath(path).parent
+                while str(parent) != ".":
+                    self.prefixes.add(str(parent))
+                    parent = parent.parent
+                continue
+
+            self.globs.append(entry)
+            body, dir_only = _glob_to_regex(entry)
+            if dir_only:
+                # Anything below a matching directory matches, the directory itself only if it is one
+                anywhere.append(f"{body}/.*")
+                dirs.append(body)
+            else:
+                anywhere.append(f"{body}(?:/.*)?")
+
+        self.glob_regex = (
+            re.compile(f"(?:{'|'.join(anywhere)})\\Z", re.DOTALL) if anywhere else None
+        )
+        self.dir_regex = re.compile(f"(?:{'|'.join(dirs)})\\Z", re.DOTALL) if dirs else None
+        self.regex = re.compile(regex) if regex else None
+
+    def __bool__(self) -> bool:
+        return bool(self.paths or self.globs or self.regex)
+
+    def matches_subtree(self, path: str, *, is_dir: bool = False) -> bool:
+        """Check whether a path or one of its parents is selected by a path or glob rule.
+
+        Returns:
+            bool: True if the rule covers the path and therefore everything below it.
+        """
+        if self.paths:
+            candidate = path
+            while candidate:
+                if candidate in self.paths:
+                    return True
+                candidate = candidate.rpartition("/")[0]
+
+        if self.glob_regex and self.glob_regex.match(path):
+            return True
+
+        return bool(is_dir and self.dir_regex and self.dir_regex.match(path))
+
+    def matches(self, path: str, *, is_dir: bool = False) -> bool:
+        """Check whether a path is selected by any rule.
+
+        Returns:
+            bool: True if the path matches.
+        """
+        if self.matches_subtree(path, is_dir=is_dir):
+            return True
+
+        return bool(self.regex and self.regex.match(path))
+
+    def could_match_below(self, directory: str) -> bool:
+        """Check whether any rule could select an entry below a directory.
+
+        Returns:
+            bool: False only when no entry below the directory can match.
+        """
+        if self.regex:
+            return True
+        if directory in self.prefixes:
+            return True
+
+        for glob in self.globs:
+            if "/" not in glob.strip("/"):
+                return True
+            prefix = _literal_prefix(glob)
+            if not prefix or prefix == directory:
+                return True
+            if prefix.startswith(f"{directory}/") or directory.startswith(f"{prefix}/"):
+                return True
+
+        return False
+
+
+class BackupFilter:
+    """Decide which paths belong in a backup, compiled once from the include and exclude settings.
+
+    Build a filter once per backup run rather than evaluating the configuration for every file. Entries in the file lists are matched by path, and a directory entry also matches everything below it. Entries containing `*`, `?` or `[`, or ending in `/`, are gitignore-style globs, and all globs in one list are compiled into a single expression. Paths are matched relative to the backup source directory.
+    """
+
+    def __init__(
+        self,
+        include_files: Iterable[str] = (),
+        exclude_files: Iterable[str] = (),
+        include_regex: str = "",
+        exclude_regex: str = "",
+    ) -> None:
+        self._include = _Rules(include_files, include_regex)
+        self._exclude = _Rules(exclude_files, exclude_regex)
+
+    @classmethod
+    def from_config(cls, config: Config) -> "BackupFilter":
+        """Build the filter for the current configuration.
+
+        Args:
+            config (Config): The job's configuration.
+
+        Returns:
+            BackupFilter: The compiled filter, shared between calls with the same settings.
+        """
+        return _compile_filter(
+            config.include_files, config.exclude_files, config.include_regex, config.exclude_regex
+        )
+
+    def matches(self, path: PurePath | str, *, is_dir: bool = False) -> bool:
+        """Check whether a path passes the include rules and none of the exclude rules.
+
+        Args:
+            path (PurePath | str): The path relative to the backup source directory.
+            is_dir (bool, optional): Whether the path is a directory, which glob patterns ending in `/` require. Defaults to False.
+
+        Returns:
+            bool: True if the path should be backed up.
+        """
+        return self.included(path, is_dir=is_dir) and not self.excluded(path, is_dir=is_dir)
+
+    def included(self, path: PurePath | str, *, is_dir: bool = False) -> bool:
+        """Check whether a path passes the include rules, ignoring the exclude rules.
+
+        Args:
+            path (PurePath | str): The path relative to the backup source directory.
+            is_dir (bool, optional): Whether the path is a directory. Defaults to False.
+
+        Returns:
+            bool: True if there are no include rules or one of them matches the path.
+        """
+        test_path = path.as_posix() if isinstance(path, PurePath) else path
+        return not self._include or self._include.matches(test_path, is_dir=is_dir)
+
+    def excluded(self, path: PurePath | str, *, is_dir: bool = False) -> bool:
+        """Check whether a path matches any exclude rule.
+
+        Walkers apply this to every entry, also below a directory that was included, so an exclude rule wins at any depth.
+
+        Args:
+            path (PurePath | str): The path relative to the backup source directory.
+            is_dir (bool, optional): Whether the path is a directory. Defaults to False.
+
+        Returns:
+            bool: True if the path must not be backed up.
+        """
+        test_path = path.as_posix() if isinstance(path, PurePath) else path
+        return self._exclude.matches(test_path, is_dir=is_dir)
+
+    def could_match_under(self, directory: PurePath | str) -> bool:
+        """Check whether a directory can contain any path that passes the filter.
+
+        Use this to skip whole subtrees while walking the source directory. The check is conservative: a True result does not guarantee a match, but False means nothing below the directory will be backed up unless the directory itself is.
+
+        Args:
+            directory (PurePath | str): The directory relative to the backup source directory.
+
+        Returns:
+            bool: False if every path below the directory would be filtered out.
+        """
+        test_path = directory.as_posix() if isinstance(directory, PurePath) else directory
+
+        if self._exclude.matches_subtree(test_path, is_dir=True):
+            return False
+
+        if not self._include:
+            return True
+
+        return self._include.matches(test_path, is_dir=True) or self._include.could_match_below(
+            test_path
+        )
+
+
+@lru_cache(maxsize=8)
+def _compile_filter(
+    include_files: tuple[str, ...],
+    exclude_files: tuple[str, ...],
+    include_regex: str,
+    exclude_regex: str,
+) -> BackupFilter:
+    """Compile a filter once for each distinct set of rules.
+
+    Returns:
+        BackupFilter: The compiled filter.
+    """
+    return BackupFilter(include_files, exclude_files, include_regex, exclude_regex)
@@ -1,62 +1,218 @@
 """Helper utilities for service_backup."""
 
 import os
-import re
 import shutil
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-import arrow
-import inflect
-from arrow import Arrow
 from loguru import logger
 
-from homelab_service_backup.constants import FILESYSTEM_BACKUP_EXT, POSTGRES_BACKUP_EXT
+from homelab_service_backup.constants import (
+    FILESYSTEM_BACKUP_EXTENSIONS,
+    POSTGRES_BACKUP_EXTENSIONS,
+    POSTGRES_DIRECTORY_EXTENSIONS,
+    REPOSITORY_SNAPSHOT_EXT,
+)
 
+from .archive_index import get_index_path, get_legacy_index_path
+from .catalog import get_catalog
+from .compression import CodecName
 from .config import Config
+from .digests import get_digests_path
+from .filters import BackupFilter
+from .manifest import get_manifest_path, resolve_backup_chain
+from .repository import ChunkStore, Snapshot, get_chunk_store_path, is_snapshot
+from .tracing import get_report_path
 
-p = inflect.engine()
+if TYPE_CHECKING:
+    from arrow import Arrow
 
 
-def get_job_name() -> str:
+def pluralize(word: str, count: int) -> str:
+    """Return the singular or plural form of a noun for a count, for use in log messages.
+
+    Log messages only use regular nouns, so this avoids importing `inflect`, which takes seconds.
+
+    Args:
+        word (str): The singular noun.
+        count (int): The number of things the noun describes.
+
+    Returns:
+        str: The noun, with an `s` appended unless `count` is one.
+
+    Examples:
+        >>> pluralize("file", 1)
+        'file'
+        >>> pluralize("backup", 0)
+        'backups'
+    """
+    return word if count == 1 else f"{word}s"
+
+
+def get_job_name(config: Config) -> str:
     """Retrieve the name of the current job. If backup type is postgres, append '-postgres' to the job name.
 
+    Args:
+        config (Config): The job's configuration.
+
     Returns:
         str: The name of the current job.
     """
-    if Config().use_postgres:
-        return f"{Config().job_name}-postgres"
+    if config.use_postgres:
+        return f"{config.job_name}-postgres"
+
+    return config.job_name
+
+
+def get_postgres_connection_args(config: Config) -> list[str]:
+    """Build the connection arguments shared by pg_dump, pg_restore and psql.
+
+    Args:
+        config (Config): The job's configuration.
+
+    Returns:
+        list[str]: The host, port, user and database arguments.
+    """
+    return [
+        "-h",
+        config.postgres_host,
+        "-p",
+        str(config.postgres_port),
+        "-U",
+        config.postgres_user,
+        "-d",
+        config.postgres_db,
+    ]
+
+
+def get_postgres_env(config: Config) -> dict[str, str]:
+    """Build the environment for pg_dump, pg_restore and psql, with the password in `PGPASSWORD`.
+
+    The password is passed to each command rather than set in `os.environ`, so jobs for different databases can run at the same time.
+
+    Args:
+        config (Config): The job's configuration.
+
+    Returns:
+        dict[str, str]: The process environment with the job's password added.
+    """
+    return {**os.environ, "PGPASSWORD": config.postgres_password}
 
-    return Config().job_name
 
+def get_backup_file_extension(config: Config) -> str:
+    """Retrieve the file extension for the current backup type and configured compression codec.
 
-def get_backup_file_extension() -> str:
-    """Retrieve the file extension for the current backup type.
+    Args:
+        config (Config): The job's configuration.
 
     Returns:
         str: The file extension for the current backup type.
     """
-    if Config().use_postgres:
-        return POSTGRES_BACKUP_EXT
+    if config.use_postgres and config.postgres_format == "directory":
+        return POSTGRES_DIRECTORY_EXTENSIONS["tar" if config.postgres_pack else "directory"]
+
+    if config.use_postgres:
+        return POSTGRES_BACKUP_EXTENSIONS[config.compression]
+
+    if config.backup_mode == "repository":
+        return REPOSITORY_SNAPSHOT_EXT
+
+    return FILESYSTEM_BACKUP_EXTENSIONS[config.compression]
+
+
+def get_backup_codec(file: Path) -> CodecName:
+    """Detect the compression codec of a backup file from its extension.
+
+    Restores and retention rely on this rather than the current configuration so that changing `compression` does not orphan backups written with a previous codec.
+
+    Args:
+        file (Path): The backup file to inspect.
+
+    Returns:
+        CodecName: The codec the backup was written with.
+
+    Raises:
+        ValueError: If the extension does not belong to any known codec.
+    """
+    for extensions in (FILESYSTEM_BACKUP_EXTENSIONS, POSTGRES_BACKUP_EXTENSIONS):
+        for codec, extension in extensions.items():
+            if file.name.endswith(f".{extension}"):
+                return codec  # type: ignore [return-value]
+
+    msg = f"Unknown backup file extension: {file.name}"
+    raise ValueError(msg)
 
-    return FILESYSTEM_BACKUP_EXT
 
+def is_directory_dump(file: Path) -> bool:
+    """Check whether a backup is a directory-format PostgreSQL dump rather than a SQL file.
 
-def chown_all_files(directory: Path | str) -> None:
+    Args:
+        file (Path): The backup to inspect. Either the dump directory or a tar archive of it.
+
+    Returns:
+        bool: True if the backup must be restored with `pg_restore`.
+    """
+    return file.name.endswith(tuple(f".{ext}" for ext in POSTGRES_DIRECTORY_EXTENSIONS.values()))
+
+
+def list_backup_files(config: Config) -> list[Path]:
+    """List every backup file for the current job, regardless of the codec it was written with.
+
+    Backups are read from the catalog rather than by scanning the backup storage directory. Backups are matched on the job name recorded in the catalog, so a job named `foo` does not pick up the backups of `foo-postgres` or `foo-bar`. Directory-format PostgreSQL dumps stored unpacked are listed as their directory.
+
+    Args:
+        config (Config): The job's configuration.
+
+    Returns:
+        list[Path]: The backup files for the current job, oldest first.
+    """
+    if config.use_postgres:
+        extensions = [
+            *POSTGRES_BACKUP_EXTENSIONS.values(),
+            *POSTGRES_DIRECTORY_EXTENSIONS.values(),
+        ]
+    else:
+        extensions = [*FILESYSTEM_BACKUP_EXTENSIONS.values(), REPOSITORY_SNAPSHOT_EXT]
+    suffixes = tuple(f".{extension}" for extension in extensions)
+
+    return [
+        config.backup_storage_dir / entry.name
+        for entry in get_catalog(config).for_job(get_job_name(config))
+        if entry.name.endswith(suffixes)
+    ]
+
+
+def get_chown_ids(config: Config) -> tuple[int, int] | None:
+    """Retrieve the user and group id restored files should be owned by.
+
+    Args:
+        config (Config): The job's configuration.
+
+    Returns:
+        tuple[int, int] | None: The configured uid and gid, or None if either is not set.
+    """
+    if not config.chown_user or not config.chown_group:
+        return None
+
+    return int(config.chown_user), int(config.chown_group)
+
+
+def chown_all_files(config: Config, directory: Path | str) -> None:
     """Recursively change the ownership of all files in a directory.
 
     Args:
+        config (Config): The job's configuration.
         directory (Path | str): The directory to recursively change the ownership of.
     """
     if isinstance(directory, str):
         directory = Path(directory)
 
-    config = Config()
-    if not config.chown_user or not config.chown_group:
+    owner = get_chown_ids(config)
+    if owner is None:
         logger.debug("No chown_user or chown_group specified in config")
         return
 
-    uid = int(config.chown_user)
-    gid = int(config.chown_group)
+    uid, gid = owner
     # Find all files using pathlib and chown the owner and group
 
     os.chown(directory.resolve(), uid, gid)
@@ -70,43 +226,25 @@ def chown_all_files(directory: Path | str) -> None:
     logger.info(f"Changed ownership of all files in {directory} to {uid}:{gid}")
 
 
-def filter_file_for_backup(file: Path) -> bool:
+def filter_file_for_backup(config: Config, file: Path) -> bool:
     """Determine whether a file should be backed up based on inclusion and exclusion criteria.
 
     This function decides if a given file should be included in a backup operation. It evaluates
     the file against a set of inclusion and exclusion rules defined in the application's configuration.
     A file must meet any specified inclusion criteria and not meet any of the exclusion criteria to be
-    eligible for backup. The rules can be specified as exact file paths or regular expressions.
+    eligible for backup. The rules can be specified as file paths, glob patterns or regular expressions.
+    The rules are compiled once per configuration, see `BackupFilter` for the matching details.
 
     Args:
+        config (Config): The job's configuration.
         file (Path): The file path to evaluate for backup eligibility.
 
     Returns:
         bool: True if the file should be backed up, based on the evaluation of inclusion and
               exclusion rules. False otherwise.
     """
-    config = Config()
-    include_files = config.include_files
-    exclude_files = config.exclude_files
-    include_regex = re.compile(config.include_regex) if config.include_regex else None
-    exclude_regex = re.compile(config.exclude_regex) if config.exclude_regex else None
-
-    test_path = str(file)
-
-    # Skip files that don't match the include rules
-    if include_files and test_path not in include_files:
-        logger.trace(f"Skipping file due to include rules: {file}")
-        return False
-    if include_regex and not include_regex.match(test_path):
-        logger.trace(f"Skipping file due to include regex: {file}")
-        return False
-
-    # Skip files that match the exclude rules
-    if exclude_files and test_path in exclude_files:
-        logger.trace(f"Skipping file due to exclude rules: {file}")
-        return False
-    if exclude_regex and exclude_regex.match(test_path):
-        logger.trace(f"Skipping file due to exclude regex: {file}")
+    if not BackupFilter.from_config(config).matches(file):
+        logger.trace(f"Skipping file due to include/exclude rules: {file}")
         return False
 
     return True
@@ -125,24 +263,27 @@ def clean_directory(directory: Path) -> None:
     n = 0
     for child in directory.iterdir():
         n += 1
-        if child.is_file():
-            child.unlink()
-        else:
+        if child.is_dir() and not child.is_symlink():
             shutil.rmtree(child)
+        else:
+            child.unlink()
 
     if n == 0:
         logger.debug(f"{directory} is already empty")
     else:
-        logger.info(f"Deleted {n} {p.plural_noun('file', n)} in {directory}")
+        logger.info(f"Deleted {n} {pluralize('file', n)} in {directory}")
 
 
-def clean_old_backups() -> list[Path]:
+def clean_old_backups(config: Config) -> list[Path]:
     """Cleans up old database backups exceeding retention policies.
 
     Iterates over the backup files stored in the backup directory, organizing them by type
     (daily, weekly, monthly, yearly), and deletes files exceeding the retention count set for each
     type. It logs the action taken for each deleted backup.
 
+    Args:
+        config (Config): The job's configuration.
+
     Returns:
         A list of Path objects representing the backup files that were deleted.
     """
@@ -156,77 +297,126 @@ def clean_old_backups() -> list[Path]:
         "yearly": [],
     }
 
-    # Build the dictionary of backups
-    backup_dir = Config().backup_storage_dir
-    job_name = get_job_name()
-    for file in sorted(
-        backup_dir.glob(f"{job_name}-*.{get_backup_file_extension()}"),
-        key=lambda x: x.stat().st_mtime,
-        reverse=True,
-    ):
+    # Build the dictionary of backups, newest first
+    for file in reversed(list_backup_files(config)):
         for backup_type in backups:  # noqa: PLC0206
             if file.name and backup_type in file.name:
                 backups[backup_type].append(file)
 
-    # # Now delete the old backups
-    deleted_files = []
+    expired = []
     for backup_type in backups:  # noqa: PLC0206
-        policy = getattr(Config(), f"retention_{backup_type}", 2)
+        policy = getattr(config, f"retention_{backup_type}", 2)
         if len(backups[backup_type]) > policy:
-            for backup in backups[backup_type][policy:]:
-                logger.debug(f"Delete {backup.name}")
-                deleted_files.append(backup)
-                backup.unlink()
-                deleted += 1
+            expired.extend(backups[backup_type][policy:])
+
+    # Keep every archive a retained incremental backup depends on so each chain stays restorable
+    retained = {backup for type_backups in backups.values() for backup in type_backups}.difference(
+        expired
+    )
+    required = {ancestor for backup in retained for ancestor in resolve_backup_chain(backup)[:-1]}
+
+    # # Now delete the old backups
+    deleted_files = []
+    for backup in expired:
+        if backup in required:
+            logger.debug(f"Keep {backup.name} because a retained backup depends on it")
+            continue
+
+        logger.debug(f"Delete {backup.name}")
+        deleted_files.append(backup)
+        if backup.is_dir():
+            shutil.rmtree(backup)
+        else:
+            backup.unlink(missing_ok=True)
+        get_manifest_path(backup).unlink(missing_ok=True)
+        get_index_path(backup).unlink(missing_ok=True)
+        get_legacy_index_path(backup).unlink(missing_ok=True)
+        get_digests_path(backup).unlink(missing_ok=True)
+        get_report_path(backup).unlink(missing_ok=True)
+        deleted += 1
+
+    get_catalog(config).remove([backup.name for backup in deleted_files])
+
+    if any(is_snapshot(backup) for backup in deleted_files):
+        prune_chunk_store(config)
 
     return deleted_files
 
 
-def get_current_time() -> Arrow:
+def prune_chunk_store(config: Config) -> int:
+    """Delete chunks from the job's chunk store that no remaining snapshot references.
+
+    Call after snapshots are removed so repository mode reclaims the space of data that only expired backups contained.
+
+    Args:
+        config (Config): The job's configuration.
+
+    Returns:
+        int: The number of chunks deleted.
+    """
+    store = ChunkStore(get_chunk_store_path(config.backup_storage_dir, get_job_name(config)))
+    referenced: set[str] = set()
+    for snapshot in filter(is_snapshot, list_backup_files(config)):
+        referenced.update(Snapshot.read(snapshot).referenced_chunks())
+
+    deleted = store.prune(referenced)
+    if deleted:
+        logger.info(f"Delete {deleted} unreferenced {pluralize('chunk', deleted)}")
+
+    return deleted
+
+
+def get_current_time(config: Config) -> "Arrow":
     """Retrieves the current time, optionally adjusted to a specific timezone.
 
     Return the current time as an Arrow object. If a timezone is specified in the application's configuration, adjusts the time to that timezone; otherwise, uses UTC.
 
+    Args:
+        config (Config): The job's configuration.
+
     Returns:
         The current time as an Arrow object, possibly adjusted for timezone.
     """
-    return arrow.utcnow().to(Config().tz)
+    import arrow  # noqa: PLC0415
 
+    return arrow.utcnow().to(config.tz)
 
-def find_most_recent_backup() -> Path | None:
+
+def find_most_recent_backup(config: Config) -> Path | None:
     """Find and return the most recent backup file for the current job.
 
-    Search the backup directory for files matching the job name pattern and return the newest one based on modification time. The search uses the job name and appropriate file extension for the current backup type.
+    Look up the job's backups in the catalog and return the one written last. Backups written with any compression codec are considered so switching codecs does not hide older backups.
+
+    Args:
+        config (Config): The job's configuration.
 
     Returns:
         Path | None: Path to the most recent backup file, or None if no backups exist.
     """
-    job_name = get_job_name()
-    backup_dir = Config().backup_storage_dir
-    backup_files = sorted(
-        backup_dir.glob(f"{job_name}-*.{get_backup_file_extension()}"),
-        key=lambda x: x.stat().st_mtime,
-    )
+    backup_files = list_backup_files(config)
 
     return backup_files[-1] if backup_files else None
 
 
-def type_of_backup() -> str:
+def type_of_backup(config: Config) -> str:
     """Determines the backup type based on the current date.
 
     Evaluates the current date to decide whether the backup should be classified as yearly,
     monthly, weekly, or daily.
 
+    Args:
+        config (Config): The job's configuration.
+
     Returns:
         A string representing the backup type ('yearly', 'monthly', 'weekly', 'daily').
     """
-    now = get_current_time()
+    now = get_current_time(config)
 
     today = now.format("YYYY-MM-DD")
     yearly = now.span("year")[0].format("YYYY-MM-DD")
     monthly = now.span("month")[0].format("YYYY-MM-DD")
 
-    most_recent = find_most_recent_backup()
+    most_recent = find_most_recent_backup(config)
 
     if most_recent and now.format("YYYYMMDD") in most_recent.name:
         return "hourly"
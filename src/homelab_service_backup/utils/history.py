@@ -0,0 +1,79 @@
+"""A record of how long every job run took."""
+
+import fcntl
+import json
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Literal, NamedTuple
+
+HISTORY_FILENAME = "hsb-runs.jsonl"
+HISTORY_KEEP = 1000  # Runs kept once the history is trimmed, it is trimmed at twice this many
+
+RunOutcome = Literal["success", "failed", "cancelled", "skipped", "deferred"]
+
+
+class RunRecord(NamedTuple):
+    """One run of a job."""
+
+    job: str
+    action: str
+    started: float  # Seconds since the epoch
+    duration: float  # Seconds
+    outcome: RunOutcome
+
+
+class RunHistory:
+    """Record the runs of the jobs using a backup storage directory in a JSON lines file.
+
+    Every run appends one record, so slow or overlapping runs can be spotted and schedules tuned to how long jobs really take. Several jobs and processes can share a storage directory, so every write holds an exclusive lock on a lock file next to the history. The oldest runs are dropped once the file holds twice `HISTORY_KEEP` records.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self.path = directory / HISTORY_FILENAME
+        self.lock_path = directory / f".{HISTORY_FILENAME}.lock"
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        """Hold the history's write lock."""
+        with self.lock_path.open("a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def add(self, record: RunRecord) -> None:
+        """Append a finished run, trimming the oldest runs once there are too many.
+
+        Args:
+            record (RunRecord): The run.
+        """
+        line = json.dumps(record._asdict(), separators=(",", ":")) + "\n"
+        with self._lock():
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(line)
+
+            lines = self.path.read_text(encoding="utf-8").splitlines(keepends=True)
+            if len(lines) > 2 * HISTORY_KEEP:
+                temporary = self.path.with_name(f".{HISTORY_FILENAME}.tmp")
+                temporary.write_text("".join(lines[-HISTORY_KEEP:]), encoding="utf-8")
+                temporary.replace(self.path)
+
+    def runs(self, job: str | None = None) -> list[RunRecord]:
+        """List recorded runs, oldest first.
+
+        Args:
+            job (str | None, optional): Only list the runs of this job. Defaults to None, which lists every run.
+
+        Returns:
+            list[RunRecord]: The runs.
+        """
+        if not self.path.exists():
+            return []
+
+        with self.path.open(encoding="utf-8") as f:
+            records = [RunRecord(**json.loads(line)) for line in f if line.strip()]
+
+        return [record for record in records if job is None or record.job == job]
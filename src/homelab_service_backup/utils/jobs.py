@@ -0,0 +1,149 @@
+"""Load the multi-job configuration file."""
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+import tomllib
+from pydantic import ValidationError
+
+from .config import Config
+
+DEFAULT_JOBS_FILE = Path(__file__).parents[1] / "default_config.toml"
+
+
+class JobsFileError(Exception):
+    """Raised when a multi-job configuration file can not be read or defines an invalid job."""
+
+
+@dataclass
+class JobsFile:
+    """The jobs defined in a multi-job configuration file and the limits they run under."""
+
+    jobs: list[Config]
+    defaults: dict[str, Any] = field(default_factory=dict)
+    max_concurrent_jobs: int = 2
+    max_jobs_per_storage: int = 1
+    storage_limits: dict[Path, int] = field(default_factory=dict)
+    metrics_port: int = 0
+    metrics_file: Path | None = None
+
+    @property
+    def logging_config(self) -> Config:
+        """Build the configuration logging is set up from, before any job runs.
+
+        Only the logging settings are read from it, so it is built from the defaults without validating the settings every job requires.
+
+        Returns:
+            Config: The shared defaults, with `hsb` as the job name.
+        """
+        return Config.model_construct(**{"job_name": "hsb", **self.defaults})
+
+    def storage_target(self, config: Config) -> tuple[Path, int]:
+        """Find the storage target a job reads from or writes to, and how many jobs may use it at once.
+
+        A storage directory belongs to the deepest entry in `storage_limits` that contains it, so jobs writing to different directories on the same mount share that mount's limit. Other directories are their own target, limited by `max_jobs_per_storage`.
+
+        Args:
+            config (Config): The job's configuration.
+
+        Returns:
+            tuple[Path, int]: The storage target and the number of jobs that may use it at the same time.
+        """
+        storage_dir = config.backup_storage_dir
+        targets = [path for path in self.storage_limits if storage_dir.is_relative_to(path)]
+        if not targets:
+            return storage_dir, self.max_jobs_per_storage
+
+        target = max(targets, key=lambda x: len(x.parts))
+        return target, self.storage_limits[target]
+
+
+def _read_toml(path: Path) -> dict[str, Any]:
+    """Parse a TOML file.
+
+    Returns:
+        dict[str, Any]: The parsed document.
+
+    Raises:
+        JobsFileError: If the file can not be read or is not valid TOML.
+    """
+    try:
+        with path.open("rb") as f:
+            return tomllib.load(f)
+    except (OSError, tomllib.TOMLDecodeError) as e:
+        msg = f"Can not read {path}: {e}"
+        raise JobsFileError(msg) from e
+
+
+def _validate_job(index: int, settings: dict[str, Any]) -> Config:
+    """Validate one job's settings the same way the environment is validated.
+
+    Returns:
+        Config: The job's configuration.
+
+    Raises:
+        JobsFileError: If a setting is missing or invalid, the job does not back up, restore or verify, or it streams its backups to stdout.
+    """
+    name = settings.get("job_name", f"#{index + 1}")
+    try:
+        config = Config.model_validate(settings)
+    except ValidationError as e:
+        errors = ", ".join(f"{error['loc'][0]}: {error['msg']}" for error in e.errors())
+        msg = f"Invalid job {name}: {errors}"
+        raise JobsFileError(msg) from e
+
+    if config.action not in {"backup", "restore", "verify"}:
+        msg = f"Invalid job {name}: action must be 'backup', 'restore' or 'verify'"
+        raise JobsFileError(msg)
+
+    if config.output == "stdout":
+        msg = f"Invalid job {name}: jobs can not share stdout, use output 'file' or 'command'"
+        raise JobsFileError(msg)
+
+    return config
+
+
+def load_jobs_file(path: Path) -> JobsFile:
+    """Read a multi-job configuration file.
+
+    The file is merged over the packaged `default_config.toml`. Every table in its `jobs` array is merged over the `defaults` table and validated like the HSB_ environment variables, using the same setting names in lowercase without the prefix.
+
+    Args:
+        path (Path): The configuration file.
+
+    Returns:
+        JobsFile: The jobs and the limits they run under.
+
+    Raises:
+        JobsFileError: If the file can not be read, defines no jobs, or defines an invalid or duplicate job.
+    """
+    default = _read_toml(DEFAULT_JOBS_FILE)
+    document = _read_toml(path)
+
+    defaults = {**default.get("defaults", {}), **document.get("defaults", {})}
+    jobs = [_validate_job(i, {**defaults, **job}) for i, job in enumerate(document.get("jobs", []))]
+    if not jobs:
+        msg = f"No jobs defined in {path}"
+        raise JobsFileError(msg)
+
+    # Jobs with the same name would share their backups in the catalog
+    seen: set[tuple[str, bool]] = set()
+    for config in jobs:
+        key = (config.job_name, config.use_postgres)
+        if key in seen:
+            msg = f"Duplicate job {config.job_name}"
+            raise JobsFileError(msg)
+        seen.add(key)
+
+    storage_limits = {**default.get("storage_limits", {}), **document.get("storage_limits", {})}
+    metrics_file = document.get("metrics_file", default["metrics_file"])
+    return JobsFile(
+        jobs=jobs,
+        defaults=defaults,
+        max_concurrent_jobs=document.get("max_concurrent_jobs", default["max_concurrent_jobs"]),
+        max_jobs_per_storage=document.get("max_jobs_per_storage", default["max_jobs_per_storage"]),
+        storage_limits={Path(path).resolve(): limit for path, limit in storage_limits.items()},
+        metrics_port=document.get("metrics_port", default["metrics_port"]),
+        metrics_file=Path(metrics_file) if metrics_file else None,
+    )
@@ -0,0 +1,203 @@
+"""Limit the backups writing to a shared backup storage directory across every node."""
+
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from collections.abc import Iterator
+from contextlib import contextmanager, suppress
+from pathlib import Path
+from types import TracebackType
+from typing import Self
+
+from loguru import logger
+
+from .cancellation import check_cancelled
+
+LEASE_DIRNAME = ".hsb-leases"
+LEASE_POLL_INTERVAL = 1.0  # Seconds between attempts to take a lease while waiting
+
+
+class LeaseTimeoutError(Exception):
+    """Raised when no storage lease became free before the timeout."""
+
+
+class StorageLease:
+    """A cooperative semaphore shared by every hsb instance that writes to a backup storage directory.
+
+    Each holder owns a lease file in the `.hsb-leases` directory, so no more than `slots` backups write at once, whichever node they run on. Waiting jobs take a numbered ticket and leases are granted in ticket order, so a job is never overtaken by jobs that started waiting after it.
+
+    Holders and waiters touch their file while they hold or wait. A lease or ticket that was not touched for `ttl` seconds belongs to a process that crashed or lost the storage, and is removed by the next process taking a lease. Ages are measured against the storage's own clock, read from the modification time of a file touched just before, so clock drift between nodes does not expire live leases. Every change to the lease directory holds an exclusive lock on a lock file in it, the same way the catalog is written.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        slots: int,
+        ttl: float = 300,
+        job: str = "",
+        poll_interval: float = LEASE_POLL_INTERVAL,
+    ) -> None:
+        self.path = directory / LEASE_DIRNAME
+        self.slots = slots
+        self.ttl = ttl
+        self.job = job
+        self.poll_interval = poll_interval
+        self.holder = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lease_file = self.path / f"{self.holder}.lease"
+        self._ticket: Path | None = None
+        self._stop = threading.Event()
+        self._heartbeat: threading.Thread | None = None
+
+    @contextmanager
+    def _lock(self) -> Iterator[float]:
+        """Hold the lease directory's lock.
+
+        Yields:
+            float: The storage's current time, in seconds since the epoch.
+        """
+        with (self.path / ".lock").open("a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                os.utime(lock.fileno())
+                yield os.fstat(lock.fileno()).st_mtime
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _expire(self, now: float) -> None:
+        """Remove the leases and tickets of processes that stopped touching them."""
+        for path in [*self.path.glob("*.lease"), *self.path.glob("*.ticket")]:
+            try:
+                age = now - path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if age > self.ttl:
+                logger.warning(
+                    f"Remove stale storage {path.suffix[1:]} {path.stem} ({age:.0f}s old)"
+                )
+                path.unlink(missing_ok=True)
+
+    def _take_ticket(self) -> Path:
+        """Create a ticket numbered after every ticket handed out before it.
+
+        Returns:
+            Path: The ticket file.
+        """
+        counter = self.path / ".counter"
+        number = int(counter.read_text(encoding="utf-8") or 0) + 1 if counter.exists() else 1
+        counter.write_text(str(number), encoding="utf-8")
+        ticket = self.path / f"{number:012d}-{self.holder}.ticket"
+        ticket.touch()
+        return ticket
+
+    def _try_acquire(self) -> bool:
+        """Take a lease if one is free and no ticket is ahead of ours.
+
+        Returns:
+            bool: True if the lease was taken.
+        """
+        with self._lock() as now:
+            self._expire(now)
+            if self._ticket is None or not self._ticket.exists():
+                self._ticket = self._take_ticket()
+            else:
+                os.utime(self._ticket)
+
+            free = self.slots - len(list(self.path.glob("*.lease")))
+            queue = sorted(self.path.glob("*.ticket"))
+            if free <= 0 or self._ticket not in queue[:free]:
+                return False
+
+            self.lease_file.write_text(
+                json.dumps({"holder": self.holder, "job": self.job, "acquired": now}),
+                encoding="utf-8",
+            )
+            self._ticket.unlink()
+            self._ticket = None
+            return True
+
+    def _withdraw(self) -> None:
+        """Leave the queue without taking a lease."""
+        if self._ticket is not None:
+            self._ticket.unlink(missing_ok=True)
+            self._ticket = None
+
+    def _keep_alive(self) -> None:
+        """Touch the lease file until the lease is released, so other nodes do not expire it."""
+        while not self._stop.wait(self.ttl / 3):
+            with suppress(FileNotFoundError):
+                os.utime(self.lease_file)
+                continue
+
+            logger.warning(
+                "Storage lease expired while held, another backup may now write at the same time"
+            )
+            return
+
+    def _wait(self, timeout: float | None) -> None:
+        """Retry taking a lease until one is granted.
+
+        Raises:
+            LeaseTimeoutError: If the timeout passed first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waiting = False
+        while not self._try_acquire():
+            if not waiting:
+                logger.info(f"Wait for one of {self.slots} storage leases")
+                waiting = True
+            if deadline is not None and time.monotonic() > deadline:
+                msg = f"No storage lease became free within {timeout:.0f}s"
+                raise LeaseTimeoutError(msg)
+            check_cancelled()
+            time.sleep(self.poll_interval)
+
+    def acquire(self, timeout: float | None = None) -> None:
+        """Wait for a free lease and hold it until `release` is called.
+
+        A job that gives up or is cancelled while waiting leaves the queue.
+
+        Args:
+            timeout (float | None, optional): Seconds to wait before giving up. Defaults to None, which waits until a lease is free.
+        """
+        self.path.mkdir(exist_ok=True)
+        try:
+            self._wait(timeout)
+        except BaseException:
+            self._withdraw()
+            raise
+
+        logger.debug(f"Acquired storage lease {self.holder}")
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._keep_alive, name="hsb-lease", daemon=True)
+        self._heartbeat.start()
+
+    def release(self) -> None:
+        """Give the lease back so the next waiting job can take it."""
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        self.lease_file.unlink(missing_ok=True)
+        logger.debug(f"Released storage lease {self.holder}")
+
+    def __enter__(self) -> Self:
+        """Wait for a free lease when entering the runtime context.
+
+        Returns:
+            Self: The lease, held until the context exits.
+        """
+        self.acquire()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        """Release the lease when leaving the runtime context."""
+        self.release()
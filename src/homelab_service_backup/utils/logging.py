@@ -5,7 +5,7 @@ import sys
 
 from loguru import logger
 
-from .config import Config
+from .config import Config, get_config
 from .console import console
 
 
@@ -33,7 +33,7 @@ def cli_log_formatter(record: dict) -> str:
     name = record["level"].name
     lvl_color = color_map.get(name, "bold")
 
-    return f"{{time:YYYY-MM-DD HH:mm}} | [{lvl_color}]{{level: <8}} | {{message}}[/{lvl_color}]"
+    return f"{{time:YYYY-MM-DD HH:mm}} | [{lvl_color}]{{level: <8}} | {{extra[job_prefix]}}{{message}}[/{lvl_color}]"
 
 
 def log_file_formatter(record: dict) -> str:
@@ -49,27 +49,38 @@ def log_file_formatter(record: dict) -> str:
     """
     message = record["message"].replace("[code]", "'").replace("[/]", "'")
 
-    return f"{{time:YYYY-MM-DD HH:mm:ss}} | {Config().host_name: <7} | {{level: <7}} | {Config().job_name}: {message}\n"
+    return f"{{time:YYYY-MM-DD HH:mm:ss}} | {{extra[host]: <7}} | {{level: <7}} | {{extra[job]}}: {message}\n"
 
 
-def instantiate_logger() -> None:  # pragma: no cover
+def instantiate_logger(config: Config | None = None) -> None:  # pragma: no cover
     """Configure and initialize the Loguru logger with console and file outputs.
 
     Set up console logging with color formatting and optional file logging with rotation. Configure the logger based on settings from Config() including log level, file path, and output destinations. Intercept and redirect standard logging to Loguru.
+
+    The host and job name are bound to every record once, rather than read from the configuration for each message. In multi-job mode each job overrides them with `logger.contextualize`, and sets `job_prefix` so console lines show which job they belong to.
+
+    Args:
+        config (Config | None, optional): The configuration to read logging settings from. Defaults to the configuration of the current job.
     """
+    config = config or get_config()
     logger.remove()
+    logger.configure(extra={"host": config.host_name, "job": config.job_name, "job_prefix": ""})
+
+    # Keep stdout free for the backup stream
+    if config.output == "stdout":
+        console.stderr = True
 
     logger.add(
         console.print,
-        level=Config().log_level.upper(),
+        level=config.log_level.upper(),
         colorize=True,
         format=cli_log_formatter,  # type: ignore [arg-type]
     )
 
-    if Config().log_to_file:
+    if config.log_to_file:
         logger.add(
-            Config().log_file,
-            level=Config().log_level.upper(),
+            config.log_file,
+            level=config.log_level.upper(),
             format=log_file_formatter,  # type: ignore [arg-type]
             rotation="50 MB",
             retention=2,
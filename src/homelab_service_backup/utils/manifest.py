@@ -0,0 +1,147 @@
+"""File manifests that describe the contents of each backup archive."""
+
+import gzip
+import json
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Literal, NamedTuple
+
+MANIFEST_SUFFIX = ".manifest.json.gz"
+MANIFEST_VERSION = 1
+
+
+class FileState(NamedTuple):
+    """The subset of `stat()` data used to decide whether a file changed between backups."""
+
+    size: int
+    mtime_ns: int
+    inode: int
+    mode: int
+
+    @classmethod
+    def from_stat(cls, st: os.stat_result) -> "FileState":
+        """Build a file state from a stat result.
+
+        Args:
+            st (os.stat_result): The result of `lstat()` on the file.
+
+        Returns:
+            FileState: The file state.
+        """
+        return cls(size=st.st_size, mtime_ns=st.st_mtime_ns, inode=st.st_ino, mode=st.st_mode)
+
+
+@dataclass
+class Manifest:
+    """Record every file covered by a backup so the next run can archive only what changed.
+
+    A full backup's manifest lists every file in the archive. An incremental manifest still lists the complete state of the source directory at backup time, but its archive only holds the files that differ from `parent`, and `deleted` lists paths that disappeared since the parent was written.
+    """
+
+    backup: str
+    kind: Literal["full", "incremental"] = "full"
+    parent: str | None = None
+    files: dict[str, FileState] = field(default_factory=dict)
+    deleted: list[str] = field(default_factory=list)
+
+    def has_changed(self, path: str, state: FileState) -> bool:
+        """Check whether a file differs from the state recorded in this manifest.
+
+        Args:
+            path (str): The path of the file relative to the source directory.
+            state (FileState): The current state of the file.
+
+        Returns:
+            bool: True if the file is new or any recorded attribute changed.
+        """
+        return self.files.get(path) != state
+
+    def write(self, backup_file: Path) -> Path:
+        """Write the manifest next to its backup archive.
+
+        Args:
+            backup_file (Path): The backup archive the manifest describes.
+
+        Returns:
+            Path: The path of the written manifest.
+        """
+        path = get_manifest_path(backup_file)
+        data = {
+            "version": MANIFEST_VERSION,
+            "backup": self.backup,
+            "kind": self.kind,
+            "parent": self.parent,
+            "files": self.files,
+            "deleted": self.deleted,
+        }
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+
+        return path
+
+
+def get_manifest_path(backup_file: Path) -> Path:
+    """Return the path of the manifest that belongs to a backup archive.
+
+    Args:
+        backup_file (Path): The backup archive.
+
+    Returns:
+        Path: The manifest path.
+    """
+    return backup_file.with_name(f"{backup_file.name}{MANIFEST_SUFFIX}")
+
+
+def read_manifest(backup_file: Path) -> Manifest | None:
+    """Load the manifest that belongs to a backup archive.
+
+    Args:
+        backup_file (Path): The backup archive.
+
+    Returns:
+        Manifest | None: The manifest, or None if the backup was written without one.
+    """
+    path = get_manifest_path(backup_file)
+    if not path.exists():
+        return None
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        data = json.load(f)
+
+    return Manifest(
+        backup=data["backup"],
+        kind=data["kind"],
+        parent=data["parent"],
+        files={name: FileState(*state) for name, state in data["files"].items()},
+        deleted=data["deleted"],
+    )
+
+
+def resolve_backup_chain(backup_file: Path) -> list[Path]:
+    """List the archives needed to restore a backup, starting with the full backup it builds on.
+
+    Follow each manifest's `parent` back to the most recent full backup. Archives written without a manifest are treated as full backups.
+
+    Args:
+        backup_file (Path): The backup to restore.
+
+    Returns:
+        list[Path]: The archives to extract, oldest first.
+
+    Raises:
+        FileNotFoundError: If an archive in the chain is missing.
+    """
+    chain = [backup_file]
+    manifest = read_manifest(backup_file)
+
+    while manifest and manifest.kind == "incremental" and manifest.parent:
+        parent = backup_file.parent / manifest.parent
+        if not parent.exists():
+            msg = f"Backup chain is broken, missing parent archive: {parent.name}"
+            raise FileNotFoundError(msg)
+
+        chain.append(parent)
+        manifest = read_manifest(parent)
+
+    return list(reversed(chain))
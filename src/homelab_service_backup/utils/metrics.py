@@ -0,0 +1,290 @@
+"""Expose how every job's runs went as Prometheus metrics."""
+
+import threading
+import time
+from collections import Counter
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from operator import attrgetter
+from pathlib import Path
+
+from loguru import logger
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@dataclass
+class RunStats:
+    """What one run did, counted while it runs.
+
+    `read_bytes` counts the uncompressed data a run archived or restored, and `written_bytes` what it wrote to the backup storage directory or, for restores, to the job data directory.
+    """
+
+    files: int = 0
+    read_bytes: int = 0
+    written_bytes: int = 0
+    deleted_backups: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add(
+        self, files: int = 0, read_bytes: int = 0, written_bytes: int = 0, deleted_backups: int = 0
+    ) -> None:
+        """Add to the counters, from any thread of the run."""
+        with self._lock:
+            self.files += files
+            self.read_bytes += read_bytes
+            self.written_bytes += written_bytes
+            self.deleted_backups += deleted_backups
+
+
+_run_stats: ContextVar[RunStats | None] = ContextVar("run_stats", default=None)
+
+
+@contextmanager
+def collect_stats(stats: RunStats) -> Iterator[None]:
+    """Count what the run in this block does into `stats`.
+
+    Args:
+        stats (RunStats): The counters of the run.
+    """
+    token = _run_stats.set(stats)
+    try:
+        yield
+    finally:
+        _run_stats.reset(token)
+
+
+def current_stats() -> RunStats | None:
+    """Return the counters of the run in the current thread.
+
+    Returns:
+        RunStats | None: The counters, or None if they are not collected.
+    """
+    return _run_stats.get()
+
+
+def count_run(
+    files: int = 0, read_bytes: int = 0, written_bytes: int = 0, deleted_backups: int = 0
+) -> None:
+    """Add to the counters of the run in the current thread, if they are collected."""
+    if (stats := _run_stats.get()) is not None:
+        stats.add(files, read_bytes, written_bytes, deleted_backups)
+
+
+@dataclass
+class JobMetrics:
+    """The last run of a job that started and how all of its runs ended."""
+
+    action: str
+    stats: RunStats = field(default_factory=RunStats)
+    duration: float = 0.0
+    finished: float = 0.0
+    last_success: float = 0.0
+    succeeded: bool = False
+    runs: Counter[str] = field(default_factory=Counter)
+
+    @property
+    def compression_ratio(self) -> float | None:
+        """Uncompressed bytes per byte written by the last backup, None for other actions."""
+        if self.action != "backup" or not self.stats.written_bytes:
+            return None
+
+        return self.stats.read_bytes / self.stats.written_bytes
+
+    @property
+    def throughput(self) -> float:
+        """Uncompressed bytes the last run processed per second."""
+        return self.stats.read_bytes / self.duration if self.duration else 0.0
+
+
+_GAUGES: tuple[tuple[str, str, Callable[[JobMetrics], float | None]], ...] = (
+    ("hsb_last_run_duration_seconds", "Seconds the last run took.", attrgetter("duration")),
+    (
+        "hsb_last_run_timestamp_seconds",
+        "When the last run finished, in seconds since the epoch.",
+        attrgetter("finished"),
+    ),
+    ("hsb_last_run_success", "Whether the last run succeeded.", attrgetter("succeeded")),
+    (
+        "hsb_last_success_timestamp_seconds",
+        "When the last successful run finished, in seconds since the epoch.",
+        attrgetter("last_success"),
+    ),
+    ("hsb_last_run_files", "Files the last run archived or restored.", attrgetter("stats.files")),
+    (
+        "hsb_last_run_read_bytes",
+        "Uncompressed bytes the last run archived or restored.",
+        attrgetter("stats.read_bytes"),
+    ),
+    (
+        "hsb_last_run_written_bytes",
+        "Bytes the last run wrote to backup storage, or restored to the job data directory.",
+        attrgetter("stats.written_bytes"),
+    ),
+    (
+        "hsb_last_run_compression_ratio",
+        "Uncompressed bytes per byte the last backup stored.",
+        attrgetter("compression_ratio"),
+    ),
+    (
+        "hsb_last_run_throughput_bytes_per_second",
+        "Uncompressed bytes the last run processed per second.",
+        attrgetter("throughput"),
+    ),
+    (
+        "hsb_last_run_deleted_backups",
+        "Expired backups retention deleted after the last run.",
+        attrgetter("stats.deleted_backups"),
+    ),
+)
+
+
+def _label(value: str) -> str:
+    """Escape a label value for the Prometheus text format.
+
+    Returns:
+        str: The value, quoted.
+    """
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{escaped}"'
+
+
+class MetricsRegistry:
+    """Hold the metrics of every job and render them in the Prometheus text format.
+
+    When `textfile` is set, the metrics are also written to it after every run, for the textfile collector of the node exporter. The file is replaced atomically, so the collector never reads a partial file.
+    """
+
+    def __init__(self, textfile: Path | None = None) -> None:
+        self.textfile = textfile
+        self.next_runs: Callable[[], dict[str, float]] | None = None
+        self._jobs: dict[str, JobMetrics] = {}
+        self._lock = threading.Lock()
+        # Jobs finishing together must not write the temporary file at the same time
+        self._textfile_lock = threading.Lock()
+
+    def record_run(
+        self,
+        job: str,
+        action: str,
+        outcome: str,
+        stats: RunStats | None = None,
+        duration: float = 0.0,
+    ) -> None:
+        """Record a finished run and update the textfile.
+
+        Runs that were skipped or never started only count towards `hsb_runs_total`, so the last run metrics keep describing the last run that did something.
+
+        Args:
+            job (str): The job's name, with `-postgres` appended for PostgreSQL jobs.
+            action (str): The job's action.
+            outcome (str): How the run ended.
+            stats (RunStats | None, optional): What the run did. Defaults to None for runs that never started.
+            duration (float, optional): Seconds the run took. Defaults to 0.
+        """
+        with self._lock:
+            metrics = self._jobs.setdefault(job, JobMetrics(action))
+            metrics.runs[outcome] += 1
+            if stats is not None:
+                metrics.stats = stats
+                metrics.duration = duration
+                metrics.finished = time.time()
+                metrics.succeeded = outcome == "success"
+                if metrics.succeeded:
+                    metrics.last_success = metrics.finished
+
+        self.write_textfile()
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text format.
+
+        Returns:
+            str: The metrics.
+        """
+        with self._lock:
+            jobs = dict(self._jobs)
+            lines = []
+            for name, description, value in _GAUGES:
+                lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge"]
+                for job, metrics in jobs.items():
+                    if metrics.finished and (sample := value(metrics)) is not None:
+                        lines.append(f"{name}{{job={_label(job)}}} {float(sample):g}")
+
+            lines += [
+                "# HELP hsb_runs_total Runs of each job by how they ended.",
+                "# TYPE hsb_runs_total counter",
+            ]
+            lines.extend(
+                f"hsb_runs_total{{job={_label(job)},outcome={_label(outcome)}}} {count}"
+                for job, metrics in jobs.items()
+                for outcome, count in sorted(metrics.runs.items())
+            )
+
+        lines += [
+            "# HELP hsb_next_run_timestamp_seconds When the job runs next, in seconds since the epoch.",
+            "# TYPE hsb_next_run_timestamp_seconds gauge",
+        ]
+        next_runs = self.next_runs() if self.next_runs else {}
+        lines.extend(
+            f"hsb_next_run_timestamp_seconds{{job={_label(job)}}} {timestamp:.3f}"
+            for job, timestamp in next_runs.items()
+        )
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self) -> None:
+        """Replace the textfile with the current metrics, if one is configured.
+
+        Writes from different threads are serialized, so each one renders and replaces the file in turn.
+        """
+        if self.textfile is None:
+            return
+
+        temporary = self.textfile.with_name(f".{self.textfile.name}.tmp")
+        with self._textfile_lock:
+            try:
+                temporary.write_text(self.render(), encoding="utf-8")
+                temporary.replace(self.textfile)
+            except OSError as e:
+                logger.warning(f"Failed to write metrics to {self.textfile}: {e}")
+
+
+def serve_metrics(registry: MetricsRegistry, port: int, address: str = "") -> ThreadingHTTPServer:
+    """Serve the metrics at `/metrics` over HTTP from a background thread.
+
+    Args:
+        registry (MetricsRegistry): The metrics to serve.
+        port (int): The TCP port to listen on.
+        address (str, optional): The address to listen on. Defaults to every address.
+
+    Returns:
+        ThreadingHTTPServer: The running server, stopped with `shutdown()`.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """Answer scrapes of `/metrics`."""
+
+        def do_GET(self) -> None:  # noqa: N802
+            """Send the metrics, or 404 for any other path."""
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: object) -> None:  # noqa: A002, PLR6301
+            """Log requests at TRACE level instead of writing them to stderr."""
+            logger.trace(f"Metrics: {format % args}")
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="hsb-metrics", daemon=True).start()
+    logger.info(f"Serve metrics on port {server.server_address[1]}")
+    return server
@@ -0,0 +1,135 @@
+"""Destinations that backup streams are written to."""
+
+import hashlib
+import os
+import shlex
+import subprocess  # noqa: S404
+import sys
+from collections.abc import Iterator
+from contextlib import contextmanager, suppress
+from pathlib import Path
+from typing import BinaryIO, cast
+
+from loguru import logger
+
+from .catalog import Catalog
+from .config import Config
+from .throttle import limit_writes
+
+STREAM_BUFFER_SIZE = 1024 * 1024  # Bytes held in memory before blocking on a slow receiver
+
+
+class OutputCommandError(OSError):
+    """Raised when the command receiving a streamed backup fails."""
+
+
+class _HashingWriter:
+    """Hash and count the bytes of a backup while it is written, so it can be cataloged without reading it back."""
+
+    def __init__(self, fileobj: BinaryIO) -> None:
+        self.fileobj = fileobj
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        """Write data to the backup file.
+
+        Args:
+            data (bytes): The bytes to write.
+
+        Returns:
+            int: The number of bytes written.
+        """
+        self._hash.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self) -> None:
+        """Flush the backup file."""
+        self.fileobj.flush()
+
+    def hexdigest(self) -> str:
+        """Return the SHA-256 of everything written.
+
+        Returns:
+            str: The hex digest.
+        """
+        return self._hash.hexdigest()
+
+
+def is_streaming(config: Config) -> bool:
+    """Check whether backups are streamed instead of written to the backup storage directory.
+
+    Args:
+        config (Config): The job's configuration.
+
+    Returns:
+        bool: True if backups go to stdout or an output command.
+    """
+    return config.output != "file"
+
+
+@contextmanager
+def open_backup_output(config: Config, backup_file: Path) -> Iterator[BinaryIO]:
+    """Open the destination a backup is written to.
+
+    By default the backup is written to `backup_file` and recorded in the catalog, with its SHA-256, once it is complete. A backup that fails or is cancelled part way is removed. When streaming, the bytes go to stdout or to the stdin of `HSB_OUTPUT_COMMAND` instead, so nothing is staged on local disk. The command runs through the shell with `HSB_BACKUP_NAME` set to the backup's file name, letting a receiver such as `ssh host 'cat > "$HSB_BACKUP_NAME"'` name its copy. Writes block once `STREAM_BUFFER_SIZE` bytes are waiting, so memory stays bounded when the receiver is slower than the backup.
+
+    Args:
+        config (Config): The job's configuration.
+        backup_file (Path): The file the backup would be written to in the backup storage directory.
+
+    Yields:
+        BinaryIO: The stream to write the backup to.
+
+    Raises:
+        OutputCommandError: If the output command exits with a non-zero status.
+    """
+    match config.output:
+        case "stdout":
+            stdout = sys.stdout.buffer
+            yield limit_writes(stdout)
+            stdout.flush()
+        case "command":
+            logger.debug(f"Stream backup to: {config.output_command}")
+            process = subprocess.Popen(  # noqa: S602
+                config.output_command,
+                shell=True,
+                stdin=subprocess.PIPE,
+                bufsize=STREAM_BUFFER_SIZE,
+                env={**os.environ, "HSB_BACKUP_NAME": backup_file.name},
+            )
+            stdin = cast("BinaryIO", process.stdin)
+            try:
+                yield limit_writes(stdin)
+                stdin.close()
+            except BrokenPipeError as e:
+                # The receiver exited before reading everything, report its status rather than the pipe error
+                with suppress(BrokenPipeError):
+                    stdin.close()
+                returncode = process.wait()
+                msg = f"Output command exited with status {returncode} before the backup was complete: {shlex.quote(config.output_command)}"
+                raise OutputCommandError(msg) from e
+            except BaseException:
+                process.kill()
+                process.wait()
+                with suppress(BrokenPipeError):
+                    stdin.close()
+                raise
+
+            returncode = process.wait()
+            if returncode:
+                msg = f"Output command exited with status {returncode}: {shlex.quote(config.output_command)}"
+                raise OutputCommandError(msg)
+        case _:
+            try:
+                with backup_file.open("wb") as fh:
+                    writer = _HashingWriter(limit_writes(fh))
+                    yield cast("BinaryIO", writer)
+            except BaseException:
+                # Never leave a partial backup that could be mistaken for a complete one
+                backup_file.unlink(missing_ok=True)
+                raise
+            Catalog(backup_file.parent).add(
+                backup_file, size=writer.size, checksum=writer.hexdigest()
+            )
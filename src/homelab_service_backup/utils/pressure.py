@@ -0,0 +1,219 @@
+"""Defer and pause jobs while the machine is short of CPU, I/O or memory, using Linux pressure stall information."""
+
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from operator import itemgetter
+from pathlib import Path
+from typing import TYPE_CHECKING, Self
+
+from loguru import logger
+
+from .cancellation import check_cancelled
+
+if TYPE_CHECKING:
+    from .config import Config
+
+PRESSURE_DIR = Path("/proc/pressure")
+CGROUP_DIR = Path("/sys/fs/cgroup")
+PROC_CGROUP = Path("/proc/self/cgroup")
+PRESSURE_CHECK_INTERVAL = 5.0  # Seconds between pressure checks during a run, and while waiting
+
+
+def read_pressure(path: Path) -> float | None:
+    """Read the share of the last 10 seconds in which some tasks stalled on a resource.
+
+    Args:
+        path (Path): A pressure file, such as `/proc/pressure/io` or `io.pressure` in a cgroup directory.
+
+    Returns:
+        float | None: The `some avg10` value in percent, or None if the file can not be read.
+    """
+    try:
+        text = path.read_text(encoding="utf-8")
+    except OSError:
+        return None
+
+    for line in text.splitlines():
+        kind, *fields = line.split()
+        if kind == "some":
+            values = dict(field.split("=", 1) for field in fields)
+            return float(values["avg10"])
+
+    return None
+
+
+def _own_cgroup() -> Path | None:
+    """Find the cgroup v2 directory of this process, where its container's pressure files are.
+
+    Returns:
+        Path | None: The directory, or None if the process is not in a cgroup v2 hierarchy.
+    """
+    try:
+        lines = PROC_CGROUP.read_text(encoding="utf-8").splitlines()
+    except OSError:
+        return None
+
+    for line in lines:
+        if line.startswith("0::"):
+            return CGROUP_DIR / line.removeprefix("0::").strip().lstrip("/")
+
+    return None
+
+
+class PressureMonitor:
+    """Hold a job back while any watched resource is under more pressure than the threshold.
+
+    Pressure is read from the system-wide files in `/proc/pressure` and from the files of the process's own cgroup, so limits of the container a job runs in count as well as the machine. The highest value of all of them is compared to the threshold. The deadline covers the whole run: once it passed, a run that did not start yet gives up, and a run in progress stops pausing and finishes.
+    """
+
+    def __init__(
+        self,
+        files: dict[str, list[Path]],
+        threshold: float,
+        deadline: float,
+        interval: float = PRESSURE_CHECK_INTERVAL,
+    ) -> None:
+        self.files = files
+        self.threshold = threshold
+        self.deadline = deadline
+        self.interval = interval
+        self._expires = time.monotonic() + deadline if deadline else None
+        self._next_check = 0.0
+
+    @classmethod
+    def from_config(cls, config: "Config") -> Self | None:
+        """Watch the resources a job is configured to watch.
+
+        Args:
+            config (Config): The job's configuration.
+
+        Returns:
+            PressureMonitor | None: The monitor, or None if the job has no threshold or the kernel provides no pressure information.
+        """
+        if not config.pressure_threshold:
+            return None
+
+        cgroup = _own_cgroup()
+        files: dict[str, list[Path]] = {}
+        for resource in config.pressure_resources:
+            candidates = [PRESSURE_DIR / resource]
+            if cgroup is not None:
+                candidates.append(cgroup / f"{resource}.pressure")
+            if readable := [path for path in candidates if read_pressure(path) is not None]:
+                files[resource] = readable
+
+        if not files:
+            logger.warning("No pressure stall information available, run without checking pressure")
+            return None
+
+        return cls(
+            files, config.pressure_threshold, config.pressure_deadline, PRESSURE_CHECK_INTERVAL
+        )
+
+    def pressure(self) -> tuple[str, float]:
+        """Read the pressure on the most stalled resource.
+
+        Returns:
+            tuple[str, float]: The resource and its pressure in percent.
+        """
+        return max(
+            (
+                (resource, read_pressure(path) or 0.0)
+                for resource, paths in self.files.items()
+                for path in paths
+            ),
+            key=itemgetter(1),
+        )
+
+    def expired(self) -> bool:
+        """Check whether the deadline passed.
+
+        Returns:
+            bool: True if the deadline passed.
+        """
+        return self._expires is not None and time.monotonic() > self._expires
+
+    def _wait(self) -> bool:
+        """Sleep until the pressure drops below the threshold.
+
+        Returns:
+            bool: True once it dropped, False if the deadline passed first.
+        """
+        while self.pressure()[1] > self.threshold:
+            if self.expired():
+                return False
+            check_cancelled()
+            time.sleep(self.interval)
+
+        self._next_check = time.monotonic() + self.interval
+        return True
+
+    def defer(self) -> bool:
+        """Wait for the pressure to drop before a run starts.
+
+        A cancelled run stops waiting with `RunCancelledError`.
+
+        Returns:
+            bool: True once the run may start, False if the pressure stayed high until the deadline.
+        """
+        resource, value = self.pressure()
+        if value <= self.threshold:
+            return True
+
+        logger.info(f"Defer run, {resource} pressure is {value:.1f}%, above {self.threshold:g}%")
+        start = time.monotonic()
+        if not self._wait():
+            logger.error(
+                f"Give up, pressure stayed above {self.threshold:g}% for {self.deadline:g}s"
+            )
+            return False
+
+        logger.info(f"Start run after waiting {time.monotonic() - start:.0f}s for pressure to drop")
+        return True
+
+    def pause(self) -> None:
+        """Pause the run in progress while the pressure is high, reading it at most once per interval.
+
+        A cancelled run stops pausing with `RunCancelledError`.
+        """
+        now = time.monotonic()
+        if now < self._next_check or self.expired():
+            return
+
+        self._next_check = now + self.interval
+        resource, value = self.pressure()
+        if value <= self.threshold:
+            return
+
+        logger.info(f"Pause run, {resource} pressure is {value:.1f}%, above {self.threshold:g}%")
+        if self._wait():
+            logger.info(f"Resume run after {time.monotonic() - now:.0f}s")
+        else:
+            logger.warning("Pressure deadline passed, finish the run without pausing")
+
+
+_monitor: ContextVar[PressureMonitor | None] = ContextVar("pressure_monitor", default=None)
+
+
+@contextmanager
+def watch_pressure(monitor: PressureMonitor | None) -> Iterator[None]:
+    """Let the run in this block pause while the machine is under pressure.
+
+    Like cancellation, the run checks between files and archive members, so a pause never leaves a file half written.
+
+    Args:
+        monitor (PressureMonitor | None): The job's monitor, or None to never pause.
+    """
+    token = _monitor.set(monitor)
+    try:
+        yield
+    finally:
+        _monitor.reset(token)
+
+
+def pause_under_pressure() -> None:
+    """Pause the run in the current thread while the machine is under pressure."""
+    if (monitor := _monitor.get()) is not None:
+        monitor.pause()
@@ -0,0 +1,309 @@
+"""Profile backup and restore runs with cProfile, a stack sampler and tracemalloc."""
+
+import cProfile
+import functools
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from collections.abc import Callable, Collection, Iterator
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from types import FrameType, TracebackType
+from typing import Concatenate, ParamSpec, Self, TypeVar
+
+from loguru import logger
+
+from .config import Config
+
+PROFILE_DIR_NAME = "profiles"
+SAMPLE_INTERVAL = 0.005
+MEMORY_CHECK_INTERVAL = 0.5
+TRACEMALLOC_FRAMES = 25
+TOP_ALLOCATIONS = 10
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+def _collapse(thread: str, frame: FrameType | None) -> str:
+    """Describe a thread's stack as one line of the collapsed stack format.
+
+    Returns:
+        str: The thread name and its frames from the outermost to the innermost, separated by semicolons.
+    """
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_qualname} ({code.co_filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join([thread, *reversed(frames)])
+
+
+class StackSampler:
+    """Sample the stack of every thread at a fixed interval, for wall-clock flame graphs.
+
+    Unlike cProfile, sampling sees the compression, extraction and dump threads a run starts and barely slows the run down. Threads waiting for I/O or a lock are sampled too, so the samples show where the run spent its time rather than only where it used the CPU. The samples are written in the collapsed stack format of `flamegraph.pl`, which speedscope and most other flame graph viewers read.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL) -> None:
+        self.interval = interval
+        self.samples: Counter[str] = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="hsb-sampler", daemon=True)
+
+    def __enter__(self) -> Self:
+        """Start sampling when entering the runtime context.
+
+        Returns:
+            Self: The sampler, sampling until the context exits.
+        """
+        self._thread.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        """Stop sampling when leaving the runtime context."""
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        """Count the stack of every other thread until stopped."""
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():  # noqa: SLF001
+                if ident != own:
+                    self.samples[_collapse(names.get(ident, str(ident)), frame)] += 1
+
+    def write(self, path: Path) -> None:
+        """Write the samples, one stack per line followed by how often it was seen.
+
+        Args:
+            path (Path): The file to write.
+        """
+        path.write_text(
+            "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common()),
+            encoding="utf-8",
+        )
+
+
+class MemoryProfiler:
+    """Trace allocations with tracemalloc and keep a snapshot of them taken near the peak.
+
+    The traced memory is checked at an interval and a new snapshot is taken whenever it is higher than at the last snapshot, so the snapshot shows what held the memory when the run used the most. tracemalloc traces the whole process, and is shared by the runs of concurrent jobs that profile memory.
+    """
+
+    _lock = threading.Lock()
+    _users = 0
+    _started = False
+
+    def __init__(self, interval: float = MEMORY_CHECK_INTERVAL) -> None:
+        self.interval = interval
+        self.snapshot: tracemalloc.Snapshot | None = None
+        self.peak = 0
+        self._snapshot_size = -1
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="hsb-memory", daemon=True)
+
+    def __enter__(self) -> Self:
+        """Start tracing allocations when entering the runtime context, unless another run already traces them.
+
+        Returns:
+            Self: The profiler, tracing until the context exits.
+        """
+        cls = type(self)
+        with cls._lock:
+            if not cls._users and not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+                cls._started = True
+            cls._users += 1
+        self._thread.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        """Take a last snapshot, and stop tracing allocations when leaving the runtime context unless another run still traces them."""
+        self._stop.set()
+        self._thread.join()
+        self._check()
+        cls = type(self)
+        with cls._lock:
+            cls._users -= 1
+            if not cls._users and cls._started:
+                tracemalloc.stop()
+                cls._started = False
+
+    def _check(self) -> None:
+        """Take a snapshot if more memory is traced than at the last one."""
+        current, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak)
+        if current > self._snapshot_size:
+            self._snapshot_size = current
+            self.snapshot = tracemalloc.take_snapshot().filter_traces(
+                (tracemalloc.Filter(inclusive=False, filename_pattern=tracemalloc.__file__),)
+            )
+
+    def _run(self) -> None:
+        """Check the traced memory until stopped."""
+        while not self._stop.wait(self.interval):
+            self._check()
+
+    def write(self, path: Path) -> None:
+        """Write the snapshot, which `tracemalloc.Snapshot.load` reads back, and log its largest allocations.
+
+        Args:
+            path (Path): The file to write.
+        """
+        if self.snapshot is None:
+            return
+
+        self.snapshot.dump(str(path))
+        logger.info(f"Peak traced memory: {self.peak / 1024 / 1024:.1f} MiB")
+        for statistic in self.snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+            logger.debug(f"Allocated: {statistic}")
+
+
+class RunProfiler:
+    """Profile a run with any of cProfile, the stack sampler and tracemalloc, and write what each collected.
+
+    Args:
+        modes (Collection[str]): Which profilers to run, any of `cpu`, `sample` and `memory`.
+    """
+
+    def __init__(self, modes: Collection[str]) -> None:
+        self.cpu = cProfile.Profile() if "cpu" in modes else None
+        self.sampler = StackSampler() if "sample" in modes else None
+        self.memory = MemoryProfiler() if "memory" in modes else None
+        self._stack = ExitStack()
+
+    def __enter__(self) -> Self:
+        """Start the profilers when entering the runtime context.
+
+        Returns:
+            Self: The profiler, profiling until the context exits.
+        """
+        with self._stack as stack:
+            if self.memory is not None:
+                stack.enter_context(self.memory)
+            if self.sampler is not None:
+                stack.enter_context(self.sampler)
+            if self.cpu is not None:
+                try:
+                    stack.enter_context(self.cpu)
+                except ValueError as e:
+                    # Python 3.12 and later allow one active profiler, another job may be using it
+                    logger.warning(f"Skip CPU profile: {e}")
+                    self.cpu = None
+            self._stack = stack.pop_all()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        """Stop the profilers when leaving the runtime context."""
+        self._stack.close()
+
+    def write(self, directory: Path, stem: str) -> list[Path]:
+        """Write every profile to a directory, named after the run.
+
+        Args:
+            directory (Path): The directory to write to, created if missing.
+            stem (str): The file name of every profile, without its extension.
+
+        Returns:
+            list[Path]: The files written.
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        written = []
+        if self.cpu is not None:
+            self.cpu.dump_stats(directory / f"{stem}.prof")
+            written.append(directory / f"{stem}.prof")
+        if self.sampler is not None:
+            self.sampler.write(directory / f"{stem}.folded")
+            written.append(directory / f"{stem}.folded")
+        if self.memory is not None and self.memory.snapshot is not None:
+            self.memory.write(directory / f"{stem}.tracemalloc")
+            written.append(directory / f"{stem}.tracemalloc")
+        return written
+
+
+def get_profile_dir(config: Config) -> Path:
+    """Return the directory a job writes its profiles to.
+
+    Args:
+        config (Config): The job's configuration.
+
+    Returns:
+        Path: `profile_dir`, or a `profiles` directory in the backup storage directory if it is not set.
+    """
+    if config.profile_dir:
+        return Path(config.profile_dir)
+
+    return config.backup_storage_dir / PROFILE_DIR_NAME
+
+
+_profiling: ContextVar[bool] = ContextVar("profiling", default=False)
+
+
+@contextmanager
+def _profile_run(config: Config, name: str) -> Iterator[None]:
+    """Profile the run in this block and write its profiles when it ends, also if it failed."""
+    from .helpers import get_current_time, get_job_name  # noqa: PLC0415
+
+    stem = f"{get_job_name(config)}-{get_current_time(config).format('YYYYMMDDTHHmmss')}-{name}"
+    profiler = RunProfiler(config.profile)
+    token = _profiling.set(True)
+    try:
+        with profiler:
+            yield
+    finally:
+        _profiling.reset(token)
+        try:
+            written = profiler.write(get_profile_dir(config), stem)
+        except OSError as e:
+            logger.warning(f"Failed to write profiles: {e}")
+        else:
+            logger.info(f"Wrote profiles: {', '.join(str(path) for path in written)}")
+
+
+def profiled(
+    name: str,
+) -> Callable[[Callable[Concatenate[Config, P], R]], Callable[Concatenate[Config, P], R]]:
+    """Profile every call of a task with the profilers listed in `profile`.
+
+    Calls from inside a profiled run are part of its profiles.
+
+    Args:
+        name (str): The run's name in the profiles' file names.
+
+    Returns:
+        Callable: The decorator, for functions that take the run's configuration first.
+    """
+
+    def decorator(
+        task: Callable[Concatenate[Config, P], R],
+    ) -> Callable[Concatenate[Config, P], R]:
+        @functools.wraps(task)
+        def wrapper(config: Config, *args: P.args, **kwargs: P.kwargs) -> R:
+            if not config.profile or _profiling.get():
+                return task(config, *args, **kwargs)
+
+            with _profile_run(config, name):
+                return task(config, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
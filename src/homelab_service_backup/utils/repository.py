@@ -0,0 +1,438 @@
+"""Deduplicating chunk repository for filesystem backups."""
+
+import gzip
+import hashlib
+import json
+import os
+import stat
+from collections.abc import Iterable, Iterator
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import BinaryIO, Literal
+
+import zstandard
+
+from homelab_service_backup.constants import REPOSITORY_SNAPSHOT_EXT
+
+from .manifest import FileState
+from .metrics import count_run
+from .throttle import limit_reads, throttle_read, throttle_write
+from .walker import WalkEntry
+
+SNAPSHOT_VERSION = 1
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+
+_WINDOW_STEPS = 6
+_WINDOW = 1 << _WINDOW_STEPS  # Bytes before a cut that decide whether it is a boundary
+_BOUNDARY_MASK = (
+    0x0F  # With the 16 bits of the two lanes, one window in 2**20 is a boundary, about one per MiB
+)
+_SCAN_SIZE = 256 * 1024  # Bytes hashed at a time, so a boundary found early ends the scan early
+
+
+def _permutation(*seed: int) -> bytes:
+    """Derive a fixed translation table that maps every byte to a different byte.
+
+    Derive it from a fixed hash so chunk boundaries, and therefore deduplication, are stable across runs, hosts and Python versions.
+
+    Returns:
+        bytes: The table, for `bytes.translate`.
+    """
+    return bytes(
+        sorted(range(256), key=lambda i: hashlib.blake2b(bytes([*seed, i]), digest_size=8).digest())
+    )
+
+
+# Two independent lanes, each an initial table and a permutation per doubling step
+_LANES = tuple(
+    (_permutation(lane, 0xFF), tuple(_permutation(lane, step) for step in range(_WINDOW_STEPS)))
+    for lane in range(2)
+)
+
+
+def _window_hashes(data: bytes, table: bytes, steps: tuple[bytes, ...]) -> int:
+    """Hash every window of `_WINDOW` bytes in a buffer to one byte, all at once.
+
+    Each byte is mapped through `table`, then every doubling step combines the hash of each window with the permuted hash of the window just before it: `h2w[i] = hw[i] ^ perm(hw[i - w])`. The permutations do not distribute over XOR, so after the last step byte `i` is a non-linear mix of every byte of the window ending at `i`, not a plain XOR of per-byte values. One call computes one 8-bit lane; `find_chunk_boundary` combines two lanes and confirms their candidates with BLAKE2b. Working on the whole buffer as bytes and one large integer keeps every step in C.
+
+    Returns:
+        int: The hashes as a little-endian integer, byte `i` holding the hash of the window ending at `data[i]`. Bytes before `_WINDOW - 1` hash the shorter window that starts at the beginning of the buffer.
+    """
+    length = len(data)
+    hashes = data.translate(table)
+    mixed = int.from_bytes(hashes, "little")
+    for step, permutation in enumerate(steps):
+        shifted = int.from_bytes(hashes.translate(permutation), "little") << (8 << step)
+        mixed = int.from_bytes(hashes, "little") ^ shifted
+        hashes = mixed.to_bytes(length + (1 << step), "little")[:length]
+    return mixed
+
+
+def find_chunk_boundary(
+    data: bytes | bytearray,
+    min_size: int = CHUNK_MIN_SIZE,
+    max_size: int = CHUNK_MAX_SIZE,
+) -> int:
+    """Find the end of the first content-defined chunk in a buffer.
+
+    A boundary is placed after the first window of `_WINDOW` bytes whose rolling hash has 20 zero bits, so the decision depends only on the bytes just before the cut. Inserting or removing data in a file moves at most the chunks around the edit, and every other chunk still deduplicates against earlier backups. Two 8-bit lanes of the hash are computed for a whole stretch of the buffer at once, and the remaining 4 bits are only checked, with BLAKE2b of the window, where both lanes are zero. Data that never produces a boundary, such as a single repeated byte, is cut at `max_size`.
+
+    Args:
+        data (bytes | bytearray): The buffer to scan. Pass at least `max_size` bytes unless the end of the file is reached.
+        min_size (int, optional): Smallest chunk to emit. Defaults to CHUNK_MIN_SIZE.
+        max_size (int, optional): Largest chunk to emit. Defaults to CHUNK_MAX_SIZE.
+
+    Returns:
+        int: The length of the first chunk.
+    """
+    length = len(data)
+    if length <= min_size:
+        return length
+
+    limit = min(max_size, length)
+    start = min_size
+    while start < limit:
+        end = min(start + _SCAN_SIZE, limit)
+        base = max(start - _WINDOW, 0)
+        segment = bytes(data[base:end])
+        candidates = 0
+        for table, steps in _LANES:
+            candidates |= _window_hashes(segment, table, steps)
+        lanes = candidates.to_bytes(len(segment) + _WINDOW, "little")[: len(segment)]
+
+        # Byte i decides the cut after it, so the first one that may end the chunk is at start - 1
+        index = lanes.find(b"\x00", start - 1 - base)
+        while index >= 0:
+            window = segment[max(index + 1 - _WINDOW, 0) : index + 1]
+            if not hashlib.blake2b(window, digest_size=1).digest()[0] & _BOUNDARY_MASK:
+                return base + index + 1
+            index = lanes.find(b"\x00", index + 1)
+        start = end
+
+    return limit
+
+
+def iter_chunks(fileobj: BinaryIO, max_size: int = CHUNK_MAX_SIZE) -> Iterator[bytes]:
+    """Split a stream into content-defined chunks while holding at most `max_size` bytes in memory.
+
+    Args:
+        fileobj (BinaryIO): The stream to split.
+        max_size (int, optional): Largest chunk to emit. Defaults to CHUNK_MAX_SIZE.
+
+    Yields:
+        bytes: Consecutive chunks of the stream.
+    """
+    buffer = bytearray()
+    eof = False
+
+    while not eof or buffer:
+        while not eof and len(buffer) < max_size:
+            data = fileobj.read(max_size - len(buffer))
+            if not data:
+                eof = True
+            buffer += data
+
+        if not buffer:
+            return
+
+        cut = find_chunk_boundary(buffer, max_size=max_size)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+class ChunkStore:
+    """Store each unique chunk once, compressed and addressed by its BLAKE2b digest.
+
+    Chunks live under `<root>/<first two hex digits>/<digest>` so no single directory grows too large for NFS or ext4 to list quickly.
+    """
+
+    def __init__(self, root: Path, level: int = 3) -> None:
+        self.root = root
+        self.level = level
+        self.new_chunks = 0
+        self.new_bytes = 0
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def chunk_path(self, digest: str) -> Path:
+        """Return the path a chunk is stored at.
+
+        Args:
+            digest (str): The hex digest of the chunk.
+
+        Returns:
+            Path: The chunk's file path.
+        """
+        return self.root / digest[:2] / digest
+
+    def put(self, data: bytes) -> str:
+        """Store a chunk unless an identical chunk already exists.
+
+        Args:
+            data (bytes): The uncompressed chunk.
+
+        Returns:
+            str: The hex digest that identifies the chunk.
+        """
+        count_run(read_bytes=len(data))
+        digest = hashlib.blake2b(data, digest_size=32).hexdigest()
+        path = self.chunk_path(digest)
+        if path.exists():
+            return digest
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary name first so an interrupted backup never leaves a truncated chunk behind
+        tmp_path = path.with_name(f".{digest}.{os.getpid()}.tmp")
+        compressed = self._compressor.compress(data)
+        throttle_write(len(compressed))
+        tmp_path.write_bytes(compressed)
+        tmp_path.replace(path)
+        count_run(written_bytes=len(compressed))
+
+        self.new_chunks += 1
+        self.new_bytes += len(data)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        """Read and decompress a chunk.
+
+        Args:
+            digest (str): The hex digest of the chunk.
+
+        Returns:
+            bytes: The uncompressed chunk.
+        """
+        compressed = self.chunk_path(digest).read_bytes()
+        throttle_read(len(compressed))
+        return self._decompressor.decompress(compressed)
+
+    def iter_digests(self) -> Iterator[str]:
+        """Yield the digest of every stored chunk.
+
+        Yields:
+            str: A chunk digest.
+        """
+        if not self.root.is_dir():
+            return
+
+        for prefix in self.root.iterdir():
+            if prefix.is_dir():
+                yield from (
+                    chunk.name for chunk in prefix.iterdir() if not chunk.name.startswith(".")
+                )
+
+    def prune(self, referenced: set[str]) -> int:
+        """Delete every chunk that no snapshot references.
+
+        Args:
+            referenced (set[str]): Digests referenced by the snapshots being retained.
+
+        Returns:
+            int: The number of chunks deleted.
+        """
+        deleted = 0
+        for digest in list(self.iter_digests()):
+            if digest not in referenced:
+                self.chunk_path(digest).unlink(missing_ok=True)
+                deleted += 1
+
+        return deleted
+
+
+@dataclass
+class SnapshotEntry:
+    """One file, directory, symlink or hard link recorded in a snapshot.
+
+    For a symlink `target` is the link's target, and for a hard link it is the path of the file recorded first for the same inode.
+    """
+
+    path: str
+    kind: Literal["file", "dir", "symlink", "link"]
+    mode: int
+    mtime_ns: int
+    size: int = 0
+    inode: int = 0
+    target: str | None = None
+    chunks: list[str] = field(default_factory=list)
+
+    @property
+    def state(self) -> FileState:
+        """The stat data used to detect whether the file changed since this snapshot."""
+        return FileState(size=self.size, mtime_ns=self.mtime_ns, inode=self.inode, mode=self.mode)
+
+
+@dataclass
+class Snapshot:
+    """A small index that rebuilds a backup from the chunks in a chunk store."""
+
+    backup: str
+    entries: list[SnapshotEntry] = field(default_factory=list)
+
+    def referenced_chunks(self) -> set[str]:
+        """Collect the digests of every chunk this snapshot needs.
+
+        Returns:
+            set[str]: The referenced chunk digests.
+        """
+        return {digest for entry in self.entries for digest in entry.chunks}
+
+    def write(self, path: Path) -> None:
+        """Write the snapshot index to disk.
+
+        Args:
+            path (Path): The snapshot file to write.
+        """
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "version": SNAPSHOT_VERSION,
+                    "backup": self.backup,
+                    "entries": [asdict(entry) for entry in self.entries],
+                },
+                f,
+                separators=(",", ":"),
+            )
+        tmp_path.replace(path)
+
+    @classmethod
+    def read(cls, path: Path) -> "Snapshot":
+        """Load a snapshot index from disk.
+
+        Args:
+            path (Path): The snapshot file to read.
+
+        Returns:
+            Snapshot: The snapshot.
+        """
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+
+        return cls(
+            backup=data["backup"], entries=[SnapshotEntry(**entry) for entry in data["entries"]]
+        )
+
+
+def is_snapshot(path: Path) -> bool:
+    """Check whether a backup file is a repository snapshot rather than an archive.
+
+    Args:
+        path (Path): The backup file.
+
+    Returns:
+        bool: True if the file is a snapshot index.
+    """
+    return path.name.endswith(f".{REPOSITORY_SNAPSHOT_EXT}")
+
+
+def get_chunk_store_path(backup_dir: Path, job_name: str) -> Path:
+    """Return the chunk store directory for a job.
+
+    Each job gets its own store so one job's garbage collection can never remove chunks another job is writing.
+
+    Args:
+        backup_dir (Path): The backup storage directory.
+        job_name (str): The name of the job.
+
+    Returns:
+        Path: The chunk store directory.
+    """
+    return backup_dir / f"{job_name}.chunks"
+
+
+def create_snapshot(
+    name: str,
+    files: Iterable[WalkEntry],
+    store: ChunkStore,
+    previous: Snapshot | None = None,
+) -> Snapshot:
+    """Chunk every file into the store and build the snapshot that describes them.
+
+    Files whose size, mtime, inode and mode match the previous snapshot reuse its chunk list without being read again. Files with several links that were already recorded are stored as hard links to the first path, as `build_tarinfo` does for archives.
+
+    Args:
+        name (str): The snapshot's backup file name.
+        files (Iterable[WalkEntry]): The entries to back up, as yielded by `walk_directory`.
+        store (ChunkStore): The chunk store to write to.
+        previous (Snapshot | None, optional): The most recent snapshot of the same job. Defaults to None.
+
+    Returns:
+        Snapshot: The new snapshot.
+    """
+    known = {entry.path: entry for entry in previous.entries} if previous else {}
+    snapshot = Snapshot(backup=name)
+    inodes: dict[tuple[int, int], str] = {}
+
+    for file, relative, st in files:
+        entry = SnapshotEntry(
+            path=str(relative),
+            kind="file",
+            mode=st.st_mode,
+            mtime_ns=st.st_mtime_ns,
+            size=st.st_size,
+            inode=st.st_ino,
+        )
+
+        if stat.S_ISDIR(st.st_mode):
+            entry.kind = "dir"
+        elif stat.S_ISLNK(st.st_mode):
+            entry.kind = "symlink"
+            entry.target = str(file.readlink())
+        elif not stat.S_ISREG(st.st_mode):
+            continue
+        elif st.st_nlink > 1 and (first := inodes.get((st.st_ino, st.st_dev))):
+            entry.kind = "link"
+            entry.target = first
+        elif (prior := known.get(entry.path)) and prior.state == entry.state:
+            entry.chunks = prior.chunks
+        else:
+            with file.open("rb") as f:
+                entry.chunks = [store.put(chunk) for chunk in iter_chunks(limit_reads(f))]
+
+        if entry.kind == "file":
+            count_run(files=1)
+            if st.st_nlink > 1 and st.st_ino:
+                inodes[st.st_ino, st.st_dev] = entry.path
+        snapshot.entries.append(entry)
+
+    return snapshot
+
+
+def restore_snapshot(snapshot: Snapshot, store: ChunkStore, destination: Path) -> None:
+    """Rebuild the files described by a snapshot from the chunk store.
+
+    Hard links are recreated to the file restored first for the same inode. Directory modes and timestamps are applied last, deepest first, so writing their contents does not overwrite them.
+
+    Args:
+        snapshot (Snapshot): The snapshot to restore.
+        store (ChunkStore): The chunk store holding the snapshot's chunks.
+        destination (Path): The directory to restore into.
+    """
+    directories: list[SnapshotEntry] = []
+
+    for entry in snapshot.entries:
+        target = destination / entry.path
+        match entry.kind:
+            case "dir":
+                target.mkdir(parents=True, exist_ok=True)
+                directories.append(entry)
+            case "symlink":
+                target.parent.mkdir(parents=True, exist_ok=True)
+                target.symlink_to(entry.target or "")
+            case "link":
+                target.parent.mkdir(parents=True, exist_ok=True)
+                target.hardlink_to(destination / (entry.target or ""))
+            case "file":
+                target.parent.mkdir(parents=True, exist_ok=True)
+                with target.open("wb") as f:
+                    for digest in entry.chunks:
+                        f.write(data := store.get(digest))
+                        throttle_write(len(data))
+                target.chmod(stat.S_IMODE(entry.mode))
+                os.utime(target, ns=(entry.mtime_ns, entry.mtime_ns))
+
+    for entry in sorted(directories, key=lambda x: x.path.count("/"), reverse=True):
+        target = destination / entry.path
+        target.chmod(stat.S_IMODE(entry.mode))
+        os.utime(target, ns=(entry.mtime_ns, entry.mtime_ns))
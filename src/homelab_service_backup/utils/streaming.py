@@ -0,0 +1,168 @@
+"""Feed decompressed backups to external commands with bounded memory."""
+
+import threading
+import time
+from contextlib import suppress
+from queue import Full, Queue
+from types import TracebackType
+from typing import TYPE_CHECKING, BinaryIO, Self
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    from sh import RunningCommand
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_QUEUE_CHUNKS = 8  # Chunks buffered between the reader thread and the consumer
+PROGRESS_INTERVAL = 10.0  # Seconds between progress log messages
+_UNIT_STEP = 1024
+
+
+def format_bytes(size: float) -> str:
+    """Format a byte count for log messages.
+
+    Args:
+        size (float): The number of bytes.
+
+    Returns:
+        str: The size with a binary unit, such as `1.5 GiB`.
+
+    Examples:
+        >>> format_bytes(1536)
+        '1.5 KiB'
+    """
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if abs(size) < _UNIT_STEP or unit == "TiB":
+            break
+        size /= _UNIT_STEP
+
+    return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+
+
+class StreamFeeder:
+    """Read a stream on a background thread into a bounded queue that `sh` consumes as a command's stdin.
+
+    Decompressing on its own thread keeps the codec busy while the command processes the previous chunk, and the bounded queue keeps memory at `chunk_size * max_chunks` however large the stream is. Progress is logged in bytes per second while the stream is read.
+
+    The end of the stream is only queued once the whole stream was read. If reading fails, the command passed to `attach` is killed instead, so it never takes a truncated stream for a complete one, and the read error is raised when the feeder exits.
+
+    Examples:
+        >>> import io
+        >>> with StreamFeeder(io.BytesIO(b"data"), label="Example") as feeder:
+        ...     feeder.queue.get()
+        b'data'
+    """
+
+    def __init__(
+        self,
+        fileobj: BinaryIO,
+        label: str,
+        chunk_size: int = STREAM_CHUNK_SIZE,
+        max_chunks: int = STREAM_QUEUE_CHUNKS,
+    ) -> None:
+        self.fileobj = fileobj
+        self.label = label
+        self.chunk_size = chunk_size
+        self.queue: Queue[bytes | None] = Queue(maxsize=max_chunks)
+        self.bytes_read = 0
+        self.error: BaseException | None = None
+
+        self._started = 0.0
+        self._lock = threading.Lock()
+        self._command: RunningCommand | None = None
+        self._killed = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="hsb-feeder", daemon=True)
+
+    def __enter__(self) -> Self:
+        """Start reading the stream.
+
+        Returns:
+            Self: The feeder instance.
+        """
+        self._started = time.monotonic()
+        self._thread.start()
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        """Stop the reader thread, whether or not the consumer finished the stream."""
+        self._stop.set()
+        self._thread.join()
+
+        # A command killed because reading failed fails too, the read error is the cause
+        if self.error is not None and (exc_type is None or self._killed):
+            raise self.error from exc_value
+
+    def attach(self, command: "RunningCommand") -> "RunningCommand":
+        """Kill the command consuming the stream if reading it fails, also if it already failed.
+
+        Args:
+            command (RunningCommand): The command reading the queue, started with `_bg=True`.
+
+        Returns:
+            RunningCommand: The command.
+        """
+        with self._lock:
+            self._command = command
+            if self.error is not None:
+                self._kill()
+        return command
+
+    def _kill(self) -> None:
+        """Kill the attached command, which may have exited already."""
+        if self._command is not None:
+            self._killed = True
+            with suppress(OSError):
+                self._command.kill()
+
+    @property
+    def elapsed(self) -> float:
+        """Seconds since the feeder started."""
+        return time.monotonic() - self._started
+
+    @property
+    def rate(self) -> float:
+        """Average bytes read per second."""
+        return self.bytes_read / max(self.elapsed, 1e-9)
+
+    def _put(self, item: bytes | None) -> bool:
+        """Block until the consumer accepts an item or the feeder is stopped.
+
+        Returns:
+            bool: False if the feeder was stopped before the item was queued.
+        """
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+            except Full:
+                continue
+            return True
+
+        return False
+
+    def _run(self) -> None:
+        """Read the stream in chunks until it is exhausted, then queue the end-of-stream marker, or kill the command if reading fails."""
+        last_report = time.monotonic()
+        try:
+            while chunk := self.fileobj.read(self.chunk_size):
+                if not self._put(chunk):
+                    return
+                self.bytes_read += len(chunk)
+
+                if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    logger.info(
+                        f"{self.label}: {format_bytes(self.bytes_read)} at {format_bytes(self.rate)}/s"
+                    )
+        except Exception as e:  # noqa: BLE001
+            with self._lock:
+                self.error = e
+                self._kill()
+            return
+
+        self._put(None)
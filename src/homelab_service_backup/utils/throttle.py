@@ -0,0 +1,266 @@
+"""Limit the bandwidth and priority of a job, so backups do not starve the service they back up."""
+
+import ctypes
+import os
+import platform
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, BinaryIO, TypeVar, cast
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    from .config import Config
+
+THROTTLE_BURST_SECONDS = 0.25  # Bytes allowed in a burst, as seconds of the rate
+
+# ioprio_set and ioprio_get have no wrapper in Python or glibc
+IOPRIO_SYSCALLS = {
+    "x86_64": (251, 252),
+    "aarch64": (30, 31),
+    "armv7l": (314, 315),
+    "i686": (289, 290),
+}
+IOPRIO_WHO_PROCESS = 1  # With id 0, the calling thread
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASSES = {"low": (2, 7), "idle": (3, 0)}  # Lowest best-effort level, and the idle class
+
+_File = TypeVar("_File", bound=BinaryIO)
+
+
+class TokenBucket:
+    """Limit the rate at which bytes are read or written, shared by every thread of a job.
+
+    The bucket refills at `rate` bytes per second and holds up to `burst` bytes. Taking more than the bucket holds is allowed, and the caller then sleeps until the debt is repaid, so large reads and writes need no splitting.
+    """
+
+    def __init__(self, rate: float, burst: float | None = None) -> None:
+        self.rate = rate
+        self.capacity = burst if burst is not None else rate * THROTTLE_BURST_SECONDS
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int) -> None:
+        """Take bytes from the bucket, sleeping until the rate allows them.
+
+        Args:
+            amount (int): The number of bytes read or written.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+
+
+_buckets: ContextVar[tuple[TokenBucket | None, TokenBucket | None]] = ContextVar(
+    "io_buckets", default=(None, None)
+)
+
+
+class _ThrottledReader:
+    """Read from a file no faster than a bucket allows."""
+
+    def __init__(self, fileobj: BinaryIO, bucket: TokenBucket) -> None:
+        self.fileobj = fileobj
+        self.bucket = bucket
+
+    def read(self, size: int = -1) -> bytes:
+        """Read from the file.
+
+        Args:
+            size (int, optional): The maximum number of bytes to read. Defaults to -1.
+
+        Returns:
+            bytes: The data read.
+        """
+        data = self.fileobj.read(size)
+        self.bucket.consume(len(data))
+        return data
+
+    def readinto(self, buffer: memoryview) -> int:
+        """Read from the file into a buffer.
+
+        Args:
+            buffer (memoryview): The buffer to fill.
+
+        Returns:
+            int: The number of bytes read.
+        """
+        size = self.fileobj.readinto(buffer)  # type: ignore[attr-defined]
+        self.bucket.consume(size)
+        return size
+
+    def __getattr__(self, name: str) -> object:
+        return getattr(self.fileobj, name)
+
+
+class _ThrottledWriter:
+    """Write to a file no faster than a bucket allows."""
+
+    def __init__(self, fileobj: BinaryIO, bucket: TokenBucket) -> None:
+        self.fileobj = fileobj
+        self.bucket = bucket
+
+    def write(self, data: bytes) -> int:
+        """Write to the file.
+
+        Args:
+            data (bytes): The bytes to write.
+
+        Returns:
+            int: The number of bytes written.
+        """
+        self.bucket.consume(len(data))
+        return self.fileobj.write(data)
+
+    def __getattr__(self, name: str) -> object:
+        return getattr(self.fileobj, name)
+
+
+def limit_reads(fileobj: _File) -> _File:
+    """Apply the current job's read limit to a file.
+
+    The limit is bound when the file is wrapped, so the wrapper can be read from any thread.
+
+    Args:
+        fileobj (_File): The file to read from.
+
+    Returns:
+        _File: The file, wrapped if the job has a read limit.
+    """
+    bucket = _buckets.get()[0]
+    return fileobj if bucket is None else cast("_File", _ThrottledReader(fileobj, bucket))
+
+
+def limit_writes(fileobj: BinaryIO) -> BinaryIO:
+    """Apply the current job's write limit to a file.
+
+    The limit is bound when the file is wrapped, so the wrapper can be written from any thread.
+
+    Args:
+        fileobj (BinaryIO): The file to write to.
+
+    Returns:
+        BinaryIO: The file, wrapped if the job has a write limit.
+    """
+    bucket = _buckets.get()[1]
+    return fileobj if bucket is None else cast("BinaryIO", _ThrottledWriter(fileobj, bucket))
+
+
+def throttle_read(amount: int) -> None:
+    """Count bytes read without a wrapped file against the current job's read limit.
+
+    Args:
+        amount (int): The number of bytes read.
+    """
+    if (bucket := _buckets.get()[0]) is not None:
+        bucket.consume(amount)
+
+
+def throttle_write(amount: int) -> None:
+    """Count bytes written without a wrapped file against the current job's write limit.
+
+    Args:
+        amount (int): The number of bytes written.
+    """
+    if (bucket := _buckets.get()[1]) is not None:
+        bucket.consume(amount)
+
+
+def _io_priority_syscall(index: int) -> int | None:
+    """Look up the number of the ioprio_set (0) or ioprio_get (1) syscall on this machine.
+
+    Returns:
+        int | None: The syscall number, or None if it is not known for this architecture.
+    """
+    numbers = IOPRIO_SYSCALLS.get(platform.machine())
+    return numbers[index] if numbers else None
+
+
+def get_io_priority() -> int | None:
+    """Read the I/O priority of the calling thread, as returned by the ioprio_get syscall.
+
+    Returns:
+        int | None: The class shifted left by 13 bits plus the level, or None if it can not be read.
+    """
+    number = _io_priority_syscall(1)
+    if number is None:
+        return None
+
+    result = ctypes.CDLL(None, use_errno=True).syscall(number, IOPRIO_WHO_PROCESS, 0)
+    return None if result < 0 else result
+
+
+def _set_io_priority(ionice: str) -> None:
+    """Set the I/O priority class of the calling thread."""
+    number = _io_priority_syscall(0)
+    if number is None:
+        logger.warning(f"Can not set I/O priority on {platform.machine()}")
+        return
+
+    io_class, level = IOPRIO_CLASSES[ionice]
+    value = (io_class << IOPRIO_CLASS_SHIFT) | level
+    if ctypes.CDLL(None, use_errno=True).syscall(number, IOPRIO_WHO_PROCESS, 0, value) < 0:
+        logger.warning(f"Failed to set I/O priority: {os.strerror(ctypes.get_errno())}")
+
+
+def has_priority(config: "Config") -> bool:
+    """Check whether a job runs with a lowered CPU or I/O priority.
+
+    Args:
+        config (Config): The job's configuration.
+
+    Returns:
+        bool: True if any of `nice`, `ionice` or `sched_idle` is set.
+    """
+    return bool(config.nice) or config.ionice != "normal" or config.sched_idle
+
+
+def lower_priority(config: "Config") -> None:
+    """Lower the CPU and I/O priority of the calling thread.
+
+    On Linux priorities belong to threads, and threads and processes inherit them from the thread that starts them. Lowering the job's thread before it starts therefore covers the compression and extraction threads and the pg_dump, pg_restore and psql processes of the run. Priorities can not be raised again without privileges, so threads that outlive the job should not be lowered.
+
+    Args:
+        config (Config): The job's configuration.
+    """
+    if not has_priority(config):
+        return
+
+    if config.nice:
+        os.nice(config.nice)
+    if config.sched_idle:
+        os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    if config.ionice != "normal":
+        _set_io_priority(config.ionice)
+
+    logger.debug(
+        f"Lowered priority: nice {config.nice}, ionice {config.ionice}, sched_idle {config.sched_idle}"
+    )
+
+
+@contextmanager
+def io_limits(config: "Config") -> Iterator[None]:
+    """Apply a job's read and write bandwidth limits to the I/O of the run in this block.
+
+    Reads of the data being backed up or the backup being restored, and writes of the backup or the restored files, share one bucket each across every thread of the run.
+
+    Args:
+        config (Config): The job's configuration.
+    """
+    read = TokenBucket(config.io_read_limit) if config.io_read_limit else None
+    write = TokenBucket(config.io_write_limit) if config.io_write_limit else None
+    token = _buckets.set((read, write))
+    try:
+        yield
+    finally:
+        _buckets.reset(token)
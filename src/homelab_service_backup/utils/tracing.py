@@ -0,0 +1,396 @@
+"""Time the phases of a run as spans, for run reports and OpenTelemetry trace files."""
+
+import functools
+import json
+import os
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Concatenate, ParamSpec, TypeVar
+
+from loguru import logger
+
+from .config import Config
+from .metrics import RunStats, collect_stats, current_stats
+
+REPORT_SUFFIX = ".report.json"
+REPORT_VERSION = 1
+OTLP_STATUS_OK = 1
+OTLP_STATUS_ERROR = 2
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+_export_lock = threading.Lock()  # Jobs of one process append to the same trace file
+
+
+def _stats_totals(stats: RunStats | None) -> tuple[int, int, int, int]:
+    """Read the counters of a run, all zero if they are not collected.
+
+    Returns:
+        tuple[int, int, int, int]: The files, bytes read, bytes written and deleted backups.
+    """
+    if stats is None:
+        return 0, 0, 0, 0
+
+    return stats.files, stats.read_bytes, stats.written_bytes, stats.deleted_backups
+
+
+@dataclass
+class Span:
+    """A timed phase of a run, with counters of what it did.
+
+    Counters are added with `count_span` while the span is the current one, and the run's files, bytes and deleted backups counted while it was open are added when it ends. Counters of a span include those of the spans inside it.
+    """
+
+    name: str
+    span_id: str
+    parent_id: str | None
+    start_ns: int = field(default_factory=time.time_ns)
+    duration_ns: int = 0
+    counters: dict[str, float] = field(default_factory=dict)
+    error: str | None = None
+    _started: int = field(default_factory=time.perf_counter_ns, repr=False)
+    _stats: tuple[int, int, int, int] = field(
+        default_factory=lambda: _stats_totals(current_stats()), repr=False
+    )
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add(self, **counters: float) -> None:
+        """Add to the span's counters, from any thread of the run."""
+        with self._lock:
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self) -> None:
+        """End the span and add what the run counted while it was open."""
+        self.duration_ns = time.perf_counter_ns() - self._started
+        now = _stats_totals(current_stats())
+        names = ("files", "read_bytes", "written_bytes", "deleted_backups")
+        self.add(
+            **{
+                name: after - before
+                for name, before, after in zip(names, self._stats, now, strict=True)
+                if after != before
+            }
+        )
+
+    @property
+    def end_ns(self) -> int:
+        """When the span ended, in nanoseconds since the epoch."""
+        return self.start_ns + self.duration_ns
+
+
+class RunTrace:
+    """The spans of one run, written as a JSON run report or exported in the OTLP JSON format.
+
+    The report lists every span in the order it started, each with its parent, duration and counters. The OTLP export is one `ExportTraceServiceRequest` per line, the format the file exporter and the `otlpjsonfile` receiver of the OpenTelemetry Collector use.
+    """
+
+    def __init__(self, name: str, **attributes: str) -> None:
+        self.name = name
+        self.attributes = attributes
+        self.trace_id = os.urandom(16).hex()
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+
+    def start_span(self, name: str, parent: Span | None) -> Span:
+        """Start a span of the run.
+
+        Args:
+            name (str): The phase the span times.
+            parent (Span | None): The span it is part of, or None for the run itself.
+
+        Returns:
+            Span: The started span.
+        """
+        span = Span(name, os.urandom(8).hex(), parent.span_id if parent else None)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def report(self) -> dict[str, Any]:
+        """Build the run report.
+
+        Returns:
+            dict[str, Any]: The run and its spans, with times in seconds.
+        """
+        root = self.spans[0]
+        return {
+            "version": REPORT_VERSION,
+            "trace_id": self.trace_id,
+            "run": self.name,
+            **self.attributes,
+            "started": root.start_ns / 1e9,
+            "duration": root.duration_ns / 1e9,
+            "error": root.error,
+            "spans": [
+                {
+                    "name": span.name,
+                    "span_id": span.span_id,
+                    "parent_id": span.parent_id,
+                    "offset": (span.start_ns - root.start_ns) / 1e9,
+                    "duration": span.duration_ns / 1e9,
+                    "counters": {name: round(value, 6) for name, value in span.counters.items()},
+                    "error": span.error,
+                }
+                for span in self.spans
+            ],
+        }
+
+    def write_report(self, path: Path) -> None:
+        """Write the run report, replacing the file atomically.
+
+        Args:
+            path (Path): The report file.
+        """
+        temporary = path.with_name(f".{path.name}.tmp")
+        temporary.write_text(json.dumps(self.report(), indent=2), encoding="utf-8")
+        temporary.replace(path)
+
+    def to_otlp(self) -> dict[str, Any]:
+        """Build the OTLP JSON export of the run's spans.
+
+        Returns:
+            dict[str, Any]: An `ExportTraceServiceRequest`, with counters as `hsb.` attributes.
+        """
+        resource = {
+            "service.name": "homelab-service-backup",
+            **{
+                "host.name" if key == "host" else f"hsb.{key}": value
+                for key, value in self.attributes.items()
+            },
+        }
+        spans = []
+        for span in self.spans:
+            attributes = [
+                {"key": f"hsb.{name}", "value": _otlp_value(value)}
+                for name, value in span.counters.items()
+            ]
+            status: dict[str, Any] = {"code": OTLP_STATUS_OK}
+            if span.error is not None:
+                status = {"code": OTLP_STATUS_ERROR, "message": span.error}
+            spans.append(
+                {
+                    "traceId": self.trace_id,
+                    "spanId": span.span_id,
+                    "parentSpanId": span.parent_id or "",
+                    "name": span.name,
+                    "kind": 1,  # SPAN_KIND_INTERNAL
+                    "startTimeUnixNano": str(span.start_ns),
+                    "endTimeUnixNano": str(span.end_ns),
+                    "attributes": attributes,
+                    "status": status,
+                }
+            )
+
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {"key": key, "value": _otlp_value(value)}
+                            for key, value in resource.items()
+                        ]
+                    },
+                    "scopeSpans": [{"scope": {"name": "homelab_service_backup"}, "spans": spans}],
+                }
+            ]
+        }
+
+    def export(self, path: Path) -> None:
+        """Append the run's spans to an OTLP JSON lines file.
+
+        Args:
+            path (Path): The trace file.
+        """
+        line = f"{json.dumps(self.to_otlp(), separators=(',', ':'))}\n"
+        with _export_lock, path.open("a", encoding="utf-8") as f:
+            f.write(line)
+
+
+def _otlp_value(value: float | str) -> dict[str, Any]:
+    """Encode an attribute value for OTLP JSON, which writes 64-bit integers as strings.
+
+    Returns:
+        dict[str, Any]: The `AnyValue`.
+    """
+    if isinstance(value, str):
+        return {"stringValue": value}
+    if isinstance(value, int) or value.is_integer():
+        return {"intValue": str(int(value))}
+    return {"doubleValue": value}
+
+
+_current: ContextVar[tuple[RunTrace, Span] | None] = ContextVar("current_span", default=None)
+
+
+@contextmanager
+def _activate(trace: RunTrace, name: str) -> Iterator[Span]:
+    """Start a span of a trace and make it the current span in this block.
+
+    Yields:
+        Span: The started span, ended when the block exits.
+    """
+    current = _current.get()
+    span = trace.start_span(name, current[1] if current else None)
+    token = _current.set((trace, span))
+    try:
+        yield span
+    except BaseException as e:
+        span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        span.finish()
+        _current.reset(token)
+
+
+@contextmanager
+def span(name: str) -> Iterator[Span | None]:
+    """Time a phase of the run as a span inside the current one.
+
+    Does nothing when the run is not traced, so phases can be marked wherever they happen.
+
+    Args:
+        name (str): The phase.
+
+    Yields:
+        Span | None: The span, or None if the run is not traced.
+    """
+    if (current := _current.get()) is None:
+        yield None
+        return
+
+    with _activate(current[0], name) as child:
+        yield child
+
+
+def count_span(**counters: float) -> None:
+    """Add to the counters of the current span, if the run is traced."""
+    if (current := _current.get()) is not None:
+        current[1].add(**counters)
+
+
+def timed_iter(iterable: Iterable[R], counter: str) -> Iterator[R]:
+    """Add the time spent producing each item of an iterable to a counter of the current span.
+
+    Use it for phases that are interleaved with others, such as walking the directory while its files are archived, which can not be timed as spans of their own.
+
+    Args:
+        iterable (Iterable[R]): The items to time.
+        counter (str): The counter of the current span to add the seconds to.
+
+    Returns:
+        Iterator[R]: The items, untimed if the run is not traced.
+    """
+    if (current := _current.get()) is None:
+        return iter(iterable)
+
+    return _timed(iter(iterable), current[1], counter)
+
+
+def _timed(iterator: Iterator[R], target: Span, counter: str) -> Iterator[R]:
+    """Yield the items of an iterator, adding the time it took to produce them to a span's counter.
+
+    Yields:
+        R: The next item.
+    """
+    elapsed = 0
+    try:
+        while True:
+            started = time.perf_counter_ns()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter_ns() - started
+            yield item
+    finally:
+        target.add(**{counter: elapsed / 1e9})
+
+
+def get_report_path(backup_file: Path) -> Path:
+    """Return the path of the run report that belongs to a backup.
+
+    Args:
+        backup_file (Path): The backup file.
+
+    Returns:
+        Path: The run report path.
+    """
+    return backup_file.with_name(f"{backup_file.name}{REPORT_SUFFIX}")
+
+
+def _write_trace(config: Config, trace: RunTrace, result: object) -> None:
+    """Write the run report next to the backup a run created, and append the run to the trace file."""
+    # Backups return the file they created, streamed backups leave nothing to write the report next to
+    if config.run_report and isinstance(result, Path) and result.exists():
+        try:
+            trace.write_report(get_report_path(result))
+        except OSError as e:
+            logger.warning(f"Failed to write run report: {e}")
+
+    if config.trace_file:
+        try:
+            trace.export(Path(config.trace_file))
+        except OSError as e:
+            logger.warning(f"Failed to write trace to {config.trace_file}: {e}")
+
+    summary = ", ".join(
+        f"{span.name} {span.duration_ns / 1e9:.2f}s"
+        for span in trace.spans[1:]
+        if span.parent_id == trace.spans[0].span_id
+    )
+    logger.debug(f"Run phases: {summary}")
+
+
+def traced(
+    name: str,
+) -> Callable[[Callable[Concatenate[Config, P], R]], Callable[Concatenate[Config, P], R]]:
+    """Trace every call of a task as a run, when `run_report` or `trace_file` is set.
+
+    The run's files and bytes are collected for its spans when no caller collects them already. Calls from inside a traced run become spans of it.
+
+    Args:
+        name (str): The run's name in reports and traces.
+
+    Returns:
+        Callable: The decorator, for functions that take the run's configuration first.
+    """
+
+    def decorator(
+        task: Callable[Concatenate[Config, P], R],
+    ) -> Callable[Concatenate[Config, P], R]:
+        @functools.wraps(task)
+        def wrapper(config: Config, *args: P.args, **kwargs: P.kwargs) -> R:
+            if _current.get() is not None:
+                with span(name):
+                    return task(config, *args, **kwargs)
+
+            if not config.run_report and not config.trace_file:
+                return task(config, *args, **kwargs)
+
+            from .helpers import get_job_name  # noqa: PLC0415
+
+            trace = RunTrace(
+                name, job=get_job_name(config), action=config.action, host=config.host_name
+            )
+            result = None
+            try:
+                with (
+                    collect_stats(RunStats()) if current_stats() is None else nullcontext(),
+                    _activate(trace, name),
+                ):
+                    result = task(config, *args, **kwargs)
+            finally:
+                _write_trace(config, trace, result)
+            return result
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,199 @@
+"""Walk a directory tree for backup without statting any entry twice."""
+
+import grp
+import os
+import pwd
+import stat
+import tarfile
+from collections.abc import Callable, Collection, Iterator
+from functools import cache
+from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
+
+from loguru import logger
+
+from homelab_service_backup.constants import ALWAYS_ECLUDE_FILENAMES
+
+from .cancellation import check_cancelled
+from .metrics import count_run
+from .pressure import pause_under_pressure
+from .tar_writer import TarWriter
+from .throttle import limit_reads
+from .tracing import count_span
+
+if TYPE_CHECKING:
+    import hashlib
+
+
+class WalkEntry(NamedTuple):
+    """A file, directory or link found while walking a directory tree."""
+
+    path: Path
+    relative: Path
+    stat: os.stat_result
+
+
+def walk_directory(
+    root: Path,
+    exclude_names: Collection[str] = ALWAYS_ECLUDE_FILENAMES,
+    descend: Callable[[Path], bool] | None = None,
+) -> Iterator[WalkEntry]:
+    """Yield every entry below a directory, skipping excluded names and everything beneath them.
+
+    Use `os.scandir` so each entry is statted exactly once and the result is handed to the caller, and prune excluded directories before descending into them. Symlinks are yielded but never followed. Entries are yielded in name order, each directory's entries before the contents of its subdirectories, so a directory is always seen before anything inside it. A cancelled run stops with `RunCancelledError` before the next entry, and a run under pressure pauses there.
+
+    Args:
+        root (Path): The directory to walk.
+        exclude_names (Collection[str], optional): File or directory names to skip along with their contents. Defaults to ALWAYS_ECLUDE_FILENAMES.
+        descend (Callable[[Path], bool] | None, optional): Called with the relative path of each directory after it is yielded. Return False to skip its contents. Defaults to None, which descends into every directory.
+
+    Yields:
+        WalkEntry: The absolute path, the path relative to `root` and the `lstat()` result of each entry.
+    """
+    stack: list[tuple[Path, Path]] = [(root, Path())]
+
+    while stack:
+        directory, relative = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda x: x.name)
+        except OSError as e:
+            logger.warning(f"Skip unreadable directory: {directory}: {e}")
+            continue
+
+        subdirectories = []
+        statted = 0
+        for entry in entries:
+            if entry.name in exclude_names:
+                continue
+
+            statted += 1
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                # Removed since the directory was listed
+                continue
+
+            check_cancelled()
+            pause_under_pressure()
+            path = Path(entry.path)
+            entry_relative = relative / entry.name
+            yield WalkEntry(path, entry_relative, st)
+
+            if stat.S_ISDIR(st.st_mode) and (descend is None or descend(entry_relative)):
+                subdirectories.append((path, entry_relative))
+
+        count_span(directories=1, stat_calls=statted)
+        stack.extend(reversed(subdirectories))
+
+
+@cache
+def _user_name(uid: int) -> str:
+    """Look up the name of a user id.
+
+    Returns:
+        str: The user name, or an empty string if the id has none.
+    """
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return ""
+
+
+@cache
+def _group_name(gid: int) -> str:
+    """Look up the name of a group id.
+
+    Returns:
+        str: The group name, or an empty string if the id has none.
+    """
+    try:
+        return grp.getgrgid(gid).gr_name
+    except KeyError:
+        return ""
+
+
+def build_tarinfo(entry: WalkEntry, inodes: dict[tuple[int, int], str]) -> tarfile.TarInfo | None:
+    """Build a tar header from the stat result collected by the walker.
+
+    Mirror `TarFile.gettarinfo` without calling `lstat()` again, and cache user and group name lookups which `gettarinfo` repeats for every file. Regular files with several links that were already archived are stored as hard links, as `tarfile` does. Only files with more than one link are remembered, as no later entry can link to the others.
+
+    Args:
+        entry (WalkEntry): The entry to describe.
+        inodes (dict[tuple[int, int], str]): The archive's record of the multiply linked files it stored, by inode and device. Updated with the entry.
+
+    Returns:
+        tarfile.TarInfo | None: The header, or None for file types tar can not store, such as sockets.
+    """
+    st = entry.stat
+    arcname = entry.relative.as_posix()
+    tarinfo = tarfile.TarInfo(arcname)
+
+    mode = st.st_mode
+    if stat.S_ISREG(mode):
+        inode = (st.st_ino, st.st_dev)
+        if st.st_nlink > 1 and inodes.get(inode, arcname) != arcname:
+            tarinfo.type = tarfile.LNKTYPE
+            tarinfo.linkname = inodes[inode]
+        else:
+            tarinfo.type = tarfile.REGTYPE
+            tarinfo.size = st.st_size
+            if st.st_nlink > 1 and st.st_ino:
+                inodes[inode] = arcname
+    elif stat.S_ISDIR(mode):
+        tarinfo.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = str(entry.path.readlink())
+    elif stat.S_ISFIFO(mode):
+        tarinfo.type = tarfile.FIFOTYPE
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        tarinfo.type = tarfile.CHRTYPE if stat.S_ISCHR(mode) else tarfile.BLKTYPE
+        tarinfo.devmajor = os.major(st.st_rdev)
+        tarinfo.devminor = os.minor(st.st_rdev)
+    else:
+        return None
+
+    tarinfo.mode = mode
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
+    tarinfo.mtime = st.st_mtime
+    tarinfo.uname = _user_name(st.st_uid)
+    tarinfo.gname = _group_name(st.st_gid)
+
+    return tarinfo
+
+
+def add_to_tar(
+    tar: TarWriter, entry: WalkEntry, digest: "hashlib.blake2b | None" = None
+) -> tuple[tarfile.TarInfo, int | None] | None:
+    """Add a single walker entry to an archive without statting it again.
+
+    Empty files are stored without being opened, which saves a system call per file in directories full of empty lock and marker files.
+
+    Args:
+        tar (TarWriter): The archive to add to.
+        entry (WalkEntry): The entry to add. Directories are added without their contents.
+        digest (hashlib.blake2b | None, optional): A hash to update with a regular file's data while it is archived. Defaults to None.
+
+    Returns:
+        tuple[tarfile.TarInfo, int | None] | None: The member added and the CRC-32 of its data, which is None for members without data. None if the entry's file type can not be archived.
+    """
+    tarinfo = build_tarinfo(entry, tar.inodes)
+    if tarinfo is None:
+        logger.warning(f"Skip unsupported file type: {entry.relative}")
+        return None
+
+    if not tarinfo.isreg():
+        tar.addfile(tarinfo)
+        return tarinfo, None
+
+    count_run(files=1)
+    if not tarinfo.size:
+        tar.addfile(tarinfo)
+        return tarinfo, 0
+
+    with entry.path.open("rb") as f:
+        checksum = tar.addfile(tarinfo, limit_reads(f), digest)
+
+    return tarinfo, checksum
@@ -0,0 +1,168 @@
+# type: ignore
+"""Test seekable archive indexes."""
+
+import gzip
+import io
+import json
+import os
+import tarfile
+import zlib
+from pathlib import Path
+
+import pytest
+
+from homelab_service_backup.utils import (
+    ArchiveIndex,
+    IndexEntry,
+    TarWriter,
+    open_compressed_reader,
+    open_compressed_writer,
+    read_index,
+    walk_directory,
+)
+from homelab_service_backup.utils.archive_index import get_index_path, get_legacy_index_path
+from homelab_service_backup.utils.walker import add_to_tar
+
+
+def _write_indexed_archive(source: Path, codec: str, block_size: int) -> tuple[bytes, ArchiveIndex]:
+    """Archive a directory the way filesystem backups are written, starting a block every `block_size` bytes."""
+    buffer = io.BytesIO()
+    index = ArchiveIndex(backup="backup.tgz")
+    with (
+        open_compressed_writer(buffer, codec=codec, workers=2) as compressed,
+        TarWriter(compressed) as tar,
+    ):
+        for entry in walk_directory(source):
+            if compressed.block_size >= block_size:
+                compressed.start_block()
+            offset = tar.offset - compressed.block_start
+            tarinfo, checksum = add_to_tar(tar, entry)
+            index.members[tarinfo.name] = IndexEntry.from_tarinfo(
+                tarinfo, compressed.block_offset, offset, checksum
+            )
+
+    return buffer.getvalue(), index
+
+
+@pytest.fixture
+def source(tmp_path: Path) -> Path:
+    """Create a directory with enough data to span several blocks."""
+    source = tmp_path / "source"
+    (source / "conf").mkdir(parents=True)
+    for i in range(20):
+        (source / f"data{i:02}.bin").write_bytes(os.urandom(20_000))
+    (source / "conf" / "app.yml").write_text("key: value")
+    return source
+
+
+@pytest.mark.parametrize("codec", ["gzip", "zstd", "none"])
+def test_index_seeks_to_members(source: Path, codec: str):
+    """Verify every member can be read by seeking to its block, without the data before it."""
+    # Given: An archive split into blocks with its index
+    data, index = _write_indexed_archive(source, codec, block_size=50_000)
+    assert len({entry.block for entry in index.members.values()}) > 1
+
+    for name, entry in index.members.items():
+        # When: Decompressing from the member's block only
+        fh = io.BytesIO(data)
+        fh.seek(entry.block)
+        reader = open_compressed_reader(fh, codec)
+        reader.read(entry.offset)
+        with tarfile.open(fileobj=reader, mode="r|") as archive:
+            member = archive.next()
+            content = archive.extractfile(member).read() if member.isreg() else b""
+
+        # Then: The member is the indexed one and its data matches the checksum
+        assert member.name == name
+        assert member.size == entry.size
+        if entry.checksum is not None:
+            assert zlib.crc32(content) == entry.checksum
+
+
+@pytest.mark.parametrize("codec", ["gzip", "zstd"])
+def test_block_split_archive_reads_as_one_stream(source: Path, codec: str):
+    """Verify an archive written in blocks is still a single valid compressed tar stream."""
+    data, index = _write_indexed_archive(source, codec, block_size=50_000)
+
+    with tarfile.open(fileobj=open_compressed_reader(io.BytesIO(data), codec), mode="r|") as tar:
+        names = [member.name for member in tar]
+
+    assert names == list(index.members)
+
+
+def test_index_roundtrip_and_select(tmp_path: Path):
+    """Verify an index written next to an archive reads back and selects paths and directories."""
+    # Given: An index with nested members
+    backup_file = tmp_path / "job-20240101T000000-daily.tgz"
+    index = ArchiveIndex(
+        backup=backup_file.name,
+        members={
+            "conf": IndexEntry(0, 0, 0, None, 1700000000, "5", ""),
+            "conf/app.yml": IndexEntry(0, 512, 10, 1234, 1700000000, "0", ""),
+            "config.yml": IndexEntry(100, 0, 5, 5678, 1700000000, "0", ""),
+        },
+    )
+
+    # When: Writing and reading it back
+    index.write(backup_file)
+    loaded = read_index(backup_file)
+
+    # Then: It round-trips and selecting a directory does not match a sibling prefix
+    assert get_index_path(backup_file).exists()
+    assert loaded == index
+    assert set(loaded.select(["conf"])) == {"conf", "conf/app.yml"}
+    assert set(loaded.select(["config.yml"])) == {"config.yml"}
+    assert read_index(tmp_path / "missing.tgz") is None
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_read_index_selects_paths(tmp_path: Path, legacy: bool):
+    """Verify reading an index for some paths only loads their members, also for names JSON escapes."""
+    # Given: An index with nested members and names that need escaping
+    backup_file = tmp_path / "job-20240101T000000-daily.tgz"
+    entry = IndexEntry(0, 0, 0, None, 1700000000, "0", "")
+    names = ["conf", "conf/app.yml", "config.yml", 'quo"te', 'quo"te/x', "ünï/cödé.txt", "other"]
+    index = ArchiveIndex(backup=backup_file.name, members=dict.fromkeys(names, entry))
+    if legacy:
+        data = {"version": 1, "backup": index.backup, "members": index.members}
+        with gzip.open(get_legacy_index_path(backup_file), "wt", encoding="utf-8") as f:
+            json.dump(data, f)
+    else:
+        index.write(backup_file)
+
+    # When: Reading it for a directory, a quoted name and a non-ASCII path
+    loaded = read_index(backup_file, ["conf", 'quo"te', "ünï/cödé.txt"])
+
+    # Then: Only the selected members are loaded
+    assert set(loaded.members) == {"conf", "conf/app.yml", 'quo"te', 'quo"te/x', "ünï/cödé.txt"}
+    assert loaded.members["conf/app.yml"] == entry
+
+
+def test_index_entry_is_current(tmp_path: Path):
+    """Verify files on disk are compared by type, size, mtime and optionally checksum."""
+    # Given: A file, a symlink and a directory on disk with matching index entries
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "file.txt").write_text("hello")
+    os.utime(tmp_path / "file.txt", (1_700_000_000, 1_700_000_000))
+    (tmp_path / "link").symlink_to("file.txt")
+    file_entry = IndexEntry(0, 0, 5, zlib.crc32(b"hello"), 1_700_000_000, "0", "")
+
+    def is_current(name, entry, **kwargs):
+        return entry.is_current(tmp_path, name, (tmp_path / name).lstat(), **kwargs)
+
+    # Then: Matching entries are current
+    assert is_current("file.txt", file_entry, compare_checksum=True)
+    assert is_current("dir", IndexEntry(0, 0, 0, None, 0, "5", ""))
+    assert is_current("link", IndexEntry(0, 0, 0, None, 0, "2", "file.txt"))
+
+    # And: Any difference means the member must be restored
+    assert not is_current("file.txt", file_entry._replace(mtime=1_600_000_000))
+    assert not is_current("file.txt", file_entry._replace(size=6))
+    assert not is_current("link", IndexEntry(0, 0, 0, None, 0, "2", "other.txt"))
+    assert not is_current("dir", file_entry)
+
+    # And: A same-size change with the same mtime is only caught by the checksum
+    (tmp_path / "file.txt").write_text("HELLO")
+    os.utime(tmp_path / "file.txt", (1_700_000_000, 1_700_000_000))
+    assert is_current("file.txt", file_entry)
+    assert not is_current("file.txt", file_entry, compare_checksum=True)
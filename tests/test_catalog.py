@@ -0,0 +1,186 @@
+# type: ignore
+"""Test the backup catalog."""
+
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import pytest
+
+from homelab_service_backup.utils import (
+    Catalog,
+    Config,
+    find_most_recent_backup,
+    get_catalog,
+    open_backup_output,
+)
+from homelab_service_backup.utils import catalog as catalog_module
+from homelab_service_backup.utils.catalog import CATALOG_FILENAME, parse_backup_name
+
+
+def _touch(directory: Path, name: str, mtime: int) -> Path:
+    """Create an empty backup file with a given modification time."""
+    path = directory / name
+    path.write_bytes(b"backup")
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+@pytest.mark.parametrize(
+    ("name", "expected"),
+    [
+        (
+            "nginx-20240101T000000-daily.tgz",
+            {"job": "nginx", "timestamp": "20240101T000000", "type": "daily", "extension": "tgz"},
+        ),
+        (
+            "my-app-postgres-20240101T000000-hourly.sql.zst",
+            {
+                "job": "my-app-postgres",
+                "timestamp": "20240101T000000",
+                "type": "hourly",
+                "extension": "sql.zst",
+            },
+        ),
+        ("nginx-20240101T000000-daily.tgz.index.json.gz", None),
+        ("nginx-20240101T000000-daily.tgz.index.jsonl.gz", None),
+        ("nginx-20240101T000000-daily.txt", None),
+        ("hsb-catalog.jsonl", None),
+    ],
+)
+def test_parse_backup_name(name: str, expected: dict | None):
+    """Verify backup names are split into their parts and other files are ignored."""
+    assert parse_backup_name(name) == expected
+
+
+def test_catalog_rebuilds_from_directory(tmp_path: Path):
+    """Verify a missing catalog is built from the backups on disk, ordered by modification time."""
+    # Given: Backups of two jobs sharing a directory and an unrelated file
+    _touch(tmp_path, "foo-20240102T000000-daily.tgz", 1_700_000_200)
+    _touch(tmp_path, "foo-20240101T000000-daily.tgz", 1_700_000_100)
+    _touch(tmp_path, "foo-postgres-20240101T000000-daily.sql.gz", 1_700_000_300)
+    _touch(tmp_path, "notes.txt", 1_700_000_400)
+
+    # When: Listing the backups of one job
+    entries = Catalog(tmp_path).for_job("foo")
+
+    # Then: The catalog is written and only the job's backups are listed, oldest first
+    assert (tmp_path / CATALOG_FILENAME).exists()
+    assert [entry.name for entry in entries] == [
+        "foo-20240101T000000-daily.tgz",
+        "foo-20240102T000000-daily.tgz",
+    ]
+    assert entries[0].codec == "gzip"
+    assert entries[0].size == len(b"backup")
+    assert [entry.name for entry in Catalog(tmp_path).for_job("foo-postgres")] == [
+        "foo-postgres-20240101T000000-daily.sql.gz"
+    ]
+
+
+def test_catalog_add_and_remove(tmp_path: Path):
+    """Verify added and removed backups are replayed from the catalog by a new instance."""
+    # Given: An empty catalog
+    catalog = Catalog(tmp_path)
+    assert catalog.entries() == {}
+
+    # When: Adding two backups and removing one
+    first = _touch(tmp_path, "foo-20240101T000000-daily.tgz", 1_700_000_000)
+    second = _touch(tmp_path, "foo-20240102T000000-daily.tgz", 1_700_000_000)
+    catalog.add(first, checksum="abc")
+    catalog.add(second)
+    catalog.add(tmp_path / "notes.txt")
+    catalog.remove([first.name])
+
+    # Then: A fresh instance sees the result without scanning the directory
+    entries = Catalog(tmp_path).entries()
+    assert list(entries) == [second.name]
+    assert entries[second.name].checksum is None
+    assert len((tmp_path / CATALOG_FILENAME).read_text().splitlines()) == 4
+
+
+def test_catalog_compacts_superseded_records(tmp_path: Path, monkeypatch):
+    """Verify the catalog is rewritten once removed backups pile up."""
+    # Given: A low compaction threshold
+    monkeypatch.setattr(catalog_module, "CATALOG_COMPACT_THRESHOLD", 4)
+    catalog = Catalog(tmp_path)
+    backups = [
+        _touch(tmp_path, f"foo-2024010{i}T000000-daily.tgz", 1_700_000_000 + i) for i in range(1, 6)
+    ]
+
+    # When: Adding five backups and removing three
+    for backup in backups:
+        catalog.add(backup)
+    catalog.remove([backup.name for backup in backups[:3]])
+
+    # Then: Only the version record and the remaining backups are left
+    lines = (tmp_path / CATALOG_FILENAME).read_text().splitlines()
+    assert len(lines) == 3
+    assert list(catalog.entries()) == [backups[3].name, backups[4].name]
+
+
+def test_catalog_compaction_keeps_concurrent_adds(tmp_path: Path, monkeypatch):
+    """Verify compacting the catalog never drops backups another writer adds meanwhile."""
+    # Given: A catalog compacted on every removal
+    monkeypatch.setattr(catalog_module, "CATALOG_COMPACT_THRESHOLD", 0)
+    assert Catalog(tmp_path).entries() == {}
+    added = [tmp_path / f"foo-20240101T{i:06d}-daily.tgz" for i in range(200)]
+    removed = [f"bar-20240101T{i:06d}-daily.tgz" for i in range(200)]
+
+    # When: One writer adds backups while another removes backups and compacts
+    def add():
+        catalog = Catalog(tmp_path)
+        for backup in added:
+            catalog.add(backup, size=1)
+
+    def remove():
+        catalog = Catalog(tmp_path)
+        for name in removed:
+            catalog.remove([name])
+
+    threads = [threading.Thread(target=add), threading.Thread(target=remove)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Then: Every added backup is in the catalog
+    assert set(Catalog(tmp_path).entries()) == {backup.name for backup in added}
+
+
+def test_catalog_rebuild_keeps_checksums(tmp_path: Path):
+    """Verify rebuilding picks up backups changed by hand and keeps known checksums."""
+    # Given: A cataloged backup with a checksum, one deleted by hand and one copied in by hand
+    catalog = Catalog(tmp_path)
+    kept = _touch(tmp_path, "foo-20240101T000000-daily.tgz", 1_700_000_000)
+    deleted = _touch(tmp_path, "foo-20240102T000000-daily.tgz", 1_700_000_000)
+    catalog.add(kept, checksum="abc")
+    catalog.add(deleted)
+    deleted.unlink()
+    copied = _touch(tmp_path, "foo-20240103T000000-daily.tgz", 1_700_000_000)
+
+    # When: Rebuilding the catalog
+    count = catalog.rebuild()
+
+    # Then: It matches the directory and the checksum survives
+    entries = catalog.entries()
+    assert count == 2
+    assert set(entries) == {kept.name, copied.name}
+    assert entries[kept.name].checksum == "abc"
+
+
+def test_open_backup_output_records_backup(tmp_path: Path, mock_config):
+    """Verify backups written to a file are cataloged with their size and SHA-256."""
+    # Given: A backup storage directory
+    with Config.change_config_sources(mock_config(backup_storage_dir=tmp_path, job_name="foo")):
+        backup_file = tmp_path / "foo-20240101T000000-daily.tgz"
+
+        # When: Writing a backup
+        with open_backup_output(Config(), backup_file) as fh:
+            fh.write(b"data")
+
+        # Then: It is cataloged and found as the most recent backup
+        entry = get_catalog(Config()).entries()[backup_file.name]
+        assert entry.size == 4
+        assert entry.checksum == hashlib.sha256(b"data").hexdigest()
+        assert find_most_recent_backup(Config()) == backup_file
@@ -0,0 +1,146 @@
+# type: ignore
+"""Test compression utilities."""
+
+import gzip
+import io
+import os
+import tarfile
+import zlib
+
+import pytest
+
+from homelab_service_backup.utils.compression import (
+    ParallelGzipWriter,
+    open_compressed_reader,
+    open_compressed_writer,
+    resolve_worker_count,
+)
+
+
+@pytest.mark.parametrize(
+    ("size", "block_size", "workers"),
+    [
+        (0, 1024, 1),
+        (100, 1024, 2),
+        (1024, 1024, 4),
+        (250_000, 4096, 4),
+        (250_000, 4096, 1),
+    ],
+)
+def test_parallel_gzip_writer_roundtrip(size, block_size, workers):
+    """Verify the parallel writer produces a gzip stream that decompresses to the original bytes."""
+    # Given: Compressible data spanning several blocks
+    data = (b"homelab-service-backup " * (size // 23 + 1))[:size]
+    buffer = io.BytesIO()
+
+    # When: Compressing with the parallel writer
+    with ParallelGzipWriter(buffer, level=6, workers=workers, block_size=block_size) as writer:
+        for start in range(0, len(data), 1000):
+            writer.write(data[start : start + 1000])
+
+    # Then: The output is a single valid gzip member
+    assert gzip.decompress(buffer.getvalue()) == data
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    assert decompressor.decompress(buffer.getvalue()) == data
+    assert decompressor.eof
+    assert not decompressor.unused_data
+
+
+def test_parallel_gzip_writer_incompressible_data():
+    """Verify incompressible data survives compression across block boundaries."""
+    # Given: Random bytes
+    data = os.urandom(300_000)
+    buffer = io.BytesIO()
+
+    # When: Compressing with the parallel writer
+    with ParallelGzipWriter(buffer, workers=3, block_size=8192) as writer:
+        writer.write(data)
+
+    # Then: The data round-trips
+    assert gzip.decompress(buffer.getvalue()) == data
+
+
+def test_parallel_gzip_writer_tar_stream(tmp_path):
+    """Verify a tar stream written through the parallel writer is readable as a .tgz."""
+    # Given: A few files on disk
+    for i in range(5):
+        (tmp_path / f"file_{i}.txt").write_text(f"content {i}\n" * 1000)
+    archive = tmp_path / "backup.tgz"
+
+    # When: Writing a tar stream through the parallel writer
+    with (
+        archive.open("wb") as fh,
+        ParallelGzipWriter(fh, workers=2, block_size=4096) as gz,
+        tarfile.open(fileobj=gz, mode="w|") as tar,
+    ):
+        for i in range(5):
+            tar.add(tmp_path / f"file_{i}.txt", arcname=f"file_{i}.txt")
+
+    # Then: The archive opens with tarfile's gzip support
+    with tarfile.open(archive, "r:gz") as tar:
+        assert sorted(tar.getnames()) == [f"file_{i}.txt" for i in range(5)]
+        assert tar.extractfile("file_3.txt").read() == b"content 3\n" * 1000
+
+
+def test_parallel_gzip_writer_rejects_write_after_close():
+    """Verify writing to a closed writer raises an error."""
+    # Given: A closed writer
+    writer = ParallelGzipWriter(io.BytesIO(), workers=1)
+    writer.close()
+
+    # When/Then: Writing raises ValueError
+    with pytest.raises(ValueError, match="closed"):
+        writer.write(b"data")
+
+
+def test_resolve_worker_count():
+    """Verify zero workers resolves to the CPU count."""
+    assert resolve_worker_count(3) == 3
+    assert resolve_worker_count(0) == (os.cpu_count() or 1)
+
+
+@pytest.mark.parametrize("codec", ["gzip", "zstd", "none"])
+def test_codec_roundtrip(codec):
+    """Verify each codec writes a stream its reader decompresses back to the original bytes."""
+    # Given: Data written through the codec's writer
+    data = b"homelab-service-backup\n" * 20_000
+    buffer = io.BytesIO()
+    with open_compressed_writer(buffer, codec=codec, workers=2) as writer:
+        writer.write(data)
+        writer.flush()
+
+    # When: Reading the data back
+    buffer.seek(0)
+    reader = open_compressed_reader(buffer, codec)
+
+    # Then: The original bytes are returned and compression reduced the size
+    assert reader.read() == data
+    if codec == "none":
+        assert len(buffer.getvalue()) == len(data)
+    else:
+        assert len(buffer.getvalue()) < len(data)
+
+
+def test_zstd_tar_stream(tmp_path):
+    """Verify a tar stream written with zstd is readable in tarfile stream mode."""
+    # Given: A zstd compressed tar archive
+    (tmp_path / "foo.txt").write_text("foo")
+    archive = tmp_path / "backup.tar.zst"
+    with (
+        archive.open("wb") as fh,
+        open_compressed_writer(fh, codec="zstd", level=3) as compressed,
+        tarfile.open(fileobj=compressed, mode="w|") as tar,
+    ):
+        tar.add(tmp_path / "foo.txt", arcname="foo.txt")
+
+    # When: Reading the archive back
+    with (
+        archive.open("rb") as fh,
+        open_compressed_reader(fh, "zstd") as reader,
+        tarfile.open(fileobj=reader, mode="r|") as tar,
+    ):
+        member = tar.next()
+
+        # Then: The member is intact
+        assert member.name == "foo.txt"
+        assert tar.extractfile(member).read() == b"foo"
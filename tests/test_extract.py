@@ -0,0 +1,154 @@
+# type: ignore
+"""Test extracting backup archives with parallel writers."""
+
+import io
+import os
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from homelab_service_backup.utils import ParallelExtractor
+
+
+def _archive(source: Path) -> io.BytesIO:
+    """Build an uncompressed tar stream of a directory, the way backups are written."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w|") as tar:
+        tar.add(source, arcname=".")
+    buffer.seek(0)
+    return buffer
+
+
+def _tree(root: Path) -> dict[str, tuple[str, bytes | str]]:
+    """Describe every entry below a directory by type and contents."""
+    tree = {}
+    for path in sorted(root.rglob("*")):
+        name = str(path.relative_to(root))
+        if path.is_symlink():
+            tree[name] = ("link", str(path.readlink()))
+        elif path.is_dir():
+            tree[name] = ("dir", "")
+        else:
+            tree[name] = ("file", path.read_bytes())
+    return tree
+
+
+@pytest.fixture
+def source(tmp_path: Path) -> Path:
+    """Create a directory with nested files, a symlink and a hard link."""
+    source = tmp_path / "source"
+    (source / "a" / "b").mkdir(parents=True)
+    for i in range(50):
+        (source / "a" / f"file{i}.txt").write_bytes(os.urandom(i * 997))
+    (source / "a" / "b" / "deep.txt").write_text("deep")
+    (source / "a" / "b" / "script.sh").write_text("#!/bin/sh")
+    (source / "a" / "b" / "script.sh").chmod(0o750)
+    (source / "link").symlink_to("a/b/deep.txt")
+    (source / "hard").hardlink_to(source / "a" / "b" / "deep.txt")
+    os.utime(source / "a" / "b", (1_600_000_000, 1_600_000_000))
+    return source
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_parallel_extractor_round_trip(tmp_path: Path, source: Path, workers: int):
+    """Verify every file, link, mode and directory timestamp is restored."""
+    # Given: An archive of the source directory
+    archive = _archive(source)
+    destination = tmp_path / "restore"
+    destination.mkdir()
+
+    # When: Extracting it with a small read-ahead budget
+    with ParallelExtractor(destination, workers=workers, max_pending_bytes=4096) as extractor:
+        extractor.extract(archive)
+
+    # Then: The tree matches the source
+    assert _tree(destination) == _tree(source)
+    assert (destination / "a" / "b" / "script.sh").stat().st_mode & 0o777 == 0o750
+    assert (destination / "hard").stat().st_ino == (
+        destination / "a" / "b" / "deep.txt"
+    ).stat().st_ino
+    assert (destination / "a" / "b").stat().st_mtime == 1_600_000_000
+    assert extractor.files == 52
+
+
+def test_parallel_extractor_replays_chain(tmp_path: Path, source: Path):
+    """Verify later archives overwrite files and replace a directory with a symlink."""
+    # Given: A full archive and a later archive that changes a file and turns a directory into a link
+    full = _archive(source)
+    (source / "a" / "file1.txt").write_text("changed")
+    later_dir = tmp_path / "later"
+    (later_dir / "a").mkdir(parents=True)
+    (later_dir / "a" / "file1.txt").write_text("changed")
+    (later_dir / "a" / "b").symlink_to("elsewhere")
+    incremental = _archive(later_dir)
+    destination = tmp_path / "restore"
+    destination.mkdir()
+
+    # When: Replaying both archives with one extractor
+    with ParallelExtractor(destination, workers=4) as extractor:
+        extractor.extract(full)
+        extractor.extract(incremental)
+
+    # Then: The later archive wins
+    assert (destination / "a" / "file1.txt").read_text() == "changed"
+    assert (destination / "a" / "b").is_symlink()
+    assert (destination / "a" / "file2.txt").stat().st_size == 2 * 997
+
+
+def test_parallel_extractor_rejects_unsafe_members(tmp_path: Path):
+    """Verify members that would escape the destination are refused."""
+    # Given: An archive with a path outside the destination
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        info = tarfile.TarInfo("../escape.txt")
+        info.size = 4
+        tar.addfile(info, io.BytesIO(b"evil"))
+    buffer.seek(0)
+    destination = tmp_path / "restore"
+    destination.mkdir()
+
+    # When/Then: Extraction fails before anything is written
+    with (
+        pytest.raises(tarfile.OutsideDestinationError),
+        ParallelExtractor(destination) as extractor,
+    ):
+        extractor.extract(buffer)
+    assert not (tmp_path / "escape.txt").exists()
+
+
+def test_parallel_extractor_skips_special_files(tmp_path: Path):
+    """Verify device files and FIFOs are skipped while the rest of the archive is restored."""
+    # Given: An archive with a FIFO and a character device between two files
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, kind in [("fifo", tarfile.FIFOTYPE), ("null", tarfile.CHRTYPE)]:
+            info = tarfile.TarInfo(name)
+            info.type = kind
+            tar.addfile(info)
+            info = tarfile.TarInfo(f"{name}.txt")
+            info.size = len(name)
+            tar.addfile(info, io.BytesIO(name.encode()))
+    buffer.seek(0)
+    destination = tmp_path / "restore"
+    destination.mkdir()
+
+    # When: Extracting it
+    with ParallelExtractor(destination) as extractor:
+        extractor.extract(buffer)
+
+    # Then: Only the regular files are restored
+    assert _tree(destination) == {"fifo.txt": ("file", b"fifo"), "null.txt": ("file", b"null")}
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="Changing ownership requires root")
+def test_parallel_extractor_applies_owner(tmp_path: Path, source: Path):
+    """Verify ownership is applied to every entry while extracting."""
+    destination = tmp_path / "restore"
+    destination.mkdir()
+
+    with ParallelExtractor(destination, owner=(1234, 5678)) as extractor:
+        extractor.extract(_archive(source))
+
+    owners = {(p.lstat().st_uid, p.lstat().st_gid) for p in [destination, *destination.rglob("*")]}
+    assert owners == {(1234, 5678)}
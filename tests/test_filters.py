@@ -0,0 +1,132 @@
+# type: ignore
+"""Test the compiled include/exclude filter."""
+
+from pathlib import Path
+
+import pytest
+
+from homelab_service_backup.modules import backup
+from homelab_service_backup.utils import BackupFilter, Config, walk_directory
+
+
+@pytest.mark.parametrize(
+    ("path", "rules", "is_dir", "expected"),
+    [
+        ("foo.txt", {}, False, True),
+        ("docs/readme.md", {"include_files": ["docs"]}, False, True),
+        ("other/readme.md", {"include_files": ["docs"]}, False, False),
+        ("docs/readme.md", {"exclude_files": ["docs/"]}, False, False),
+        ("docs2/readme.md", {"exclude_files": ["docs"]}, False, True),
+        ("a/b/debug.log", {"exclude_files": ["*.log"]}, False, False),
+        ("a/b/debug.log.1", {"exclude_files": ["*.log"]}, False, True),
+        ("a/cache/x.bin", {"exclude_files": ["cache/"]}, False, False),
+        ("a/cache", {"exclude_files": ["cache/"]}, False, True),
+        ("a/cache", {"exclude_files": ["cache/"]}, True, False),
+        ("logs/2024/app.log", {"include_files": ["logs/**/*.log"]}, False, True),
+        ("logs/app.log", {"include_files": ["logs/**/*.log"]}, False, True),
+        ("other/logs/app.log", {"include_files": ["logs/**/*.log"]}, False, False),
+        ("img1.png", {"include_files": ["img[0-9].png"]}, False, True),
+        ("imgA.png", {"include_files": ["img[!A].png"]}, False, False),
+        ("foo.txt", {"include_files": ["foo.txt"], "exclude_regex": r".*\.txt"}, False, False),
+    ],
+)
+def test_backup_filter_matches(path: str, rules, is_dir: bool, expected: bool):
+    """Verify paths, directory prefixes and gitignore-style globs are matched."""
+    assert BackupFilter(**rules).matches(Path(path), is_dir=is_dir) is expected
+
+
+@pytest.mark.parametrize(
+    ("directory", "rules", "expected"),
+    [
+        ("anything", {}, True),
+        ("node_modules", {"exclude_files": ["node_modules"]}, False),
+        ("a/node_modules", {"exclude_files": ["node_modules/"]}, False),
+        ("data", {"exclude_regex": "data"}, True),
+        ("config", {"include_files": ["config/app.yml"]}, True),
+        ("media", {"include_files": ["config/app.yml"]}, False),
+        ("config/sub", {"include_files": ["config"]}, True),
+        ("media", {"include_files": ["config/*.yml"]}, False),
+        ("config", {"include_files": ["config/*.yml"]}, True),
+        ("media", {"include_files": ["*.yml"]}, True),
+        ("media", {"include_regex": r"config/.*"}, True),
+    ],
+)
+def test_backup_filter_could_match_under(directory: str, rules, expected: bool):
+    """Verify subtrees are only pruned when nothing below them can match."""
+    assert BackupFilter(**rules).could_match_under(Path(directory)) is expected
+
+
+def test_backup_filter_from_config_is_cached(mock_config):
+    """Verify the filter is compiled once for each distinct configuration."""
+    with Config.change_config_sources(mock_config(exclude_files="foo.txt")):
+        first = BackupFilter.from_config(Config())
+        second = BackupFilter.from_config(Config())
+    with Config.change_config_sources(mock_config(exclude_files="bar.txt")):
+        third = BackupFilter.from_config(Config())
+
+    assert first is second
+    assert first is not third
+    assert not third.matches("bar.txt")
+
+
+def test_backup_filter_prunes_walk(tmp_path: Path):
+    """Verify the walker skips directories the filter can not match anything below."""
+    # Given: A tree where only one directory holds included files
+    for directory in ("config", "media/movies"):
+        (tmp_path / directory).mkdir(parents=True)
+        (tmp_path / directory / "file.yml").touch()
+    backup_filter = BackupFilter(include_files=["config/*.yml"])
+    visited = []
+
+    def descend(directory: Path) -> bool:
+        visited.append(str(directory))
+        return backup_filter.could_match_under(directory)
+
+    # When: Walking with the filter's prune check
+    relative = [str(entry.relative) for entry in walk_directory(tmp_path, descend=descend)]
+
+    # Then: The media directory is listed but never descended
+    assert "media/movies" not in relative
+    assert visited == ["config", "media"]
+
+
+@pytest.mark.parametrize(
+    "rules",
+    [
+        {"exclude_files": ["a/secret.txt", "*.log", "a/cache/"]},
+        {"exclude_regex": r"a/secret\.txt|.*\.log|a/cache"},
+        {"include_files": ["a"], "exclude_files": ["a/secret.txt", "*.log", "a/cache/"]},
+    ],
+)
+def test_nested_excludes_are_applied(tmp_path: Path, monkeypatch, rules):
+    """Verify exclude rules drop entries below an included directory and prune excluded directories."""
+    # Given: A source tree with files to exclude below the top level
+    source = tmp_path / "data"
+    (source / "a" / "cache").mkdir(parents=True)
+    (tmp_path / "storage").mkdir()
+    for name in ("top.log", "a/keep.txt", "a/secret.txt", "a/deep.log", "a/cache/x.bin"):
+        (source / name).write_text(name)
+    config = Config.model_validate(
+        {
+            "action": "backup",
+            "job_name": "job",
+            "backup_storage_dir": tmp_path / "storage",
+            "job_data_dir": source,
+            "log_to_file": False,
+            **rules,
+        }
+    )
+    descended = []
+    walk = backup.walk_directory
+
+    def recording_walk(root: Path, descend):
+        return walk(root, descend=lambda d: descend(d) and not descended.append(str(d)))
+
+    monkeypatch.setattr(backup, "walk_directory", recording_walk)
+
+    # When: Listing the entries that belong in the backup
+    names = sorted(str(entry.relative) for entry in backup._iter_backup_files(config, source))
+
+    # Then: Only the kept entries are listed, and the excluded directory is never read
+    assert names == ["a", "a/keep.txt"]
+    assert "a/cache" not in descended
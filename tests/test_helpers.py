@@ -1,18 +1,21 @@
 # type: ignore
 """Test helper utilities."""
 
+import os
 from pathlib import Path
 
 import pytest
 from freezegun import freeze_time
 
 from homelab_service_backup.constants import FILESYSTEM_BACKUP_EXT
+from homelab_service_backup.utils import Config
 from homelab_service_backup.utils.helpers import (
-    Config,
     clean_directory,
     clean_old_backups,
     filter_file_for_backup,
     find_most_recent_backup,
+    get_backup_codec,
+    get_backup_file_extension,
     type_of_backup,
 )
 
@@ -27,6 +30,8 @@ def test_clean_directory(tmp_path: Path):
     (test_dir / "subdir" / "subdir").mkdir()
     (test_dir / "subdir" / "subdir" / "file.txt").touch()
     (test_dir / "another_file.txt").touch()
+    (test_dir / "dangling_link").symlink_to("missing")
+    (test_dir / "dir_link").symlink_to(tmp_path)
     assert (test_dir / "subdir").exists()
     assert (test_dir / "subdir" / "file.txt").exists()
     assert (test_dir / "another_file.txt").exists()
@@ -37,13 +42,14 @@ def test_clean_directory(tmp_path: Path):
     # THEN: The directory should be empty but still exist
     assert test_dir.exists(), "The directory itself should not be deleted."
     assert not list(test_dir.iterdir()), "The directory should be empty after cleaning."
+    assert tmp_path.exists(), "Symlinked directories should not be followed."
 
 
 def test_find_most_recent_backup(mock_config, backup_dir: Path, debug):
     """Test that find_most_recent_backup correctly identifies the most recent backup file."""
     # WHEN: Invoking the function to find the most recent backup
     with Config.change_config_sources(mock_config(backup_storage_dir=backup_dir)):
-        most_recent_backup = find_most_recent_backup()
+        most_recent_backup = find_most_recent_backup(Config())
         # debug("config", Config().model_dump())
 
         # THEN: The function should return the path to the most recently modified backup file
@@ -56,6 +62,86 @@ def test_find_most_recent_backup(mock_config, backup_dir: Path, debug):
         )
 
 
+def test_find_most_recent_backup_any_codec(mock_config, backup_dir: Path):
+    """Verify find_most_recent_backup returns the newest backup even when it was written with another codec."""
+    # Given: A newer zstd backup alongside gzip backups and another job's backup
+    with Config.change_config_sources(mock_config(backup_storage_dir=backup_dir)):
+        newest = backup_dir / f"{Config().job_name}-20230303T030300-daily.tar.zst"
+        newest.touch()
+        os.utime(newest, (newest.stat().st_atime, newest.stat().st_mtime + 1000))
+        (backup_dir / f"{Config().job_name}-postgres-20240303T030300-daily.sql.zst").touch()
+
+        # When: Finding the most recent backup
+        most_recent_backup = find_most_recent_backup(Config())
+
+    # Then: The zstd backup is returned
+    assert most_recent_backup == newest
+
+
+@pytest.mark.parametrize(
+    ("filename", "expected"),
+    [
+        ("job-20240101T000000-daily.tgz", "gzip"),
+        ("job-20240101T000000-daily.tar.zst", "zstd"),
+        ("job-20240101T000000-daily.tar", "none"),
+        ("job-postgres-20240101T000000-daily.sql.gz", "gzip"),
+        ("job-postgres-20240101T000000-daily.sql.zst", "zstd"),
+        ("job-postgres-20240101T000000-daily.sql", "none"),
+    ],
+)
+def test_get_backup_codec(filename: str, expected: str):
+    """Verify the codec is detected from the backup file extension."""
+    assert get_backup_codec(Path(filename)) == expected
+
+
+def test_get_backup_codec_unknown():
+    """Verify an unknown extension raises ValueError."""
+    with pytest.raises(ValueError, match="Unknown backup file extension"):
+        get_backup_codec(Path("job-20240101T000000-daily.zip"))
+
+
+@pytest.mark.parametrize(
+    ("config", "expected"),
+    [
+        ({}, "tgz"),
+        ({"compression": "zstd"}, "tar.zst"),
+        ({"compression": "none"}, "tar"),
+        ({"use_postgres": True}, "sql.gz"),
+        ({"use_postgres": True, "compression": "zstd"}, "sql.zst"),
+        ({"use_postgres": True, "postgres_format": "directory"}, "dump.tar"),
+        ({"use_postgres": True, "postgres_format": "directory", "postgres_pack": False}, "dump"),
+    ],
+)
+def test_get_backup_file_extension(mock_config, config, expected: str):
+    """Verify the backup file extension follows the configured codec."""
+    with Config.change_config_sources(mock_config(**config)):
+        assert get_backup_file_extension(Config()) == expected
+
+
+def test_clean_old_backups_directory_dumps(tmp_path: Path, mock_config):
+    """Verify retention lists and deletes unpacked directory-format PostgreSQL dumps."""
+    # Given: Two hourly directory dumps with one hourly backup retained
+    backup_dir = tmp_path / "backups"
+    backup_dir.mkdir()
+    with Config.change_config_sources(
+        mock_config(backup_storage_dir=backup_dir, use_postgres=True)
+    ):
+        for i in range(2):
+            dump = backup_dir / f"{Config().job_name}-postgres-2024010{i + 1}T000000-hourly.dump"
+            dump.mkdir()
+            (dump / "toc.dat").touch()
+            os.utime(dump, (i * 10, i * 10))
+
+        # When: Cleaning old backups
+        deleted = clean_old_backups(Config())
+        most_recent = find_most_recent_backup(Config())
+
+    # Then: The older dump directory is removed and the newer one is the most recent backup
+    assert [backup.name for backup in deleted] == ["test_job-postgres-20240101T000000-hourly.dump"]
+    assert not deleted[0].exists()
+    assert most_recent.name == "test_job-postgres-20240102T000000-hourly.dump"
+
+
 @pytest.mark.parametrize(
     ("date", "expected"),
     [
@@ -71,14 +157,14 @@ def test_backup_type_of_backup(backup_dir: Path, mock_config, date: str, expecte
     with Config.change_config_sources(mock_config(backup_storage_dir=backup_dir)):
         freezer = freeze_time(date)
         freezer.start()
-        assert type_of_backup() == expected
+        assert type_of_backup(Config()) == expected
         freezer.stop()
 
 
 def test_clean_old_backups(backup_dir: Path, mock_config, debug) -> None:
     """Test cleaning old backups."""
     with Config.change_config_sources(mock_config(backup_storage_dir=backup_dir)):
-        deleted_files = clean_old_backups()
+        deleted_files = clean_old_backups(Config())
 
         # debug("config", Config().model_dump())
         # debug("dir", backup_dir)
@@ -112,4 +198,4 @@ def test_filter_file_for_backup(mock_config, filename: str, config, expected, de
     """Test filter_file_for_backup."""
     with Config.change_config_sources(mock_config(**config)):
         # debug("config", Config().model_dump())
-        assert filter_file_for_backup(Path(filename)) == expected
+        assert filter_file_for_backup(Config(), Path(filename)) == expected
@@ -0,0 +1,242 @@
+# type: ignore
+"""Test multi-job configuration files and running their jobs."""
+
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from homelab_service_backup.modules import run_jobs, scheduler
+from homelab_service_backup.utils import Catalog, JobsFileError, get_config, load_jobs_file
+
+
+def _write_jobs(tmp_path: Path, body: str) -> Path:
+    """Write a jobs file with storage and data directories for jobs `a` to `d`."""
+    for name in ("storage", "other", "a", "b", "c", "d"):
+        (tmp_path / name).mkdir(exist_ok=True)
+    path = tmp_path / "jobs.toml"
+    path.write_text(body.replace("{tmp}", str(tmp_path)))
+    return path
+
+
+def test_load_jobs_file(tmp_path: Path):
+    """Verify jobs are merged over the defaults and validated."""
+    # Given: A jobs file with shared defaults and a job overriding them
+    path = _write_jobs(
+        tmp_path,
+        """
+        max_concurrent_jobs = 4
+
+        [storage_limits]
+        "{tmp}" = 3
+
+        [defaults]
+        backup_storage_dir = "{tmp}/storage"
+        log_to_file = false
+        retention_daily = 9
+        include_files = "config,data"
+
+        [[jobs]]
+        job_name = "a"
+        job_data_dir = "{tmp}/a"
+
+        [[jobs]]
+        job_name = "b"
+        job_data_dir = "{tmp}/b"
+        retention_daily = 1
+        """,
+    )
+
+    # When: Loading it
+    jobs = load_jobs_file(path)
+
+    # Then: Every job has the defaults, its own settings and the packaged defaults
+    assert [config.job_name for config in jobs.jobs] == ["a", "b"]
+    assert [config.retention_daily for config in jobs.jobs] == [9, 1]
+    assert jobs.jobs[0].action == "backup"
+    assert jobs.jobs[0].include_files == ("config", "data")
+    assert jobs.max_concurrent_jobs == 4
+    assert jobs.max_jobs_per_storage == 1
+    assert jobs.storage_target(jobs.jobs[0]) == (tmp_path.resolve(), 3)
+    assert jobs.logging_config.log_to_file is False
+
+
+def test_storage_target_uses_deepest_limit(tmp_path: Path):
+    """Verify a storage directory belongs to the deepest configured target that contains it."""
+    path = _write_jobs(
+        tmp_path,
+        """
+        [storage_limits]
+        "{tmp}" = 3
+        "{tmp}/storage" = 2
+
+        [[jobs]]
+        job_name = "a"
+        backup_storage_dir = "{tmp}/storage"
+
+        [[jobs]]
+        job_name = "b"
+        backup_storage_dir = "{tmp}/other"
+        """,
+    )
+    jobs = load_jobs_file(path)
+
+    assert jobs.storage_target(jobs.jobs[0]) == ((tmp_path / "storage").resolve(), 2)
+    assert jobs.storage_target(jobs.jobs[1]) == (tmp_path.resolve(), 3)
+
+
+@pytest.mark.parametrize(
+    ("jobs", "message"),
+    [
+        ("", "No jobs defined"),
+        ('[[jobs]]\njob_name = "a"', "Invalid job a: backup_storage_dir"),
+        (
+            '[[jobs]]\njob_name = "a"\nbackup_storage_dir = "{tmp}/storage"\noutput = "stdout"',
+            "jobs can not share stdout",
+        ),
+        (
+            '[[jobs]]\njob_name = "a"\nbackup_storage_dir = "{tmp}/storage"\naction = "rebuild-catalog"',
+            "action must be",
+        ),
+        (
+            '[[jobs]]\njob_name = "a"\nbackup_storage_dir = "{tmp}/storage"\n'
+            '[[jobs]]\njob_name = "a"\nbackup_storage_dir = "{tmp}/other"',
+            "Duplicate job a",
+        ),
+        ("jobs = [", "Can not read"),
+    ],
+)
+def test_load_jobs_file_errors(tmp_path: Path, jobs: str, message: str):
+    """Verify invalid jobs files are rejected with the job that is wrong."""
+    path = _write_jobs(tmp_path, jobs)
+
+    with pytest.raises(JobsFileError, match=message):
+        load_jobs_file(path)
+
+
+def test_run_jobs_limits_concurrency(tmp_path: Path, monkeypatch):
+    """Verify jobs run in parallel with their own configuration, limited per storage target."""
+    # Given: Two jobs on one storage directory limited to one job, and two on another
+    path = _write_jobs(
+        tmp_path,
+        """
+        max_concurrent_jobs = 4
+        max_jobs_per_storage = 2
+
+        [storage_limits]
+        "{tmp}/storage" = 1
+
+        [defaults]
+        backup_storage_dir = "{tmp}/other"
+
+        [[jobs]]
+        job_name = "a"
+        backup_storage_dir = "{tmp}/storage"
+
+        [[jobs]]
+        job_name = "b"
+        backup_storage_dir = "{tmp}/storage"
+
+        [[jobs]]
+        job_name = "c"
+
+        [[jobs]]
+        job_name = "d"
+        """,
+    )
+    lock = threading.Lock()
+    running: dict[Path, int] = {}
+    peak: dict[Path, int] = {}
+    seen: list[tuple[str, str]] = []
+
+    def task(config):
+        with lock:
+            storage = config.backup_storage_dir
+            running[storage] = running.get(storage, 0) + 1
+            peak[storage] = max(peak.get(storage, 0), running[storage])
+            seen.append((config.job_name, get_config().job_name))
+        time.sleep(0.1)
+        with lock:
+            running[storage] -= 1
+        return config.job_name != "d"
+
+    monkeypatch.setattr(scheduler, "get_task", lambda config: task)
+
+    # When: Running the jobs
+    succeeded = run_jobs(load_jobs_file(path))
+
+    # Then: Each job saw its own configuration and the storage limits held
+    assert sorted(seen) == [(name, name) for name in "abcd"]
+    assert peak == {(tmp_path / "storage").resolve(): 1, (tmp_path / "other").resolve(): 2}
+    assert not succeeded
+
+
+def test_run_jobs_backs_up_filesystems(tmp_path: Path):
+    """Verify each job writes its own backup into its own catalog."""
+    # Given: Two filesystem jobs sharing a storage directory
+    path = _write_jobs(
+        tmp_path,
+        """
+        max_concurrent_jobs = 2
+        max_jobs_per_storage = 2
+
+        [defaults]
+        backup_storage_dir = "{tmp}/storage"
+        log_to_file = false
+
+        [[jobs]]
+        job_name = "a"
+        job_data_dir = "{tmp}/a"
+
+        [[jobs]]
+        job_name = "b"
+        job_data_dir = "{tmp}/b"
+        compression = "zstd"
+        """,
+    )
+    (tmp_path / "a" / "a.txt").write_text("a")
+    (tmp_path / "b" / "b.txt").write_text("b")
+    jobs = load_jobs_file(path)
+
+    # When: Running them
+    assert run_jobs(jobs)
+
+    # Then: Both backups were written and cataloged under their job
+    catalog = Catalog(tmp_path / "storage")
+    assert [entry.codec for entry in catalog.for_job("a")] == ["gzip"]
+    assert [entry.codec for entry in catalog.for_job("b")] == ["zstd"]
+    for entry in catalog.entries().values():
+        assert (tmp_path / "storage" / entry.name).exists()
+
+
+def test_run_jobs_verifies_backups(tmp_path: Path):
+    """Verify a jobs file can verify the backups of its jobs and fails when one is damaged."""
+    # Given: Backups written by two jobs, and a jobs file setting the same jobs to verify them
+    jobs = """
+        [defaults]
+        backup_storage_dir = "{tmp}/storage"
+        log_to_file = false
+        action = "ACTION"
+
+        [[jobs]]
+        job_name = "a"
+        job_data_dir = "{tmp}/a"
+
+        [[jobs]]
+        job_name = "b"
+        job_data_dir = "{tmp}/b"
+        """
+    backup = load_jobs_file(_write_jobs(tmp_path, jobs.replace("ACTION", "backup")))
+    (tmp_path / "a" / "a.txt").write_text("a")
+    (tmp_path / "b" / "b.txt").write_text("b")
+    assert run_jobs(backup)
+    verify = load_jobs_file(_write_jobs(tmp_path, jobs.replace("ACTION", "verify")))
+    assert [config.action for config in verify.jobs] == ["verify", "verify"]
+
+    # When/Then: Verifying passes until a backup is damaged
+    assert run_jobs(verify)
+    [entry] = Catalog(tmp_path / "storage").for_job("b")
+    damaged = tmp_path / "storage" / entry.name
+    damaged.write_bytes(damaged.read_bytes()[:-10])
+    assert not run_jobs(verify)
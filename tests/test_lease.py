@@ -0,0 +1,140 @@
+# type: ignore
+"""Test storage leases shared by processes writing to one backup storage directory."""
+
+import json
+import multiprocessing
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from homelab_service_backup.modules import do_backup_filesystem
+from homelab_service_backup.utils import Config, LeaseTimeoutError, StorageLease, use_config
+from homelab_service_backup.utils.lease import LEASE_DIRNAME
+
+
+def _hold_lease(directory: Path, slots: int, log: Path) -> None:
+    """Take a lease in a separate process, recording when it was held."""
+    with StorageLease(directory, slots, poll_interval=0.02):
+        start = time.time()
+        time.sleep(0.2)
+        end = time.time()
+    log.write_text(json.dumps([start, end]))
+
+
+def _wait_for(predicate, timeout: float = 5) -> None:
+    """Poll until a condition holds."""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def test_lease_limits_processes(tmp_path: Path):
+    """Verify no more than the configured number of processes hold a lease at once."""
+    # Given: Five processes sharing a storage directory with two leases
+    context = multiprocessing.get_context("fork")
+    logs = [tmp_path / f"{i}.json" for i in range(5)]
+    processes = [context.Process(target=_hold_lease, args=(tmp_path, 2, log)) for log in logs]
+
+    # When: They all take a lease at the same time
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(30)
+
+    # Then: Every process held a lease, never more than two at once
+    assert [process.exitcode for process in processes] == [0] * 5
+    intervals = [json.loads(log.read_text()) for log in logs]
+    for start, _ in intervals:
+        assert sum(1 for s, e in intervals if s <= start < e) <= 2
+    assert not list((tmp_path / LEASE_DIRNAME).glob("*.lease"))
+    assert not list((tmp_path / LEASE_DIRNAME).glob("*.ticket"))
+
+
+def test_stale_lease_expires(tmp_path: Path):
+    """Verify a lease that is no longer touched by its holder is taken over."""
+    # Given: The only lease held by a process that stopped touching it a while ago
+    (tmp_path / LEASE_DIRNAME).mkdir()
+    stale = tmp_path / LEASE_DIRNAME / "crashed-1-abc.lease"
+    stale.write_text("{}")
+    os.utime(stale, (time.time() - 60, time.time() - 60))
+
+    # When: Another process takes a lease
+    lease = StorageLease(tmp_path, 1, ttl=30, poll_interval=0.01)
+    lease.acquire(timeout=5)
+
+    # Then: The stale lease was removed and the new one is held
+    assert not stale.exists()
+    assert lease.lease_file.exists()
+    lease.release()
+    assert not lease.lease_file.exists()
+
+
+def test_lease_queue_is_fair(tmp_path: Path):
+    """Verify waiting jobs get a lease in the order they started waiting."""
+    # Given: A held lease and two jobs that start waiting for it one after the other
+    holder = StorageLease(tmp_path, 1)
+    holder.acquire()
+    order: list[str] = []
+
+    def wait(name: str) -> None:
+        with StorageLease(tmp_path, 1, poll_interval=0.01):
+            order.append(name)
+            time.sleep(0.05)
+
+    def tickets() -> int:
+        return len(list((tmp_path / LEASE_DIRNAME).glob("*.ticket")))
+
+    first = threading.Thread(target=wait, args=("first",))
+    first.start()
+    _wait_for(lambda: tickets() == 1)
+    second = threading.Thread(target=wait, args=("second",))
+    second.start()
+    _wait_for(lambda: tickets() == 2)
+
+    # When: The lease is released
+    holder.release()
+    first.join(5)
+    second.join(5)
+
+    # Then: The job waiting longest got it first
+    assert order == ["first", "second"]
+
+
+def test_lease_timeout(tmp_path: Path):
+    """Verify a job gives up after the timeout and leaves the queue."""
+    with StorageLease(tmp_path, 1):
+        waiting = StorageLease(tmp_path, 1, poll_interval=0.01)
+        with pytest.raises(LeaseTimeoutError, match="No storage lease"):
+            waiting.acquire(timeout=0.1)
+
+    assert not list((tmp_path / LEASE_DIRNAME).glob("*.ticket"))
+
+
+def test_backup_holds_lease(tmp_path: Path):
+    """Verify a backup takes a storage lease while it writes and gives it back after."""
+    # Given: A job with storage leases enabled
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "file.txt").write_text("data")
+    (tmp_path / "storage").mkdir()
+    config = Config.model_validate(
+        {
+            "action": "backup",
+            "job_name": "job",
+            "backup_storage_dir": tmp_path / "storage",
+            "job_data_dir": tmp_path / "data",
+            "storage_lease_slots": 1,
+        }
+    )
+
+    # When: Running the backup
+    with use_config(config):
+        backup_file = do_backup_filesystem(config)
+
+    # Then: The backup was written and no lease is left behind
+    assert backup_file.exists()
+    assert (tmp_path / "storage" / LEASE_DIRNAME).is_dir()
+    assert not list((tmp_path / "storage" / LEASE_DIRNAME).glob("*.lease"))
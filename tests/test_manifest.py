@@ -0,0 +1,144 @@
+# type: ignore
+"""Test backup manifests."""
+
+import os
+from pathlib import Path
+
+import pytest
+
+from homelab_service_backup.modules import do_backup_filesystem
+from homelab_service_backup.utils import Config, clean_old_backups, use_config
+from homelab_service_backup.utils.manifest import (
+    FileState,
+    Manifest,
+    get_manifest_path,
+    read_manifest,
+    resolve_backup_chain,
+)
+
+
+def _write_backup(backup_dir: Path, name: str, parent: str | None = None, mtime_offset: int = 0):
+    """Create an empty archive with a manifest and a distinct modification time."""
+    backup_file = backup_dir / name
+    backup_file.touch()
+    os.utime(backup_file, (backup_file.stat().st_atime, backup_file.stat().st_mtime + mtime_offset))
+    Manifest(backup=name, kind="incremental" if parent else "full", parent=parent, files={}).write(
+        backup_file
+    )
+    return backup_file
+
+
+def test_manifest_roundtrip(tmp_path: Path):
+    """Verify a manifest written next to an archive reads back unchanged."""
+    # Given: A manifest with files and deletions
+    backup_file = tmp_path / "job-20240101T000000-daily.tgz"
+    state = FileState.from_stat((tmp_path).stat())
+    manifest = Manifest(
+        backup=backup_file.name,
+        kind="incremental",
+        parent="job-20231231T000000-weekly.tgz",
+        files={"foo.txt": state},
+        deleted=["bar.txt"],
+    )
+
+    # When: Writing and reading it back
+    path = manifest.write(backup_file)
+
+    # Then: The manifest is stored next to the archive and round-trips
+    assert path == get_manifest_path(backup_file)
+    assert read_manifest(backup_file) == manifest
+
+
+def test_manifest_has_changed(tmp_path: Path):
+    """Verify changes are detected from size, mtime, inode and mode."""
+    # Given: A manifest recording one file
+    state = FileState(size=1, mtime_ns=2, inode=3, mode=4)
+    manifest = Manifest(backup="backup.tgz", files={"foo.txt": state})
+
+    # Then: Only identical state is unchanged
+    assert not manifest.has_changed("foo.txt", state)
+    assert manifest.has_changed("foo.txt", state._replace(mtime_ns=5))
+    assert manifest.has_changed("bar.txt", state)
+
+
+def test_read_manifest_missing(tmp_path: Path):
+    """Verify archives without a manifest return None."""
+    assert read_manifest(tmp_path / "job-20240101T000000-daily.tgz") is None
+
+
+def test_resolve_backup_chain(tmp_path: Path):
+    """Verify the chain of an incremental backup walks back to its full backup."""
+    # Given: A full backup followed by two incrementals
+    full = _write_backup(tmp_path, "job-20240101T000000-weekly.tgz")
+    first = _write_backup(tmp_path, "job-20240102T000000-daily.tgz", parent=full.name)
+    second = _write_backup(tmp_path, "job-20240103T000000-daily.tgz", parent=first.name)
+
+    # When/Then: The chain is returned oldest first
+    assert resolve_backup_chain(second) == [full, first, second]
+    assert resolve_backup_chain(full) == [full]
+
+
+def test_resolve_backup_chain_broken(tmp_path: Path):
+    """Verify a missing parent archive raises FileNotFoundError."""
+    # Given: An incremental whose parent was removed
+    backup = _write_backup(
+        tmp_path, "job-20240102T000000-daily.tgz", parent="job-20240101T000000-weekly.tgz"
+    )
+
+    # When/Then: Resolving the chain fails
+    with pytest.raises(FileNotFoundError, match="missing parent archive"):
+        resolve_backup_chain(backup)
+
+
+def test_clean_old_backups_keeps_chain(tmp_path: Path, mock_config):
+    """Verify retention keeps expired archives that a retained incremental depends on."""
+    # Given: A full weekly backup and three daily incrementals, with one daily retained
+    backup_dir = tmp_path / "backups"
+    backup_dir.mkdir()
+    with Config.change_config_sources(mock_config(backup_storage_dir=backup_dir)):
+        old_full = _write_backup(backup_dir, "test_job-20240101T000000-weekly.tgz")
+        old_daily = _write_backup(
+            backup_dir, "test_job-20240102T000000-daily.tgz", old_full.name, 10
+        )
+        full = _write_backup(backup_dir, "test_job-20240108T000000-weekly.tgz", mtime_offset=20)
+        first = _write_backup(backup_dir, "test_job-20240109T000000-daily.tgz", full.name, 30)
+        second = _write_backup(backup_dir, "test_job-20240110T000000-daily.tgz", first.name, 40)
+
+        # When: Cleaning old backups
+        deleted = clean_old_backups(Config())
+
+    # Then: The expired daily in the current chain is kept and the old chain is removed
+    assert sorted(deleted) == sorted([old_full, old_daily])
+    assert first.exists()
+    assert second.exists()
+    assert full.exists()
+    assert not get_manifest_path(old_full).exists()
+    assert not get_manifest_path(old_daily).exists()
+
+
+def test_incremental_manifest_skips_nested_excludes(tmp_path: Path):
+    """Verify an incremental backup neither archives nor records files excluded below the top level."""
+    # Given: An incremental job excluding a nested file, a glob and a nested directory
+    data = tmp_path / "data"
+    (data / "a" / "cache").mkdir(parents=True)
+    (tmp_path / "storage").mkdir()
+    for name in ("a/keep.txt", "a/secret.txt", "a/deep.log", "a/cache/x.bin"):
+        (data / name).write_text(name)
+    config = Config.model_validate(
+        {
+            "action": "backup",
+            "job_name": "job",
+            "backup_storage_dir": tmp_path / "storage",
+            "job_data_dir": data,
+            "log_to_file": False,
+            "backup_mode": "incremental",
+            "exclude_files": ["a/secret.txt", "*.log", "a/cache/"],
+        }
+    )
+
+    # When: Backing up
+    with use_config(config):
+        backup_file = do_backup_filesystem(config)
+
+    # Then: The manifest only lists the kept entries
+    assert sorted(read_manifest(backup_file).files) == ["a", "a/keep.txt"]
@@ -0,0 +1,219 @@
+# type: ignore
+"""Test run metrics, their Prometheus exposition and the scheduler serving them."""
+
+import re
+import tarfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import pytest
+from loguru import logger
+
+from homelab_service_backup.modules import scheduler
+from homelab_service_backup.utils import (
+    Config,
+    JobsFile,
+    MetricsRegistry,
+    ParallelExtractor,
+    RunStats,
+    collect_stats,
+    count_run,
+    serve_metrics,
+)
+
+
+def _config(tmp_path: Path, **settings) -> Config:
+    """Build a backup job of `tmp_path/data` storing its backups in `tmp_path/storage`, creating both."""
+    (tmp_path / "data").mkdir(exist_ok=True)
+    (tmp_path / "storage").mkdir(exist_ok=True)
+    return Config.model_validate(
+        {
+            "action": "backup",
+            "job_name": "job",
+            "backup_storage_dir": tmp_path / "storage",
+            "job_data_dir": tmp_path / "data",
+            "log_to_file": False,
+            **settings,
+        }
+    )
+
+
+def _samples(text: str) -> dict[str, float]:
+    """Parse the samples of a Prometheus text exposition.
+
+    Returns:
+        dict[str, float]: Every sample's value by its name and labels.
+    """
+    return {
+        name: float(value)
+        for name, value in re.findall(r"^([^#\s][^ ]*) (\S+)$", text, flags=re.MULTILINE)
+    }
+
+
+def test_counts_go_to_the_collecting_run():
+    """Verify counts only reach the stats of the run collecting them, including from threads started with its context."""
+    stats = RunStats()
+
+    count_run(files=5)
+    with collect_stats(stats):
+        count_run(files=1, read_bytes=10)
+        thread = threading.Thread(target=count_run, kwargs={"written_bytes": 4})
+        thread.start()
+        thread.join()
+        count_run(deleted_backups=2)
+
+    assert (stats.files, stats.read_bytes, stats.written_bytes, stats.deleted_backups) == (
+        1,
+        10,
+        0,
+        2,
+    )
+
+
+def test_render_exposition():
+    """Verify the last run of each job is rendered in the Prometheus text format."""
+    # Given: A backup that ran, a restore that failed and a job that was only skipped
+    registry = MetricsRegistry()
+    registry.next_runs = lambda: {"db-postgres": 1_700_000_000.5}
+    backup = RunStats(files=3, read_bytes=4000, written_bytes=1000, deleted_backups=2)
+    registry.record_run("web", "backup", "success", backup, 2.0)
+    registry.record_run("files", "restore", "failed", RunStats(read_bytes=50), 1.0)
+    registry.record_run('we"ird', "backup", "skipped")
+
+    # When: Rendering the metrics
+    text = registry.render()
+    samples = _samples(text)
+
+    # Then: Every gauge describes the last run, and every run is counted by its outcome
+    assert "# TYPE hsb_runs_total counter" in text
+    assert samples['hsb_last_run_files{job="web"}'] == 3
+    assert samples['hsb_last_run_compression_ratio{job="web"}'] == 4
+    assert samples['hsb_last_run_throughput_bytes_per_second{job="web"}'] == 2000
+    assert samples['hsb_last_run_deleted_backups{job="web"}'] == 2
+    assert samples['hsb_last_run_success{job="web"}'] == 1
+    assert samples['hsb_last_run_success{job="files"}'] == 0
+    assert samples['hsb_last_success_timestamp_seconds{job="files"}'] == 0
+    assert 'hsb_last_run_compression_ratio{job="files"}' not in samples
+    assert samples['hsb_runs_total{job="files",outcome="failed"}'] == 1
+    assert samples['hsb_runs_total{job="we\\"ird",outcome="skipped"}'] == 1
+    assert 'hsb_last_run_duration_seconds{job="we\\"ird"}' not in samples
+    assert samples['hsb_next_run_timestamp_seconds{job="db-postgres"}'] == 1_700_000_000.5
+
+
+def test_concurrent_runs_write_textfile(tmp_path: Path):
+    """Verify jobs finishing at the same time each replace the textfile without failing."""
+    # Given: A registry writing a textfile, and a warning handler
+    textfile = tmp_path / "hsb.prom"
+    registry = MetricsRegistry(textfile)
+    warnings = []
+    handler = logger.add(warnings.append, format="{message}", level="WARNING")
+
+    # When: Eight jobs record runs from their own threads at once
+    def record(job: str) -> None:
+        for _ in range(25):
+            registry.record_run(job, "backup", "success", RunStats(files=1), 1.0)
+
+    threads = [threading.Thread(target=record, args=(f"job{i}",)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    logger.remove(handler)
+
+    # Then: Nothing failed, and the textfile holds every run of every job
+    assert warnings == []
+    samples = _samples(textfile.read_text(encoding="utf-8"))
+    for i in range(8):
+        assert samples[f'hsb_runs_total{{job="job{i}",outcome="success"}}'] == 25
+    assert not list(tmp_path.glob(".*.tmp"))
+
+
+def test_runner_records_backup(tmp_path: Path):
+    """Verify a backup run by the scheduler's runner records what it archived in the metrics textfile."""
+    # Given: A runner writing metrics to a textfile, and a directory to back up
+    config = _config(tmp_path, compression="zstd")
+    for i in range(3):
+        (tmp_path / "data" / f"{i}.txt").write_text("x" * 10_000)
+    registry = MetricsRegistry(tmp_path / "hsb.prom")
+
+    # When: Running the job
+    assert scheduler.JobRunner(JobsFile(jobs=[config]), registry).run(config)
+
+    # Then: The textfile counts the files and the bytes read and written
+    samples = _samples((tmp_path / "hsb.prom").read_text(encoding="utf-8"))
+    assert samples['hsb_last_run_files{job="job"}'] == 3
+    assert samples['hsb_last_run_read_bytes{job="job"}'] > 30_000
+    assert 0 < samples['hsb_last_run_written_bytes{job="job"}'] < 30_000
+    assert samples['hsb_last_run_compression_ratio{job="job"}'] > 1
+    assert samples['hsb_runs_total{job="job",outcome="success"}'] == 1
+    assert not list(tmp_path.glob(".hsb.prom.*"))
+
+
+def test_restore_counts_files(tmp_path: Path):
+    """Verify restored files are counted."""
+    # Given: An archive of two files
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "a").write_text("aaaa")
+    (tmp_path / "src" / "b").write_text("bb")
+    with tarfile.open(tmp_path / "backup.tar", "w") as tar:
+        tar.add(tmp_path / "src" / "a", arcname="a")
+        tar.add(tmp_path / "src" / "b", arcname="b")
+    (tmp_path / "dest").mkdir()
+    stats = RunStats()
+
+    # When: Extracting it
+    with (
+        collect_stats(stats),
+        (tmp_path / "backup.tar").open("rb") as fh,
+        ParallelExtractor(tmp_path / "dest") as extractor,
+    ):
+        extractor.extract(fh)
+
+    # Then: Both files and their sizes are counted
+    assert (stats.files, stats.read_bytes, stats.written_bytes) == (2, 6, 6)
+
+
+def test_serve_metrics(tmp_path: Path):
+    """Verify the metrics are served at /metrics and nothing else is."""
+    registry = MetricsRegistry()
+    registry.record_run("job", "backup", "success", RunStats(files=1), 1.0)
+    server = serve_metrics(registry, 0, "127.0.0.1")
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        with urllib.request.urlopen(f"{url}/metrics") as response:  # noqa: S310
+            assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+            assert 'hsb_last_run_files{job="job"} 1' in response.read().decode()
+
+        with pytest.raises(urllib.error.HTTPError, match="404") as error:
+            urllib.request.urlopen(f"{url}/other")  # noqa: S310
+        error.value.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_scheduler_writes_next_runs(tmp_path: Path):
+    """Verify the textfile lists every job's next run as soon as the scheduler starts."""
+    # Given: A scheduler for a PostgreSQL job that writes metrics to a textfile
+    config = _config(tmp_path, schedule=True, schedule_hour="3", use_postgres=True)
+    registry = MetricsRegistry(tmp_path / "hsb.prom")
+    blocking = scheduler._create_scheduler(
+        scheduler.JobRunner(JobsFile(jobs=[config]), registry), [config]
+    )
+
+    # When: Starting it
+    thread = threading.Thread(target=blocking.start, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not (tmp_path / "hsb.prom").exists() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    blocking.shutdown(wait=False)
+    thread.join(5)
+
+    # Then: The job's next run is listed under its name
+    samples = _samples((tmp_path / "hsb.prom").read_text(encoding="utf-8"))
+    assert samples['hsb_next_run_timestamp_seconds{job="job-postgres"}'] > time.time()
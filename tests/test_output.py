@@ -0,0 +1,91 @@
+# type: ignore
+"""Test streaming backup output."""
+
+from pathlib import Path
+
+import pytest
+
+from homelab_service_backup.utils import (
+    Config,
+    OutputCommandError,
+    RunCancelledError,
+    open_backup_output,
+)
+
+
+def _stream(backup_file: Path, chunks: int = 64) -> None:
+    """Write more data than a pipe buffer holds to the backup output."""
+    with open_backup_output(Config(), backup_file) as fh:
+        for _ in range(chunks):
+            fh.write(b"x" * 65536)
+
+
+def _cancel(backup_file: Path) -> None:
+    """Write part of a backup, then stop the way a cancelled run does.
+
+    Raises:
+        RunCancelledError: Always, after the first write.
+    """
+    with open_backup_output(Config(), backup_file) as fh:
+        fh.write(b"data")
+        raise RunCancelledError
+
+
+def test_open_backup_output_file(tmp_path: Path, mock_config):
+    """Verify backups are written to the backup file by default."""
+    backup_file = tmp_path / "job-20240101T000000-daily.tgz"
+    with (
+        Config.change_config_sources(mock_config()),
+        open_backup_output(Config(), backup_file) as fh,
+    ):
+        fh.write(b"data")
+
+    assert backup_file.read_bytes() == b"data"
+
+
+def test_open_backup_output_file_removed_on_error(tmp_path: Path, mock_config):
+    """Verify a backup file that fails part way is removed instead of left incomplete."""
+    backup_file = tmp_path / "job-20240101T000000-daily.tgz"
+
+    with Config.change_config_sources(mock_config()), pytest.raises(RunCancelledError):
+        _cancel(backup_file)
+
+    assert not backup_file.exists()
+
+
+def test_open_backup_output_stdout(tmp_path: Path, mock_config, capsysbinary):
+    """Verify streamed backups go to stdout without creating the backup file."""
+    backup_file = tmp_path / "job-20240101T000000-daily.tgz"
+    with (
+        Config.change_config_sources(mock_config(output="stdout")),
+        open_backup_output(Config(), backup_file) as fh,
+    ):
+        fh.write(b"data")
+
+    assert capsysbinary.readouterr().out == b"data"
+    assert not backup_file.exists()
+
+
+def test_open_backup_output_command(tmp_path: Path, mock_config):
+    """Verify the output command receives the stream and the backup name."""
+    # Given: A command that writes its stdin to a file named after the backup
+    command = f'cat > "{tmp_path}/received-$HSB_BACKUP_NAME"'
+    backup_file = tmp_path / "backups" / "job-20240101T000000-daily.tgz"
+
+    # When: Streaming more data than the pipe buffer holds
+    with Config.change_config_sources(mock_config(output="command", output_command=command)):
+        _stream(backup_file)
+
+    # Then: The receiver got every byte and nothing was staged locally
+    assert (tmp_path / f"received-{backup_file.name}").stat().st_size == 64 * 65536
+    assert not backup_file.exists()
+
+
+@pytest.mark.parametrize("command", ["exit 3", "cat > /dev/null; exit 3"])
+def test_open_backup_output_command_fails(tmp_path: Path, mock_config, command: str):
+    """Verify a failing output command raises OutputCommandError."""
+    with (
+        Config.change_config_sources(mock_config(output="command", output_command=command)),
+        pytest.raises(OutputCommandError, match="status 3"),
+    ):
+        _stream(tmp_path / "backup.tgz")
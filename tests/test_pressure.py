@@ -0,0 +1,136 @@
+# type: ignore
+"""Test deferring and pausing jobs while the machine is under pressure."""
+
+import threading
+import time
+from pathlib import Path
+
+from homelab_service_backup.modules import do_backup_filesystem, scheduler
+from homelab_service_backup.utils import (
+    Config,
+    JobsFile,
+    PressureMonitor,
+    RunHistory,
+    read_pressure,
+    use_config,
+    watch_pressure,
+)
+from homelab_service_backup.utils import pressure as pressure_module
+
+
+def _write_pressure(path: Path, some: float) -> None:
+    """Write a pressure file in the kernel's format."""
+    path.write_text(
+        f"some avg10={some:.2f} avg60=1.00 avg300=0.50 total=12345\n"
+        "full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n"
+    )
+
+
+def _config(tmp_path: Path, **settings) -> Config:
+    """Build a backup job storing its backups in `tmp_path`."""
+    return Config.model_validate(
+        {
+            "action": "backup",
+            "job_name": "job",
+            "backup_storage_dir": tmp_path,
+            "log_to_file": False,
+            **settings,
+        }
+    )
+
+
+def test_read_pressure(tmp_path: Path):
+    """Verify the share of time some tasks stalled is read, and missing files are ignored."""
+    _write_pressure(tmp_path / "io", 42.5)
+
+    assert read_pressure(tmp_path / "io") == 42.5
+    assert read_pressure(tmp_path / "missing") is None
+
+
+def test_defer_waits_for_pressure_to_drop(tmp_path: Path):
+    """Verify a run waits while pressure is above the threshold and starts once it dropped."""
+    # Given: I/O pressure above the threshold that drops after a while
+    _write_pressure(tmp_path / "io", 80)
+    monitor = PressureMonitor({"io": [tmp_path / "io"]}, threshold=20, deadline=30, interval=0.02)
+    threading.Timer(0.3, _write_pressure, args=(tmp_path / "io", 5)).start()
+
+    # When: Deferring the run
+    start = time.perf_counter()
+    calm = monitor.defer()
+
+    # Then: It started once the pressure dropped
+    assert calm is True
+    assert time.perf_counter() - start >= 0.3
+
+
+def test_defer_gives_up_after_deadline(tmp_path: Path):
+    """Verify a run gives up when the pressure stays high until the deadline."""
+    _write_pressure(tmp_path / "cpu", 10)
+    _write_pressure(tmp_path / "memory", 90)
+    monitor = PressureMonitor(
+        {"cpu": [tmp_path / "cpu"], "memory": [tmp_path / "memory"]},
+        threshold=50,
+        deadline=0.2,
+        interval=0.02,
+    )
+
+    assert monitor.pressure() == ("memory", 90)
+    assert monitor.defer() is False
+
+
+def test_backup_pauses_under_pressure(tmp_path: Path):
+    """Verify a backup in progress pauses while pressure is high and finishes once it dropped."""
+    # Given: A job with data to back up and pressure that rises once the backup is under way
+    (tmp_path / "data").mkdir()
+    for i in range(3):
+        (tmp_path / "data" / f"file{i}.txt").write_text("data")
+    (tmp_path / "storage").mkdir()
+    pressure_file = tmp_path / "io"
+    _write_pressure(pressure_file, 0)
+    config = _config(tmp_path / "storage", job_data_dir=tmp_path / "data")
+    monitor = PressureMonitor({"io": [pressure_file]}, threshold=20, deadline=30, interval=0)
+    original_pause = monitor.pause
+    paused = []
+
+    def pause():
+        if not paused:
+            paused.append(True)
+            _write_pressure(pressure_file, 90)
+            threading.Timer(0.3, _write_pressure, args=(pressure_file, 0)).start()
+        original_pause()
+
+    monitor.pause = pause
+
+    # When: Running the backup
+    start = time.perf_counter()
+    with use_config(config), watch_pressure(monitor):
+        backup_file = do_backup_filesystem(config)
+
+    # Then: It paused until the pressure dropped and was written completely
+    assert time.perf_counter() - start >= 0.3
+    assert backup_file.exists()
+
+
+def test_scheduled_run_deferred(tmp_path: Path, monkeypatch):
+    """Verify a run is recorded as deferred when its container stays under pressure."""
+    # Given: Low pressure on the machine, but high pressure in the job's own cgroup
+    (tmp_path / "proc").mkdir()
+    _write_pressure(tmp_path / "proc" / "io", 1)
+    (tmp_path / "cgroup" / "system.slice" / "hsb").mkdir(parents=True)
+    _write_pressure(tmp_path / "cgroup" / "system.slice" / "hsb" / "io.pressure", 75)
+    (tmp_path / "self-cgroup").write_text("0::/system.slice/hsb\n")
+    monkeypatch.setattr(pressure_module, "PRESSURE_DIR", tmp_path / "proc")
+    monkeypatch.setattr(pressure_module, "CGROUP_DIR", tmp_path / "cgroup")
+    monkeypatch.setattr(pressure_module, "PROC_CGROUP", tmp_path / "self-cgroup")
+    monkeypatch.setattr(pressure_module, "PRESSURE_CHECK_INTERVAL", 0.05)
+    config = _config(tmp_path, pressure_threshold=50, pressure_deadline=1, pressure_resources="io")
+    ran = []
+    monkeypatch.setattr(scheduler, "get_task", lambda config: ran.append)
+
+    # When: Running the job
+    result = scheduler.JobRunner(JobsFile(jobs=[config])).run(config)
+
+    # Then: It never started and the history says why
+    assert result is False
+    assert ran == []
+    assert [run.outcome for run in RunHistory(tmp_path).runs("job")] == ["deferred"]
@@ -0,0 +1,120 @@
+# type: ignore
+"""Test profiling backup and restore runs."""
+
+import pstats
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+import pytest
+
+from homelab_service_backup.modules import do_backup_filesystem, do_restore_filesystem
+from homelab_service_backup.utils import (
+    Config,
+    StackSampler,
+    get_profile_dir,
+    profiled,
+    use_config,
+)
+
+
+def _config(tmp_path: Path, **settings) -> Config:
+    """Build a job backing up `tmp_path/data` to `tmp_path/storage`, creating both."""
+    (tmp_path / "data").mkdir(exist_ok=True)
+    (tmp_path / "storage").mkdir(exist_ok=True)
+    (tmp_path / "data" / "file.txt").write_text("x" * 50_000)
+    return Config.model_validate(
+        {
+            "action": "backup",
+            "job_name": "job",
+            "backup_storage_dir": tmp_path / "storage",
+            "job_data_dir": tmp_path / "data",
+            "log_to_file": False,
+            **settings,
+        }
+    )
+
+
+def test_profile_backup_and_restore(tmp_path: Path):
+    """Verify every profiler writes its profile of a backup and a restore, named after the job and run."""
+    # Given: A job profiled with every profiler
+    config = _config(tmp_path, profile="cpu,sample,memory", profile_dir=str(tmp_path / "profiles"))
+    assert config.profile == ("cpu", "sample", "memory")
+
+    # When: Backing it up and restoring it
+    with use_config(config):
+        do_backup_filesystem(config)
+        do_restore_filesystem(config)
+
+    # Then: Each run has a cProfile dump, its sampled stacks and an allocation snapshot
+    for run in ("backup", "restore"):
+        [prof] = (tmp_path / "profiles").glob(f"job-*-{run}.prof")
+        functions = {function for _, _, function in pstats.Stats(str(prof)).stats}
+        assert f"do_{run}_filesystem" in functions
+        assert prof.with_suffix(".folded").exists()
+        snapshot = tracemalloc.Snapshot.load(str(prof.with_suffix(".tracemalloc")))
+        assert snapshot.traceback_limit > 1
+    assert not tracemalloc.is_tracing()
+
+
+def test_no_profile_by_default(tmp_path: Path):
+    """Verify runs are not profiled unless a profiler is configured."""
+    config = _config(tmp_path)
+
+    with use_config(config):
+        do_backup_filesystem(config)
+
+    assert get_profile_dir(config) == tmp_path / "storage" / "profiles"
+    assert not get_profile_dir(config).exists()
+
+
+def test_failed_run_is_profiled(tmp_path: Path):
+    """Verify the profile of a run that failed is still written."""
+    # Given: A profiled task that fails
+    config = _config(tmp_path, profile="cpu")
+
+    @profiled("backup")
+    def task(config):
+        msg = "broken"
+        raise ValueError(msg)
+
+    # When: Running it
+    with use_config(config), pytest.raises(ValueError, match="broken"):
+        task(config)
+
+    # Then: Its profile is in the backup storage directory
+    assert len(list(get_profile_dir(config).glob("job-*-backup.prof"))) == 1
+
+
+def test_sampler_collapses_stacks(tmp_path: Path):
+    """Verify the sampler counts the stacks of other threads in the collapsed stack format."""
+    # Given: A thread spinning in a function
+    stop = threading.Event()
+
+    def spin():
+        while not stop.is_set():
+            pass
+
+    thread = threading.Thread(target=spin, name="worker")
+    thread.start()
+
+    # When: Sampling it for a while
+    try:
+        with StackSampler(0.001) as sampler:
+            time.sleep(0.2)
+    finally:
+        stop.set()
+        thread.join()
+    sampler.write(tmp_path / "stacks.folded")
+
+    # Then: Its stacks start with the thread name and pass through the function, outermost first
+    lines = (tmp_path / "stacks.folded").read_text(encoding="utf-8").splitlines()
+    worker = [line.rsplit(" ", 1) for line in lines if line.startswith("worker;")]
+    assert worker
+    for stack, count in worker:
+        frames = stack.split(";")
+        assert int(count) > 0
+        assert frames[1].startswith("Thread._bootstrap ")
+        assert any("test_sampler_collapses_stacks.<locals>.spin" in frame for frame in frames)
+    assert "hsb-sampler" not in "".join(lines)
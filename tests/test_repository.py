@@ -0,0 +1,192 @@
+# type: ignore
+"""Test the deduplicating chunk repository."""
+
+import io
+import json
+import os
+import random
+from pathlib import Path
+
+from homelab_service_backup.utils import Config, clean_old_backups
+from homelab_service_backup.utils.repository import (
+    CHUNK_MAX_SIZE,
+    ChunkStore,
+    Snapshot,
+    SnapshotEntry,
+    create_snapshot,
+    find_chunk_boundary,
+    get_chunk_store_path,
+    iter_chunks,
+    restore_snapshot,
+)
+from homelab_service_backup.utils.walker import walk_directory
+
+
+def _random_bytes(size: int, seed: int = 0) -> bytes:
+    """Return reproducible incompressible data."""
+    return random.Random(seed).randbytes(size)
+
+
+def test_find_chunk_boundary_limits():
+    """Verify chunks are never smaller than the minimum or larger than the maximum size."""
+    # Given: Data made of a single byte, which never produces a boundary
+    data = b"\x00" * (CHUNK_MAX_SIZE * 2)
+
+    # When/Then: The chunk is cut at the maximum size, and short buffers are returned whole
+    assert find_chunk_boundary(data) == CHUNK_MAX_SIZE
+    assert find_chunk_boundary(b"short") == len(b"short")
+
+
+def test_iter_chunks_shift_resistant(tmp_path: Path):
+    """Verify inserting data near the start of a file only changes the chunks around the edit."""
+    # Given: A file and a copy with a few bytes inserted at the start
+    data = _random_bytes(24 * 1024 * 1024)
+    original = tmp_path / "original"
+    original.write_bytes(data)
+    shifted = tmp_path / "shifted"
+    shifted.write_bytes(b"inserted" + data)
+
+    # When: Chunking both files
+    with original.open("rb") as f:
+        original_chunks = list(iter_chunks(f))
+    with shifted.open("rb") as f:
+        shifted_chunks = list(iter_chunks(f))
+
+    # Then: The chunks reassemble the data and almost all of them are shared
+    assert b"".join(original_chunks) == data
+    assert len(original_chunks) > 4
+    assert len(set(original_chunks) & set(shifted_chunks)) >= len(original_chunks) - 2
+
+
+def _log_text(size: int, seed: int = 0) -> bytes:
+    """Return reproducible log lines, made of a few words and numbers like real logs."""
+    rng = random.Random(seed)
+    words = ("GET", "POST", "/api/items", "200", "404", "INFO", "ERROR", "user", "session")
+    lines = []
+    length = 0
+    while length < size:
+        line = f"2024-01-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:00:00Z {' '.join(rng.choices(words, k=6))} {rng.randint(0, 99999)}\n"
+        lines.append(line.encode())
+        length += len(lines[-1])
+    return b"".join(lines)
+
+
+def _json_records(count: int, seed: int = 0) -> bytes:
+    """Return reproducible JSON of many similar records."""
+    rng = random.Random(seed)
+    records = [
+        {"id": i, "name": f"user{rng.randint(0, 10**6)}", "active": rng.random() > 0.5}
+        for i in range(count)
+    ]
+    return json.dumps(records, indent=2).encode()
+
+
+def test_text_chunks_survive_insert():
+    """Verify log text and JSON are cut by content, so inserting a line only changes the chunks around it."""
+    for data in (_log_text(12 * 1024 * 1024), _json_records(150_000)):
+        # Given: Text and a copy with a line inserted at the start
+        edited = b'{"inserted": true}\n' + data
+
+        # When: Chunking both
+        original_chunks = list(iter_chunks(io.BytesIO(data)))
+        edited_chunks = list(iter_chunks(io.BytesIO(edited)))
+
+        # Then: The chunks vary in size, and all but the edited one are shared
+        assert b"".join(original_chunks) == data
+        assert len(original_chunks) > 4
+        assert len({len(chunk) for chunk in original_chunks}) > 2
+        assert len(set(original_chunks) & set(edited_chunks)) >= len(original_chunks) - 1
+
+
+def test_chunk_store_deduplicates(tmp_path: Path):
+    """Verify identical chunks are stored once and read back unchanged."""
+    # Given: An empty chunk store
+    store = ChunkStore(tmp_path / "chunks")
+
+    # When: Storing the same chunk twice
+    first = store.put(b"hello world")
+    second = store.put(b"hello world")
+
+    # Then: Only one chunk is written
+    assert first == second
+    assert store.new_chunks == 1
+    assert list(store.iter_digests()) == [first]
+    assert store.get(first) == b"hello world"
+
+
+def test_snapshot_roundtrip(tmp_path: Path):
+    """Verify a directory restored from a snapshot matches the source."""
+    # Given: A source directory with files, a subdirectory, a symlink and a hard link
+    source = tmp_path / "source"
+    (source / "sub").mkdir(parents=True)
+    (source / "foo.txt").write_text("foo")
+    (source / "sub" / "hard.txt").hardlink_to(source / "foo.txt")
+    (source / "sub" / "bar.bin").write_bytes(_random_bytes(1024 * 1024))
+    (source / "empty").touch()
+    (source / "link").symlink_to("foo.txt")
+    os.utime(source / "sub", ns=(1_000_000_000, 1_000_000_000))
+    store = ChunkStore(tmp_path / "chunks")
+
+    # When: Writing a snapshot and restoring it elsewhere
+    snapshot_file = tmp_path / "job-20240101T000000-daily.snapshot.json.gz"
+    create_snapshot(snapshot_file.name, walk_directory(source), store).write(snapshot_file)
+    destination = tmp_path / "destination"
+    destination.mkdir()
+    restore_snapshot(Snapshot.read(snapshot_file), store, destination)
+
+    # Then: Contents, links and directory timestamps are restored
+    assert (destination / "foo.txt").read_text() == "foo"
+    assert (destination / "sub" / "bar.bin").read_bytes() == (
+        source / "sub" / "bar.bin"
+    ).read_bytes()
+    assert (destination / "empty").read_bytes() == b""
+    assert (destination / "link").readlink() == Path("foo.txt")
+    assert (destination / "sub" / "hard.txt").samefile(destination / "foo.txt")
+    assert (destination / "sub").stat().st_mtime_ns == 1_000_000_000
+
+
+def test_create_snapshot_reuses_unchanged_files(tmp_path: Path):
+    """Verify unchanged files reuse the previous snapshot's chunks without writing new data."""
+    # Given: A snapshot of a directory with two files
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "foo.bin").write_bytes(_random_bytes(1024, seed=1))
+    (source / "bar.bin").write_bytes(_random_bytes(1024, seed=2))
+    previous = create_snapshot("first", walk_directory(source), ChunkStore(tmp_path / "chunks"))
+
+    # When: Changing one file and taking a second snapshot
+    (source / "bar.bin").write_bytes(_random_bytes(2048, seed=3))
+    store = ChunkStore(tmp_path / "chunks")
+    snapshot = create_snapshot("second", walk_directory(source), store, previous)
+
+    # Then: Only the changed file is stored again
+    assert store.new_chunks == 1
+    assert snapshot.entries[1].chunks == previous.entries[1].chunks
+
+
+def test_clean_old_backups_prunes_chunks(tmp_path: Path, mock_config):
+    """Verify deleting expired snapshots removes the chunks only they referenced."""
+    # Given: Two hourly snapshots that each reference one chunk, with one hourly retained
+    backup_dir = tmp_path / "backups"
+    backup_dir.mkdir()
+    with Config.change_config_sources(
+        mock_config(backup_storage_dir=backup_dir, retention_hourly=1)
+    ):
+        store = ChunkStore(get_chunk_store_path(backup_dir, Config().job_name))
+        chunks = [store.put(b"old"), store.put(b"new")]
+        for i, chunk in enumerate(chunks):
+            name = f"{Config().job_name}-2024010{i + 1}T000000-hourly.snapshot.json.gz"
+            entry = SnapshotEntry(
+                path="foo.txt", kind="file", mode=0o100644, mtime_ns=0, chunks=[chunk]
+            )
+            Snapshot(backup=name, entries=[entry]).write(backup_dir / name)
+            os.utime(backup_dir / name, (i * 10, i * 10))
+
+        # When: Cleaning old backups
+        deleted = clean_old_backups(Config())
+
+    # Then: The old snapshot and its chunk are removed
+    assert [backup.name for backup in deleted] == [
+        "test_job-20240101T000000-hourly.snapshot.json.gz"
+    ]
+    assert list(store.iter_digests()) == [chunks[1]]
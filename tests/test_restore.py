@@ -0,0 +1,152 @@
+# type: ignore
+"""Test restoring filesystem and PostgreSQL backups."""
+
+import gzip
+import os
+import random
+from pathlib import Path
+
+import pytest
+
+from homelab_service_backup.modules import (
+    do_backup_filesystem,
+    do_restore_filesystem,
+    do_restore_postgres,
+)
+from homelab_service_backup.utils import Config, use_config
+
+
+def _config(tmp_path: Path, **settings) -> Config:
+    """Build a job backing up `tmp_path/data` to `tmp_path/storage`, creating both."""
+    (tmp_path / "data").mkdir(exist_ok=True)
+    (tmp_path / "storage").mkdir(exist_ok=True)
+    return Config.model_validate(
+        {
+            "action": "restore",
+            "job_name": "job",
+            "backup_storage_dir": tmp_path / "storage",
+            "job_data_dir": tmp_path / "data",
+            "log_to_file": False,
+            **settings,
+        }
+    )
+
+
+def test_corrupt_zstd_archive_fails_restore(tmp_path: Path):
+    """Verify a corrupt zstd archive fails the restore like a corrupt gzip archive does, instead of raising."""
+    # Given: A zstd backup whose compressed data is damaged
+    config = _config(tmp_path, compression="zstd")
+    for i in range(20):
+        (tmp_path / "data" / f"{i}.txt").write_bytes(f"line {i}\n".encode() * 2000)
+    with use_config(config):
+        backup = do_backup_filesystem(config)
+    data = bytearray(backup.read_bytes())
+    for offset in range(len(data) // 3, len(data) // 3 + 64):
+        data[offset] ^= 0xFF
+    backup.write_bytes(bytes(data))
+
+    # When: Restoring it
+    with use_config(config):
+        restored = do_restore_filesystem(config)
+
+    # Then: The restore reports the failure
+    assert restored is False
+
+
+@pytest.mark.parametrize("codec", ["gzip", "zstd", "none"])
+def test_restore_single_path(tmp_path: Path, codec: str):
+    """Verify a path restore writes only the selected file and leaves the rest of the directory alone."""
+    # Given: A backup of a directory with a nested file
+    config = _config(tmp_path, compression=codec)
+    data = tmp_path / "data"
+    (data / "sub" / "deep").mkdir(parents=True)
+    (data / "a.txt").write_text("a", encoding="utf-8")
+    (data / "sub" / "b.txt").write_text("b", encoding="utf-8")
+    (data / "sub" / "deep" / "c.txt").write_text("c", encoding="utf-8")
+    with use_config(config):
+        do_backup_filesystem(config)
+    (data / "a.txt").write_text("changed", encoding="utf-8")
+    (data / "sub" / "deep" / "c.txt").unlink()
+
+    # When: Restoring the nested file
+    with use_config(config):
+        restored = do_restore_filesystem(config, paths=["sub/deep/c.txt"])
+
+    # Then: Only that file is restored
+    assert restored is True
+    assert (data / "sub" / "deep" / "c.txt").read_text(encoding="utf-8") == "c"
+    assert (data / "a.txt").read_text(encoding="utf-8") == "changed"
+
+
+@pytest.mark.parametrize("codec", ["gzip", "zstd", "none"])
+def test_restore_delta(tmp_path: Path, codec: str):
+    """Verify a delta restore rewrites changed files, deletes new ones and keeps the rest."""
+    # Given: A backup, after which one file changed, one was added and one was removed
+    config = _config(tmp_path, compression=codec, restore_mode="delta")
+    data = tmp_path / "data"
+    (data / "sub").mkdir()
+    (data / "a.txt").write_text("a", encoding="utf-8")
+    (data / "b.txt").write_text("b", encoding="utf-8")
+    (data / "sub" / "c.txt").write_text("c", encoding="utf-8")
+    with use_config(config):
+        do_backup_filesystem(config)
+    (data / "a.txt").write_text("modified", encoding="utf-8")
+    (data / "new.txt").write_text("new", encoding="utf-8")
+    (data / "sub" / "c.txt").unlink()
+    kept = (data / "b.txt").stat().st_ino
+
+    # When: Restoring in delta mode
+    with use_config(config):
+        restored = do_restore_filesystem(config)
+
+    # Then: The directory matches the backup and the unchanged file was not rewritten
+    assert restored is True
+    assert (data / "a.txt").read_text(encoding="utf-8") == "a"
+    assert (data / "sub" / "c.txt").read_text(encoding="utf-8") == "c"
+    assert not (data / "new.txt").exists()
+    assert (data / "b.txt").stat().st_ino == kept
+
+
+@pytest.fixture
+def fake_psql(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """Put a psql on the PATH that records its arguments and only applies a dump it read to the end.
+
+    Returns:
+        Path: The directory the fake psql records its arguments and the applied dump in.
+    """
+    record = tmp_path / "psql"
+    record.mkdir()
+    script = record / "psql"
+    script.write_text(
+        f'#!/bin/sh\nprintf "%s\\n" "$@" > {record}/args\ncat > {record}/received && touch {record}/applied\n',
+        encoding="utf-8",
+    )
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{record}{os.pathsep}{os.environ['PATH']}")
+    return record
+
+
+@pytest.mark.parametrize("truncated", [False, True])
+def test_restore_postgres_applies_only_complete_dumps(tmp_path: Path, fake_psql: Path, truncated):
+    """Verify a dump is applied in one transaction that stops at the first error, and a truncated dump is never handed to psql as complete."""
+    # Given: A compressed dump, possibly cut short
+    config = _config(tmp_path, use_postgres=True, postgres_db="app", postgres_user="app")
+    rng = random.Random(0)
+    dump = "".join(
+        f"INSERT INTO items VALUES ({i}, '{rng.randbytes(16).hex()}');\n"  # noqa: S608
+        for i in range(100_000)
+    ).encode()
+    compressed = gzip.compress(b"DROP TABLE IF EXISTS items;\n" + dump)
+    if truncated:
+        compressed = compressed[: len(compressed) // 2]
+    (tmp_path / "storage" / "job-postgres-20240101T000000-daily.sql.gz").write_bytes(compressed)
+
+    # When: Restoring it
+    with use_config(config):
+        restored = do_restore_postgres(config)
+
+    # Then: psql runs in a single transaction, and only applies the complete dump
+    args = (fake_psql / "args").read_text(encoding="utf-8").splitlines()
+    assert {"--single-transaction", "--variable=ON_ERROR_STOP=1"} <= set(args)
+    assert restored is not truncated
+    assert (fake_psql / "applied").exists() is not truncated
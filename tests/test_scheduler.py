@@ -0,0 +1,191 @@
+# type: ignore
+"""Test scheduled runs, their overlap policy and the run history."""
+
+import threading
+import time
+from pathlib import Path
+
+import pytest
+import sh
+from apscheduler.schedulers.blocking import BlockingScheduler
+
+from homelab_service_backup.modules import do_backup_filesystem, scheduler
+from homelab_service_backup.utils import (
+    Catalog,
+    Config,
+    JobsFile,
+    RunCancelledError,
+    RunHistory,
+    RunRecord,
+    cancellable,
+    check_cancelled,
+    use_config,
+    wait_for_command,
+)
+from homelab_service_backup.utils import history as history_module
+
+
+def _config(tmp_path: Path, **settings) -> Config:
+    """Build a scheduled backup job storing its backups in `tmp_path`."""
+    return Config.model_validate(
+        {
+            "action": "backup",
+            "job_name": "job",
+            "backup_storage_dir": tmp_path,
+            "log_to_file": False,
+            "schedule": True,
+            **settings,
+        }
+    )
+
+
+def _overlapping_runs(config: Config, monkeypatch, first_task) -> tuple[list[bool], list[str]]:
+    """Start a second run of a job while its first run is in progress.
+
+    Returns:
+        tuple[list[bool], list[str]]: The results of the first and second run, and the order the tasks started and finished in.
+    """
+    events: list[str] = []
+    started = threading.Event()
+    calls = iter(["first", "second"])
+
+    def task(config):
+        name = next(calls)
+        events.append(f"{name} start")
+        if name == "first":
+            started.set()
+            first_task()
+        events.append(f"{name} end")
+        return True
+
+    monkeypatch.setattr(scheduler, "get_task", lambda config: task)
+    runner = scheduler.JobRunner(JobsFile(jobs=[config]))
+    results: dict[str, bool] = {}
+
+    first = threading.Thread(target=lambda: results.update(first=runner.run(config)))
+    first.start()
+    started.wait()
+    results["second"] = runner.run(config)
+    first.join()
+
+    return [results["first"], results["second"]], events
+
+
+def test_overlap_skip(tmp_path: Path, monkeypatch):
+    """Verify a run is skipped while the previous run of the job is in progress."""
+    # Given: A job that skips overlapping runs, with a first run that waits to be released
+    config = _config(tmp_path, schedule_overlap="skip")
+    release = threading.Event()
+
+    def first_task():
+        # Released once the second run returned, which it must without waiting
+        release.wait(5)
+
+    threading.Timer(0.5, release.set).start()
+
+    # When: A second run starts while the first is in progress
+    results, events = _overlapping_runs(config, monkeypatch, first_task)
+
+    # Then: The second run was skipped before the first finished, and both are in the history
+    assert results == [True, False]
+    assert events == ["first start", "first end"]
+    assert [run.outcome for run in RunHistory(tmp_path).runs("job")] == ["skipped", "success"]
+
+
+def test_overlap_queue(tmp_path: Path, monkeypatch):
+    """Verify a run waits for the previous run of the job to finish."""
+    config = _config(tmp_path, schedule_overlap="queue")
+
+    results, events = _overlapping_runs(config, monkeypatch, lambda: time.sleep(0.3))
+
+    assert results == [True, True]
+    assert events == ["first start", "first end", "second start", "second end"]
+    runs = RunHistory(tmp_path).runs("job")
+    assert [run.outcome for run in runs] == ["success", "success"]
+    assert runs[0].duration >= 0.3
+
+
+def test_overlap_kill(tmp_path: Path, monkeypatch):
+    """Verify a run cancels the previous run of the job and starts once it stopped."""
+    # Given: A job that cancels overlapping runs, with a first run that would run for a long time
+    config = _config(tmp_path, schedule_overlap="kill")
+
+    def first_task():
+        for _ in range(500):
+            check_cancelled()
+            time.sleep(0.01)
+
+    # When: A second run starts while the first is in progress
+    results, events = _overlapping_runs(config, monkeypatch, first_task)
+
+    # Then: The first run stopped early and the second one ran after it
+    assert results == [False, True]
+    assert events == ["first start", "second start", "second end"]
+    runs = RunHistory(tmp_path).runs("job")
+    assert [run.outcome for run in runs] == ["cancelled", "success"]
+    assert runs[0].duration < 5
+
+
+def test_cancelled_backup_removes_partial_file(tmp_path: Path):
+    """Verify a cancelled backup stops without leaving an incomplete backup behind."""
+    # Given: A job with data to back up and a run that is already cancelled
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "file.txt").write_text("data")
+    (tmp_path / "storage").mkdir()
+    config = _config(tmp_path / "storage", job_data_dir=tmp_path / "data")
+    cancel = threading.Event()
+    cancel.set()
+
+    # When: Running the backup
+    with use_config(config), cancellable(cancel), pytest.raises(RunCancelledError):
+        do_backup_filesystem(config)
+
+    # Then: No backup was written or cataloged
+    assert not [path for path in (tmp_path / "storage").iterdir() if path.suffix == ".tgz"]
+    assert not Catalog(tmp_path / "storage").entries()
+
+
+def test_wait_for_command_terminates_cancelled_command():
+    """Verify an external command is terminated when its run is cancelled."""
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+    command = sh.sleep(30, _bg=True, _bg_exc=False)
+
+    start = time.perf_counter()
+    with cancellable(cancel), pytest.raises(RunCancelledError):
+        wait_for_command(command)
+
+    assert time.perf_counter() - start < 5
+    assert not command.is_alive()
+
+
+def test_add_cron_job_settings(tmp_path: Path):
+    """Verify jobs are scheduled with their jitter and misfire grace, coalescing missed runs."""
+    # Given: A scheduler that is not started
+    config = _config(
+        tmp_path, schedule_hour="2", schedule_jitter=30, schedule_misfire_grace=0, tz="Etc/UTC"
+    )
+    blocking = BlockingScheduler()
+
+    # When: Adding the job
+    scheduler._add_cron_job(blocking, scheduler.JobRunner(JobsFile(jobs=[config])), config)
+
+    # Then: The job's settings are applied and the runner decides about overlapping runs
+    job = blocking.get_jobs()[0]
+    assert job.name == "job"
+    assert job.trigger.jitter == 30
+    assert job.misfire_grace_time is None
+    assert job.coalesce is True
+    assert job.max_instances == 2
+
+
+def test_run_history_is_trimmed(tmp_path: Path, monkeypatch):
+    """Verify the run history keeps the most recent runs once it grows too long."""
+    monkeypatch.setattr(history_module, "HISTORY_KEEP", 2)
+    history = RunHistory(tmp_path)
+
+    for i in range(5):
+        history.add(RunRecord("job", "backup", float(i), 1.0, "success"))
+
+    assert [run.started for run in history.runs()] == [3.0, 4.0]
+    assert history.runs("other") == []
@@ -0,0 +1,58 @@
+# type: ignore
+"""Guard the CLI's cold start time."""
+
+import subprocess  # noqa: S404
+import sys
+
+LAZY_MODULES = ("apscheduler", "arrow", "inflect", "nclutils", "sh")
+BASELINE_MODULES = ("confz", "loguru", "pydantic", "rich", "typer", "zstandard")
+
+
+def _import_time(statement: str) -> float:
+    """Run an import in a fresh interpreter and return its cumulative import time in seconds."""
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    # Top level imports are indented by one space, their cumulative time includes everything they import
+    top_level = [
+        line.split("|")
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:") and "cumulative" not in line
+    ]
+    return (
+        sum(int(cumulative) for _, cumulative, name in top_level if not name.startswith("  ")) / 1e6
+    )
+
+
+def test_cli_import_does_not_load_heavy_modules():
+    """Verify importing the CLI leaves dependencies that only some runs need unloaded."""
+    # When: Importing the CLI in a fresh interpreter
+    result = subprocess.run(  # noqa: S603
+        [
+            sys.executable,
+            "-c",
+            "import sys, homelab_service_backup.cli; print(*sorted(sys.modules), sep='\\n')",
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    loaded = {module.split(".")[0] for module in result.stdout.splitlines()}
+
+    # Then: None of the lazily imported modules are loaded
+    assert loaded.isdisjoint(LAZY_MODULES)
+
+
+def test_cli_import_time():
+    """Verify importing the CLI costs little more than importing the libraries every run needs."""
+    # Given: The import time of the libraries the CLI can not start without
+    baseline = min(_import_time(f"import {', '.join(BASELINE_MODULES)}") for _ in range(3))
+
+    # When: Importing the CLI
+    cli = min(_import_time("import homelab_service_backup.cli") for _ in range(3))
+
+    # Then: The CLI's own modules add a bounded amount on top
+    assert cli < baseline * 1.5 + 0.25, f"CLI import took {cli:.2f}s, baseline {baseline:.2f}s"
@@ -0,0 +1,103 @@
+# type: ignore
+"""Test streaming decompressed data to external commands."""
+
+import gzip
+import io
+from contextlib import suppress
+from queue import Empty
+
+import pytest
+
+from homelab_service_backup.utils import StreamFeeder, format_bytes
+
+
+class _EndlessReader:
+    """A stream that never ends, to prove the feeder only reads as fast as it is consumed."""
+
+    def __init__(self):
+        self.bytes_read = 0
+
+    def read(self, size: int) -> bytes:
+        self.bytes_read += size
+        return b"x" * size
+
+
+class _Command:
+    """A command that records being killed."""
+
+    def __init__(self):
+        self.killed = False
+
+    def kill(self):
+        self.killed = True
+
+
+def _drain(feeder: StreamFeeder) -> bytes:
+    """Consume a feeder's queue until the end-of-stream marker."""
+    chunks = []
+    while (chunk := feeder.queue.get()) is not None:
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def _consume_until_idle(feeder: StreamFeeder, command: _Command, received: list) -> None:
+    """Attach a command to a feeder and collect what it queues until nothing arrives for a second."""
+    with feeder:
+        feeder.attach(command)
+        with suppress(Empty):
+            while True:
+                received.append(feeder.queue.get(timeout=1))
+
+
+def test_stream_feeder_streams_decompressed_data():
+    """Verify the feeder yields the whole decompressed stream in bounded chunks."""
+    # Given: A gzip stream of several chunks
+    data = bytes(range(256)) * 4096
+    reader = gzip.GzipFile(fileobj=io.BytesIO(gzip.compress(data)))
+
+    # When: Draining the feeder
+    with StreamFeeder(reader, label="Test", chunk_size=64 * 1024) as feeder:
+        received = _drain(feeder)
+
+    # Then: The data arrives intact and is counted
+    assert received == data
+    assert feeder.bytes_read == len(data)
+
+
+def test_stream_feeder_bounds_memory():
+    """Verify the feeder stops reading ahead once its queue is full, and stops when abandoned."""
+    # Given: A stream that never ends
+    reader = _EndlessReader()
+
+    # When: Reading a single chunk and leaving the feeder
+    with StreamFeeder(reader, label="Test", chunk_size=1024, max_chunks=4) as feeder:
+        feeder.queue.get()
+
+    # Then: Only the consumed chunk plus a full queue was read
+    assert reader.bytes_read <= 1024 * 6
+
+
+def test_stream_feeder_raises_read_errors():
+    """Verify a read error kills the consuming command instead of ending the stream, and is raised when the feeder exits."""
+    # Given: A truncated gzip stream and a command consuming it
+    reader = gzip.GzipFile(fileobj=io.BytesIO(gzip.compress(b"x" * 100_000)[:-20]))
+    command = _Command()
+
+    received = []
+
+    # When: Reading everything the feeder queues
+    with pytest.raises(EOFError):
+        _consume_until_idle(StreamFeeder(reader, label="Test"), command, received)
+
+    # Then: The stream never ended and the command was killed
+    assert None not in received
+    assert command.killed
+
+
+@pytest.mark.parametrize(
+    ("size", "expected"),
+    [(0, "0 B"), (1023, "1023 B"), (1024, "1.0 KiB"), (5 * 1024**3, "5.0 GiB")],
+)
+def test_format_bytes(size: int, expected: str):
+    """Verify byte counts are formatted with binary units."""
+    assert format_bytes(size) == expected
@@ -0,0 +1,148 @@
+# type: ignore
+"""Test the constant-memory tar writer."""
+
+import io
+import multiprocessing
+import os
+import re
+import tarfile
+import zlib
+from pathlib import Path
+
+import pytest
+
+from homelab_service_backup.utils import TarWriter, WalkEntry, add_to_tar, walk_directory
+
+MIB = 1024 * 1024
+SYNTHETIC_FILES = 1_000_000
+RSS_CAP = 150 * MIB  # A spawned interpreter with the package imported takes about 60 MiB
+INCREMENTAL_FILES = 100_000
+INCREMENTAL_BYTES_PER_FILE = 1024  # The manifest costs about 450 bytes per file
+
+
+def test_matches_tarfile(tmp_path: Path):
+    """Verify the writer produces the same bytes as tarfile for every kind of member."""
+    # Given: A directory with data, empty, hard linked, symlinked, long and non-ASCII names
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "file.txt").write_bytes(os.urandom(3000))
+    (tmp_path / "empty").touch()
+    os.link(tmp_path / "sub" / "file.txt", tmp_path / "hardlink.txt")
+    (tmp_path / "symlink").symlink_to("sub/file.txt")
+    (tmp_path / ("long" * 40)).write_text("long name")
+    (tmp_path / "grüße.txt").write_text("unicode")
+    entries = list(walk_directory(tmp_path))
+
+    # When: Archiving the entries with the writer and with tarfile
+    actual = io.BytesIO()
+    with TarWriter(actual) as tar:
+        checksums = {
+            info.name: checksum for info, checksum in (add_to_tar(tar, e) for e in entries)
+        }
+    expected = io.BytesIO()
+    with tarfile.open(fileobj=expected, mode="w") as reference:
+        for entry in entries:
+            reference.add(entry.path, arcname=str(entry.relative), recursive=False)
+
+    # Then: The archives are identical and the checksums match the data
+    assert actual.getvalue() == expected.getvalue()
+    assert checksums["hardlink.txt"] == zlib.crc32((tmp_path / "sub" / "file.txt").read_bytes())
+    assert checksums["empty"] == 0
+    assert checksums["sub"] is None
+
+
+def test_short_file_fails(tmp_path: Path):
+    """Verify a file that is shorter than its header says fails the archive instead of corrupting it."""
+    info = tarfile.TarInfo("shrunk")
+    info.size = 100
+
+    with TarWriter(io.BytesIO()) as tar, pytest.raises(OSError, match="unexpected end of data"):
+        tar.addfile(info, io.BytesIO(b"only 13 bytes"))
+
+
+def _synthetic_tree(data: Path, count: int):
+    """Yield walker entries for `count` empty files in directories of 1000, without creating them."""
+    file_stat = (data / "empty").lstat()
+    dir_stat = data.lstat()
+    for i in range(count):
+        directory = Path(f"d{i // 1000:04}")
+        if i % 1000 == 0:
+            yield WalkEntry(data, directory, dir_stat)
+        yield WalkEntry(data / "empty", directory / f"f{i:07}", file_stat)
+
+
+def _back_up_synthetic_tree(
+    storage: Path, data: Path, count: int, backup_mode: str = "full"
+) -> None:
+    """Back up a synthetic tree in a fresh process, writing its peak RSS to a file in `storage`."""
+    from loguru import logger  # noqa: PLC0415
+
+    from homelab_service_backup.modules import backup  # noqa: PLC0415
+    from homelab_service_backup.utils import Config, use_config  # noqa: PLC0415
+
+    logger.remove()
+    backup._iter_backup_files = lambda config, source_dir: _synthetic_tree(data, count)
+    config = Config.model_validate(
+        {
+            "action": "backup",
+            "job_name": "job",
+            "backup_storage_dir": storage,
+            "job_data_dir": data,
+            "backup_mode": backup_mode,
+            "compression": "zstd",
+            "compression_level": 1,
+            "log_to_file": False,
+            "log_level": "WARNING",
+        }
+    )
+    with use_config(config):
+        assert backup.do_backup_filesystem(config)
+
+    # ru_maxrss survives the exec of a spawned process and would include the parent's peak
+    status = Path("/proc/self/status").read_text(encoding="utf-8")
+    peak = re.search(r"VmHWM:\s+(\d+) kB", status).group(1)
+    (storage / "rss").write_text(str(int(peak) * 1024))
+
+
+def _peak_rss(root: Path, count: int, backup_mode: str = "full") -> int:
+    """Back up a synthetic tree of `count` files below `root` in a spawned process.
+
+    Returns:
+        int: The peak RSS of the process, in bytes.
+    """
+    (root / "storage").mkdir(parents=True)
+    (root / "data").mkdir()
+    (root / "data" / "empty").touch()
+
+    process = multiprocessing.get_context("spawn").Process(
+        target=_back_up_synthetic_tree,
+        args=(root / "storage", root / "data", count, backup_mode),
+    )
+    process.start()
+    process.join()
+
+    assert process.exitcode == 0
+    return int((root / "storage" / "rss").read_text())
+
+
+def test_memory_is_constant(tmp_path: Path):
+    """Verify backing up a million files stays under a fixed RSS cap."""
+    # Given: A synthetic tree of a million empty files
+    # When: Backing it up in a fresh process
+    peak = _peak_rss(tmp_path, SYNTHETIC_FILES)
+
+    # Then: The backup succeeded without its memory growing with the number of files
+    assert peak < RSS_CAP
+
+
+def test_incremental_memory_per_file(tmp_path: Path):
+    """Verify an incremental backup's manifest costs a bounded amount of memory per file.
+
+    Incremental jobs keep the state of every file in memory to write the manifest, so unlike full backups their memory grows with the number of files.
+    """
+    # Given: Two synthetic trees that differ by INCREMENTAL_FILES files
+    # When: Backing each up in incremental mode in a fresh process
+    small = _peak_rss(tmp_path / "small", INCREMENTAL_FILES, backup_mode="incremental")
+    large = _peak_rss(tmp_path / "large", 2 * INCREMENTAL_FILES, backup_mode="incremental")
+
+    # Then: Each additional file costs less than the documented budget
+    assert (large - small) / INCREMENTAL_FILES < INCREMENTAL_BYTES_PER_FILE
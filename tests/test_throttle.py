@@ -0,0 +1,143 @@
+# type: ignore
+"""Test bandwidth limits and lowered priorities."""
+
+import io
+import os
+import threading
+import time
+from pathlib import Path
+
+from homelab_service_backup.modules import do_backup_filesystem, scheduler
+from homelab_service_backup.utils import (
+    Config,
+    TokenBucket,
+    get_io_priority,
+    io_limits,
+    limit_reads,
+    limit_writes,
+    lower_priority,
+    use_config,
+)
+
+MIB = 1024 * 1024
+
+
+def _config(tmp_path: Path, **settings) -> Config:
+    """Build a backup job storing its backups in `tmp_path`."""
+    return Config.model_validate(
+        {"action": "backup", "job_name": "job", "backup_storage_dir": tmp_path, **settings}
+    )
+
+
+def _in_thread(func):
+    """Run a function on a new thread, so priorities lowered by it do not stick to the test thread.
+
+    Returns:
+        Any: What the function returned.
+    """
+    result = []
+    thread = threading.Thread(target=lambda: result.append(func()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def test_token_bucket_limits_rate():
+    """Verify bytes taken beyond the burst are spread out at the configured rate."""
+    # Given: A bucket of 1 MiB/s without any burst
+    bucket = TokenBucket(MIB, burst=0)
+
+    # When: Taking half a MiB in pieces
+    start = time.perf_counter()
+    for _ in range(4):
+        bucket.consume(MIB // 8)
+
+    # Then: It took as long as the rate requires
+    assert time.perf_counter() - start >= 0.45
+
+
+def test_limits_apply_to_wrapped_files(tmp_path: Path):
+    """Verify files are only wrapped when the job has a limit and wrapped reads are slowed down."""
+    # Given: A job reading at 2 MiB/s, which may burst a quarter of a second's worth
+    data = os.urandom(MIB + MIB // 4)
+    config = _config(tmp_path, io_read_limit="2M")
+    assert config.io_read_limit == 2 * MIB
+
+    # When: Reading more than the burst through the job's limits
+    with io_limits(config):
+        reader = limit_reads(io.BytesIO(data))
+        writer = limit_writes(io.BytesIO())
+        start = time.perf_counter()
+        assert reader.read() == data
+        elapsed = time.perf_counter() - start
+
+    # Then: Only reads were limited, to the configured rate
+    assert isinstance(writer, io.BytesIO)
+    assert elapsed >= 0.35
+    assert isinstance(limit_reads(io.BytesIO()), io.BytesIO)
+
+
+def test_throttled_backup(tmp_path: Path):
+    """Verify a backup reads its source no faster than the read limit."""
+    # Given: A job with more data than its read limit allows in a burst
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "file.bin").write_bytes(os.urandom(MIB + MIB // 4))
+    (tmp_path / "storage").mkdir()
+    config = _config(tmp_path / "storage", job_data_dir=tmp_path / "data", io_read_limit=2 * MIB)
+
+    # When: Running the backup
+    start = time.perf_counter()
+    with use_config(config), io_limits(config):
+        backup_file = do_backup_filesystem(config)
+
+    # Then: It was written, slowed down to the read limit
+    assert backup_file.exists()
+    assert time.perf_counter() - start >= 0.35
+
+
+def test_lower_priority(tmp_path: Path):
+    """Verify the nice value, scheduling policy and I/O class of the calling thread are lowered."""
+    config = _config(tmp_path, nice=5, ionice="idle", sched_idle=True)
+
+    def lower():
+        before = os.getpriority(os.PRIO_PROCESS, 0)
+        lower_priority(config)
+        return (
+            before,
+            os.getpriority(os.PRIO_PROCESS, 0),
+            os.sched_getscheduler(0),
+            get_io_priority(),
+        )
+
+    before, after, policy, io_priority = _in_thread(lower)
+
+    assert after == min(before + 5, 19)
+    assert policy == os.SCHED_IDLE
+    assert io_priority in {None, 3 << 13}
+
+
+def test_run_task_lowers_only_the_job(tmp_path: Path, monkeypatch):
+    """Verify a job with a lower priority runs on its own thread and leaves the caller's priority alone."""
+    # Given: A job with a higher nice value
+    config = _config(tmp_path, nice=3)
+    seen = {}
+
+    def task(config):
+        seen["nice"] = os.getpriority(os.PRIO_PROCESS, 0)
+        seen["job"] = config.job_name
+        return True
+
+    monkeypatch.setattr(scheduler, "get_task", lambda config: task)
+
+    def run():
+        before = os.getpriority(os.PRIO_PROCESS, 0)
+        result = scheduler.run_task(config)
+        return before, result, os.getpriority(os.PRIO_PROCESS, 0)
+
+    # When: Running it
+    before, result, after = _in_thread(run)
+
+    # Then: The task ran lowered and the calling thread was not changed
+    assert result is True
+    assert seen == {"nice": min(before + 3, 19), "job": "job"}
+    assert after == before
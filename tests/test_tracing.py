@@ -0,0 +1,144 @@
+# type: ignore
+"""Test run traces, run reports and their OpenTelemetry export."""
+
+import json
+from pathlib import Path
+
+import pytest
+
+from homelab_service_backup.modules import do_backup_filesystem, do_restore_filesystem
+from homelab_service_backup.utils import (
+    Config,
+    count_span,
+    get_report_path,
+    span,
+    traced,
+    use_config,
+)
+
+
+def _config(tmp_path: Path, **settings) -> Config:
+    """Build a job backing up `tmp_path/data` to `tmp_path/storage`, creating both."""
+    (tmp_path / "data").mkdir(exist_ok=True)
+    (tmp_path / "storage").mkdir(exist_ok=True)
+    return Config.model_validate(
+        {
+            "action": "backup",
+            "job_name": "job",
+            "backup_storage_dir": tmp_path / "storage",
+            "job_data_dir": tmp_path / "data",
+            "log_to_file": False,
+            **settings,
+        }
+    )
+
+
+def _fill(data: Path) -> None:
+    """Create a small tree of files to back up."""
+    (data / "sub").mkdir()
+    for i in range(4):
+        (data / "sub" / f"{i}.txt").write_text("x" * 5000)
+    (data / "top.txt").write_text("top")
+
+
+def _read_traces(path: Path) -> list[list[dict]]:
+    """Read the spans of every run in an OTLP JSON lines file.
+
+    Returns:
+        list[list[dict]]: The spans of each run, in the order the runs were exported.
+    """
+    return [
+        json.loads(line)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        for line in path.read_text(encoding="utf-8").splitlines()
+    ]
+
+
+def test_backup_writes_run_report(tmp_path: Path):
+    """Verify a backup writes a report of its phases and what each did next to the backup."""
+    # Given: A job with run reports enabled
+    config = _config(tmp_path, run_report=True)
+    _fill(tmp_path / "data")
+
+    # When: Backing it up
+    with use_config(config):
+        backup = do_backup_filesystem(config)
+
+    # Then: The report has the run and its archive and retention phases with their counters
+    report = json.loads(get_report_path(backup).read_text(encoding="utf-8"))
+    spans = {entry["name"]: entry for entry in report["spans"]}
+    assert report["run"] == "backup"
+    assert report["job"] == "job"
+    assert set(spans) == {"backup", "archive", "retention"}
+    assert spans["archive"]["parent_id"] == spans["backup"]["span_id"]
+    archive = spans["archive"]["counters"]
+    assert archive["files"] == 5
+    assert archive["directories"] == 2
+    assert archive["stat_calls"] == 6
+    assert archive["read_bytes"] > 20_000
+    assert {"walk_seconds", "compress_seconds", "write_seconds"} <= set(archive)
+    assert report["duration"] >= spans["archive"]["duration"]
+
+
+def test_no_report_by_default(tmp_path: Path):
+    """Verify runs are not traced unless a report or trace file is configured."""
+    config = _config(tmp_path)
+    _fill(tmp_path / "data")
+
+    with use_config(config):
+        backup = do_backup_filesystem(config)
+
+    assert not get_report_path(backup).exists()
+    with span("phase") as current:
+        assert current is None
+
+
+def test_trace_file_exports_runs(tmp_path: Path):
+    """Verify backups and restores are appended to the trace file as OTLP JSON spans."""
+    # Given: A job exporting its runs to a trace file
+    trace_file = tmp_path / "trace.jsonl"
+    config = _config(tmp_path, trace_file=str(trace_file))
+    _fill(tmp_path / "data")
+
+    # When: Backing it up and restoring it
+    with use_config(config):
+        do_backup_filesystem(config)
+        do_restore_filesystem(config)
+
+    # Then: Each run is one line, with every span in one trace under the run's span
+    backup, restore = _read_traces(trace_file)
+    assert [entry["name"] for entry in backup] == ["backup", "archive", "retention"]
+    assert [entry["name"] for entry in restore] == ["restore", "clean", "extract"]
+    for spans in (backup, restore):
+        root = spans[0]
+        assert len(root["traceId"]) == 32
+        assert len(root["spanId"]) == 16
+        assert not root["parentSpanId"]
+        assert {entry["traceId"] for entry in spans} == {root["traceId"]}
+        assert {entry["parentSpanId"] for entry in spans[1:]} == {root["spanId"]}
+        assert all(entry["status"] == {"code": 1} for entry in spans)
+    extract = {item["key"]: item["value"] for item in restore[2]["attributes"]}
+    assert extract["hsb.files"] == {"intValue": "5"}
+
+
+def test_failed_phase_is_recorded(tmp_path: Path):
+    """Verify a phase that raises marks its span and the run's span as failed, and the run is still exported."""
+    # Given: A traced task whose phase fails
+    trace_file = tmp_path / "trace.jsonl"
+    config = _config(tmp_path, trace_file=str(trace_file))
+
+    @traced("backup")
+    def task(config):
+        with span("phase"):
+            count_span(items=3)
+            msg = "broken"
+            raise ValueError(msg)
+
+    # When: Running it
+    with use_config(config), pytest.raises(ValueError, match="broken"):
+        task(config)
+
+    # Then: Both spans carry the error and the phase kept its counters
+    [[run, phase]] = _read_traces(trace_file)
+    assert run["status"] == {"code": 2, "message": "ValueError: broken"}
+    assert phase["status"] == {"code": 2, "message": "ValueError: broken"}
+    assert phase["attributes"] == [{"key": "hsb.items", "value": {"intValue": "3"}}]
@@ -0,0 +1,196 @@
+# type: ignore
+"""Test digest manifests and verifying backups."""
+
+import gzip
+import os
+from pathlib import Path
+
+import pytest
+from loguru import logger
+
+from homelab_service_backup.modules import do_backup_filesystem, do_verify
+from homelab_service_backup.modules import verify as verify_module
+from homelab_service_backup.utils import (
+    Config,
+    DigestManifestError,
+    DigestReader,
+    file_digest,
+    get_catalog,
+    get_digests_path,
+    use_config,
+)
+
+
+def _config(tmp_path: Path, **settings) -> Config:
+    """Build a job backing up `tmp_path/data` to `tmp_path/storage`."""
+    return Config.model_validate(
+        {
+            "action": "verify",
+            "job_name": "job",
+            "backup_storage_dir": tmp_path / "storage",
+            "job_data_dir": tmp_path / "data",
+            "log_to_file": False,
+            "signing_key": "secret",
+            **settings,
+        }
+    )
+
+
+def _catalog_checksum(tmp_path: Path, backup: Path) -> str:
+    """Look up the SHA-256 the catalog recorded for a backup."""
+    return get_catalog(_config(tmp_path)).entries()[backup.name].checksum
+
+
+@pytest.fixture
+def backup(tmp_path: Path) -> Path:
+    """Back up a directory of files with a signed digest manifest."""
+    (tmp_path / "data" / "sub").mkdir(parents=True)
+    (tmp_path / "storage").mkdir()
+    for name in ("same.txt", "touched.txt", "edited.txt", "deleted.txt"):
+        (tmp_path / "data" / name).write_text(f"contents of {name}")
+    (tmp_path / "data" / "sub" / "large.bin").write_bytes(os.urandom(300_000))
+    (tmp_path / "data" / "empty").touch()
+
+    config = _config(tmp_path, compression="none")
+    with use_config(config):
+        return do_backup_filesystem(config)
+
+
+@pytest.fixture
+def messages():
+    """Collect the messages logged during a test.
+
+    Yields:
+        list[str]: The messages, each ending in a newline.
+    """
+    collected = []
+    handler = logger.add(collected.append, format="{message}", level="INFO")
+    yield collected
+    logger.remove(handler)
+
+
+def test_digests_written_with_backup(tmp_path: Path, backup: Path):
+    """Verify the digest manifest lists every regular file with its digest and the archive's checksum."""
+    with DigestReader(backup, key="secret") as digests:
+        entries = {entry.name: entry for entry in digests}
+
+    assert set(entries) == {
+        "same.txt",
+        "touched.txt",
+        "edited.txt",
+        "deleted.txt",
+        "sub/large.bin",
+        "empty",
+    }
+    assert entries["sub/large.bin"].digest == file_digest(tmp_path / "data" / "sub" / "large.bin")
+    assert entries["empty"].size == 0
+    assert digests.archive == _catalog_checksum(tmp_path, backup)
+
+
+def test_intact_backup_verifies(tmp_path: Path, backup: Path):
+    """Verify an untouched backup passes."""
+    config = _config(tmp_path)
+
+    with use_config(config):
+        assert do_verify(config) is True
+
+
+def test_damaged_file_fails(tmp_path: Path, backup: Path, messages):
+    """Verify a damaged file in an archive is reported by name."""
+    # Given: An archive with a byte of one file changed
+    data = backup.read_bytes()
+    position = data.index(b"contents of same.txt")
+    backup.write_bytes(data[:position] + b"C" + data[position + 1 :])
+    config = _config(tmp_path)
+
+    # When: Verifying it
+    with use_config(config):
+        result = do_verify(config)
+
+    # Then: The file and the archive checksum are reported
+    assert result is False
+    assert f"{backup.name}: Digest mismatch: same.txt\n" in messages
+    assert f"{backup.name}: Archive checksum does not match\n" in messages
+
+
+@pytest.mark.parametrize(
+    ("key", "error"),
+    [
+        ("other", "signature does not match"),
+        ("", "is signed, set HSB_SIGNING_KEY"),
+    ],
+)
+def test_manifest_needs_the_signing_key(tmp_path: Path, backup: Path, key: str, error: str):
+    """Verify a manifest is only trusted with the key it was signed with."""
+    with (
+        DigestReader(backup, key=key) as digests,
+        pytest.raises(DigestManifestError, match=error),
+    ):
+        list(digests)
+
+
+def test_tampered_manifest_fails(tmp_path: Path, backup: Path, messages):
+    """Verify a digest changed in the manifest breaks its signature."""
+    # Given: A manifest whose digest for a file was replaced with that of other data
+    path = get_digests_path(backup)
+    lines = gzip.decompress(path.read_bytes()).splitlines(keepends=True)
+    original = file_digest(tmp_path / "data" / "same.txt")
+    (tmp_path / "forged").write_text("forged")
+    lines = [
+        line.replace(original.encode(), file_digest(tmp_path / "forged").encode()) for line in lines
+    ]
+    path.write_bytes(gzip.compress(b"".join(lines)))
+    config = _config(tmp_path)
+
+    # When: Verifying the backup
+    with use_config(config):
+        result = do_verify(config)
+
+    # Then: It fails on the signature
+    assert result is False
+    assert any("signature does not match" in message for message in messages)
+
+
+def test_compare_with_source(tmp_path: Path, backup: Path, monkeypatch, messages):
+    """Verify only files whose stat changed are read again, and only changed contents are reported."""
+    # Given: Source files touched, edited in place and deleted since the backup
+    data = tmp_path / "data"
+    os.utime(data / "touched.txt", ns=(0, 1_000_000_000))
+    (data / "edited.txt").write_text("CONTENTS of edited.txt")
+    os.utime(data / "edited.txt", ns=(0, 2_000_000_000))
+    (data / "deleted.txt").unlink()
+    hashed = []
+    monkeypatch.setattr(
+        verify_module, "file_digest", lambda path: hashed.append(path.name) or file_digest(path)
+    )
+    config = _config(tmp_path, verify_source=True)
+
+    # When: Verifying the backup against the job data directory
+    with use_config(config):
+        result = do_verify(config)
+
+    # Then: The backup is intact, and the edited and deleted files are reported
+    assert result is True
+    assert sorted(hashed) == ["edited.txt", "touched.txt"]
+    assert [message for message in messages if message.startswith("Changed")] == [
+        "Changed since the backup: deleted.txt\n",
+        "Changed since the backup: edited.txt\n",
+    ]
+
+
+def test_snapshot_only_job_passes(tmp_path: Path, messages):
+    """Verify a repository job passes when its snapshots are the only backups to verify."""
+    # Given: A job that only has repository snapshots
+    (tmp_path / "data").mkdir()
+    (tmp_path / "storage").mkdir()
+    (tmp_path / "data" / "file.txt").write_text("contents")
+    config = _config(tmp_path, backup_mode="repository")
+    with use_config(config):
+        do_backup_filesystem(config)
+
+        # When: Verifying the job
+        verified = do_verify(config)
+
+    # Then: The run passes with nothing verified
+    assert verified is True
+    assert any("Nothing to verify" in message for message in messages)
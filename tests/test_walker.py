@@ -0,0 +1,83 @@
+# type: ignore
+"""Test the backup directory walker."""
+
+import io
+import os
+import tarfile
+from pathlib import Path
+
+from homelab_service_backup.utils import TarWriter, add_to_tar, walk_directory
+from homelab_service_backup.utils.walker import build_tarinfo
+
+
+def test_walk_directory_prunes_excluded(tmp_path: Path):
+    """Verify excluded directories are skipped along with everything beneath them."""
+    # Given: A tree containing excluded directories and files
+    (tmp_path / "keep" / "@eaDir" / "deep").mkdir(parents=True)
+    (tmp_path / "keep" / "@eaDir" / "deep" / "thumb.jpg").touch()
+    (tmp_path / "keep" / "file.txt").touch()
+    (tmp_path / "keep" / ".DS_Store").touch()
+    (tmp_path / "__pycache__").mkdir()
+    (tmp_path / "__pycache__" / "mod.pyc").touch()
+    (tmp_path / "a.txt").touch()
+
+    # When: Walking the tree
+    entries = list(walk_directory(tmp_path))
+
+    # Then: Only included entries are yielded, parents before children
+    assert [str(entry.relative) for entry in entries] == ["a.txt", "keep", "keep/file.txt"]
+    assert entries[2].path == tmp_path / "keep" / "file.txt"
+    assert entries[2].stat.st_ino == (tmp_path / "keep" / "file.txt").stat().st_ino
+
+
+def test_walk_directory_does_not_follow_symlinks(tmp_path: Path):
+    """Verify symlinks to directories are yielded but not descended into."""
+    # Given: A symlink pointing at a directory
+    (tmp_path / "target").mkdir()
+    (tmp_path / "target" / "file.txt").touch()
+    (tmp_path / "link").symlink_to("target")
+
+    # When: Walking the tree
+    relative = [str(entry.relative) for entry in walk_directory(tmp_path)]
+
+    # Then: The link appears once and its target's contents only under the real directory
+    assert relative == ["link", "target", "target/file.txt"]
+
+
+def test_build_tarinfo_matches_tarfile(tmp_path: Path):
+    """Verify headers built from walker entries match the ones tarfile builds for files, links and directories."""
+    # Given: A directory with a file, a hard link, a symlink and a subdirectory
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "file.txt").write_text("hello")
+    os.link(tmp_path / "sub" / "file.txt", tmp_path / "hardlink.txt")
+    (tmp_path / "symlink").symlink_to("sub/file.txt")
+
+    # When: Building headers from the walker's entries and with tarfile
+    inodes = {}
+    with tarfile.open(fileobj=io.BytesIO(), mode="w") as reference:
+        for entry in walk_directory(tmp_path):
+            actual = build_tarinfo(entry, inodes)
+            expected = reference.gettarinfo(entry.path, arcname=str(entry.relative))
+
+            # Then: Every header matches
+            assert actual.get_info() == expected.get_info()
+
+
+def test_add_to_tar_roundtrip(tmp_path: Path):
+    """Verify files added from walker entries extract with their contents."""
+    # Given: A directory with a file and a hard link to it
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "file.txt").write_text("hello")
+    os.link(tmp_path / "sub" / "file.txt", tmp_path / "hardlink.txt")
+
+    # When: Archiving the walker's entries
+    buffer = io.BytesIO()
+    with TarWriter(buffer) as tar:
+        for entry in walk_directory(tmp_path):
+            add_to_tar(tar, entry)
+
+    # Then: The first copy holds the data and the second is a hard link to it
+    buffer.seek(0)
+    with tarfile.open(fileobj=buffer, mode="r:") as tar:
+        assert tar.getmember("sub/file.txt").linkname == "hardlink.txt"
+        assert tar.extractfile("hardlink.txt").read() == b"hello"